@@ -0,0 +1,135 @@
+# bench_cluster.py
+# วัดการ scale ของโหมด cluster (p2p_directory.py + serverp2p.py --directory) บน loopback
+# แต่ละรอบเริ่ม Directory 1 ตัวและ relay node ตามจำนวนที่กำหนด (process แยก, คนละ Control Port/Pool บนเครื่องเดียว)
+# เปิดหลายอุโมงค์ผ่าน Directory (clientp2p + echo service ของตัวเองต่ออุโมงค์) แล้วให้ผู้เล่นจำลองส่งก้อนใหญ่เต็มกำลัง
+# รายงาน throughput รวม, latency, จำนวนอุโมงค์ที่ Directory แจกให้แต่ละ node และ CPU ของแต่ละ node
+#
+# หมายเหตุ: เหมือน bench_workers.py ตัวเลขจะ scale ได้ก็ต่อเมื่อเครื่องมี core พอสำหรับทุก node และทุกฝั่งของการทดสอบ
+#
+# Usage: python benchmarks/bench_cluster.py [--nodes 1,2,4] [--tunnels 8] [--duration 10] [--engine asyncio]
+#            [--out result.json]
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_relay import _start, _stop, process_usage, summarize # noqa: E402
+from bench_workers import _merge_peer_stats, drive_tunnel # noqa: E402
+
+
+def wait_for_nodes(directory, count, timeout=15):
+    """รอจน Directory ได้รายงานแรกจากครบทุก node (ก่อนนั้นอุโมงค์จะไปกองที่ node ที่มาถึงก่อน)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if sum('Node joined' in line for line in directory.lines) >= count:
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"only {sum('Node joined' in line for line in directory.lines)}/{count} nodes joined the directory")
+
+
+def run_round(node_count, options):
+    directory, _ = _start(['p2p_directory.py', '--control-port', str(options.base_port)], r'Directory listening')
+    processes = [directory]
+    nodes = []
+    try:
+        for index in range(node_count):
+            control = options.base_port + 100 * (index + 1)
+            node, _ = _start(['serverp2p.py', '--engine', options.engine, '--control-port', str(control),
+                              '--port-range', f"{control + 1}-{control + 99}", '--node-name', f"node{index}",
+                              '--directory', f"127.0.0.1:{options.base_port}", '--load-report-interval', '0.5']
+                             + options.server_args.split(), r'Server Control listening')
+            processes.append(node)
+            nodes.append(node)
+        wait_for_nodes(directory, node_count)
+
+        addrs = []
+        for _ in range(options.tunnels):
+            service, match = _start([os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_relay.py'),
+                                     '--serve', 'echo'], r'port (\d+)')
+            processes.append(service)
+            client, match = _start(['clientp2p.py', '127.0.0.1', str(options.base_port), match.group(1)], r'Port: (\d+)')
+            processes.append(client)
+            addrs.append(('127.0.0.1', int(match.group(1))))
+        time.sleep(0.5)
+
+        pids = [node.pid for node in nodes]
+        before = {pid: process_usage(pid) for pid in pids}
+        results = multiprocessing.Queue()
+        started = time.monotonic()
+        stop_at = started + options.duration
+        drivers = [multiprocessing.Process(target=drive_tunnel,
+                                           args=(addr, options.peers, options.size, options.window, stop_at, results))
+                   for addr in addrs]
+        for driver in drivers:
+            driver.start()
+        rows = [row for _ in drivers for row in results.get()]
+        for driver in drivers:
+            driver.join()
+        elapsed = time.monotonic() - started
+        after = {pid: process_usage(pid) for pid in pids}
+    finally:
+        for proc in reversed(processes):
+            _stop(proc)
+
+    placed = [len(re.findall(rf'on node node{index} ', ''.join(directory.lines))) for index in range(node_count)]
+    result = summarize(_merge_peer_stats(rows), options.duration)
+    result.update({
+        'nodes': node_count,
+        'elapsed_s': round(elapsed, 2),
+        'tunnels_per_node': placed,
+        'node_cpu_s': [round(after[pid]['cpu_s'] - before[pid]['cpu_s'], 3) if before.get(pid) and after.get(pid) else None
+                       for pid in pids],
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate throughput of a directory-balanced relay cluster vs node count")
+    parser.add_argument('--nodes', default='1,2,4', help="comma separated relay node counts")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--tunnels', type=int, default=8, help="tunnels (client + echo service pairs) per round")
+    parser.add_argument('--peers', type=int, default=2, help="players per tunnel")
+    parser.add_argument('--size', type=int, default=65536, help="message size in bytes")
+    parser.add_argument('--window', type=int, default=16, help="messages in flight per player")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per round")
+    parser.add_argument('--server-args', default='', help="extra arguments for every serverp2p.py node")
+    parser.add_argument('--base-port', type=int, default=19000,
+                        help="directory port; node N uses control port base+100*(N+1) and the 99 ports after it")
+    parser.add_argument('--out', help="write the JSON result to this file (default: stdout)")
+    options = parser.parse_args()
+
+    result = {
+        'meta': {'engine': options.engine, 'tunnels': options.tunnels, 'peers_per_tunnel': options.peers,
+                 'size': options.size, 'duration_s': options.duration, 'server_args': options.server_args,
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'rounds': [],
+    }
+    for node_count in (int(count) for count in options.nodes.split(',')):
+        print(f"[bench] nodes={node_count}", file=sys.stderr)
+        result['rounds'].append(run_round(node_count, options))
+        time.sleep(1) # ให้ Port ของรอบก่อนปิดให้หมด
+
+    baseline = result['rounds'][0]['throughput_mbps'] / result['rounds'][0]['nodes'] or None
+    print(f"{'nodes':>5} {'Mbps':>10} {'p99 ms':>9} {'errors':>7} {'efficiency':>10}  tunnels/node  node cpu_s", file=sys.stderr)
+    for row in result['rounds']:
+        row['scaling_efficiency'] = round(row['throughput_mbps'] / (row['nodes'] * baseline), 3) if baseline else None
+        p99 = (row['latency_ms'] or {}).get('p99')
+        print(f"{row['nodes']:>5} {row['throughput_mbps']:>10} {p99!s:>9} {row['errors']:>7} "
+              f"{row['scaling_efficiency']!s:>10}  {row['tunnels_per_node']}  {row['node_cpu_s']}", file=sys.stderr)
+
+    text = json.dumps(result, indent=2)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# bench_frames.py
+# Micro-benchmark: ตัวแกะ Frame แบบเดิม (data += chunk) เทียบกับ FrameDecoder (recv_into)
+# วัด frames/sec และหน่วยความจำชั่วคราวสูงสุดที่ถูกจองต่อ 1 Frame (tracemalloc)
+#
+# Usage: python benchmarks/bench_frames.py [--frames N] [--sizes 64,4096,65536]
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from p2p_tunnel import FrameDecoder
+
+
+def legacy_frames(sock):
+    """สำเนาของตัวแกะ Frame แบบเดิมใน forward_from_host_to_peers (ใช้เป็นค่าอ้างอิง)"""
+    while True:
+        header_buffer = b''
+        while len(header_buffer) < 8:
+            packet = sock.recv(8 - len(header_buffer))
+            if not packet:
+                return
+            header_buffer += packet
+        player_id, length = struct.unpack('!II', header_buffer)
+        data = b''
+        while len(data) < length:
+            chunk = sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("Tunnel connection lost while reading data payload.")
+            data += chunk
+        yield player_id, data
+
+
+def decoder_frames(sock):
+    return FrameDecoder(sock).frames()
+
+
+def _make_stream(frame_size, frames):
+    payload = os.urandom(frame_size)
+    one = b''.join(struct.pack('!II', (i % 64) + 1, frame_size) + payload for i in range(64))
+    repeats, rest = divmod(frames, 64)
+    return one * repeats + one[:rest * (8 + frame_size)]
+
+
+def _feed(sock, stream):
+    try:
+        sock.sendall(stream)
+    finally:
+        sock.close()
+
+
+def run(decode, frame_size, frames, trace=False):
+    reader, writer = socket.socketpair()
+    stream = _make_stream(frame_size, frames)
+    feeder = threading.Thread(target=_feed, args=(writer, stream), daemon=True)
+    feeder.start()
+
+    count = 0
+    peak = 0
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    for _player_id, payload in decode(reader):
+        if trace:
+            current, frame_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, frame_peak - current)
+            tracemalloc.reset_peak()
+        count += 1
+    elapsed = time.perf_counter() - started
+    if trace:
+        tracemalloc.stop()
+    reader.close()
+    feeder.join()
+    assert count == frames, (count, frames)
+    return count / elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame decoder micro-benchmark")
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--sizes', default='64,1024,4096,65536')
+    args = parser.parse_args()
+
+    print(f"{'frame size':>10} {'decoder':>8} {'frames/sec':>12} {'peak alloc/frame':>17}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        # เฟรมใหญ่ลดจำนวนลงเพื่อไม่ให้ใช้เวลานานเกินไป
+        frames = max(1000, min(args.frames, args.frames * 1024 // max(size, 1024)))
+        for name, decode in (('legacy', legacy_frames), ('decoder', decoder_frames)):
+            rate, _ = run(decode, size, frames)
+            _, peak = run(decode, size, min(frames, 20000), trace=True)
+            print(f"{size:>10} {name:>8} {rate:>12,.0f} {peak:>15,} B")
+
+
+if __name__ == "__main__":
+    main()
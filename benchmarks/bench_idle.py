@@ -0,0 +1,203 @@
+# bench_idle.py
+# Soak test หน่วยความจำของผู้เล่นที่เชื่อมต่อค้างไว้เฉยๆ (idle): ตัวเลขนี้กำหนดว่า relay 1 เครื่องรับผู้เล่นได้กี่คน
+# เริ่ม serverp2p 1 ตัว ขออุโมงค์ 1 อันแล้วเป็น Host เองใน process นี้ (ส่ง Frame ของผู้เล่นกลับไปเหมือน echo service)
+# จากนั้นเปิดผู้เล่นทีละชุดจนครบ --peers คน แต่ละคนส่ง --touch bytes รอ echo แล้วเงียบไปจนจบรอบ
+# (ผู้เล่นทุกคนเคยมีข้อมูลวิ่งผ่านมาแล้ว จึงเห็นว่าบัฟเฟอร์ที่ใช้ชั่วคราวถูกคืนหรือไม่)
+# รายงาน RSS และจำนวน Thread ของ Server ต่อผู้เล่น 1 คน ระหว่างค้างไว้ --hold วินาที และหลังผู้เล่นทุกคนออกไปแล้ว
+#
+# Usage: python benchmarks/bench_idle.py [--engines thread,asyncio] [--peers 10000] [--hold 30] [--out result.json]
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_relay import _start, _stop, process_usage # noqa: E402
+from p2p_tunnel import FRAME_HEADER, FrameDecoder, control_request # noqa: E402
+
+
+def scrape_totals(metrics_port, names):
+    """ผลรวมของแต่ละ metric ใน names จาก /metrics ของ Server (ทุก label รวมกัน) คืนค่า {} ถ้าอ่านไม่ได้"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=10) as response:
+            text = response.read().decode()
+    except OSError:
+        return {}
+    totals = {}
+    for line in text.splitlines():
+        name = line.split('{', 1)[0].split(' ', 1)[0]
+        if name in names:
+            totals[name] = totals.get(name, 0) + float(line.rsplit(' ', 1)[1])
+    return totals
+
+
+def thread_count(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('Threads:'))
+    except (OSError, StopIteration):
+        return None
+
+
+def echo_host(sock):
+    """Host ของอุโมงค์: ส่งทุก Frame ของผู้เล่นกลับไปที่ผู้เล่นคนเดิม (Frame ความยาว 0 = ผู้เล่นหลุด ไม่ต้องตอบ)"""
+    try:
+        for player_id, payload in FrameDecoder(sock).frames():
+            if payload:
+                sock.sendall(FRAME_HEADER.pack(player_id, len(payload)) + payload)
+    except OSError:
+        pass
+
+
+def open_peers(addr, count, batch, touch, peers):
+    """เปิดผู้เล่นทีละ batch คน แต่ละคนส่ง touch bytes แล้วรอ echo ครบ คืนค่าจำนวนที่ล้มเหลว"""
+    errors = 0
+    payload = b'x' * touch
+    while len(peers) < count:
+        group = []
+        for _ in range(min(batch, count - len(peers) - len(group))):
+            try:
+                sock = socket.create_connection(addr, timeout=30)
+                if touch:
+                    sock.sendall(payload)
+                group.append(sock)
+            except OSError:
+                errors += 1
+        for sock in group:
+            try:
+                got = 0
+                while got < touch:
+                    chunk = sock.recv(touch - got)
+                    if not chunk:
+                        raise ConnectionError("relay closed the connection")
+                    got += len(chunk)
+                peers.append(sock)
+            except OSError:
+                errors += 1
+                sock.close()
+        if errors > count // 10:
+            break
+    return errors
+
+
+def run_round(engine, options):
+    metrics_port = options.base_port + 101
+    server, _ = _start(['serverp2p.py', '--engine', engine, '--control-port', str(options.base_port),
+                        '--port-range', f"{options.base_port + 1}-{options.base_port + 100}",
+                        '--metrics-port', str(metrics_port), '--peer-log-rate', '0'] + options.server_args.split(),
+                       r'Server Control listening')
+    peers = []
+    try:
+        reply = control_request(('127.0.0.1', options.base_port), 'PORT')
+        port = int(reply['port'])
+        host = socket.create_connection(('127.0.0.1', port))
+        threading.Thread(target=echo_host, args=(host,), daemon=True).start()
+        time.sleep(1)
+        base = process_usage(server.pid)
+        base_threads = thread_count(server.pid)
+
+        started = time.monotonic()
+        errors = open_peers(('127.0.0.1', port), options.peers, options.batch, options.touch, peers)
+        connect_s = time.monotonic() - started
+        samples = []
+        hold_until = time.monotonic() + options.hold
+        while True:
+            usage = process_usage(server.pid)
+            samples.append(usage['rss_kb'])
+            if time.monotonic() >= hold_until:
+                break
+            time.sleep(1)
+        accounting = scrape_totals(metrics_port, ('p2p_players', 'p2p_session_memory_bytes', 'p2p_peer_threads',
+                                                  'p2p_parked_players'))
+        held_threads = thread_count(server.pid)
+
+        for sock in peers:
+            sock.close()
+        peers = []
+        time.sleep(options.settle)
+        after = process_usage(server.pid)
+        host.close()
+    finally:
+        for sock in peers:
+            sock.close()
+        _stop(server)
+
+    held = len(samples) and samples[-1]
+    count = max(1, options.peers - errors)
+    return {
+        'engine': engine,
+        'peers': options.peers - errors,
+        'errors': errors,
+        'connect_s': round(connect_s, 2),
+        'server_rss_base_kb': base['rss_kb'],
+        'server_rss_held_kb': held,
+        'server_rss_peak_kb': usage['rss_peak_kb'],
+        'server_rss_after_kb': after['rss_kb'],
+        'rss_per_peer_kb': round((held - base['rss_kb']) / count, 2),
+        # ครึ่งหลังของช่วงค้างไว้ (ผู้เล่นถูกจอดหมดแล้ว): ยังโตขึ้นเรื่อยๆ = มีอะไรรั่ว
+        'rss_drift_kb': samples[-1] - samples[len(samples) // 2],
+        'threads_per_peer': round((held_threads - base_threads) / count, 2) if held_threads and base_threads else None,
+        'players_reported': int(accounting.get('p2p_players', 0)),
+        'accounted_bytes_per_peer': round(accounting['p2p_session_memory_bytes'] / count)
+                                    if accounting.get('p2p_session_memory_bytes') else None,
+        'peer_threads': int(accounting['p2p_peer_threads']) if 'p2p_peer_threads' in accounting else None,
+        'parked': int(accounting['p2p_parked_players']) if 'p2p_parked_players' in accounting else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server memory per idle peer")
+    parser.add_argument('--engines', default='thread,asyncio', help="comma separated server engines to measure")
+    parser.add_argument('--peers', type=int, default=10000, help="idle peers to hold")
+    parser.add_argument('--batch', type=int, default=500, help="peers connected before waiting for their echoes")
+    parser.add_argument('--touch', type=int, default=64, help="bytes each peer sends (and gets back) before going idle")
+    parser.add_argument('--hold', type=float, default=30, help="seconds to hold the idle peers while sampling RSS")
+    parser.add_argument('--settle', type=float, default=3, help="seconds to wait after closing the peers")
+    parser.add_argument('--server-args', default='', help="extra arguments for serverp2p.py")
+    parser.add_argument('--base-port', type=int, default=19500,
+                        help="server control port; the pool uses the next 100 ports and metrics the one after")
+    parser.add_argument('--out', help="write the JSON result to this file (default: stdout)")
+    options = parser.parse_args()
+
+    # ผู้เล่นทุกคนเป็น fd ทั้งใน process นี้และใน Server (ที่สืบทอด limit ไปตอนเริ่ม)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < options.peers + 1024:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard == resource.RLIM_INFINITY else
+                                                    min(hard, options.peers + 1024), hard))
+
+    result = {
+        'meta': {'peers': options.peers, 'touch': options.touch, 'hold_s': options.hold,
+                 'server_args': options.server_args, 'nofile': resource.getrlimit(resource.RLIMIT_NOFILE)[0],
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'rounds': [],
+    }
+    for engine in options.engines.split(','):
+        print(f"[bench] engine={engine} peers={options.peers}", file=sys.stderr)
+        result['rounds'].append(run_round(engine, options))
+        time.sleep(1)
+
+    print(f"{'engine':>8} {'peers':>6} {'errors':>6} {'KB/peer':>8} {'acct B/peer':>11} {'threads/peer':>12} "
+          f"{'parked':>7} {'after KB':>9}", file=sys.stderr)
+    for row in result['rounds']:
+        print(f"{row['engine']:>8} {row['peers']:>6} {row['errors']:>6} {row['rss_per_peer_kb']:>8} "
+              f"{row['accounted_bytes_per_peer']!s:>11} {row['threads_per_peer']!s:>12} {row['parked']!s:>7} "
+              f"{row['server_rss_after_kb']:>9}", file=sys.stderr)
+
+    text = json.dumps(result, indent=2)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
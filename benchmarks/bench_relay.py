@@ -0,0 +1,587 @@
+# bench_relay.py
+# Load test ของ relay ทั้งระบบบน loopback: serverp2p + clientp2p (subprocess) + Local Service (echo หรือ sink)
+# ผู้เล่นจำลองอยู่ใน process นี้ วัด throughput, round-trip latency (p50/p99/p999), CPU และ RSS
+# ของ server/client แล้วเขียนผลเป็น JSON เพื่อเทียบกันระหว่างแต่ละรอบ
+# [ใหม่] จำนวน Frame และขนาดเฉลี่ยของ Frame ที่ relay ส่งต่อในแต่ละทิศทาง (จาก /metrics ของ Server)
+#
+# Scenarios:
+#   small_frames  ผู้เล่นจำนวนมาก ส่งข้อความเล็กๆ ตามอัตราที่กำหนด (เหมือน game state)
+#   bulk          ผู้เล่นไม่กี่คนส่งก้อนใหญ่เต็มกำลัง
+#   storm         เปิด-ส่ง-รอ echo-ปิด การเชื่อมต่อใหม่ต่อเนื่อง (connection storm)
+#   slow_readers  ผู้เล่นที่อ่านช้าปนกับผู้เล่นปกติ ดูว่าผู้เล่นปกติโดนถ่วงแค่ไหน
+#   upload        ผู้เล่นส่งอย่างเดียวไปยัง sink (Local Service นับ bytes ที่ได้รับ)
+#   mixed         ผู้เล่นข้อความเล็กปนกับผู้เล่นที่ส่งก้อนใหญ่เต็มกำลัง ดู latency ของข้อความเล็ก (ความยุติธรรมของคิว)
+#   connect_storm [ใหม่] ผู้เล่น 5,000 คนต่อเข้ามาพร้อมกันเกือบในทันที (เหมือนทุกคนต่อกลับหลัง Server รีสตาร์ท)
+#                 แต่ละคนส่ง 1 ข้อความ รอ echo แล้วค้างการเชื่อมต่อไว้ วัดอัตรารับผู้เล่นและเวลาจนได้ echo
+#
+# Usage: python benchmarks/bench_relay.py [--scenarios small_frames,bulk] [--engine asyncio]
+#            [--duration 10] [--set small_frames.peers=200] [--out result.json] [--compare old.json]
+import argparse
+import errno
+import json
+import os
+import platform
+import re
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSAGE_HEADER = struct.Struct('!dQ') # เวลาที่ส่ง (perf_counter) + ลำดับ อยู่ต้นทุกข้อความ
+DRAIN_SECONDS = 3 # เวลาที่รอ echo ที่ยังค้างหลังหมดเวลาส่ง
+
+SCENARIOS = {
+    'small_frames': {'peers': 100, 'size': 64, 'rate': 50, 'window': 4, 'ramp': 1.0, 'service': 'echo'},
+    'bulk': {'peers': 4, 'size': 65536, 'rate': 0, 'window': 16, 'ramp': 0, 'service': 'echo'},
+    'storm': {'connections': 2000, 'concurrency': 50, 'size': 64, 'service': 'echo'},
+    'slow_readers': {'peers': 20, 'size': 256, 'rate': 50, 'window': 4, 'ramp': 0.5,
+                     'slow_peers': 5, 'slow_size': 16384, 'slow_rate': 100, 'slow_read_bps': 32768, 'service': 'echo'},
+    'upload': {'peers': 4, 'size': 65536, 'rate': 0, 'service': 'sink'},
+    'mixed': {'peers': 20, 'size': 64, 'rate': 50, 'window': 4, 'ramp': 0.5,
+              'bulk_peers': 4, 'bulk_size': 65536, 'bulk_window': 16, 'service': 'echo'},
+    'connect_storm': {'connections': 5000, 'size': 64, 'timeout': 30, 'service': 'echo'},
+}
+
+
+# --- Local Service (รันเป็น subprocess ด้วย --serve echo|sink) ---
+
+def serve_local(kind):
+    """echo: ส่งทุกอย่างกลับ, sink: ทิ้งข้อมูลแล้วพิมพ์จำนวน bytes ทั้งหมดตอนได้ SIGTERM"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    received = [0]
+
+    def handle(conn):
+        buffer = bytearray(256 * 1024)
+        view = memoryview(buffer)
+        try:
+            while True:
+                count = conn.recv_into(buffer)
+                if not count:
+                    break
+                if kind == 'echo':
+                    conn.sendall(view[:count])
+                else:
+                    received[0] += count
+        except OSError:
+            pass
+        conn.close()
+
+    def stop(signum, frame):
+        print(f"received {received[0]}", flush=True)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    print(f"port {listener.getsockname()[1]}", flush=True)
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+# --- การจัดการ process ---
+
+def _start(args, pattern, timeout=15):
+    """เริ่ม subprocess แล้วรอบรรทัดแรกที่ตรงกับ pattern คืนค่า (process, match)"""
+    proc = subprocess.Popen([sys.executable, '-u'] + args, cwd=ROOT, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        line = proc.stdout.readline()
+        if not line:
+            break
+        match = re.search(pattern, line)
+        if match:
+            # อ่าน stdout ที่เหลือเก็บไว้เรื่อยๆ ไม่ให้ pipe เต็มแล้ว process ค้าง
+            proc.lines = []
+            proc.drainer = threading.Thread(target=proc.lines.extend, args=(proc.stdout,), daemon=True)
+            proc.drainer.start()
+            return proc, match
+    proc.kill()
+    raise RuntimeError(f"{args[0]} did not print {pattern!r} within {timeout}s")
+
+
+def _stop(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def process_usage(pid):
+    """CPU (วินาที user+system) และ RSS ปัจจุบัน/สูงสุด (KB) จาก /proc (Linux) คืนค่า None ถ้าอ่านไม่ได้"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        'cpu_s': (int(fields[11]) + int(fields[12])) / ticks,
+        'rss_kb': int(status['VmRSS'].split()[0]),
+        'rss_peak_kb': int(status['VmHWM'].split()[0]),
+    }
+
+
+def scrape_frames(metrics_port):
+    """[ใหม่] ผลรวม (frames, bytes) ทุกอุโมงค์แยกตามทิศทางจาก /metrics ของ Server คืนค่า None ถ้าอ่านไม่ได้"""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5) as response:
+            text = response.read().decode()
+    except OSError:
+        return None
+    totals = {}
+    for line in text.splitlines():
+        match = re.match(r'p2p_(frames|bytes)_total\{.*direction="(\w+)".*\} (\S+)$', line)
+        if match:
+            kind, direction, value = match.groups()
+            frames_bytes = totals.setdefault(direction, [0, 0])
+            frames_bytes[kind == 'bytes'] += int(float(value))
+    return totals
+
+
+def _frames_delta(before, after):
+    if before is None or after is None:
+        return None
+    delta = {}
+    for direction, (frames, total) in after.items():
+        old_frames, old_total = before.get(direction, (0, 0))
+        frames, total = frames - old_frames, total - old_total
+        delta[direction] = {'frames': frames, 'bytes': total, 'avg_frame_bytes': round(total / frames) if frames else 0}
+    return delta
+
+
+def _usage_delta(before, after):
+    if before is None or after is None:
+        return None
+    return {'cpu_s': round(after['cpu_s'] - before['cpu_s'], 3), 'rss_kb': after['rss_kb'],
+            'rss_peak_kb': after['rss_peak_kb']}
+
+
+# --- ผู้เล่นจำลอง ---
+
+class PeerStats:
+    """ผลของผู้เล่น 1 คน (แก้โดย Thread ของผู้เล่นคนนั้นเท่านั้น)"""
+    def __init__(self):
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.errors = 0
+        self.dropped = False
+
+
+def _recv_exact(sock, view):
+    got = 0
+    while got < len(view):
+        count = sock.recv_into(view[got:])
+        if not count:
+            raise ConnectionError("relay closed the connection")
+        got += count
+
+
+def echo_peer(addr, size, rate, window, stop_at, stats, start_delay=0):
+    """
+    ส่งข้อความขนาด size ตาม rate (ข้อความ/วินาที, 0 = เต็มกำลัง) โดยมีข้อความค้างรอ echo ได้ไม่เกิน window
+    latency คือเวลาตั้งแต่ส่งจนได้ echo ของข้อความนั้นครบ
+    start_delay: ทยอยเชื่อมต่อ (ramp) เพื่อวัดสภาวะปกติ แยกจากการวัด connection storm
+    """
+    time.sleep(start_delay)
+    try:
+        sock = socket.create_connection(addr, timeout=10)
+    except OSError:
+        stats.errors += 1
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.settimeout(stop_at - time.monotonic() + DRAIN_SECONDS + 5)
+    in_flight = threading.Semaphore(window)
+    padding = os.urandom(size - MESSAGE_HEADER.size)
+    sender_done = threading.Event()
+
+    def read_echoes():
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        try:
+            while not (sender_done.is_set() and stats.received >= stats.sent):
+                _recv_exact(sock, view)
+                sent_at, _ = MESSAGE_HEADER.unpack_from(buffer)
+                stats.latencies.append(time.perf_counter() - sent_at)
+                stats.received += 1
+                stats.bytes_received += size
+                in_flight.release()
+        except (OSError, ConnectionError):
+            if not sender_done.is_set() or stats.received < stats.sent:
+                stats.errors += 1
+
+    reader = threading.Thread(target=read_echoes, daemon=True)
+    reader.start()
+    interval = 1 / rate if rate else 0
+    next_send = time.monotonic()
+    try:
+        while time.monotonic() < stop_at:
+            if interval:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send += interval
+            if not in_flight.acquire(timeout=max(0.0, stop_at - time.monotonic())):
+                break
+            sock.sendall(MESSAGE_HEADER.pack(time.perf_counter(), stats.sent) + padding)
+            stats.sent += 1
+            stats.bytes_sent += size
+    except OSError:
+        stats.errors += 1
+    sender_done.set()
+    reader.join(DRAIN_SECONDS + 5)
+    sock.close()
+
+
+def sink_peer(addr, size, stop_at, stats):
+    """ส่งอย่างเดียวเต็มกำลังจนหมดเวลา (ใช้กับ Local Service แบบ sink)"""
+    try:
+        sock = socket.create_connection(addr, timeout=10)
+        payload = os.urandom(size)
+        while time.monotonic() < stop_at:
+            sock.sendall(payload)
+            stats.sent += 1
+            stats.bytes_sent += size
+        sock.close()
+    except OSError:
+        stats.errors += 1
+
+
+def slow_peer(addr, size, rate, read_bps, stop_at, stats):
+    """ส่งคำขอใหญ่ตาม rate แต่อ่าน echo ช้าไม่เกิน read_bps (bytes/วินาที) บันทึกว่าถูก relay ตัดทิ้งหรือไม่"""
+    try:
+        sock = socket.create_connection(addr, timeout=10)
+    except OSError:
+        stats.errors += 1
+        return
+    payload = os.urandom(size)
+
+    def read_slowly():
+        try:
+            while time.monotonic() < stop_at:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    stats.dropped = True
+                    return
+                stats.bytes_received += len(chunk)
+                time.sleep(len(chunk) / read_bps)
+        except OSError:
+            stats.dropped = time.monotonic() < stop_at
+
+    reader = threading.Thread(target=read_slowly, daemon=True)
+    reader.start()
+    try:
+        while time.monotonic() < stop_at and not stats.dropped:
+            sock.sendall(payload)
+            stats.sent += 1
+            time.sleep(1 / rate)
+    except OSError:
+        stats.dropped = True
+    reader.join(2)
+    sock.close()
+
+
+def storm_worker(addr, size, counter, lock, stats):
+    """เปิดการเชื่อมต่อใหม่, ส่ง 1 ข้อความ, รอ echo แล้วปิด วนจนครบจำนวนใน counter"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    padding = bytes(size - MESSAGE_HEADER.size)
+    while True:
+        with lock:
+            if counter[0] <= 0:
+                return
+            counter[0] -= 1
+        started = time.perf_counter()
+        try:
+            with socket.create_connection(addr, timeout=10) as sock:
+                sock.sendall(MESSAGE_HEADER.pack(started, 0) + padding)
+                _recv_exact(sock, view)
+            stats.latencies.append(time.perf_counter() - started)
+            stats.received += 1
+        except (OSError, ConnectionError):
+            stats.errors += 1
+        stats.sent += 1
+
+
+def connect_storm(addr, connections, size, timeout, stats):
+    """
+    [ใหม่] เปิดทุกการเชื่อมต่อแบบ non-blocking จาก Thread เดียวให้เร็วที่สุด (ไม่รอกันเหมือน storm_worker)
+    เวลาของแต่ละคนนับตั้งแต่ connect() จนได้ echo ครบ คนที่ได้ echo แล้วค้างการเชื่อมต่อไว้จนจบ scenario
+    คืนค่าเวลาที่คนสุดท้ายได้ echo (วินาทีนับจากเริ่ม)
+    """
+    selector = selectors.DefaultSelector()
+    padding = bytes(size - MESSAGE_HEADER.size)
+    held = []
+    started = time.perf_counter()
+    last_echo = 0.0
+    for _ in range(connections):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        opened = time.perf_counter()
+        if sock.connect_ex(addr) not in (0, errno.EINPROGRESS):
+            stats.errors += 1
+            sock.close()
+            continue
+        selector.register(sock, selectors.EVENT_WRITE, [opened, bytearray()])
+        stats.sent += 1
+    deadline = time.monotonic() + timeout
+    try:
+        while selector.get_map() and time.monotonic() < deadline:
+            for key, events in selector.select(1.0):
+                sock, (opened, data) = key.fileobj, key.data
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        if error:
+                            raise OSError(error, os.strerror(error))
+                        sock.send(MESSAGE_HEADER.pack(opened, 0) + padding) # 64B ลง send buffer ว่างได้ทั้งก้อนเสมอ
+                        selector.modify(sock, selectors.EVENT_READ, key.data)
+                        continue
+                    chunk = sock.recv(size - len(data))
+                    if not chunk:
+                        raise ConnectionError("closed before echo")
+                    data += chunk
+                    if len(data) < size:
+                        continue
+                    now = time.perf_counter()
+                    stats.latencies.append(now - opened)
+                    stats.received += 1
+                    last_echo = now - started
+                    selector.unregister(sock)
+                    held.append(sock)
+                except (OSError, ConnectionError):
+                    stats.errors += 1
+                    selector.unregister(sock)
+                    sock.close()
+        stats.errors += len(selector.get_map()) # ยังไม่ได้ echo เมื่อหมดเวลา
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+        for sock in held:
+            sock.close()
+    return last_echo
+
+
+def _run_threads(targets):
+    threads = [threading.Thread(target=target, args=args, daemon=True) for target, args in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+# --- สรุปผล ---
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    return {'p50': pick(0.50), 'p99': pick(0.99), 'p999': pick(0.999), 'max': round(ordered[-1] * 1000, 3)}
+
+
+def summarize(stats_list, elapsed):
+    latencies = [latency for stats in stats_list for latency in stats.latencies]
+    sent = sum(stats.sent for stats in stats_list)
+    received = sum(stats.received for stats in stats_list)
+    bytes_received = sum(stats.bytes_received for stats in stats_list)
+    return {
+        'messages_sent': sent,
+        'messages_received': received,
+        'lost': max(0, sent - received),
+        'errors': sum(stats.errors for stats in stats_list),
+        'messages_per_s': round(received / elapsed, 1),
+        'throughput_mbps': round(bytes_received * 8 / elapsed / 1e6, 2),
+        'latency_ms': percentiles(latencies),
+    }
+
+
+# --- Scenarios ---
+
+def run_scenario(name, params, options, server):
+    service, match = _start([os.path.abspath(__file__), '--serve', params['service']], r'port (\d+)')
+    local_port = int(match.group(1))
+    client_args = ['clientp2p.py', '127.0.0.1', str(options.base_port), str(local_port)]
+    if options.stripes > 1:
+        client_args += ['--stripes', str(options.stripes)]
+    if options.compress:
+        client_args.append('--compress')
+    if options.direct:
+        client_args.append('--direct')
+    client, match = _start(client_args, r'Port: (\d+)')
+    addr = ('127.0.0.1', int(match.group(1)))
+    time.sleep(0.5) # ให้อุโมงค์ (และเส้นเสริม) ต่อเสร็จก่อน
+
+    usage_before = {'server': process_usage(server.pid), 'client': process_usage(client.pid)}
+    frames_before = scrape_frames(options.metrics_port)
+    driver_cpu = time.process_time()
+    started = time.monotonic()
+    stop_at = started + options.duration
+    result = {'params': params}
+    try:
+        if name == 'storm':
+            stats = [PeerStats() for _ in range(params['concurrency'])]
+            counter, lock = [params['connections']], threading.Lock()
+            _run_threads((storm_worker, (addr, params['size'], counter, lock, s)) for s in stats)
+            result.update(summarize(stats, time.monotonic() - started))
+            result['connections_per_s'] = result.pop('messages_per_s')
+            del result['throughput_mbps']
+        elif name == 'connect_storm':
+            stats = PeerStats()
+            admitted_in = connect_storm(addr, params['connections'], params['size'], params['timeout'], stats)
+            result.update(summarize([stats], admitted_in or 1))
+            result['accepts_per_s'] = result.pop('messages_per_s')
+            result['admitted_in_s'] = round(admitted_in, 3)
+            del result['throughput_mbps']
+        elif name == 'upload':
+            stats = [PeerStats() for _ in range(params['peers'])]
+            _run_threads((sink_peer, (addr, params['size'], stop_at, s)) for s in stats)
+            time.sleep(1) # ให้ข้อมูลที่ค้างในอุโมงค์ไหลไปถึง sink
+        else:
+            stats = [PeerStats() for _ in range(params['peers'])]
+            ramp = params.get('ramp', 0) / len(stats)
+            targets = [(echo_peer, (addr, params['size'], params['rate'], params['window'], stop_at, s, i * ramp))
+                       for i, s in enumerate(stats)]
+            slow = [PeerStats() for _ in range(params.get('slow_peers', 0))]
+            targets += [(slow_peer, (addr, params['slow_size'], params['slow_rate'], params['slow_read_bps'], stop_at, s))
+                        for s in slow]
+            bulk = [PeerStats() for _ in range(params.get('bulk_peers', 0))]
+            targets += [(echo_peer, (addr, params['bulk_size'], 0, params['bulk_window'], stop_at, s)) for s in bulk]
+            _run_threads(targets)
+            result.update(summarize(stats, options.duration))
+            if slow:
+                result['slow_peers_dropped'] = sum(s.dropped for s in slow)
+            if bulk:
+                result['bulk'] = summarize(bulk, options.duration)
+        elapsed = time.monotonic() - started
+        result['driver_cpu_s'] = round(time.process_time() - driver_cpu, 3)
+        result['server'] = _usage_delta(usage_before['server'], process_usage(server.pid))
+        result['client'] = _usage_delta(usage_before['client'], process_usage(client.pid))
+        result['frames'] = _frames_delta(frames_before, scrape_frames(options.metrics_port))
+    finally:
+        _stop(client)
+        _stop(service)
+        service.drainer.join(2)
+
+    if name == 'upload':
+        totals = [int(line.split()[1]) for line in service.lines if line.startswith('received ')]
+        received = totals[-1] if totals else 0
+        result.update({'bytes_sent': sum(s.bytes_sent for s in stats), 'bytes_received': received,
+                       'errors': sum(s.errors for s in stats),
+                       'throughput_mbps': round(received * 8 / options.duration / 1e6, 2)})
+    result['elapsed_s'] = round(elapsed, 2)
+    return result
+
+
+def apply_overrides(scenarios, overrides):
+    """--set scenario.key=value (ค่าตัวเลขถูกแปลงเป็น int/float ให้)"""
+    for item in overrides:
+        target, _, value = item.partition('=')
+        name, _, key = target.partition('.')
+        if name not in scenarios or not key:
+            raise SystemExit(f"bad --set {item!r}: expected <scenario>.<key>=<value>")
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        scenarios[name][key] = value
+
+
+def compare(result, baseline_path):
+    """พิมพ์ตัวเลขหลักของแต่ละ scenario เทียบกับผลรอบก่อน"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scenarios']
+    keys = ('throughput_mbps', 'messages_per_s', 'connections_per_s', 'accepts_per_s', 'latency_ms.p50', 'latency_ms.p99',
+            'latency_ms.p999', 'bulk.throughput_mbps', 'server.cpu_s', 'server.rss_kb', 'frames.to_host.frames',
+            'frames.to_host.avg_frame_bytes', 'frames.to_peer.frames')
+    print(f"{'scenario':<14} {'metric':<18} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, current in result['scenarios'].items():
+        if name not in baseline:
+            continue
+        for key in keys:
+            old, new = baseline[name], current
+            for part in key.split('.'):
+                old = old.get(part) if isinstance(old, dict) else None
+                new = new.get(part) if isinstance(new, dict) else None
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else '-'
+            print(f"{name:<14} {key:<18} {old:>12} {new:>12} {change:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load test for the relay")
+    parser.add_argument('--scenarios', default='small_frames,bulk,storm,slow_readers,upload,mixed',
+                        help=f"comma separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--duration', type=float, default=10, help="seconds per timed scenario")
+    parser.add_argument('--stripes', type=int, default=1)
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--direct', action='store_true', help="clients ask for spliced per-player data connections")
+    parser.add_argument('--server-args', default='', help="extra arguments for serverp2p.py, e.g. \"--flush-us 200\"")
+    parser.add_argument('--base-port', type=int, default=19500, help="server control port; the pool uses the next 100 ports and metrics the one after")
+    parser.add_argument('--set', action='append', default=[], metavar='SCENARIO.KEY=VALUE')
+    parser.add_argument('--out', help="write the JSON result to this file (default: stdout)")
+    parser.add_argument('--compare', metavar='BASELINE_JSON')
+    parser.add_argument('--serve', choices=('echo', 'sink'), help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.serve:
+        serve_local(options.serve)
+        return
+
+    scenarios = {name: dict(params) for name, params in SCENARIOS.items()}
+    apply_overrides(scenarios, options.set)
+    selected = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    for name in selected:
+        if name not in scenarios:
+            raise SystemExit(f"unknown scenario {name!r}")
+
+    options.metrics_port = options.base_port + 101
+    server_args = ['serverp2p.py', '--engine', options.engine, '--control-port', str(options.base_port),
+                   '--port-range', f"{options.base_port + 1}-{options.base_port + 100}",
+                   '--metrics-port', str(options.metrics_port)] + options.server_args.split()
+    server, _ = _start(server_args, r'Server Control listening')
+    result = {
+        'meta': {'engine': options.engine, 'stripes': options.stripes, 'compress': options.compress,
+                 'direct': options.direct, 'duration_s': options.duration, 'server_args': options.server_args,
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'scenarios': {},
+    }
+    try:
+        for name in selected:
+            print(f"[bench] {name} {scenarios[name]}", file=sys.stderr)
+            result['scenarios'][name] = run_scenario(name, scenarios[name], options, server)
+            time.sleep(1) # ให้ Server ปิด Port ของ scenario ก่อนหน้าให้เสร็จ
+        result['meta']['server_rss_peak_kb'] = (process_usage(server.pid) or {}).get('rss_peak_kb')
+    finally:
+        _stop(server)
+
+    text = json.dumps(result, indent=2)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if options.compare:
+        compare(result, options.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# bench_workers.py
+# วัดการ scale ของโหมด pre-fork (serverp2p.py --workers N) บน loopback
+# แต่ละรอบเริ่ม Server ด้วยจำนวน worker ที่กำหนด เปิดหลายอุโมงค์ (clientp2p + echo service ของตัวเองต่ออุโมงค์)
+# แล้วให้ผู้เล่นจำลองส่งก้อนใหญ่เต็มกำลังพร้อมกันทุกอุโมงค์ (ผู้เล่นของแต่ละอุโมงค์อยู่ใน process แยก ไม่ติด GIL เดียวกัน)
+# รายงาน throughput รวม, CPU ของ Supervisor/worker แต่ละตัว และ scaling efficiency เทียบกับ 1 worker
+#
+# หมายเหตุ: Client, echo service และผู้เล่นจำลองก็ใช้ CPU บนเครื่องเดียวกัน ตัวเลขจะ scale ได้เต็มที่
+# ก็ต่อเมื่อเครื่องมี core เหลือพอสำหรับทุกฝั่ง (ดู meta.cpus ในผล)
+#
+# Usage: python benchmarks/bench_workers.py [--workers 1,2,4] [--tunnels 8] [--duration 10] [--engine asyncio]
+#            [--out result.json]
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_relay import PeerStats, _start, _stop, echo_peer, process_usage, summarize # noqa: E402
+
+
+def child_pids(pid):
+    """pid ของ process ลูก (worker) จาก /proc (Linux)"""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def drive_tunnel(addr, peers, size, window, stop_at, results):
+    """(process ลูก) ผู้เล่น peers คนของอุโมงค์เดียว ส่ง echo เต็มกำลังจนหมดเวลา แล้วส่งสรุปกลับทาง queue"""
+    stats = [PeerStats() for _ in range(peers)]
+    threads = [threading.Thread(target=echo_peer, args=(addr, size, 0, window, stop_at, s), daemon=True) for s in stats]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put([(s.latencies, s.sent, s.received, s.bytes_received, s.errors) for s in stats])
+
+
+def _merge_peer_stats(rows):
+    stats = []
+    for latencies, sent, received, bytes_received, errors in rows:
+        peer = PeerStats()
+        peer.latencies, peer.sent, peer.received, peer.bytes_received, peer.errors = latencies, sent, received, bytes_received, errors
+        stats.append(peer)
+    return stats
+
+
+def run_round(workers, options):
+    server_args = ['serverp2p.py', '--engine', options.engine, '--workers', str(workers),
+                   '--control-port', str(options.base_port),
+                   '--port-range', f"{options.base_port + 1}-{options.base_port + 100}"] + options.server_args.split()
+    server, _ = _start(server_args, r'Server Control listening')
+    time.sleep(1) # ให้ worker ที่เหลือ bind Control Port ให้ครบ
+    processes = [server]
+    try:
+        addrs = []
+        for _ in range(options.tunnels):
+            service, match = _start([os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_relay.py'),
+                                     '--serve', 'echo'], r'port (\d+)')
+            processes.append(service)
+            client, match = _start(['clientp2p.py', '127.0.0.1', str(options.base_port), match.group(1)], r'Port: (\d+)')
+            processes.append(client)
+            addrs.append(('127.0.0.1', int(match.group(1))))
+        time.sleep(0.5)
+
+        pids = [server.pid] + child_pids(server.pid)
+        before = {pid: process_usage(pid) for pid in pids}
+        results = multiprocessing.Queue()
+        started = time.monotonic()
+        stop_at = started + options.duration
+        drivers = [multiprocessing.Process(target=drive_tunnel,
+                                           args=(addr, options.peers, options.size, options.window, stop_at, results))
+                   for addr in addrs]
+        for driver in drivers:
+            driver.start()
+        rows = [row for _ in drivers for row in results.get()]
+        for driver in drivers:
+            driver.join()
+        elapsed = time.monotonic() - started
+        after = {pid: process_usage(pid) for pid in pids}
+    finally:
+        for proc in reversed(processes):
+            _stop(proc)
+
+    result = summarize(_merge_peer_stats(rows), options.duration)
+    cpu = {pid: round(after[pid]['cpu_s'] - before[pid]['cpu_s'], 3)
+           for pid in pids if before.get(pid) and after.get(pid)}
+    result.update({
+        'workers': workers,
+        'elapsed_s': round(elapsed, 2),
+        'supervisor_cpu_s': cpu.get(server.pid) if workers > 1 else None,
+        'worker_cpu_s': [cpu[pid] for pid in pids[1:] if pid in cpu] if workers > 1 else [cpu.get(server.pid)],
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate throughput of the pre-fork server vs worker count")
+    parser.add_argument('--workers', default=None, help="comma separated worker counts (default: 1,2,4.. up to the CPU count)")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--tunnels', type=int, default=8, help="tunnels (client + echo service pairs) per round")
+    parser.add_argument('--peers', type=int, default=2, help="players per tunnel")
+    parser.add_argument('--size', type=int, default=65536, help="message size in bytes")
+    parser.add_argument('--window', type=int, default=16, help="messages in flight per player")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per round")
+    parser.add_argument('--server-args', default='', help="extra arguments for serverp2p.py")
+    parser.add_argument('--base-port', type=int, default=19800, help="server control port; the pool uses the next 100 ports")
+    parser.add_argument('--out', help="write the JSON result to this file (default: stdout)")
+    options = parser.parse_args()
+
+    if options.workers:
+        counts = [int(count) for count in options.workers.split(',')]
+    else:
+        counts = [1]
+        while counts[-1] * 2 <= (os.cpu_count() or 1):
+            counts.append(counts[-1] * 2)
+
+    result = {
+        'meta': {'engine': options.engine, 'tunnels': options.tunnels, 'peers_per_tunnel': options.peers,
+                 'size': options.size, 'duration_s': options.duration, 'server_args': options.server_args,
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'rounds': [],
+    }
+    for workers in counts:
+        print(f"[bench] workers={workers}", file=sys.stderr)
+        result['rounds'].append(run_round(workers, options))
+        time.sleep(1) # ให้ Port ของรอบก่อนปิดให้หมด
+
+    baseline = result['rounds'][0]['throughput_mbps'] / result['rounds'][0]['workers'] or None
+    print(f"{'workers':>7} {'Mbps':>10} {'p99 ms':>9} {'errors':>7} {'efficiency':>10}  worker cpu_s", file=sys.stderr)
+    for row in result['rounds']:
+        row['scaling_efficiency'] = round(row['throughput_mbps'] / (row['workers'] * baseline), 3) if baseline else None
+        p99 = (row['latency_ms'] or {}).get('p99')
+        print(f"{row['workers']:>7} {row['throughput_mbps']:>10} {p99!s:>9} {row['errors']:>7} "
+              f"{row['scaling_efficiency']!s:>10}  {row['worker_cpu_s']}", file=sys.stderr)
+
+    text = json.dumps(result, indent=2)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+# replay_capture.py
+# เล่นไฟล์ capture (serverp2p.py / clientp2p.py --capture) ซ้ำกับ serverp2p จริง เพื่อได้ workload แบบ production ที่ทำซ้ำได้
+# สคริปต์นี้เป็นทั้ง Host (ขอ Port แล้วพูด Frame protocol เอง ไม่มี clientp2p/Local Service) และผู้เล่นทุกคนในไฟล์:
+#   to_host: ผู้เล่นจำลองส่งข้อมูลเข้า Public Port ตามเวลาในไฟล์ (length 0 = ผู้เล่นปิดฝั่งส่ง)
+#   to_peer: Host ส่ง Frame ไปหาผู้เล่นคนนั้นผ่านอุโมงค์ (length 0 = Host สั่งปิดผู้เล่น)
+# ไฟล์ที่ไม่มี payload ใช้ข้อมูลแทนที่ยาวเท่าเดิม ส่วนไฟล์ที่มี payload ส่งข้อมูลจริง
+#
+# --speed 1 = ตามเวลาจริง, N = เร็วขึ้น N เท่า, 0 = เร็วที่สุดเท่าที่ relay รับไหว (ไม่รอเวลาเลย)
+# ผลรายงานว่า relay ตามทันแค่ไหน: ความล่าช้าของแต่ละ record เทียบกับกำหนด (relay ดันกลับ = ส่งไม่ออก),
+# latency ตั้งแต่ส่งจนอีกฝั่งได้รับ, bytes ที่ส่ง/ได้รับแยกตามทิศทาง และ CPU ของ Server (ถ้าสคริปต์เริ่ม Server เอง)
+#
+# การจับคู่ผู้เล่นในไฟล์กับ player_id ใหม่ของ Server: เมื่อผู้เล่นส่งข้อมูลครั้งแรก Thread จับคู่ของอุโมงค์รอจน Host เห็น
+# player_id ใหม่ (ผู้เล่นใหม่ของอุโมงค์เดียวกันจึงเริ่มทีละคน) ระหว่างนั้น record ของผู้เล่นที่ยังจับคู่ไม่เสร็จถูกพักไว้
+# แล้วส่งตามลำดับเดิมเมื่อจับคู่เสร็จ Thread ที่ส่ง record ตามเวลาจึงไม่ต้องหยุดรอ
+# ผู้เล่นที่เริ่มก่อนเปิดบันทึกและยังไม่เคยส่งอะไรเลย Host ส่งหาไม่ได้ จะถูกนับเป็น skipped
+#
+# record ปิดฝั่งส่งของผู้เล่น (to_host length 0) รอให้ข้อมูลจาก Host ที่ส่งไปก่อนหน้าถึงผู้เล่นครบก่อน (ไม่เกิน CLOSE_WAIT_SECONDS)
+# เพราะ relay ปิดผู้เล่นทันทีที่เห็น EOF ข้อมูลท้ายที่ยังค้างจะหายไป ซึ่งไม่ได้เกิดในการทำงานจริงที่บันทึกไว้
+#
+# Usage: python benchmarks/replay_capture.py CAPTURE [CAPTURE ...] [--speed 1] [--server 127.0.0.1:5000]
+#            [--engine asyncio] [--server-args "..."] [--tunnels 9001,9002] [--out result.json]
+import argparse
+import heapq
+import json
+import os
+import platform
+import queue
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_relay import ROOT, _start, _stop, _usage_delta, percentiles, process_usage # noqa: E402
+sys.path.insert(0, ROOT)
+from p2p_capture import CaptureReader # noqa: E402
+from p2p_tunnel import FRAME_HEADER, HEARTBEAT_PLAYER_ID, FrameDecoder, control_request # noqa: E402
+
+FILLER = bytes(range(256)) * 1024 # ข้อมูลแทน payload ที่ไม่ได้บันทึกไว้ (ไม่ใช่ 0 ล้วน: การบีบอัดจะได้ไม่ดีเกินจริง)
+MAP_TIMEOUT = 5 # วินาทีที่รอ Host เห็นผู้เล่นใหม่
+DRAIN_SECONDS = 10 # วินาทีที่รอข้อมูลที่ยังค้างหลัง record สุดท้าย
+CLOSE_WAIT_SECONDS = 2 # วินาทีที่ record ปิดฝั่งส่งของผู้เล่นรอข้อมูลจาก Host ที่ส่งไปแล้วให้ถึงผู้เล่นก่อน
+
+
+class Flow:
+    """ข้อมูลทิศทางเดียวของผู้เล่น 1 คน: จุดสิ้นสุดของแต่ละ record ที่ส่ง (bytes สะสม, เวลา) เทียบกับ bytes ที่ได้รับ"""
+    __slots__ = ('sent', 'received', 'marks', 'latencies', 'last_arrival')
+
+    def __init__(self, latencies):
+        self.sent = 0
+        self.received = 0
+        self.marks = deque()
+        self.latencies = latencies # list ของทิศทางนี้ที่ใช้ร่วมกันทุกผู้เล่น
+        self.last_arrival = None # เวลา (perf_counter) ที่ได้รับ byte ล่าสุด
+
+    def send(self, length):
+        self.sent += length
+        self.marks.append((self.sent, time.perf_counter()))
+
+    def arrive(self, length, now):
+        self.received += length
+        if self.last_arrival is None or now > self.last_arrival:
+            self.last_arrival = now
+        marks = self.marks
+        while marks and marks[0][0] <= self.received:
+            self.latencies.append(now - marks.popleft()[1])
+
+
+class ReplayPlayer:
+    def __init__(self, tunnel, latencies):
+        self.tunnel = tunnel
+        self.sock = None
+        self.server_id = None
+        self.mapping_failed = False
+        self.pending = deque() # record ที่รอจับคู่เสร็จ: (ทิศทาง, ข้อมูล) ตามลำดับเวลา (to_host ข้อมูลว่าง = ปิดฝั่งส่ง)
+        self.to_host = Flow(latencies['to_host'])
+        self.to_peer = Flow(latencies['to_peer'])
+
+    @property
+    def mapped(self):
+        return self.server_id is not None or self.mapping_failed
+
+    def connect(self):
+        self.sock = socket.create_connection(self.tunnel.addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        sock = self.sock
+        try:
+            while True:
+                data = sock.recv(262144)
+                if not data:
+                    break
+                self.to_peer.arrive(len(data), time.perf_counter())
+        except OSError:
+            pass
+
+    def send(self, data):
+        """ส่งข้อมูลของผู้เล่นเข้า Public Port (ข้อมูลว่าง = ปิดฝั่งส่ง หลังรอข้อมูลจาก Host ที่ค้างอยู่ให้ถึงก่อน)"""
+        if data:
+            self.to_host.send(len(data))
+            self.sock.sendall(data)
+            return
+        deadline = time.monotonic() + CLOSE_WAIT_SECONDS
+        while self.to_peer.received < self.to_peer.sent and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.sock.shutdown(socket.SHUT_WR)
+
+
+class ReplayTunnel:
+    """Host ของอุโมงค์ 1 เส้นในไฟล์: Port ใหม่จาก Server, การเชื่อมต่อ Host และตาราง player_id ของ Server -> ผู้เล่น"""
+    def __init__(self, name, server_addr):
+        self.name = name
+        reply = control_request(server_addr, 'PORT')
+        self.addr = (server_addr[0], int(reply['port']))
+        self.sock = socket.create_connection(self.addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock() # Frame ถึง Host ส่งจากทั้ง Thread หลักและ Thread จับคู่
+        self.players = {} # {player_id ของ Server: ReplayPlayer}
+        self.unmapped = {} # {player_id ของ Server: [(bytes, เวลาที่ได้รับ)]} ข้อมูลที่มาก่อนจับคู่เสร็จ
+        self.new_ids = queue.Queue()
+        self.waiting = deque() # ผู้เล่นใหม่ที่รอจับคู่ตามลำดับ (คนแรกเท่านั้นที่ส่งข้อมูลออกไปแล้ว)
+        self.mapper_cond = threading.Condition(self.lock)
+        self.skipped = 0 # record ของ Thread จับคู่ที่ส่งไม่ได้
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._map_players, daemon=True).start()
+
+    def _read(self):
+        try:
+            for player_id, payload in FrameDecoder(self.sock).frames():
+                if player_id == HEARTBEAT_PLAYER_ID or not payload:
+                    continue
+                now = time.perf_counter()
+                with self.lock:
+                    player = self.players.get(player_id)
+                    if player is None:
+                        if player_id not in self.unmapped:
+                            self.unmapped[player_id] = []
+                            self.new_ids.put(player_id)
+                        self.unmapped[player_id].append((len(payload), now))
+                        continue
+                player.to_host.arrive(len(payload), now)
+        except (OSError, ValueError):
+            pass
+
+    def add_player(self, player, data):
+        """ผู้เล่นใหม่ที่ส่งข้อมูลครั้งแรกด้วย data: เข้าคิวให้ Thread จับคู่ (ไม่ block)"""
+        with self.lock:
+            player.pending.append(('to_host', data))
+            self.waiting.append(player)
+            self.mapper_cond.notify()
+
+    def issue(self, player, direction, data):
+        """
+        ส่ง record ของผู้เล่นที่มีอยู่แล้ว หรือพักไว้ถ้ายังจับคู่ไม่เสร็จ คืนค่า False ถ้าเป็น record ที่ส่งไม่ได้ (skipped)
+        raise OSError ถ้า Server ตัดผู้เล่นหรืออุโมงค์ไปแล้ว
+        """
+        with self.lock:
+            if not player.mapped:
+                player.pending.append((direction, data))
+                return True
+        return self._deliver(player, direction, data, player.server_id)
+
+    def _deliver(self, player, direction, data, player_id):
+        if direction == 'to_host':
+            player.send(data)
+            return True
+        if player_id is None:
+            return False # ผู้เล่นที่จับคู่ไม่ได้: Host ไม่รู้ player_id
+        if data:
+            player.to_peer.send(len(data))
+        self.send_frame(player_id, data)
+        return True
+
+    def _map_players(self):
+        """
+        Thread จับคู่: ส่งข้อมูลแรกของผู้เล่นที่รอคนแรก รอ player_id ใหม่ที่ Host เห็น แล้วส่ง record ที่พักไว้ตามลำดับ
+        record ที่ Thread หลักส่งมาระหว่างนี้ต่อท้าย pending จนกว่าจะว่าง แล้วจึงถือว่าจับคู่เสร็จ
+        """
+        while True:
+            with self.lock:
+                while not self.waiting:
+                    self.mapper_cond.wait()
+                player = self.waiting[0]
+                _, data = player.pending.popleft()
+            try:
+                player.send(data)
+            except OSError:
+                player.mapping_failed = True
+            player_id = None
+            if not player.mapping_failed:
+                try:
+                    player_id = self.new_ids.get(timeout=MAP_TIMEOUT)
+                except queue.Empty:
+                    player.mapping_failed = True
+                else:
+                    with self.lock:
+                        self.players[player_id] = player
+                        for length, arrived in self.unmapped.pop(player_id):
+                            player.to_host.arrive(length, arrived)
+            while True:
+                with self.lock:
+                    if not player.pending:
+                        player.server_id = player_id
+                        self.waiting.popleft()
+                        break
+                    direction, data = player.pending.popleft()
+                try:
+                    if not self._deliver(player, direction, data, player_id):
+                        self.skipped += 1
+                except OSError:
+                    self.skipped += 1
+
+    def idle(self):
+        """ไม่มีผู้เล่นรอจับคู่หรือ record ที่พักไว้"""
+        with self.lock:
+            return not self.waiting
+
+    def send_frame(self, player_id, data):
+        with self.send_lock:
+            self.sock.sendall(FRAME_HEADER.pack(player_id, len(data)) + data)
+
+    def close(self):
+        self.sock.close()
+
+
+def filler(length):
+    if length <= len(FILLER):
+        return FILLER[:length]
+    return (FILLER * (length // len(FILLER) + 1))[:length]
+
+
+def scan(paths, wanted):
+    """อ่านทุกไฟล์แบบข้าม payload: อุโมงค์ที่ต้องเล่น, จำนวน record และช่วงเวลาของไฟล์"""
+    tunnels, records, first, last = {}, 0, None, None
+    for index, path in enumerate(paths):
+        reader = CaptureReader(path, payloads=False)
+        for record in reader:
+            name = reader.tunnels.get(record.tunnel, str(record.tunnel))
+            if wanted and name not in wanted:
+                continue
+            tunnels[(index, record.tunnel)] = name
+            records += 1
+            first = record.time if first is None else min(first, record.time)
+            last = record.time if last is None else max(last, record.time)
+    return tunnels, records, first, last
+
+
+def _tagged(index, path):
+    for record in CaptureReader(path):
+        yield index, record
+
+
+def merged_records(paths):
+    """record ของทุกไฟล์เรียงตามเวลา คู่กับลำดับไฟล์ (เลขอุโมงค์ไม่ซ้ำกันแค่ภายในไฟล์เดียว)"""
+    return heapq.merge(*(_tagged(index, path) for index, path in enumerate(paths)), key=lambda item: item[1].time)
+
+
+def replay(paths, server_addr, options):
+    wanted = set(options.tunnels.split(',')) if options.tunnels else None
+    names, total, first, last = scan(paths, wanted)
+    if not total:
+        raise SystemExit("[!] No records to replay.")
+    print(f"[replay] {total} records, {len(names)} tunnel(s), {last - first:.1f}s of traffic", file=sys.stderr)
+    tunnels = {key: ReplayTunnel(name, server_addr) for key, name in names.items()}
+    latencies = {'to_host': [], 'to_peer': []}
+    players = {}
+    lags = []
+    skipped = 0
+    speed = options.speed
+
+    started = time.perf_counter()
+    for index, record in merged_records(paths):
+        tunnel = tunnels.get((index, record.tunnel))
+        if tunnel is None:
+            continue
+        if speed:
+            target = started + (record.time - first) / speed
+            wait = target - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            lags.append(max(0.0, time.perf_counter() - target))
+        key = (index, record.tunnel, record.player_id)
+        player = players.get(key)
+        data = record.payload if record.payload is not None else filler(record.length)
+        try:
+            if record.direction == 'to_host' and player is None:
+                if not record.length:
+                    continue
+                player = players[key] = ReplayPlayer(tunnel, latencies)
+                player.connect()
+                tunnel.add_player(player, data)
+            elif player is None:
+                skipped += 1
+            elif not tunnel.issue(player, record.direction, data):
+                skipped += 1
+        except OSError:
+            skipped += 1 # Server ตัดผู้เล่นคนนี้ไปแล้ว (เช่นบัฟเฟอร์เต็ม): record ที่เหลือของผู้เล่นคนนี้ส่งไม่ได้
+    issued = time.perf_counter() - started
+
+    flows = [flow for player in players.values() for flow in (player.to_host, player.to_peer)]
+    deadline = time.monotonic() + DRAIN_SECONDS
+    while time.monotonic() < deadline and (not all(tunnel.idle() for tunnel in tunnels.values()) or
+                                           any(flow.received < flow.sent for flow in flows)):
+        time.sleep(0.05)
+    # วัดถึง byte สุดท้ายที่ได้รับ ไม่ใช่ถึงตอนเลิกรอ (ข้อมูลที่ไม่มาถึงเลยจะไม่ทำให้ throughput ดูต่ำลง)
+    arrivals = [flow.last_arrival for flow in flows if flow.last_arrival is not None]
+    elapsed = max([issued] + [arrival - started for arrival in arrivals])
+    skipped += sum(tunnel.skipped for tunnel in tunnels.values())
+    for player in players.values():
+        if player.sock is not None:
+            player.sock.close()
+    for tunnel in tunnels.values():
+        tunnel.close()
+
+    capture_seconds = last - first
+    result = {
+        'records': total,
+        'tunnels': len(tunnels),
+        'players': len(players),
+        'unmapped_players': sum(1 for player in players.values() if player.mapping_failed),
+        'skipped_records': skipped,
+        'capture_s': round(capture_seconds, 3),
+        'issue_s': round(issued, 3), # เวลาที่ใช้ส่งทุก record ออกไป
+        'elapsed_s': round(elapsed, 3), # ถึง byte สุดท้ายที่ได้รับ (รวมเวลาที่ข้อมูลค้างอยู่ใน relay)
+        # 1.0 = ส่งได้ตามกำหนดเวลาทั้งหมด, ต่ำกว่า 1 = relay ดันกลับจนส่งช้ากว่าไฟล์
+        'kept_up': round(min(1.0, (capture_seconds / speed) / issued), 3) if speed and issued > 0 else None,
+        # จำนวน record ต่อวินาทีที่สคริปต์ส่งได้จริง: ถ้าใกล้กับ records / (capture_s / speed) เพดานอยู่ที่สคริปต์เอง ไม่ใช่ relay
+        'issue_records_per_s': round(total / issued) if issued > 0 else None,
+        'schedule_lag_ms': percentiles(lags),
+    }
+    for direction in ('to_host', 'to_peer'):
+        chosen = [getattr(player, direction) for player in players.values()]
+        sent = sum(flow.sent for flow in chosen)
+        received = sum(flow.received for flow in chosen)
+        result[direction] = {
+            'bytes_sent': sent,
+            'bytes_received': received,
+            'delivered': round(received / sent, 4) if sent else None,
+            'throughput_mbps': round(received * 8 / elapsed / 1e6, 2),
+            'latency_ms': percentiles(latencies[direction]),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a tunnel capture against serverp2p and report how it kept up")
+    parser.add_argument('captures', nargs='+', help="capture files (several files, e.g. one per worker, are merged by time)")
+    parser.add_argument('--speed', type=float, default=1.0, help="1 = real time, N = N times faster, 0 = as fast as possible")
+    parser.add_argument('--tunnels', help="comma separated tunnel names (ports or tokens) to replay (default: all)")
+    parser.add_argument('--server', help="control address HOST:PORT of a running server (default: start one)")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--server-args', default='', help="extra arguments for the started serverp2p.py")
+    parser.add_argument('--base-port', type=int, default=19600, help="control port of the started server; the pool uses the next 100 ports")
+    parser.add_argument('--out', help="write the JSON result to this file (default: stdout)")
+    options = parser.parse_args()
+
+    server = None
+    if options.server:
+        host, _, port = options.server.rpartition(':')
+        server_addr = (host or '127.0.0.1', int(port))
+    else:
+        server_addr = ('127.0.0.1', options.base_port)
+        server, _ = _start(['serverp2p.py', '--engine', options.engine, '--control-port', str(options.base_port),
+                            '--port-range', f"{options.base_port + 1}-{options.base_port + 100}"] +
+                           options.server_args.split(), r'Server Control listening')
+    try:
+        usage_before = process_usage(server.pid) if server else None
+        result = replay(options.captures, server_addr, options)
+        if server:
+            result['server'] = _usage_delta(usage_before, process_usage(server.pid))
+    finally:
+        if server:
+            _stop(server)
+
+    result['meta'] = {'captures': options.captures, 'speed': options.speed,
+                      'server': options.server or f"started ({options.engine}) {options.server_args}".strip(),
+                      'python': platform.python_version(), 'platform': platform.platform(),
+                      'started': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    for direction in ('to_host', 'to_peer'):
+        row = result[direction]
+        print(f"[replay] {direction}: {row['bytes_received']}/{row['bytes_sent']}B delivered, "
+              f"{row['throughput_mbps']} Mbps, latency {row['latency_ms']}", file=sys.stderr)
+    print(f"[replay] kept up: {result['kept_up']} (tool issued {result['issue_records_per_s']} records/s), "
+          f"schedule lag {result['schedule_lag_ms']}, skipped {result['skipped_records']} record(s)", file=sys.stderr)
+
+    text = json.dumps(result, indent=2)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,161 +1,118 @@
 # client.py
-import socket
-import threading
-import struct
-import sys
-import time
+import argparse
 
-def forward_from_local_to_server(local_conn, server_conn, player_id):
-    """อ่านข้อมูลจาก Local Service, ใส่ Header, แล้วส่งไปให้ Server"""
-    try:
-        while True:
-            data = local_conn.recv(4096)
-            if not data:
-                break
-            header = struct.pack('!II', player_id, len(data))
-            server_conn.sendall(header + data)
-    except (ConnectionResetError, BrokenPipeError, OSError):
-        # เมื่อ Socket ถูกปิดโดย Thread อื่น, Thread นี้จะจบการทำงานไปเงียบๆ
-        pass
-    # [แก้ไข] นำ local_conn.close() ออกไป เพราะ Thread หลักจะเป็นผู้จัดการ
-
-def forward_from_server_to_local(server_conn, local_target_addr):
-    """
-    [หัวใจหลัก] อ่านข้อมูลจาก Server, แกะ Header,
-    แล้วสร้าง/จัดการการเชื่อมต่อย่อยไปยัง Local Service
-    """
-    local_connections = {}
-    local_lock = threading.Lock()
-
-    try:
-        while True:
-            # อ่าน Header 8 bytes ให้ครบถ้วน
-            header_buffer = b''
-            while len(header_buffer) < 8:
-                packet = server_conn.recv(8 - len(header_buffer))
-                if not packet:
-                    header_buffer = None
-                    break
-                header_buffer += packet
-            
-            if not header_buffer:
-                print("[Tunnel] Server closed the connection.")
-                break
-            
-            player_id, length = struct.unpack('!II', header_buffer)
-            
-            # อ่านข้อมูลตามความยาวที่ระบุ
-            data = b''
-            if length > 0:
-                while len(data) < length:
-                    chunk = server_conn.recv(length - len(data))
-                    if not chunk:
-                        raise ConnectionError("Tunnel connection lost while reading data payload.")
-                    data += chunk
-
-            with local_lock:
-                # กรณีผู้เล่นใหม่
-                if player_id not in local_connections:
-                    if length == 0:
-                        continue
-                    
-                    print(f"[Player {player_id}] New connection detected. Connecting to local service...")
-                    try:
-                        local_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        local_conn.connect(local_target_addr)
-                        local_connections[player_id] = local_conn
-                        
-                        upstream_thread = threading.Thread(target=forward_from_local_to_server, args=(local_conn, server_conn, player_id))
-                        upstream_thread.start()
-                        print(f"[Player {player_id}] Local connection established.")
-                    except ConnectionRefusedError:
-                        print(f"[!] Could not connect to local service for Player {player_id}.")
-                        continue
-
-                # ถ้า length เป็น 0 หมายถึงผู้เล่นคนนี้หลุดการเชื่อมต่อ
-                if length == 0:
-                    if player_id in local_connections:
-                        print(f"[Player {player_id}] Disconnection signal received. Closing local connection.")
-                        local_connections[player_id].close() # Thread นี้เป็นผู้ปิดเท่านั้น
-                        del local_connections[player_id]
-                    continue
-
-                # ส่งข้อมูลไปยัง Local Service ที่ถูกต้อง
-                if player_id in local_connections:
-                    try:
-                        local_connections[player_id].sendall(data)
-                    except OSError:
-                        # Socket อาจถูกปิดไปแล้ว
-                        pass
+from p2p_client import ClientEngine, TUNNEL_FLUSH_WINDOW_US, LOCAL_POOL_SIZE, LOCAL_READ_SIZE
+from p2p_tunnel import READ_SIZE_MIN, parse_socket_buffers
+from p2p_profile import Profiler
 
-    except (ConnectionResetError, BrokenPipeError, OSError, ConnectionError) as e:
-        print(f"[Tunnel] Connection error: {e}")
-    finally:
-        print("[Tunnel] Shutting down all local connections.")
-        with local_lock:
-            for conn in local_connections.values():
-                conn.close()
-        server_conn.close()
+# [แก้ไข] ตรรกะของอุโมงค์ทั้งหมดย้ายไปอยู่ใน p2p_client.ClientEngine (ใช้ร่วมกับ p2p_gui)
+# อุโมงค์ทุกเส้นและผู้เล่นทุกคนทำงานใน event loop Thread เดียว แทน Thread ต่อผู้เล่นแบบเดิม
+LOCAL_HOST = '127.0.0.1'
+PROFILE_PATH = 'p2p-client-profile' # [ใหม่] prefix ของไฟล์ profile ที่เริ่มด้วย SIGUSR1
+PROFILE_SECONDS = 10
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="P2P tunnel client",
+        epilog="Example: python client.py 203.0.113.10 9000 25565 (several local ports, e.g. 25565 8080, "
+               "share one tunnel and each gets its own public port)")
+    parser.add_argument('server_ip')
+    parser.add_argument('control_port', type=int)
+    parser.add_argument('local_port', type=int, nargs='+')
+    parser.add_argument('--flush-us', type=int, default=TUNNEL_FLUSH_WINDOW_US,
+                        help="microseconds to wait for more frames before flushing a tunnel write (0 = no wait)")
+    parser.add_argument('--stripes', type=int, default=1,
+                        help="number of parallel tunnel connections; players are spread across them by the server")
+    parser.add_argument('--compress', action='store_true',
+                        help="ask the server to zlib-compress tunnel traffic (used only if the server agrees)")
+    parser.add_argument('--udp', action='store_true',
+                        help="expose a UDP local service: peers send datagrams to the public port")
+    parser.add_argument('--local-pool', type=int, default=LOCAL_POOL_SIZE,
+                        help="keep this many connections to the local service open in advance for new players (TCP only)")
+    parser.add_argument('--shared', action='store_true',
+                        help="ask for a token-routed tunnel on the server's shared port instead of a dedicated port")
+    parser.add_argument('--capture', metavar='FILE',
+                        help="record every tunnel frame (time, direction, player, length) to FILE for replay_capture.py")
+    parser.add_argument('--capture-payload', action='store_true',
+                        help="also store frame payloads in the capture (large; contains player data)")
+    parser.add_argument('--direct', action='store_true',
+                        help="ask for a separate spliced data connection per player (Linux, TCP; falls back to the tunnel)")
+    parser.add_argument('--local-read-max', type=int, default=LOCAL_READ_SIZE,
+                        help=f"largest read from a busy local service connection; reads start at {READ_SIZE_MIN} bytes "
+                             "and adapt (each read becomes one tunnel frame)")
+    parser.add_argument('--socket-buffer', action='append', default=[], metavar='NAME=BYTES',
+                        help="SO_SNDBUF/SO_RCVBUF per socket role, repeatable: tunnel_sndbuf, tunnel_rcvbuf, local_sndbuf, "
+                             "local_rcvbuf (default: kernel autotuning)")
+    parser.add_argument('--profile-path', default=PROFILE_PATH, metavar='PREFIX',
+                        help="file prefix for runtime profiles started by SIGUSR1 (Unix): PREFIX-<time>.folded stacks "
+                             "and .folded.timings per-frame stage timings")
+    parser.add_argument('--profile-seconds', type=int, default=PROFILE_SECONDS,
+                        help="length of a profile started by SIGUSR1")
+    return parser.parse_args(argv)
 
-def request_public_port(server_ip, server_control_port):
-    """เชื่อมต่อไปยัง Server เพื่อขอ Public Port แค่ครั้งเดียว"""
-    try:
-        print(f"[*] Requesting a public port from {server_ip}:{server_control_port}...")
-        req_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        req_socket.connect((server_ip, server_control_port))
-        response = req_socket.recv(1024).decode()
-        req_socket.close()
-        if response.startswith("ERROR"):
-            print(f"[-] Server could not assign a port: {response}")
-            return None
-        return int(response)
-    except Exception as e:
-        print(f"[!] Failed to request port: {e}")
-        return None
+def print_event(kind, data, compress_requested=False, direct_requested=False):
+    """[ใหม่] แสดงเหตุการณ์จาก ClientEngine บนหน้าจอในรูปแบบเดิมของ client"""
+    if kind == 'success':
+        print("="*40)
+        print("  SUCCESS! YOUR PERMANENT PORT IS ASSIGNED.")
+        print(f"  Your service is available at:")
+        print(f"  IP Address: {data['ip']}")
+        if len(data['services']) > 1:
+            # [ใหม่] หลาย Local Service บนอุโมงค์เดียว: แสดง Public Port คู่กับ Local Port ของแต่ละตัว
+            for local, public in data['services']:
+                print(f"  Port: {public}{' (UDP)' if data['udp'] else ''} -> local {local}")
+        else:
+            print(f"  Port: {data['port']}{' (UDP)' if data['udp'] else ''}")
+        if compress_requested:
+            print(f"  Compression: {'zlib' if data['compress'] else 'off (not supported by server)'}")
+        if direct_requested:
+            print(f"  Direct connections: {'on' if data['direct'] else 'off (not supported here or by server)'}")
+        if data['tunnel']:
+            print(f"  Tunnel ID: {data['tunnel']}")
+            print(f"  (Peers must send 'PEER {data['tunnel']}\\n' before their data)")
+        print("="*40)
+    elif kind == 'status':
+        print(f"[*] {data}")
+    elif kind in ('warning', 'error'):
+        print(f"[!] {data}")
+    elif kind == 'log':
+        print(data)
 
 def main():
-    """ฟังก์ชันหลัก ทำหน้าที่ขอ Port, สร้างอุโมงค์, แล้วเริ่มระบบจัดการผู้เล่น"""
-    if len(sys.argv) != 4:
-        print("Usage: python client.py <server_ip> <control_port> <local_port>")
-        print("Example: python client.py 203.0.113.10 9000 25565")
-        sys.exit(1)
-
-    SERVER_IP = sys.argv[1]
-    SERVER_CONTROL_PORT = int(sys.argv[2])
-    LOCAL_PORT = int(sys.argv[3])
-    LOCAL_HOST = '127.0.0.1'
-
-    # 1. ขอ Public Port มาแค่ครั้งเดียว
-    public_port = request_public_port(SERVER_IP, SERVER_CONTROL_PORT)
-    if not public_port:
-        print("[!] Could not get a public port. Exiting.")
-        return
-
-    print("="*40)
-    print("  SUCCESS! YOUR PERMANENT PORT IS ASSIGNED.")
-    print(f"  Your service is available at:")
-    print(f"  IP Address: {SERVER_IP}")
-    print(f"  Port: {public_port}")
-    print("="*40)
-    
+    """ฟังก์ชันหลัก ทำหน้าที่ขอ Port, สร้างอุโมงค์, แล้วเริ่มระบบจัดการผู้เล่น (ผ่าน ClientEngine)"""
+    args = parse_args()
     try:
-        # 2. สร้างอุโมงค์ถาวรไปยัง Public Port
-        print(f"[*] Establishing persistent tunnel to {SERVER_IP}:{public_port}...")
-        server_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_conn.connect((SERVER_IP, public_port))
-        print("[+] Tunnel established. Ready to accept multiple players.")
-        
-        # 3. เริ่ม Thread หลักที่คอยจัดการข้อมูลจากอุโมงค์
-        main_thread = threading.Thread(target=forward_from_server_to_local, args=(server_conn, (LOCAL_HOST, LOCAL_PORT)))
-        main_thread.start()
-        main_thread.join() # รอจนกว่าอุโมงค์จะถูกปิด
-
+        socket_buffers = parse_socket_buffers(args.socket_buffer, ('tunnel', 'local'))
+    except ValueError as e:
+        raise SystemExit(f"[!] --socket-buffer: {e}")
+    engine = ClientEngine(args.server_ip, args.control_port, args.local_port, LOCAL_HOST, shared=args.shared,
+                          stripes=args.stripes, compress=args.compress, udp=args.udp, flush_us=args.flush_us,
+                          local_pool=args.local_pool, direct=args.direct, capture=args.capture,
+                          capture_payload=args.capture_payload, read_max=max(1, args.local_read_max),
+                          socket_buffers=socket_buffers,
+                          on_event=lambda kind, data: print_event(kind, data, args.compress, args.direct))
+    # [ใหม่] kill -USR1 <pid>: สุ่ม stack และจับเวลาต่อ Frame ของ engine ระหว่างที่ทำงานอยู่ (ไม่มีผลเมื่อไม่ได้สั่ง)
+    profiler = Profiler(args.profile_path, on_timings=lambda timings: setattr(engine, 'timings', timings))
+    profiler.install_signal(max(1, args.profile_seconds))
+    try:
+        engine.run() # ทำงานใน Thread หลักจนกว่าอุโมงค์จะหลุดโดย RESUME ไม่ได้ หรือกด Ctrl+C
     except KeyboardInterrupt:
         print("\n[*] Program stopped by user.")
-    except Exception as e:
-        print(f"\n[!] A critical error occurred: {e}")
     finally:
+        stats = engine.stats()
+        print(f"[*] Relayed {stats['frames_to_local']} frames ({stats['bytes_to_local']}B) to the local service and "
+              f"{stats['frames_to_server']} frames ({stats['bytes_to_server']}B) to the server "
+              f"for {stats['players_opened']} player(s).")
+        if args.capture and engine.capture is not None:
+            print(f"[*] Captured {engine.capture.records} record(s) to {args.capture}.")
+        if args.direct:
+            print(f"[*] Direct connections: {stats['direct_opened']} player(s) bypassed the tunnel.")
+        compression = engine.compression_summary()
+        if compression:
+            print(f"[*] Compression: {compression}")
+        if args.local_pool > 0:
+            print(f"[*] Local pool: {stats['pool_hits']} player(s) used a pre-connected socket, "
+                  f"{stats['pool_misses']} had to connect.")
         print("[*] Final cleanup complete.")
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+# p2p_capture.py
+# บันทึก Frame ที่ผ่านอุโมงค์ลงไฟล์ binary ขนาดเล็ก เพื่อนำไปเล่นซ้ำ (benchmarks/replay_capture.py) ตอนปรับจูน relay
+#
+# รูปแบบไฟล์: ต่อกันเป็น segment (เปิดไฟล์เดิมซ้ำ เช่น worker ที่ถูกเริ่มใหม่ จะต่อ segment ใหม่ท้ายไฟล์)
+#   segment header: magic 'P2PCAP', version (1 byte), flags (1 byte: bit 0 = มี payload), เวลาเริ่ม (epoch, double)
+#   record: เวลาตั้งแต่เริ่ม segment (µs, uint64), อุโมงค์ (uint32), ทิศทาง (uint8), player_id (uint32), length (uint32)
+#           ตามด้วย payload length bytes ถ้า segment มี payload
+#   ทิศทาง 0 = ผู้เล่น -> Host (to_host), 1 = Host -> ผู้เล่น (to_peer), 2 = ชื่ออุโมงค์ใหม่ (player_id = เลขอุโมงค์,
+#   payload = ชื่อ ซึ่งมีเสมอแม้ segment จะไม่เก็บ payload) length 0 ของทิศทาง 0/1 คือผู้เล่นหลุดเหมือนใน wire format
+#
+# record เป็นข้อมูลของผู้เล่นหลังแกะการบีบอัดแล้ว (สิ่งที่ผู้เล่น/Local Service ส่งจริง) ไม่รวม heartbeat และผู้เล่นโหมด direct
+import struct
+import threading
+import time
+from collections import namedtuple
+
+CAPTURE_MAGIC = b'P2PCAP'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('!6sBBd')
+CAPTURE_RECORD = struct.Struct('!QIBII')
+CAPTURE_FLAG_PAYLOAD = 0x01
+CAPTURE_TO_HOST = 0
+CAPTURE_TO_PEER = 1
+CAPTURE_TUNNEL = 2
+CAPTURE_DIRECTIONS = {CAPTURE_TO_HOST: 'to_host', CAPTURE_TO_PEER: 'to_peer'}
+CAPTURE_FLUSH_SECONDS = 1.0 # เขียนบัฟเฟอร์ลงไฟล์ทุกเท่านี้ (process ที่ถูก kill เสีย record ไม่เกินช่วงนี้)
+CAPTURE_BUFFER_BYTES = 1024 * 1024
+
+CaptureRecord = namedtuple('CaptureRecord', 'time tunnel direction player_id length payload')
+
+
+class FrameCapture:
+    """
+    ตัวบันทึก 1 ไฟล์ที่ใช้ร่วมกันทุก Thread (มี lock สั้นๆ ต่อ record) เขียนผ่านบัฟเฟอร์ของไฟล์ ไม่ใช่ syscall ต่อ Frame
+    Thread เบื้องหลังเขียนบัฟเฟอร์ลงดิสก์ทุก CAPTURE_FLUSH_SECONDS แม้ช่วงที่ไม่มี Frame เลย
+    ผู้เรียกเช็ค `capture is not None` เองใน hot loop: เมื่อไม่ได้เปิดบันทึกจึงไม่มีค่าใช้จ่ายเพิ่มเลย
+    """
+    def __init__(self, path, payload=False):
+        self.path = path
+        self.payload = payload
+        self.file = open(path, 'ab', buffering=CAPTURE_BUFFER_BYTES)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.tunnels = 0
+        self.records = 0
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION,
+                                            CAPTURE_FLAG_PAYLOAD if payload else 0, time.time()))
+        self.closed = threading.Event()
+        threading.Thread(target=self._flusher, daemon=True).start()
+
+    def add_tunnel(self, name):
+        """ลงทะเบียนอุโมงค์ใหม่ คืนค่าเลขอุโมงค์ที่ใช้กับ record() (ชื่อซ้ำได้ เช่น Port เดิมที่ถูกแจกใหม่)"""
+        encoded = str(name).encode('utf-8', 'replace')
+        with self.lock:
+            self.tunnels += 1
+            tunnel = self.tunnels
+            self._write(CAPTURE_RECORD.pack(self._now(), 0, CAPTURE_TUNNEL, tunnel, len(encoded)), encoded)
+        return tunnel
+
+    def record(self, tunnel, direction, player_id, data=b''):
+        header = CAPTURE_RECORD.pack(self._now(), tunnel, direction, player_id, len(data))
+        with self.lock:
+            self._write(header, data if self.payload else None)
+
+    def _now(self):
+        return int((time.monotonic() - self.started) * 1_000_000)
+
+    def _write(self, header, data):
+        file = self.file
+        if file is None:
+            return
+        try:
+            file.write(header)
+            if data:
+                file.write(data)
+            self.records += 1
+        except OSError as e:
+            self._fail(e)
+
+    def _fail(self, error):
+        # ดิสก์เต็มหรือไฟล์เสีย: หยุดบันทึก แต่ relay ต้องทำงานต่อได้
+        print(f"[!] Frame capture to {self.path} stopped: {error}")
+        self.file = None
+
+    def _flusher(self):
+        while not self.closed.wait(CAPTURE_FLUSH_SECONDS):
+            with self.lock:
+                if self.file is not None:
+                    try:
+                        self.file.flush()
+                    except OSError as e:
+                        self._fail(e)
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            if self.file is not None:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+                self.file = None
+
+
+class CaptureReader:
+    """
+    อ่านไฟล์ capture เป็น CaptureRecord เรียงตามลำดับในไฟล์ (เวลาเป็น epoch วินาที จึงเทียบข้ามไฟล์/segment ได้)
+    เลขอุโมงค์ไม่ซ้ำกันทั้งไฟล์ (segment ถัดไปเริ่มนับต่อ) ชื่อของแต่ละเลขอยู่ใน tunnels หลังอ่านผ่าน record นั้นแล้ว
+    payloads=False: ข้าม payload ด้วย seek (record.payload เป็น None) ใช้สำหรับสรุปไฟล์ใหญ่ๆ
+    """
+    def __init__(self, path, payloads=True):
+        self.path = path
+        self.payloads = payloads
+        self.tunnels = {}
+        self.segments = 0
+        self.has_payload = False
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            base = 0
+            epoch = None
+            with_payload = False
+            while True:
+                header = f.read(CAPTURE_RECORD.size)
+                if not header:
+                    return
+                if header.startswith(CAPTURE_MAGIC) and len(header) >= CAPTURE_HEADER.size:
+                    # (record จริงขึ้นต้นด้วย magic ไม่ได้: จะเป็นเวลาหลายแสนปี)
+                    _, version, flags, epoch = CAPTURE_HEADER.unpack_from(header)
+                    if version != CAPTURE_VERSION:
+                        raise ValueError(f"{self.path}: unsupported capture version {version}")
+                    # header สั้นกว่า record: ถอยกลับไปที่ record แรกของ segment
+                    f.seek(CAPTURE_HEADER.size - len(header), 1)
+                    base = max(self.tunnels, default=0)
+                    with_payload = bool(flags & CAPTURE_FLAG_PAYLOAD)
+                    self.has_payload = self.has_payload or with_payload
+                    self.segments += 1
+                    continue
+                if epoch is None:
+                    raise ValueError(f"{self.path}: not a capture file")
+                if len(header) < CAPTURE_RECORD.size:
+                    return # ไฟล์ถูกตัดกลางคัน (process ถูก kill ระหว่างเขียน)
+                offset, tunnel, direction, player_id, length = CAPTURE_RECORD.unpack(header)
+                if direction == CAPTURE_TUNNEL:
+                    self.tunnels[base + player_id] = f.read(length).decode('utf-8', 'replace')
+                    continue
+                payload = None
+                if with_payload and length:
+                    if self.payloads:
+                        payload = f.read(length)
+                        if len(payload) < length:
+                            return # ไฟล์ถูกตัดกลางคัน (process ถูก kill ระหว่างเขียน)
+                    else:
+                        f.seek(length, 1)
+                yield CaptureRecord(epoch + offset / 1_000_000, base + tunnel, CAPTURE_DIRECTIONS.get(direction),
+                                    player_id, length, payload)
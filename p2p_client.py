@@ -0,0 +1,1141 @@
+# p2p_client.py
+# แกนการทำงานของฝั่ง Host (Client) ที่ใช้ร่วมกันระหว่าง clientp2p (CLI) และ p2p_gui
+# อุโมงค์ทุกเส้นและการเชื่อมต่อไปยัง Local Service ของผู้เล่นทุกคนทำงานใน event loop (selectors) Thread เดียว
+# ผู้เล่นหลายร้อยคนจึงไม่ต้องมี Thread หลายร้อยตัว และไม่มี lock ใน hot loop เลย
+#
+# งานที่ต้องรอนาน (ขอ Port, RESUME, เปิดเส้นเสริม) ทำใน Thread ชั่วคราวแล้วส่งผลกลับเข้า loop ด้วย call_soon
+# (งานต่อผู้เล่น เช่น connect ไปยัง Local Service และเปิดการเชื่อมต่อ DATA ของโหมด direct ทำใน loop แบบ non-blocking)
+# ส่วนหน้า (CLI/GUI) ติดต่อกับ ClientEngine ผ่าน start()/run(), stop(), stats() และ callback on_event(kind, data)
+# kind: 'status' (สถานะหลัก), 'log' (รายละเอียดต่อผู้เล่น), 'warning', 'success' (ได้ Port แล้ว), 'error', 'stopped'
+#
+# [ใหม่] โหมด direct (direct=True, Linux): เมื่อ Server ส่ง OPEN มาบน player_id 0 จะเปิดการเชื่อมต่อข้อมูลแยกของผู้เล่นคนนั้น
+# แล้วย้ายข้อมูลระหว่างการเชื่อมต่อนั้นกับ Local Service ด้วย splice ใน loop เดียวกัน (ไม่มี Frame และไม่ผ่าน Python)
+#
+# [ใหม่] หลาย Local Service (local_port เป็น list): ขอ Public Port ครบทุกตัวในคำสั่ง PORT เดียว ทุก service ใช้อุโมงค์
+# ชุดเดียวกัน ผู้เล่นแต่ละคนถูกส่งไปยัง Local Service ตาม service_of(player_id) ของ Frame แรก
+import errno
+import heapq
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from p2p_tunnel import (FRAME_HEADER, HEADER_SIZE, WRITER_MAX_PENDING_BYTES, UDP_MAX_DATAGRAM, LOCAL_CONNECT_TIMEOUT,
+                        LOCAL_PENDING_MAX_BYTES, HEARTBEAT_PLAYER_ID, HEARTBEAT_PING, HEARTBEAT_PONG, HEARTBEAT_MISSES,
+                        FAIR_BATCH_BYTES, FAIR_PLAYER_MAX_BYTES, FairQueue, FrameDecoder, FrameCompressor,
+                        FrameDecompressor, CompressionStats, LocalConnectionPool, DIRECT_OPEN, SPLICE_SUPPORTED, SplicePump,
+                        ControlError, control_request, resume_tunnel, add_tunnel_stripe, format_control_line,
+                        parse_control_line, CONTROL_LINE_LIMIT, send_buffers_nowait, format_compression_stats, limit_unsent, set_keepalive,
+                        ReadSizer, READ_SIZE_MIN, READ_SIZE_MAX, set_socket_buffers, service_of)
+from p2p_capture import FrameCapture, CAPTURE_TO_HOST, CAPTURE_TO_PEER
+
+TUNNEL_FLUSH_WINDOW_US = 0 # ไมโครวินาทีที่รอรวม Frame เล็กๆ ก่อนส่งขึ้นอุโมงค์ (0 = ส่งเมื่อจบรอบของ loop)
+STRIPE_ATTACH_ATTEMPTS = 5 # จำนวนครั้งที่ลองเปิดเส้นเสริมก่อน Server จะเห็นเส้นแรก
+RESUME_RETRY_SECONDS = 30 # ระยะเวลาที่พยายาม RESUME อุโมงค์เดิมหลังหลุด (ควรไม่เกิน grace ของ Server)
+LOCAL_READ_SIZE = READ_SIZE_MAX # [แก้ไข] อ่านจาก Local Service ครั้งละไม่เกินนี้ (1 ครั้ง = 1 Frame) เริ่มที่ READ_SIZE_MIN แล้วปรับด้วย ReadSizer
+FAIR_QUANTUM = 65536 + HEADER_SIZE # [ใหม่] bytes ต่อรอบ DRR ของผู้เล่นแต่ละคน (Frame ที่ใหญ่กว่านี้สะสมเครดิตข้ามรอบ)
+LOCAL_POOL_SIZE = 0 # จำนวน socket ที่ connect ไปยัง Local Service ไว้ล่วงหน้า (0 = ไม่ใช้ pool)
+DIRECT_PUMP_BYTES = 256 * 1024 # [ใหม่] bytes ที่ผู้เล่นโหมด direct ย้ายได้ต่อทิศทางต่อรอบของ loop ก่อนให้คนอื่นทำงานบ้าง
+DIRECT_ATTACH_TIMEOUT = 10 # [ใหม่] วินาทีที่รอต่อ Control Port และได้คำตอบของคำสั่ง DATA
+
+_CONNECT_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+class _Stripe:
+    """อุโมงค์ 1 เส้นใน loop: บัฟเฟอร์ขาออก, stream บีบอัด และผู้เล่นที่ Server pin ไว้กับเส้นนี้"""
+    __slots__ = ('sock', 'index', 'decoder', 'fair', 'out', 'out_bytes', 'flush_at', 'dirty', 'compressor',
+                 'decompressor', 'players', 'blocked_by', 'stalled', 'events', 'heard', 'missed')
+
+    def __init__(self, sock, index, compress):
+        self.sock = sock
+        self.index = index
+        self.decoder = FrameDecoder(sock)
+        self.fair = FairQueue(FAIR_QUANTUM) # [ใหม่] Frame ที่รอส่งแยกตามผู้เล่น ปล่อยทีละ batch ตามลำดับ DRR
+        self.out = [] # [แก้ไข] batch ปัจจุบันที่ kernel ยังรับไม่หมด (ส่งด้วย sendmsg ทีเดียว) ไม่เกินราว FAIR_BATCH_BYTES
+        self.out_bytes = 0 # out + fair
+        self.flush_at = 0.0
+        self.dirty = False # อยู่ในรายการที่ต้อง flush เมื่อจบรอบของ loop
+        self.compressor = FrameCompressor() if compress else None
+        self.decompressor = FrameDecompressor() if compress else None
+        self.players = {} # {player_id: _Player}
+        self.blocked_by = set() # ผู้เล่นที่ Local Service รับข้อมูลไม่ทัน: หยุดอ่านเส้นนี้จนกว่าจะว่าง
+        self.stalled = [] # ผู้เล่นที่หยุดอ่านจาก Local Service ไว้เพราะคิวขาออกของตัวเอง (หรือของทั้งเส้น) เต็ม
+        self.events = 0
+        self.heard = False # [ใหม่] มีข้อมูลจาก Server ตั้งแต่รอบ heartbeat ก่อน
+        self.missed = 0 # จำนวนรอบ heartbeat ติดกันที่เส้นนี้เงียบ
+
+
+class _Player:
+    """การเชื่อมต่อไปยัง Local Service ของผู้เล่น 1 คน (TCP หรือ socket UDP ที่ connect ไว้)"""
+    __slots__ = ('player_id', 'stripe', 'sock', 'udp', 'connecting', 'deadline', 'out', 'out_bytes', 'eof', 'paused',
+                 'events', 'sizer')
+
+    def __init__(self, player_id, stripe, sock, udp=False, connecting=False):
+        self.player_id = player_id
+        self.stripe = stripe
+        self.sock = sock # None = การเชื่อมต่อเสียไปแล้ว (ข้อมูลที่ตามมาถูกทิ้งจนกว่า Server จะบอกว่าผู้เล่นหลุด)
+        self.udp = udp
+        self.connecting = connecting
+        self.deadline = 0.0
+        self.out = deque() # ข้อมูลที่รอส่งไปยัง Local Service (รวมช่วงที่ยัง connect ไม่เสร็จ)
+        self.out_bytes = 0
+        self.eof = False # Local Service ปิดฝั่งส่งแล้ว (ยังส่งข้อมูลไปหาได้ต่อ)
+        self.paused = False
+        self.events = 0
+        self.sizer = None # [ใหม่] ReadSizer ของ TCP (datagram อ่านเต็มขนาดเสมอ)
+
+
+class _DirectEnd:
+    """[ใหม่] socket 1 ฝั่งของ _DirectPlayer ที่ลงทะเบียนกับ selector (ทั้งสองฝั่งชี้กลับไปที่ผู้เล่นคนเดียวกัน)"""
+    __slots__ = ('player', 'sock', 'events')
+
+    def __init__(self, player, sock):
+        self.player = player
+        self.sock = sock
+        self.events = 0
+
+
+class _DirectOpening:
+    """
+    [ใหม่] ผู้เล่นโหมด direct ที่กำลังเปิดการเชื่อมต่อใน loop ทีละขั้น (phase):
+    'local' = รอ connect ไปยัง Local Service, 'data' = รอ connect ไปยัง Control Port แล้วส่งคำสั่ง DATA,
+    'reply' = รอบรรทัดคำตอบ sock คือ socket ของขั้นปัจจุบันที่ลงทะเบียนกับ selector
+    """
+    __slots__ = ('player_id', 'phase', 'local', 'sock', 'events', 'deadline', 'request', 'reply')
+
+    def __init__(self, player_id, local):
+        self.player_id = player_id
+        self.phase = 'local'
+        self.local = local
+        self.sock = local
+        self.events = 0
+        self.deadline = None
+        self.request = b''
+        self.reply = bytearray()
+
+
+class _DirectPlayer:
+    """
+    [ใหม่] ผู้เล่น 1 คนในโหมด direct: Local Service กับการเชื่อมต่อข้อมูลจากคำสั่ง DATA
+    up ย้าย Local Service -> Server, down ย้าย Server -> Local Service (SplicePump แบบ non-blocking ทั้งคู่)
+    """
+    __slots__ = ('player_id', 'local', 'data', 'up', 'down')
+
+    def __init__(self, player_id, local_sock, data_sock):
+        self.player_id = player_id
+        self.local = _DirectEnd(self, local_sock)
+        self.data = _DirectEnd(self, data_sock)
+        self.up = SplicePump(local_sock, data_sock)
+        self.down = SplicePump(data_sock, local_sock)
+
+
+class ClientEngine:
+    """
+    ขอ Public Port แล้วต่ออุโมงค์ไปยัง Server พร้อมส่งต่อข้อมูลของผู้เล่นทุกคนไปยัง Local Service ใน Thread เดียว
+    - run() ทำงานจนจบใน Thread ที่เรียก, start() เปิด Thread ใหม่ (daemon) ให้ run()
+    - stop() เรียกจาก Thread ไหนก็ได้ loop จะตื่นทันทีและปิดทุกการเชื่อมต่อเอง
+    - stats() คืน dict ของตัวนับ (อ่านจาก Thread อื่นได้ ค่าอาจช้ากว่าความจริงเล็กน้อย)
+    - [ใหม่] local_port เป็น list ได้: Local Service หลายตัวบนอุโมงค์เดียว แต่ละตัวได้ Public Port ของตัวเอง
+    """
+    def __init__(self, server_ip, control_port, local_port, local_host='127.0.0.1', shared=False, stripes=1,
+                 compress=False, udp=False, flush_us=TUNNEL_FLUSH_WINDOW_US, local_pool=LOCAL_POOL_SIZE, direct=False,
+                 capture=None, capture_payload=False, read_max=LOCAL_READ_SIZE, socket_buffers=None, on_event=None):
+        self.server_ip = server_ip
+        self.control_port = control_port
+        ports = [local_port] if isinstance(local_port, int) else list(local_port)
+        self.local_addrs = [(local_host, port) for port in ports] # [แก้ไข] ลำดับ = service ใน player_id
+        self.shared = shared
+        self.stripes_requested = stripes
+        self.compress_requested = compress
+        self.udp_requested = udp
+        self.flush_window = flush_us / 1_000_000
+        self.local_pool_size = local_pool
+        self.direct_requested = direct and SPLICE_SUPPORTED and not udp
+        self.capture_path = capture # [ใหม่] บันทึก Frame ของอุโมงค์ลงไฟล์นี้ (p2p_capture)
+        self.capture_payload = capture_payload
+        self.capture = None
+        self.capture_id = 0
+        self.timings = None # [ใหม่] FrameTimings ของ p2p_profile ระหว่าง session (ตั้งจาก Thread อื่นได้ loop อ่านครั้งเดียวต่อ Frame)
+        self.read_max = read_max # [ใหม่] ขนาด recv สูงสุดจาก Local Service ของผู้เล่นที่ส่งต่อเนื่อง
+        self.socket_buffers = socket_buffers or {} # [ใหม่] {'tunnel'/'local': (SO_SNDBUF, SO_RCVBUF)}
+        self.on_event = on_event or (lambda kind, data: None)
+
+        self.public_port = None
+        self.public_ports = [] # [ใหม่] Public Port ของแต่ละ Local Service (ตัวแรกคือ public_port)
+        self.lease_secret = None
+        self.stripe_count = 1 # จำนวนเส้นที่ Server อนุญาต
+        self.compress = False
+        self.udp = False
+        self.heartbeat = 0 # [ใหม่] วินาทีระหว่าง PING ที่ตกลงกับ Server (0 = Server ไม่รองรับ)
+        self.direct = False # [ใหม่] Server ตกลงโหมด direct
+        self.pools = [] # [แก้ไข] LocalConnectionPool ต่อ Local Service (ว่าง = ไม่ใช้ pool)
+        self.direct_players = {} # [ใหม่] {player_id: _DirectPlayer}
+        self.direct_openings = {} # [ใหม่] {player_id: _DirectOpening} ที่ยังเปิดไม่เสร็จ
+        self.control_addr = None # [ใหม่] (family, address) ของ Control Port ที่ resolve แล้ว สำหรับคำสั่ง DATA ใน loop
+
+        self.selector = None
+        self.stripes = []
+        self.dirty = [] # เส้นที่มี Frame รอ flush
+        self.timers = [] # heap ของ (deadline, ลำดับ, player หรือ stripe): timeout ของการ connect และรอบ heartbeat
+        self.timer_seq = 0
+        self.calls = deque() # งานจาก Thread อื่นที่ต้องทำใน loop
+        self.stop_requested = threading.Event()
+        self.reattaching = False # มี Thread กำลัง RESUME/เปิดเส้นเสริมอยู่
+        self.reattach_again = False
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.thread = None
+
+        self.frames_to_local = 0 # ตัวนับทั้งหมดแก้โดย Thread ของ loop เท่านั้น
+        self.bytes_to_local = 0
+        self.frames_to_server = 0
+        self.bytes_to_server = 0
+        self.players_opened = 0
+        self.local_connect_failures = 0
+        self.direct_opened = 0
+        self.compression_sent = CompressionStats() # สถิติการบีบอัดรวมของเส้นที่จบไปแล้ว
+        self.compression_received = _DecompressTotals()
+
+    # --- API สำหรับส่วนหน้า ---
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        """ขอให้ engine หยุด (เรียกซ้ำได้ และเรียกจาก Thread ไหนก็ได้)"""
+        self.stop_requested.set()
+        self._wake()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def call_soon(self, callback, *args):
+        """ให้ loop เรียก callback(*args) ในรอบถัดไป (เรียกจาก Thread อื่นได้)"""
+        self.calls.append((callback, args))
+        self._wake()
+
+    def stats(self):
+        stripes = list(self.stripes)
+        players = [player for stripe in stripes for player in list(stripe.players.values())]
+        pools = list(self.pools)
+        return {
+            'public_port': self.public_port,
+            'public_ports': list(self.public_ports),
+            'stripes': len(stripes),
+            'players': len(players) + len(self.direct_players),
+            'players_opened': self.players_opened,
+            'direct_players': len(self.direct_players),
+            'direct_opened': self.direct_opened,
+            'local_connect_failures': self.local_connect_failures,
+            'frames_to_local': self.frames_to_local,
+            'bytes_to_local': self.bytes_to_local,
+            'frames_to_server': self.frames_to_server,
+            'bytes_to_server': self.bytes_to_server,
+            'tunnel_queued_bytes': sum(stripe.out_bytes for stripe in stripes),
+            'tunnel_queue_depths': self._queue_depths(stripes),
+            'local_queued_bytes': sum(player.out_bytes for player in players),
+            'pool_hits': sum(pool.hits for pool in pools),
+            'pool_misses': sum(pool.misses for pool in pools),
+        }
+
+    @staticmethod
+    def _queue_depths(stripes):
+        """[ใหม่] bytes ที่ผู้เล่นแต่ละคนมีค้างในคิวขึ้นอุโมงค์ {player_id: bytes} (dict(...) คัดลอกโดยไม่ปล่อย GIL ระหว่างทาง)"""
+        depths = {}
+        for stripe in stripes:
+            depths.update(dict(stripe.fair.depths))
+        return depths
+
+    def compression_summary(self):
+        """ข้อความสรุปการบีบอัดของทุกเส้น (None ถ้าไม่ได้บีบอัด)"""
+        if not self.compress:
+            return None
+        sent, received = CompressionStats(), _DecompressTotals()
+        sent.add(self.compression_sent)
+        received.add(self.compression_received)
+        for stripe in list(self.stripes):
+            sent.add(stripe.compressor.stats())
+            received.add(stripe.decompressor)
+        return format_compression_stats(sent, received)
+
+    def run(self):
+        """ขอ Port, ต่ออุโมงค์ แล้วทำงานจนกว่าจะ stop() หรืออุโมงค์หลุดโดย RESUME ไม่ได้"""
+        try:
+            if self._setup():
+                self._loop()
+        except Exception as e:
+            if not self.stop_requested.is_set():
+                self._emit('error', f"A critical error occurred: {e}")
+        finally:
+            self._close_all()
+            self._emit('stopped', "Connection closed.")
+
+    # --- การตั้งค่าอุโมงค์ (blocking ก่อนเริ่ม loop) ---
+
+    def _emit(self, kind, data):
+        self.on_event(kind, data)
+
+    def _setup(self):
+        self._emit('status', f"Requesting a public port from {self.server_ip}:{self.control_port}...")
+        services = len(self.local_addrs)
+        try:
+            reply = control_request((self.server_ip, self.control_port), 'TUNNEL' if self.shared else 'PORT',
+                                    stripes=self.stripes_requested if self.stripes_requested > 1 else None,
+                                    compress='zlib' if self.compress_requested else None,
+                                    proto='udp' if self.udp_requested else None, heartbeat=1,
+                                    direct=1 if self.direct_requested else None,
+                                    services=services if services > 1 else None)
+        except ControlError as e:
+            self._emit('error', f"Server could not assign a port: {e}")
+            return False
+        except OSError as e:
+            self._emit('error', f"Failed to request port: {e}")
+            return False
+        self.udp = reply.get('proto') == 'udp'
+        if self.udp_requested and not self.udp:
+            # Server รุ่นเก่าไม่รู้จัก proto และแจก Port แบบ TCP มาให้ ซึ่งผู้เล่น UDP ใช้ไม่ได้
+            self._emit('error', "The server does not support UDP ports.")
+            return False
+        if 'host' in reply:
+            # [ใหม่] ขอผ่าน p2p_directory: อุโมงค์, RESUME, STRIPE และ DATA ต้องไปที่ relay node ที่ถูกเลือกโดยตรง
+            self.server_ip, self.control_port = reply['host'], int(reply.get('control', self.control_port))
+            self._emit('status', f"Assigned to relay node {self.server_ip}:{self.control_port}.")
+        self.public_port = int(reply['port'])
+        self.public_ports = [int(port) for port in reply['ports'].split(',')] if 'ports' in reply else [self.public_port]
+        if len(self.public_ports) != services:
+            # Server รุ่นเก่าไม่รู้จัก services และแจก Port มาตัวเดียว: service อื่นจะไม่มีผู้เล่นเข้าถึงได้
+            self._emit('error', "The server does not support several local services on one tunnel.")
+            return False
+        self.lease_secret = reply.get('secret') # Server รุ่นเก่าไม่ส่งมา = RESUME ไม่ได้
+        self.stripe_count = int(reply.get('stripes', 1)) if self.lease_secret else 1
+        self.compress = reply.get('compress') == 'zlib'
+        self.heartbeat = int(reply.get('heartbeat', 0))
+        self.direct = reply.get('direct') == '1' and bool(self.lease_secret)
+        tunnel_token = reply.get('tunnel')
+        self._emit('success', {'ip': self.server_ip, 'port': self.public_port, 'udp': self.udp, 'tunnel': tunnel_token,
+                               'services': [(local[1], public) for local, public in zip(self.local_addrs, self.public_ports)],
+                               'compress': self.compress, 'stripes': self.stripe_count, 'direct': self.direct})
+        if self.stop_requested.is_set():
+            return False
+
+        self._emit('status', f"Connecting to tunnel at {self.server_ip}:{self.public_port}...")
+        server_conn = socket.create_connection((self.server_ip, self.public_port), timeout=10)
+        if tunnel_token:
+            # Shared Port: บอก Server ว่าการเชื่อมต่อนี้คือ Host ของอุโมงค์ไหน
+            server_conn.sendall(f"HOST {tunnel_token}\n".encode())
+        self.control_addr = (server_conn.family, (server_conn.getpeername()[0], self.control_port))
+        conns = [server_conn] + open_extra_stripes((self.server_ip, self.control_port), self.lease_secret,
+                                                   self.stripe_count - 1, self._emit)
+
+        if self.capture_path:
+            self.capture = FrameCapture(self.capture_path, payload=self.capture_payload)
+            self.capture_id = self.capture.add_tunnel(self.public_port)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.waker_r, selectors.EVENT_READ, None)
+        if self.local_pool_size > 0 and not self.udp:
+            self.pools = [LocalConnectionPool(addr, self.local_pool_size) for addr in self.local_addrs]
+        for conn in conns:
+            self._add_stripe(conn)
+        self._emit('status', f"Tunnel established over {len(conns)} connection(s). Running")
+        return True
+
+    # --- event loop ---
+
+    def _loop(self):
+        select = self.selector.select
+        while not self.stop_requested.is_set() and (self.stripes or self.reattaching):
+            for key, mask in select(self._next_timeout()):
+                target = key.data
+                if target is None:
+                    self._drain_waker()
+                elif target.sock is None:
+                    continue # ถูกปิดไปแล้วโดยเหตุการณ์ก่อนหน้าในรอบเดียวกัน
+                elif type(target) is _Player:
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush_local(target)
+                    if mask & selectors.EVENT_READ and target.events & selectors.EVENT_READ:
+                        self._read_local(target)
+                elif type(target) is _DirectEnd:
+                    self._pump_direct(target.player)
+                elif type(target) is _DirectOpening:
+                    self._advance_direct(target)
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush_stripe(target)
+                    if mask & selectors.EVENT_READ and target.events & selectors.EVENT_READ:
+                        self._read_stripe(target)
+            while self.calls:
+                callback, args = self.calls.popleft()
+                callback(*args)
+            now = time.monotonic()
+            if self.timers:
+                self._run_timers(now)
+            if self.dirty:
+                self._flush_dirty(now)
+
+    def _next_timeout(self):
+        if self.calls:
+            return 0
+        deadlines = [stripe.flush_at for stripe in self.dirty]
+        if self.timers:
+            deadlines.append(self.timers[0][0])
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def _wake(self):
+        try:
+            self.waker_w.send(b'\0')
+        except OSError:
+            pass # บัฟเฟอร์เต็มก็แปลว่า loop จะตื่นอยู่แล้ว (หรือ engine ปิดไปแล้ว)
+
+    def _drain_waker(self):
+        try:
+            while self.waker_r.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def _set_events(self, target, events):
+        """เปลี่ยนเหตุการณ์ที่สนใจของ socket (0 = ถอดออกจาก selector)"""
+        if target.events == events:
+            return
+        if events == 0:
+            self.selector.unregister(target.sock)
+        elif target.events == 0:
+            self.selector.register(target.sock, events, target)
+        else:
+            self.selector.modify(target.sock, events, target)
+        target.events = events
+
+    def _update_player(self, player):
+        events = 0
+        if player.sock is not None:
+            if player.connecting or player.out:
+                events |= selectors.EVENT_WRITE
+            if not (player.connecting or player.eof or player.paused):
+                events |= selectors.EVENT_READ
+        self._set_events(player, events)
+
+    def _update_stripe(self, stripe):
+        events = 0 if stripe.blocked_by else selectors.EVENT_READ
+        if stripe.out_bytes and not stripe.dirty:
+            events |= selectors.EVENT_WRITE
+        self._set_events(stripe, events)
+
+    # --- อุโมงค์ (ทิศ Server -> Local Service) ---
+
+    def _add_stripe(self, conn):
+        conn.settimeout(None)
+        conn.setblocking(False)
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # การรวม Frame ทำเองแล้ว
+        except OSError:
+            pass
+        set_keepalive(conn)
+        set_socket_buffers(conn, self.socket_buffers.get('tunnel'))
+        limit_unsent(conn, FAIR_BATCH_BYTES)
+        stripe = _Stripe(conn, len(self.stripes), self.compress)
+        self.stripes.append(stripe)
+        self._update_stripe(stripe)
+        if self.heartbeat:
+            self._schedule(time.monotonic() + self.heartbeat, stripe)
+
+    def _read_stripe(self, stripe):
+        """[แก้ไข] ระหว่าง profile: read ของ Frame แรกคือ recv + แกะ ของ Frame ถัดไปคือแกะจากบัฟเฟอร์อย่างเดียว"""
+        decoder = stripe.decoder
+        stripe.heard = True
+        timings = self.timings
+        read_at = time.perf_counter() if timings is not None else None
+        try:
+            # payload เป็น memoryview ในบัฟเฟอร์ของ decoder: ต้องใช้ให้เสร็จ (หรือ copy) ก่อน Frame ถัดไป
+            for player_id, data in decoder.poll():
+                if read_at is not None:
+                    timings.record('to_local', 'read', time.perf_counter() - read_at)
+                if player_id == HEARTBEAT_PLAYER_ID:
+                    if data == HEARTBEAT_PING:
+                        self._queue_frame(stripe, HEARTBEAT_PLAYER_ID, HEARTBEAT_PONG)
+                    elif self.direct and data:
+                        self._control_from_server(bytes(data).decode('ascii', 'replace'))
+                    continue
+                if decoder.flags:
+                    if stripe.decompressor is None:
+                        raise ValueError("Server sent a compressed frame without negotiating compression.")
+                    data = stripe.decompressor.decompress(player_id, data, decoder.flags)
+                if self.capture is not None:
+                    self.capture.record(self.capture_id, CAPTURE_TO_HOST, player_id, data)
+                self._to_local(stripe, player_id, data)
+                if read_at is not None:
+                    read_at = time.perf_counter()
+        except BlockingIOError:
+            return
+        except ValueError as e:
+            self._lose_stripe(stripe, f"Bad frame from server: {e}")
+            return
+        except OSError as e:
+            self._lose_stripe(stripe, f"Tunnel connection error: {e}")
+            return
+        if decoder.eof:
+            self._lose_stripe(stripe, "Server closed the connection.")
+
+    def _to_local(self, stripe, player_id, data):
+        player = stripe.players.get(player_id)
+        if player is None:
+            if not data:
+                return
+            player = self._open_player(stripe, player_id)
+            if player is None:
+                return
+
+        # ถ้า length เป็น 0 หมายถึงผู้เล่นคนนี้หลุดการเชื่อมต่อ
+        if not data:
+            self._emit('log', f"[Player {player_id}] Disconnection signal received. Closing local connection.")
+            self._close_player(player)
+            return
+
+        self.frames_to_local += 1
+        self.bytes_to_local += len(data)
+        if player.sock is None:
+            return
+        timings = self.timings
+        if timings is not None:
+            sent_at = time.perf_counter()
+        if player.udp:
+            try:
+                player.sock.send(data) # 1 Frame = 1 datagram
+            except OSError:
+                pass # บัฟเฟอร์เต็มหรือ Local Service ยังไม่เปิด (ICMP): datagram ทิ้งได้
+            if timings is not None:
+                timings.record('to_local', 'send', time.perf_counter() - sent_at)
+            return
+        if not player.out and not player.connecting:
+            try:
+                sent = player.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._drop_player(player)
+                return
+            if timings is not None:
+                timings.record('to_local', 'send', time.perf_counter() - sent_at)
+            if sent == len(data):
+                return
+            data = data[sent:]
+        player.out.append(bytes(data))
+        player.out_bytes += len(data)
+        if player.out_bytes > LOCAL_PENDING_MAX_BYTES:
+            if player.connecting:
+                # Local Service ยังไม่ตอบรับแต่ข้อมูลมาเกินที่จะเก็บไว้ได้: ยอมแพ้กับการเชื่อมต่อนี้
+                self._fail_connect(player, "too much data buffered while connecting")
+                return
+            # Local Service รับไม่ทัน: หยุดอ่านเส้นนี้ไว้ก่อน (เหมือน sendall ที่ block ของรุ่น Thread)
+            stripe.blocked_by.add(player)
+            self._update_stripe(stripe)
+        self._update_player(player)
+
+    # --- โหมด direct ---
+
+    def _control_from_server(self, line):
+        """[ใหม่] บรรทัดคำสั่งที่ Server ส่งมาบน player_id 0 (ตอนนี้มีแค่ OPEN) คำสั่งที่ไม่รู้จักถูกข้าม"""
+        try:
+            word, fields = parse_control_line(line)
+            player_id = int(fields['player'])
+        except (ValueError, KeyError):
+            return
+        if word == DIRECT_OPEN:
+            self._open_direct(player_id)
+
+    def _open_direct(self, player_id):
+        """
+        [แก้ไข] เริ่มเปิดการเชื่อมต่อของผู้เล่นโหมด direct: connect ไปยัง Local Service แล้วส่งคำสั่ง DATA ทั้งหมดใน loop
+        (non-blocking แบบเดียวกับ _open_player) ถ้าทำไม่ได้ก็ไม่ต้องทำอะไร: Server จะหมดเวลารอ
+        แล้วส่งผู้เล่นคนนี้ผ่านอุโมงค์แบบ Frame ตามปกติ
+        """
+        self._emit('log', f"[Player {player_id}] Direct connection requested. Connecting to local service...")
+        service = self._service(player_id)
+        if service is None or player_id in self.direct_openings or player_id in self.direct_players:
+            return
+        local = self.pools[service].take() if self.pools else None
+        if local is not None:
+            local.setblocking(False)
+            set_socket_buffers(local, self.socket_buffers.get('local'))
+            opening = _DirectOpening(player_id, local)
+            self.direct_openings[player_id] = opening
+            self._attach_direct(opening)
+            return
+        local = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        local.setblocking(False)
+        set_socket_buffers(local, self.socket_buffers.get('local'))
+        # เหมือน _open_player: connect ทำต่อใน loop (รอ EVENT_WRITE) ผู้เล่นคนอื่นไม่ต้องรอ
+        if local.connect_ex(self.local_addrs[service]) not in _CONNECT_IN_PROGRESS:
+            local.close()
+            self._emit('warning', f"Could not connect to local service for Player {player_id}. Using the tunnel.")
+            return
+        opening = _DirectOpening(player_id, local)
+        self.direct_openings[player_id] = opening
+        opening.deadline = time.monotonic() + LOCAL_CONNECT_TIMEOUT
+        self._schedule(opening.deadline, opening)
+        self._set_events(opening, selectors.EVENT_WRITE)
+
+    def _attach_direct(self, opening):
+        """Local Service พร้อมแล้ว: เริ่ม connect ไปยัง Control Port เพื่อส่งคำสั่ง DATA"""
+        self._set_events(opening, 0)
+        family, address = self.control_addr
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        set_socket_buffers(sock, self.socket_buffers.get('tunnel'))
+        opening.phase = 'data'
+        opening.sock = sock
+        opening.request = format_control_line('DATA', secret=self.lease_secret, player=opening.player_id)
+        if sock.connect_ex(address) not in _CONNECT_IN_PROGRESS:
+            self._fail_direct(opening, "could not reach the control port")
+            return
+        opening.deadline = time.monotonic() + DIRECT_ATTACH_TIMEOUT
+        self._schedule(opening.deadline, opening)
+        self._set_events(opening, selectors.EVENT_WRITE)
+
+    def _advance_direct(self, opening):
+        """ทำขั้นถัดไปของ _DirectOpening เมื่อ socket ของขั้นปัจจุบันพร้อม"""
+        sock = opening.sock
+        if opening.phase != 'reply':
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._fail_direct(opening, errno.errorcode.get(error, str(error)))
+                return
+            if opening.phase == 'local':
+                self._attach_direct(opening)
+                return
+            try:
+                sent = sock.send(opening.request)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self._fail_direct(opening, str(e))
+                return
+            opening.request = opening.request[sent:]
+            if opening.request:
+                return
+            opening.phase = 'reply'
+            self._set_events(opening, selectors.EVENT_READ)
+            return
+        # อ่านทีละ byte: ข้อมูลของผู้เล่นอาจตามหลังบรรทัดคำตอบมาทันที (แบบเดียวกับ recv_line) บรรทัดคำตอบสั้นมาก
+        try:
+            while True:
+                char = sock.recv(1)
+                if not char:
+                    self._fail_direct(opening, "Server closed the control connection without a reply.")
+                    return
+                if char == b'\n':
+                    break
+                opening.reply += char
+                if len(opening.reply) >= CONTROL_LINE_LIMIT:
+                    self._fail_direct(opening, "control reply is too long")
+                    return
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail_direct(opening, str(e))
+            return
+        response = opening.reply.decode('ascii', 'replace').strip()
+        if not response.startswith('OK'):
+            self._fail_direct(opening, response)
+            return
+        self._set_events(opening, 0)
+        del self.direct_openings[opening.player_id]
+        opening.sock = None
+        self._direct_ready(opening.player_id, opening.local, sock)
+
+    def _fail_direct(self, opening, reason):
+        player_id = opening.player_id
+        self._close_opening(opening)
+        if opening.phase == 'local':
+            self._emit('warning', f"Could not connect to local service for Player {player_id} ({reason}). Using the tunnel.")
+        else:
+            self._emit('warning', f"[Player {player_id}] Direct connection failed ({reason}). Using the tunnel.")
+
+    def _close_opening(self, opening):
+        self._set_events(opening, 0)
+        if opening.sock is not opening.local:
+            opening.sock.close()
+        opening.local.close()
+        opening.sock = None
+        if self.direct_openings.get(opening.player_id) is opening:
+            del self.direct_openings[opening.player_id]
+
+    def _direct_ready(self, player_id, local, data):
+        set_keepalive(data)
+        player = _DirectPlayer(player_id, local, data)
+        self.direct_players[player_id] = player
+        self.direct_opened += 1
+        self._emit('log', f"[Player {player_id}] Direct connection established.")
+        self._pump_direct(player)
+
+    def _pump_direct(self, player):
+        """ย้ายข้อมูลทั้งสองทิศทางเท่าที่ทำได้ทันที ส่ง EOF ต่อเมื่อทิศทางไหนจบ แล้วเลือกเหตุการณ์ที่ต้องรอต่อ"""
+        up, down = player.up, player.down
+        try:
+            if not up.done:
+                moved = up.pump(DIRECT_PUMP_BYTES)
+                if moved:
+                    self.frames_to_server += 1
+                    self.bytes_to_server += moved
+                if up.done:
+                    player.data.sock.shutdown(socket.SHUT_WR)
+            if not down.done:
+                moved = down.pump(DIRECT_PUMP_BYTES)
+                if moved:
+                    self.frames_to_local += 1
+                    self.bytes_to_local += moved
+                if down.done:
+                    player.local.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            self._close_direct(player)
+            return
+        if up.done and down.done:
+            self._close_direct(player)
+            return
+        read, write = selectors.EVENT_READ, selectors.EVENT_WRITE
+        self._set_events(player.local, (read if not up.done and up.wants_read else 0) |
+                                       (write if not down.done and down.wants_write else 0))
+        self._set_events(player.data, (read if not down.done and down.wants_read else 0) |
+                                      (write if not up.done and up.wants_write else 0))
+
+    def _close_direct(self, player):
+        if player.local.sock is None:
+            return
+        self._emit('log', f"[Player {player.player_id}] Disconnected.")
+        for end in (player.local, player.data):
+            self._set_events(end, 0)
+            end.sock.close()
+            end.sock = None
+        player.up.close()
+        player.down.close()
+        if self.direct_players.get(player.player_id) is player:
+            del self.direct_players[player.player_id]
+
+    # --- Local Service ---
+
+    def _service(self, player_id):
+        """[ใหม่] ลำดับ Local Service ของผู้เล่นคนนี้ (None ถ้า Server ส่ง service ที่ไม่ได้ขอไว้)"""
+        service = service_of(player_id)
+        if service < len(self.local_addrs):
+            return service
+        self._emit('warning', f"Player {player_id} arrived for unknown service {service}. Ignoring it.")
+        return None
+
+    def _open_player(self, stripe, player_id):
+        service = self._service(player_id)
+        if service is None:
+            return None
+        local_addr = self.local_addrs[service]
+        self._emit('log', f"[Player {player_id}] New connection detected. Connecting to local service {local_addr[1]}...")
+        self.players_opened += 1
+        if self.udp:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            set_socket_buffers(sock, self.socket_buffers.get('local'))
+            try:
+                sock.connect(local_addr)
+            except OSError:
+                sock.close()
+                self._emit('warning', f"Could not connect to local service for Player {player_id}.")
+                return None
+            player = _Player(player_id, stripe, sock, udp=True)
+        else:
+            sock = self.pools[service].take() if self.pools else None
+            if sock is not None:
+                sock.setblocking(False)
+                set_socket_buffers(sock, self.socket_buffers.get('local'))
+                player = _Player(player_id, stripe, sock)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                set_socket_buffers(sock, self.socket_buffers.get('local')) # ก่อน connect: window scale ตกลงกันตอน handshake
+                result = sock.connect_ex(local_addr)
+                if result not in _CONNECT_IN_PROGRESS:
+                    sock.close()
+                    self.local_connect_failures += 1
+                    self._emit('warning', f"Could not connect to local service for Player {player_id}.")
+                    return None
+                # การ connect ทำต่อใน loop (รอ EVENT_WRITE) Frame ที่ตามมาจะถูกเก็บไว้ก่อน ผู้เล่นคนอื่นไม่ต้องรอ
+                player = _Player(player_id, stripe, sock, connecting=True)
+                player.deadline = time.monotonic() + LOCAL_CONNECT_TIMEOUT
+                self._schedule(player.deadline, player)
+        if not player.udp:
+            player.sizer = ReadSizer(READ_SIZE_MIN, self.read_max)
+        stripe.players[player_id] = player
+        if not player.connecting:
+            self._emit('log', f"[Player {player_id}] Local connection established.")
+        self._update_player(player)
+        return player
+
+    def _flush_local(self, player):
+        if player.connecting:
+            error = player.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._fail_connect(player, errno.errorcode.get(error, str(error)))
+                return
+            player.connecting = False
+            self._emit('log', f"[Player {player.player_id}] Local connection established.")
+        try:
+            while player.out:
+                chunk = player.out[0]
+                sent = player.sock.send(chunk)
+                player.out_bytes -= sent
+                if sent < len(chunk):
+                    player.out[0] = memoryview(chunk)[sent:]
+                    break
+                player.out.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop_player(player)
+            return
+        stripe = player.stripe
+        if player in stripe.blocked_by and player.out_bytes <= LOCAL_PENDING_MAX_BYTES // 2:
+            stripe.blocked_by.discard(player)
+            self._update_stripe(stripe)
+        self._update_player(player)
+
+    def _read_local(self, player):
+        stripe = player.stripe
+        timings = self.timings
+        if timings is not None:
+            read_at = time.perf_counter()
+        try:
+            data = player.sock.recv(UDP_MAX_DATAGRAM if player.udp else player.sizer.size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionRefusedError:
+            if player.udp:
+                return # ICMP จาก datagram ก่อนหน้า: Local Service อาจกำลังเริ่มใหม่
+            data = b''
+        except OSError:
+            data = b''
+        if not data:
+            if player.udp:
+                return # datagram ว่างส่งต่อไม่ได้ (length 0 = ผู้เล่นหลุด)
+            # Local Service ปิดการเชื่อมต่อ: แจ้ง Server ด้วย Frame ว่าง แต่ยังส่งข้อมูลที่ตามมาให้ได้จนกว่าจะปิดจริง
+            player.eof = True
+            if self.capture is not None:
+                self.capture.record(self.capture_id, CAPTURE_TO_PEER, player.player_id)
+            if stripe.compressor is not None:
+                stripe.compressor.forget(player.player_id)
+            self._queue_frame(stripe, player.player_id)
+            self._update_player(player)
+            return
+        if timings is not None:
+            timings.record('to_server', 'read', time.perf_counter() - read_at)
+        if player.sizer is not None:
+            player.sizer.update(len(data))
+        self.frames_to_server += 1
+        self.bytes_to_server += len(data)
+        if self.capture is not None:
+            self.capture.record(self.capture_id, CAPTURE_TO_PEER, player.player_id, data)
+        if stripe.compressor is not None:
+            payload, flags = stripe.compressor.compress(player.player_id, data)
+            self._queue_frame(stripe, player.player_id, payload, flags)
+        else:
+            self._queue_frame(stripe, player.player_id, data)
+        if stripe.fair.depth(player.player_id) >= FAIR_PLAYER_MAX_BYTES or stripe.out_bytes >= WRITER_MAX_PENDING_BYTES:
+            # [แก้ไข] อุโมงค์ส่งไม่ทัน: หยุดอ่านเฉพาะผู้เล่นที่มีคิวค้างมาก (ผู้เล่นคนอื่นยังส่งต่อได้) จนกว่าคิวจะลดลง
+            player.paused = True
+            stripe.stalled.append(player)
+            self._update_player(player)
+
+    def _fail_connect(self, player, reason):
+        self.local_connect_failures += 1
+        self._emit('warning', f"Could not connect to local service for Player {player.player_id} ({reason}).")
+        # เอาออกจาก stripe.players: Frame ถัดไปของผู้เล่นคนนี้จะลอง connect ใหม่
+        self._close_player(player)
+
+    def _drop_player(self, player):
+        """การเชื่อมต่อไปยัง Local Service เสีย: ปิด socket แต่เก็บผู้เล่นไว้ ข้อมูลที่ตามมาจะถูกทิ้ง"""
+        self._release_socket(player)
+
+    def _close_player(self, player):
+        stripe = player.stripe
+        self._release_socket(player)
+        if stripe.players.get(player.player_id) is player:
+            del stripe.players[player.player_id]
+        if stripe.compressor is not None:
+            stripe.compressor.forget(player.player_id)
+        if stripe.decompressor is not None:
+            stripe.decompressor.forget(player.player_id)
+
+    def _release_socket(self, player):
+        if player.sock is None:
+            return
+        self._set_events(player, 0)
+        player.sock.close()
+        player.sock = None
+        player.connecting = False
+        player.out.clear()
+        player.out_bytes = 0
+        stripe = player.stripe
+        if player in stripe.blocked_by:
+            stripe.blocked_by.discard(player)
+            if stripe.sock is not None:
+                self._update_stripe(stripe)
+
+    def _schedule(self, deadline, target):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (deadline, self.timer_seq, target))
+
+    def _run_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            _, _, target = heapq.heappop(self.timers)
+            if target.sock is None:
+                continue # ปิดไปแล้ว: timer ที่ค้างใน heap ถูกทิ้งตรงนี้
+            if type(target) is _Stripe:
+                self._heartbeat(target, now)
+            elif type(target) is _DirectOpening:
+                if target.deadline <= now: # timer ของขั้นก่อนหน้าที่ผ่านไปแล้วไม่นับ
+                    self._fail_direct(target, "timed out")
+            elif target.connecting:
+                self._fail_connect(target, "timed out")
+
+    def _heartbeat(self, stripe, now):
+        """
+        [ใหม่] รอบ heartbeat ของเส้น: ส่ง PING แล้วดูว่าเส้นเงียบมากี่รอบติดกัน (Server ตอบ PONG ทุก PING)
+        เส้นที่หยุดอ่านไว้เพราะ Local Service รับไม่ทันไม่นับว่าเงียบ
+        """
+        if stripe.heard or stripe.blocked_by:
+            stripe.missed = 0
+        else:
+            stripe.missed += 1
+            if stripe.missed >= HEARTBEAT_MISSES:
+                self._lose_stripe(stripe, f"No heartbeat from server for {self.heartbeat * HEARTBEAT_MISSES}s.")
+                return
+        stripe.heard = False
+        self._queue_frame(stripe, HEARTBEAT_PLAYER_ID, HEARTBEAT_PING)
+        self._schedule(now + self.heartbeat, stripe)
+
+    # --- อุโมงค์ (ทิศ Local Service -> Server) ---
+
+    def _queue_frame(self, stripe, player_id, data=b'', flags=0):
+        """
+        ใส่ Frame เข้าคิวขาออกของเส้น Frame ที่เข้ามาในรอบเดียวกันของ loop ถูกส่งรวมกันเป็น syscall เดียว
+        [แก้ไข] ถ้ายังไม่มีคิวค้างเกิน 1 batch จะต่อท้าย batch ปัจจุบันตรงๆ ตามลำดับเดิม
+        ส่วนที่ค้างเกินนั้นเข้าคิวของผู้เล่นแต่ละคนใน FairQueue: ผู้เล่นที่ส่งก้อนใหญ่ไม่ดัน Frame เล็กของคนอื่นไปไว้ท้ายคิว
+        """
+        header = FRAME_HEADER.pack(player_id, len(data) | flags)
+        if stripe.out_bytes < FAIR_BATCH_BYTES and not stripe.fair.pending_bytes:
+            stripe.out.append(header)
+            if data:
+                stripe.out.append(data)
+        else:
+            stripe.fair.put(player_id, header, data)
+        stripe.out_bytes += HEADER_SIZE + len(data)
+        if not stripe.dirty and not stripe.events & selectors.EVENT_WRITE:
+            stripe.dirty = True
+            stripe.flush_at = time.monotonic() + self.flush_window
+            self.dirty.append(stripe)
+
+    def _flush_dirty(self, now):
+        waiting = []
+        for stripe in self.dirty:
+            if stripe.flush_at > now:
+                waiting.append(stripe)
+                continue
+            stripe.dirty = False
+            if stripe.sock is not None:
+                self._flush_stripe(stripe)
+        self.dirty = waiting
+
+    def _flush_stripe(self, stripe):
+        """
+        ส่งจนกว่า kernel จะรับไม่ไหว: batch ถัดไปถูกเลือกจาก FairQueue เมื่อ batch ก่อนหน้าออกไปหมดแล้วเท่านั้น
+        [ใหม่] ระหว่าง profile: send ขา to_server วัดต่อ sendmsg 1 ครั้ง (ครั้งละหลาย Frame) ไม่ใช่ต่อ Frame
+        """
+        fair = stripe.fair
+        timings = self.timings
+        try:
+            while True:
+                if not stripe.out:
+                    if not fair.pending_bytes:
+                        break
+                    stripe.out = fair.take(FAIR_BATCH_BYTES)[0]
+                if timings is not None:
+                    sent_at = time.perf_counter()
+                    stripe.out, sent = send_buffers_nowait(stripe.sock, stripe.out)
+                    timings.record('to_server', 'send', time.perf_counter() - sent_at)
+                else:
+                    stripe.out, sent = send_buffers_nowait(stripe.sock, stripe.out)
+                stripe.out_bytes -= sent
+                if stripe.out:
+                    break
+        except OSError as e:
+            self._lose_stripe(stripe, f"Tunnel connection error: {e}")
+            return
+        if stripe.stalled and stripe.out_bytes < WRITER_MAX_PENDING_BYTES // 2:
+            stalled, stripe.stalled = stripe.stalled, []
+            for player in stalled:
+                if fair.depth(player.player_id) >= FAIR_PLAYER_MAX_BYTES // 2:
+                    stripe.stalled.append(player)
+                    continue
+                player.paused = False
+                self._update_player(player)
+        self._update_stripe(stripe)
+
+    def _lose_stripe(self, stripe, reason):
+        if stripe.sock is None:
+            return
+        if not self.stop_requested.is_set():
+            self._emit('status', reason)
+        self._emit('log', f"[Tunnel] Shutting down {len(stripe.players)} local connection(s).")
+        for player in list(stripe.players.values()):
+            self._close_player(player)
+        self._set_events(stripe, 0)
+        stripe.sock.close()
+        stripe.sock = None
+        self.stripes.remove(stripe)
+        if stripe.compressor is not None:
+            self._retire_compression(stripe)
+        if not self.stop_requested.is_set():
+            self._reattach()
+
+    # --- RESUME และเส้นเสริม (ทำใน Thread ชั่วคราว) ---
+
+    def _reattach(self):
+        """อุโมงค์หลุดทุกเส้น: RESUME Port เดิม ถ้ายังมีเส้นเหลือ: เปิดเส้นที่หายไปกลับมาให้ครบ"""
+        if not self.lease_secret:
+            return # Server รุ่นเก่า: loop จะจบเองเมื่อไม่มีเส้นเหลือ
+        if self.reattaching:
+            self.reattach_again = True
+            return
+        resume = not self.stripes
+        missing = self.stripe_count - len(self.stripes)
+        if missing <= 0:
+            return
+        if resume:
+            self._emit('status', f"Tunnel lost. Resuming port {self.public_port}...")
+        self.reattaching = True
+        threading.Thread(target=self._attach_worker, args=(resume, missing), daemon=True).start()
+
+    def _attach_worker(self, resume, missing):
+        server_addr = (self.server_ip, self.control_port)
+        conns = []
+        if resume:
+            conn = resume_public_port(server_addr, self.lease_secret, self.stop_requested, self._emit)
+            if conn is None:
+                self.call_soon(self._attach_done, None)
+                return
+            conns.append(conn)
+            missing -= 1
+        conns += open_extra_stripes(server_addr, self.lease_secret, missing, self._emit)
+        self.call_soon(self._attach_done, conns)
+
+    def _attach_done(self, conns):
+        self.reattaching = False
+        if conns is None:
+            self._emit('error', "Could not resume the tunnel. Restart the client to get a new port.")
+            return
+        if self.stop_requested.is_set():
+            for conn in conns:
+                conn.close()
+            return
+        resumed = not self.stripes
+        for conn in conns:
+            self._add_stripe(conn)
+        if resumed:
+            self._emit('status', f"Tunnel resumed on port {self.public_port}. Running")
+        if self.reattach_again:
+            self.reattach_again = False
+            self._reattach()
+
+    def _retire_compression(self, stripe):
+        self.compression_sent.add(stripe.compressor.stats())
+        self.compression_received.add(stripe.decompressor)
+
+    def _close_all(self):
+        for opening in list(self.direct_openings.values()):
+            self._close_opening(opening)
+        for player in list(self.direct_players.values()):
+            self._close_direct(player)
+        for stripe in list(self.stripes):
+            for player in list(stripe.players.values()):
+                self._close_player(player)
+            if stripe.events:
+                self._set_events(stripe, 0)
+            stripe.sock.close()
+            stripe.sock = None
+            if stripe.compressor is not None:
+                self._retire_compression(stripe)
+        self.stripes = []
+        for pool in self.pools:
+            pool.close()
+        if self.capture is not None:
+            self.capture.close()
+        if self.selector is not None:
+            self.selector.close()
+        self.waker_r.close()
+        self.waker_w.close()
+
+
+class _DecompressTotals:
+    """ผลรวมตัวนับของ FrameDecompressor หลายเส้น (ใช้กับ format_compression_stats ได้เหมือน FrameDecompressor)"""
+    __slots__ = ('wire_bytes', 'raw_bytes', 'cpu_seconds')
+
+    def __init__(self):
+        self.wire_bytes = 0
+        self.raw_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def add(self, other):
+        self.wire_bytes += other.wire_bytes
+        self.raw_bytes += other.raw_bytes
+        self.cpu_seconds += other.cpu_seconds
+
+
+def resume_public_port(server_addr, secret, stop_event=None, emit=None, retry_seconds=RESUME_RETRY_SECONDS):
+    """
+    พยายามต่ออุโมงค์เดิมกลับมา (Port เดิม, ผู้เล่นที่ยังต่ออยู่ไม่หลุด) ด้วยคำสั่ง RESUME
+    คืนค่า socket ของอุโมงค์ใหม่ หรือ None ถ้า Server ไม่รู้จัก secret แล้ว/หมดเวลา/ถูกสั่งหยุด
+    """
+    emit = emit or (lambda kind, data: None)
+    stop_event = stop_event or threading.Event()
+    deadline = time.monotonic() + retry_seconds
+    delay = 0.5
+    while not stop_event.is_set():
+        try:
+            server_conn, _ = resume_tunnel(server_addr, secret)
+            return server_conn
+        except ControlError as e:
+            emit('warning', f"Server refused to resume the tunnel: {e}")
+            return None
+        except OSError as e:
+            if time.monotonic() + delay > deadline:
+                emit('warning', f"Could not reach the server to resume the tunnel: {e}")
+                return None
+        stop_event.wait(delay)
+        delay = min(delay * 2, 5)
+    return None
+
+
+def open_extra_stripes(server_addr, secret, count, emit=None):
+    """เปิดการเชื่อมต่อเสริมของอุโมงค์ด้วยคำสั่ง STRIPE คืนค่า list ของ socket ที่เปิดได้"""
+    emit = emit or (lambda kind, data: None)
+    conns = []
+    attempts = 0
+    while len(conns) < count:
+        try:
+            server_conn, _ = add_tunnel_stripe(server_addr, secret)
+        except ControlError as e:
+            # เส้นแรกอาจยังรอ Server accept อยู่: Server จะยังไม่รู้จัก Host ของ secret นี้ชั่วครู่
+            attempts += 1
+            if 'UnknownLease' in str(e) and attempts < STRIPE_ATTACH_ATTEMPTS:
+                time.sleep(0.2)
+                continue
+            emit('warning', f"Could not open an extra tunnel connection: {e}")
+            break
+        except OSError as e:
+            emit('warning', f"Could not open an extra tunnel connection: {e}")
+            break
+        conns.append(server_conn)
+    return conns
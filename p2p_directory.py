@@ -0,0 +1,257 @@
+# p2p_directory.py
+# [ใหม่] Directory ของโหมด cluster: รับคำขอ Port จาก Client แทน Control Port ของ relay node ตัวเดียว
+# แล้วเลือก node ที่ภาระน้อยที่สุดจากตัวเลขที่ node รายงานมา (อุโมงค์, ผู้เล่น และ bytes/วินาที)
+#
+# node (serverp2p.py --directory HOST:PORT) เปิดการเชื่อมต่อค้างไว้ 1 เส้นแล้วส่งบรรทัด
+#   "NODE name=... host=... control=... tunnels=... players=... bps=... free=...\n" ทุก LOAD_REPORT_INTERVAL วินาที
+# node ที่หลุดหรือเงียบเกิน NODE_REPORT_TIMEOUT ถูกตัดออกจากการเลือกทันที (ไม่ต้องรอ Health Check)
+#
+# PORT/TUNNEL ของ Client ถูกส่งต่อไปยัง Control Port ของ node ที่เลือกตามเดิมทั้งบรรทัด แล้วคำตอบ OK
+# ได้ host=<ที่อยู่ของ node> control=<Control Port ของ node> เพิ่มเข้าไป Client ต่ออุโมงค์, RESUME, STRIPE และ DATA
+# ที่ node นั้นตรงๆ ข้อมูลของผู้เล่นจึงไม่ผ่าน Directory เลย และ Directory ที่ล่มไม่กระทบอุโมงค์ที่เปิดอยู่แล้ว
+# Client รุ่นเก่า (ไม่ส่งคำสั่ง) ได้เลข Port เปล่าๆ ซึ่งใช้ได้เฉพาะเมื่อ node อยู่ที่ IP เดียวกับ Directory
+#
+# ทดสอบบนเครื่องเดียว: Directory และทุก node เป็น process แยกบน loopback คนละ Port (ดู benchmarks/bench_cluster.py)
+#   python p2p_directory.py --control-port 9000
+#   python serverp2p.py --control-port 9100 --port-range 9101-9199 --directory 127.0.0.1:9000
+#   python serverp2p.py --control-port 9200 --port-range 9201-9299 --directory 127.0.0.1:9000
+import argparse
+import secrets
+import socket
+import threading
+import time
+
+from p2p_tunnel import ControlError, control_request, format_control_line, parse_control_line, recv_line
+
+# --- การตั้งค่า ---
+DIRECTORY_HOST = '0.0.0.0'
+DIRECTORY_PORT = 9000 # Port ที่ Client ใช้ขอ Public Port (แทน Control Port ของ Server ตัวเดียว)
+CONTROL_REQUEST_TIMEOUT = 1.0 # วินาทีที่รอคำสั่งจาก Client ก่อนถือว่าเป็น Client รุ่นเก่า (เท่ากับของ serverp2p)
+NODE_REQUEST_TIMEOUT = 5 # วินาทีที่รอคำตอบจาก Control Port ของ node ก่อนลอง node ถัดไป
+NODE_REPORT_TIMEOUT = 10 # node ที่ไม่รายงานภาระเกินนี้ถือว่าใช้ไม่ได้ (node รายงานทุก 2 วินาทีโดยค่าเริ่มต้น)
+NODE_TOKEN = None # token ที่ node ต้องส่งมากับ NODE (None = รับทุก node ที่ต่อเข้ามาได้)
+TUNNEL_WEIGHT = 1.0 # น้ำหนักของอุโมงค์ 1 อันในคะแนนภาระของ node
+PLAYER_WEIGHT = 0.2 # น้ำหนักของผู้เล่น 1 คน
+MBPS_WEIGHT = 1.0 # น้ำหนักของข้อมูล 1 MiB/วินาทีที่ node ส่งต่ออยู่
+STATUS_INTERVAL = 60 # วินาทีระหว่างบรรทัดสรุปสถานะของทุก node
+# -----------------
+
+nodes = {} # {ชื่อ node: RelayNode} เฉพาะ node ที่ยังเชื่อมต่ออยู่
+nodes_lock = threading.Lock()
+
+
+class RelayNode:
+    """
+    ภาระล่าสุดของ relay node 1 ตัว (แก้ภายใต้ nodes_lock)
+    assigned นับอุโมงค์ที่ Directory แจกไปหลังรายงานล่าสุด: คำขอที่มาถี่กว่ารอบรายงานจึงไม่ไปกองที่ node เดียว
+    """
+    def __init__(self, name, host, control):
+        self.name = name
+        self.host = host
+        self.control = control
+        self.tunnels = 0
+        self.players = 0
+        self.bps = 0
+        self.free = 0 # Public Port ที่ยังว่างใน Pool ของ node
+        self.assigned = 0
+        self.reported_at = 0.0
+
+    def update(self, fields):
+        """รับบรรทัด NODE ล่าสุด raise ValueError ถ้าตัวเลขอ่านไม่ออก"""
+        self.tunnels = int(fields.get('tunnels', 0))
+        self.players = int(fields.get('players', 0))
+        self.bps = int(fields.get('bps', 0))
+        self.free = int(fields.get('free', 0))
+        self.assigned = 0 # ตัวเลขของ node รวมอุโมงค์ที่แจกไปก่อนหน้านี้แล้ว
+        self.reported_at = time.monotonic()
+
+    def load(self):
+        return ((self.tunnels + self.assigned) * TUNNEL_WEIGHT + self.players * PLAYER_WEIGHT
+                + self.bps / (1024 * 1024) * MBPS_WEIGHT)
+
+    def summary(self):
+        return (f"{self.name} ({self.host}:{self.control}): tunnels={self.tunnels}+{self.assigned} "
+                f"players={self.players} bps={self.bps} free={self.free} load={self.load():.1f}")
+
+
+def pick_nodes():
+    """node ที่ยังรับอุโมงค์ใหม่ได้ เรียงจากภาระน้อยไปมาก (ตัวแรกคือตัวที่ควรได้อุโมงค์ถัดไป)"""
+    with nodes_lock:
+        live = [node for node in nodes.values() if node.free > 0]
+    return sorted(live, key=RelayNode.load)
+
+
+def place_tunnel(command, fields, addr):
+    """
+    ส่งคำขอ PORT/TUNNEL ต่อไปยัง node ที่ภาระน้อยที่สุด คืนค่า fields ของคำตอบ OK ที่เติมที่อยู่ของ node แล้ว
+    node ที่ต่อไม่ได้หรือ Port เต็มจะถูกข้ามไปตัวถัดไป ERROR อื่นๆ (คำขอผิด) ส่งกลับไปหา Client ทันที
+    """
+    for node in pick_nodes():
+        try:
+            reply = control_request((node.host, node.control), command, timeout=NODE_REQUEST_TIMEOUT, **fields)
+        except ControlError as e:
+            if str(e).startswith("ERROR:NoPorts"):
+                with nodes_lock:
+                    node.free = 0 # จนกว่า node จะรายงานว่ามี Port ว่างอีก
+                continue
+            raise
+        except OSError as e:
+            print(f"[!] Node {node.name} did not answer: {e}. Trying the next node.")
+            continue
+        with nodes_lock:
+            node.assigned += 1
+            node.free -= len(reply.get('ports', '').split(',')) if 'ports' in reply else 1
+        print(f"[+] Assigning port {reply.get('ports') or reply.get('port')} on node {node.name} to {addr}")
+        return dict(reply, host=node.host, control=node.control)
+    print(f"[-] No node has free ports for {addr}")
+    raise ControlError("ERROR:NoPorts")
+
+
+def forward_limit(fields):
+    """LIMIT ส่งไปทุก node จนกว่าจะเจอ node ที่มีอุโมงค์นั้น (Directory ไม่ได้จำว่าอุโมงค์ไหนอยู่ที่ node ใด)"""
+    with nodes_lock:
+        candidates = list(nodes.values())
+    for node in candidates:
+        try:
+            return format_control_line('OK', **control_request((node.host, node.control), 'LIMIT',
+                                                               timeout=NODE_REQUEST_TIMEOUT, **fields))
+        except ControlError as e:
+            if not str(e).startswith("ERROR:UnknownTunnel"):
+                return f"{e}\n".encode()
+        except OSError:
+            continue
+    return b"ERROR:UnknownTunnel\n"
+
+
+def answer_client(line, addr):
+    """คำตอบของคำสั่ง 1 บรรทัดจาก Client (line=None คือ Client รุ่นเก่า) เป็น bytes"""
+    if line is None:
+        try:
+            return str(place_tunnel('PORT', {}, addr)['port']).encode() # รุ่นเก่าอ่านเลข Port เปล่าๆ ไม่มี '\n'
+        except ControlError:
+            return b"ERROR:NoPorts"
+    try:
+        command, fields = parse_control_line(line)
+    except ValueError:
+        return b"ERROR:BadRequest\n"
+    if command in ('PORT', 'TUNNEL'):
+        try:
+            return format_control_line('OK', **place_tunnel(command, fields, addr))
+        except ControlError as e:
+            return f"{e}\n".encode()
+    if command == 'LIMIT':
+        return forward_limit(fields)
+    if command in ('RESUME', 'STRIPE', 'DATA'):
+        # Client รุ่นนี้ส่งคำสั่งเหล่านี้ไปที่ control= ของ node เจ้าของอุโมงค์เอง
+        return b"ERROR:UnknownLease\n"
+    return b"ERROR:UnknownCommand\n"
+
+
+def serve_node(conn, addr, line):
+    """รับรายงานภาระจาก node 1 ตัวจนกว่าจะหลุดหรือเงียบเกิน NODE_REPORT_TIMEOUT (block จนจบ)"""
+    node = None
+    try:
+        conn.settimeout(NODE_REPORT_TIMEOUT)
+        while line:
+            _, fields = parse_control_line(line)
+            if node is None:
+                if NODE_TOKEN and not secrets.compare_digest(fields.get('token', '').encode(), NODE_TOKEN.encode()):
+                    print(f"[!] Rejected node report from {addr}: bad token")
+                    conn.sendall(b"ERROR:Forbidden\n")
+                    return
+                node = RelayNode(fields['name'], fields.get('host') or addr[0], int(fields['control']))
+                node.update(fields)
+                with nodes_lock:
+                    nodes[node.name] = node
+                conn.sendall(b"OK\n")
+                print(f"[+] Node joined: {node.summary()}")
+            else:
+                with nodes_lock:
+                    node.update(fields)
+            line = recv_line(conn)
+    except socket.timeout:
+        print(f"[!] Node {node.name if node else addr} stopped reporting for {NODE_REPORT_TIMEOUT}s.")
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[!] Node connection from {addr} ended: {e or type(e).__name__}")
+    finally:
+        conn.close()
+        if node is not None:
+            with nodes_lock:
+                if nodes.get(node.name) is node: # node ที่ต่อเข้ามาใหม่ด้วยชื่อเดิมแทนที่ตัวนี้ไปแล้ว
+                    del nodes[node.name]
+            print(f"[-] Node left: {node.name}")
+
+
+def handle_connection(conn, addr):
+    """อ่านบรรทัดแรกแล้วแยกว่าเป็น node ที่มารายงานภาระ หรือ Client ที่มาขอ Port (1 Thread ต่อการเชื่อมต่อ)"""
+    try:
+        conn.settimeout(CONTROL_REQUEST_TIMEOUT)
+        try:
+            line = recv_line(conn)
+        except socket.timeout:
+            line = None
+        except ValueError:
+            line = ''
+        if line and line.split()[0] == 'NODE':
+            serve_node(conn, addr, line)
+            return
+        conn.settimeout(None)
+        conn.sendall(answer_client(line, addr))
+    except OSError:
+        pass
+    conn.close()
+
+
+def status_reporter():
+    """พิมพ์ภาระของทุก node เป็นระยะ"""
+    while True:
+        time.sleep(STATUS_INTERVAL)
+        with nodes_lock:
+            lines = [node.summary() for node in nodes.values()]
+        print(f"[Directory] Nodes: {len(lines)}")
+        for line in lines:
+            print(f"[Directory]   {line}")
+
+
+def main():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((DIRECTORY_HOST, DIRECTORY_PORT))
+    listener.listen(128)
+    threading.Thread(target=status_reporter, daemon=True).start()
+    print(f"[*] Directory listening on {DIRECTORY_HOST}:{DIRECTORY_PORT}")
+    try:
+        while True:
+            conn, addr = listener.accept()
+            threading.Thread(target=handle_connection, args=(conn, addr), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\n[!] Directory is shutting down.")
+    finally:
+        listener.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Port directory for a cluster of P2P relay nodes")
+    parser.add_argument('--host', default=DIRECTORY_HOST, help="address to listen on")
+    parser.add_argument('--control-port', type=int, default=DIRECTORY_PORT,
+                        help="port clients ask for public ports on (relay nodes report their load here too)")
+    parser.add_argument('--node-token', default=NODE_TOKEN,
+                        help="only accept relay nodes started with the same --directory-token")
+    parser.add_argument('--report-timeout', type=float, default=NODE_REPORT_TIMEOUT,
+                        help="seconds without a load report before a node stops getting tunnels")
+    parser.add_argument('--tunnel-weight', type=float, default=TUNNEL_WEIGHT, help="load score per open tunnel")
+    parser.add_argument('--player-weight', type=float, default=PLAYER_WEIGHT, help="load score per connected player")
+    parser.add_argument('--mbps-weight', type=float, default=MBPS_WEIGHT, help="load score per MiB/s relayed")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    DIRECTORY_HOST = args.host
+    DIRECTORY_PORT = args.control_port
+    NODE_TOKEN = args.node_token
+    NODE_REPORT_TIMEOUT = args.report_timeout
+    TUNNEL_WEIGHT = args.tunnel_weight
+    PLAYER_WEIGHT = args.player_weight
+    MBPS_WEIGHT = args.mbps_weight
+    main()
@@ -1,186 +1,26 @@
 import tkinter as tk
 from tkinter import messagebox, scrolledtext
-import socket
-import threading
-import struct
-import sys
 import queue
 
-class ClientLogicThread(threading.Thread):
-    """
-    This class runs the core client logic in a separate thread to prevent the GUI from freezing.
-    It uses queues to communicate status, results, and errors back to the main GUI thread.
-    """
-    def __init__(self, server_ip, control_port, local_port, status_queue):
-        super().__init__()
-        self.server_ip = server_ip
-        self.control_port = control_port
-        self.local_port = local_port
-        self.local_host = '127.0.0.1'
-        self.status_queue = status_queue
-        
-        self.server_conn = None
-        self.shutdown_event = threading.Event()
-        self.local_connections = {}
-        self.local_lock = threading.Lock()
-
-    def stop(self):
-        """Signals the thread to shut down gracefully."""
-        self.shutdown_event.set()
-        if self.server_conn:
-            try:
-                # Closing the socket will raise an exception in the listening thread, causing it to exit.
-                self.server_conn.close()
-            except OSError:
-                pass
-        
-        with self.local_lock:
-            for conn in self.local_connections.values():
-                try:
-                    conn.close()
-                except OSError:
-                    pass
-
-    def _put_status(self, message_type, data):
-        """Puts a message into the queue for the GUI to process."""
-        self.status_queue.put({'type': message_type, 'data': data})
-
-    def run(self):
-        """The main logic of the client thread."""
-        try:
-            # 1. Request Public Port
-            self._put_status('status', f"Requesting port from {self.server_ip}:{self.control_port}...")
-            public_port = self._request_public_port()
-            if not public_port:
-                # Error is already sent by the request function
-                return
-
-            self._put_status('success', {'ip': self.server_ip, 'port': public_port})
-
-            # 2. Establish persistent tunnel
-            self._put_status('status', f"Connecting to tunnel at {self.server_ip}:{public_port}...")
-            self.server_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_conn.connect((self.server_ip, public_port))
-            self._put_status('status', "Tunnel established. Status: Running")
-
-            # 3. Start forwarding data
-            self._forward_from_server_to_local()
-
-        except Exception as e:
-            if not self.shutdown_event.is_set():
-                self._put_status('error', f"A critical error occurred: {e}")
-        finally:
-            self._put_status('stopped', "Connection closed.")
-
-    def _request_public_port(self):
-        """Requests a public port from the server's Server port."""
-        try:
-            req_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            req_socket.connect((self.server_ip, self.control_port))
-            response = req_socket.recv(1024).decode()
-            req_socket.close()
-            if response.startswith("ERROR"):
-                self._put_status('error', f"Server error: {response}")
-                return None
-            return int(response)
-        except Exception as e:
-            self._put_status('error', f"Failed to request port: {e}")
-            return None
-
-    def _forward_from_local_to_server(self, local_conn, player_id):
-        """Reads from a local connection and forwards data to the server."""
-        try:
-            while not self.shutdown_event.is_set():
-                data = local_conn.recv(4096)
-                if not data:
-                    break
-                header = struct.pack('!II', player_id, len(data))
-                if self.server_conn:
-                    self.server_conn.sendall(header + data)
-        except (ConnectionResetError, BrokenPipeError, OSError):
-            pass # Socket was likely closed by another thread.
-        finally:
-             # Send a disconnection signal for this player
-            if not self.shutdown_event.is_set() and self.server_conn:
-                try:
-                    header = struct.pack('!II', player_id, 0)
-                    self.server_conn.sendall(header)
-                except OSError:
-                    pass
-
-    def _forward_from_server_to_local(self):
-        """Reads from the server tunnel and forwards data to the correct local connection."""
-        try:
-            while not self.shutdown_event.is_set():
-                header_buffer = b''
-                while len(header_buffer) < 8:
-                    if self.shutdown_event.is_set() or not self.server_conn: return
-                    packet = self.server_conn.recv(8 - len(header_buffer))
-                    if not packet:
-                        header_buffer = None
-                        break
-                    header_buffer += packet
-                
-                if not header_buffer:
-                    self._put_status('status', "Server closed the connection.")
-                    break
-
-                player_id, length = struct.unpack('!II', header_buffer)
-                
-                data = b''
-                if length > 0:
-                    while len(data) < length:
-                        chunk = self.server_conn.recv(length - len(data))
-                        if not chunk: raise ConnectionError("Tunnel connection lost.")
-                        data += chunk
-
-                with self.local_lock:
-                    if self.shutdown_event.is_set(): break
-                    
-                    if player_id not in self.local_connections and length > 0:
-                        try:
-                            local_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            local_conn.connect((self.local_host, self.local_port))
-                            self.local_connections[player_id] = local_conn
-                            
-                            upstream_thread = threading.Thread(target=self._forward_from_local_to_server, args=(local_conn, player_id))
-                            upstream_thread.daemon = True
-                            upstream_thread.start()
-                        except ConnectionRefusedError:
-                            self._put_status('status', f"[Warning] Connection to local service for Player {player_id} refused.")
-                            continue
-                    
-                    if length == 0:
-                        if player_id in self.local_connections:
-                            self.local_connections[player_id].close()
-                            del self.local_connections[player_id]
-                        continue
-
-                    if player_id in self.local_connections:
-                        try:
-                            self.local_connections[player_id].sendall(data)
-                        except OSError:
-                            pass # Socket may have been closed.
-        finally:
-            with self.local_lock:
-                for conn in self.local_connections.values():
-                    conn.close()
+from p2p_client import ClientEngine, LOCAL_POOL_SIZE
 
 
 class P2PClientGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("P2P Client")
-        self.root.geometry("400x200")
+        self.root.geometry("400x225")
         self.root.resizable(False, False)
 
-        self.client_thread = None
+        self.engine = None
         self.status_queue = queue.Queue()
+        self.running_status = None # Last engine status that means the tunnel is up; player counts are appended to it.
 
         # --- UI Elements ---
         self.ip_var = tk.StringVar(value="127.0.0.1")
         self.control_port_var = tk.StringVar(value="9000")
         self.local_port_var = tk.StringVar(value="25565")
+        self.compress_var = tk.BooleanVar(value=False)
         
         self.public_ip_var = tk.StringVar(value="N/A")
         self.public_port_var = tk.StringVar(value="N/A")
@@ -210,9 +50,12 @@ class P2PClientGUI:
         self.control_port_entry = tk.Entry(top_frame, textvariable=self.control_port_var)
         self.control_port_entry.grid(row=1, column=1, sticky="ew")
 
-        tk.Label(top_frame, text="Local Port:").grid(row=2, column=0, sticky="w")
+        tk.Label(top_frame, text="Local Port(s):").grid(row=2, column=0, sticky="w")
         self.local_port_entry = tk.Entry(top_frame, textvariable=self.local_port_var)
         self.local_port_entry.grid(row=2, column=1, sticky="ew")
+
+        self.compress_check = tk.Checkbutton(top_frame, text="Compress traffic (zlib)", variable=self.compress_var)
+        self.compress_check.grid(row=3, column=1, sticky="w")
         
         top_frame.columnconfigure(1, weight=1)
 
@@ -235,12 +78,14 @@ class P2PClientGUI:
 
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.process_queue()
+        self.refresh_stats()
 
     def start_client(self):
         server_ip = self.ip_var.get()
         try:
             control_port = int(self.control_port_var.get())
-            local_port = int(self.local_port_var.get())
+            # Comma-separated ports share one tunnel; each gets its own public port.
+            local_ports = [int(port) for port in self.local_port_var.get().split(',')]
         except ValueError:
             messagebox.showerror("Invalid Input", "Ports must be numbers.")
             return
@@ -250,14 +95,21 @@ class P2PClientGUI:
         self.public_ip_var.set("N/A")
         self.public_port_var.set("N/A")
         
-        self.client_thread = ClientLogicThread(server_ip, control_port, local_port, self.status_queue)
-        self.client_thread.start()
+        # The engine runs the whole tunnel on one background thread and reports back through the queue.
+        self.engine = ClientEngine(server_ip, control_port, local_ports, compress=self.compress_var.get(),
+                                   local_pool=LOCAL_POOL_SIZE, on_event=self.queue_event)
+        self.engine.start()
+
+    def queue_event(self, kind, data):
+        """Called on the engine thread; the GUI thread picks the message up in process_queue."""
+        if kind != 'log': # Per-player details are too chatty for the status bar.
+            self.status_queue.put({'type': kind, 'data': data})
 
     def stop_client(self):
-        if self.client_thread and self.client_thread.is_alive():
+        if self.engine and self.engine.thread.is_alive():
             self.status_var.set("Status: Stopping...")
-            self.client_thread.stop()
-            # The thread will put a 'stopped' message in the queue upon exit.
+            self.engine.stop()
+            # The engine will put a 'stopped' message in the queue upon exit.
             # The UI will reset once that message is processed.
 
     def set_ui_state(self, is_running):
@@ -267,6 +119,7 @@ class P2PClientGUI:
         self.ip_entry.config(state=state)
         self.control_port_entry.config(state=state)
         self.local_port_entry.config(state=state)
+        self.compress_check.config(state=state)
         
         stop_state = tk.NORMAL if is_running else tk.DISABLED
         self.stop_button.config(state=stop_state)
@@ -281,28 +134,43 @@ class P2PClientGUI:
 
                 if msg_type == 'status':
                     self.status_var.set(f"Status: {data}")
+                    self.running_status = data if data.endswith("Running") else None
+                elif msg_type == 'warning':
+                    self.status_var.set(f"Status: [Warning] {data}")
                 elif msg_type == 'error':
+                    self.running_status = None
                     self.status_var.set(f"Status: Error")
                     messagebox.showerror("Client Error", data)
                     self.set_ui_state(is_running=False)
                 elif msg_type == 'success':
                     self.public_ip_var.set(data['ip'])
-                    self.public_port_var.set(data['port'])
+                    if len(data['services']) > 1:
+                        self.public_port_var.set(", ".join(f"{public} (local {local})" for local, public in data['services']))
+                    else:
+                        self.public_port_var.set(data['port'])
                 elif msg_type == 'stopped':
+                    self.running_status = None
                     self.status_var.set("Status: Stopped")
                     self.public_ip_var.set("N/A")
                     self.public_port_var.set("N/A")
                     self.set_ui_state(is_running=False)
-                    self.client_thread = None
+                    self.engine = None
 
         except queue.Empty:
             pass # No new messages
         finally:
             self.root.after(100, self.process_queue) # Check again in 100ms
 
+    def refresh_stats(self):
+        """Shows the live player count from the engine while the tunnel is running."""
+        if self.engine and self.running_status:
+            players = self.engine.stats()['players']
+            self.status_var.set(f"Status: {self.running_status} ({players} player{'s' if players != 1 else ''})")
+        self.root.after(1000, self.refresh_stats)
+
     def on_closing(self):
         """Handle window close event."""
-        if self.client_thread and self.client_thread.is_alive():
+        if self.engine and self.engine.thread.is_alive():
             self.stop_client()
         self.root.destroy()
 
@@ -0,0 +1,151 @@
+# p2p_metrics.py
+# ตัวนับและ histogram สำหรับวัดการทำงานของ relay พร้อม endpoint HTTP ที่ตอบเป็น Prometheus text format
+#
+# หลักการ: ตัวนับทุกชุดมีผู้เขียนเพียง Thread เดียว (Thread ของผู้เล่น, Thread อ่านของแต่ละเส้น
+# หรือ event loop) จึงไม่ต้องมี lock ใน hot loop เลย ตอนมีคนมาขอ /metrics ค่อยรวมทุกชุดเข้าด้วยกัน
+# ค่าที่อ่านได้จึงเป็นค่าประมาณ ณ ขณะนั้น (อาจช้ากว่าความจริง 1-2 Frame) ซึ่งเพียงพอสำหรับการ monitor
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FRAME_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144) # bytes
+RELAY_DELAY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0) # วินาที
+
+
+class Histogram:
+    """histogram แบบ bucket คงที่ (ขอบบนรวมค่าที่เท่ากับขอบ เหมือน le ของ Prometheus) เขียนได้จาก Thread เดียว"""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # ช่องสุดท้ายคือ +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def add(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+
+
+class DirectionMetrics:
+    """ตัวนับของข้อมูลทิศทางเดียว ('to_host' หรือ 'to_peer') ที่ผ่าน relay"""
+    __slots__ = ('direction', 'frames', 'bytes', 'sizes', 'delays')
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.frames = 0
+        self.bytes = 0
+        self.sizes = Histogram(FRAME_SIZE_BUCKETS)
+        self.delays = Histogram(RELAY_DELAY_BUCKETS)
+
+    def add(self, other):
+        self.frames += other.frames
+        self.bytes += other.bytes
+        self.sizes.add(other.sizes)
+        self.delays.add(other.delays)
+
+
+class MetricsWriter:
+    """สร้างข้อความ Prometheus text format โดยรวมทุก sample ของ metric เดียวกันไว้ด้วยกัน (ตามที่ format กำหนด)"""
+    def __init__(self):
+        self.families = {} # {name: (type, help, {series: ค่า})} เรียงตามลำดับที่เพิ่ม
+
+    def _family(self, name, kind, help_text):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help_text, {})
+        return family[2]
+
+    def sample(self, name, kind, help_text, value, **labels):
+        self._family(name, kind, help_text)[f"{name}{_format_labels(labels)}"] = value
+
+    def histogram(self, name, help_text, histogram, **labels):
+        samples = self._family(name, 'histogram', help_text)
+        cumulative = 0
+        for bound, count in zip(histogram.bounds, histogram.counts):
+            cumulative += count
+            samples[f"{name}_bucket{_format_labels(labels, le=bound)}"] = cumulative
+        cumulative += histogram.counts[-1]
+        samples[f"{name}_bucket{_format_labels(labels, le='+Inf')}"] = cumulative
+        samples[f"{name}_sum{_format_labels(labels)}"] = histogram.sum
+        samples[f"{name}_count{_format_labels(labels)}"] = cumulative
+
+    def merge_text(self, text):
+        """
+        [ใหม่] บวก sample จากข้อความ /metrics ของอีก process (โหมด pre-fork) เข้ากับชุดนี้
+        sample ที่ชื่อและ label ตรงกันรวมเป็นค่าเดียว (bucket ของ histogram เป็นค่าสะสมจึงบวกกันได้ตรงๆ)
+        """
+        helps = {}
+        samples = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                _, _, name, help_text = line.split(' ', 3)
+                helps[name] = help_text
+            elif line.startswith('# TYPE '):
+                _, _, name, kind = line.split(' ', 3)
+                samples = self._family(name, kind, helps.get(name, ''))
+            elif line and not line.startswith('#') and samples is not None:
+                series, _, value = line.rpartition(' ')
+                samples[series] = samples.get(series, 0) + _parse_value(value)
+
+    def total(self, name):
+        """[ใหม่] ผลรวมของทุก sample ใน metric เดียว (0 ถ้าไม่มี) ใช้สรุปยอดในบรรทัด log"""
+        family = self.families.get(name)
+        return sum(family[2].values()) if family else 0
+
+    def text(self):
+        out = []
+        for name, (kind, help_text, samples) in self.families.items():
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(f"{series} {value}" for series, value in samples.items())
+        return "\n".join(out) + "\n"
+
+
+def _parse_value(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    pairs = (f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_metrics_server(host, port, collect):
+    """
+    เปิด HTTP endpoint ใน Thread แยก (daemon) ตอบ GET /metrics ด้วยข้อความจาก collect()
+    collect ถูกเรียกเฉพาะตอนมีคนมาขอเท่านั้น ค่าใช้จ่ายของการรวมตัวนับจึงไม่อยู่ใน hot loop
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # ไม่ต้อง log ทุกครั้งที่ Prometheus มา scrape
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,221 @@
+# p2p_profile.py
+# Profiling ตอนที่ relay ทำงานอยู่ เปิดได้ทันทีด้วย signal หรือคำสั่งบน Control Port โดยไม่ต้องเริ่ม process ใหม่
+#
+# ระหว่าง session (N วินาที) มี 2 อย่างทำงานพร้อมกัน:
+#   - StackSampler: Thread ที่อ่าน stack ของทุก Thread ใน process (sys._current_frames) เป็นระยะ
+#     แล้วเขียนเป็นไฟล์ collapsed stack ("thread;ฟังก์ชัน;ฟังก์ชัน จำนวน" ต่อบรรทัด) ที่ flamegraph.pl / speedscope เปิดได้
+#     เป็นเวลาตามนาฬิกาจริง: Thread ที่รอ recv/poll อยู่ก็ถูกนับ (Asyncio engine เห็นเฉพาะ coroutine ที่กำลังรันตอนสุ่ม)
+#   - FrameTimings: เวลาต่อ Frame ของแต่ละขั้นใน forwarder (read, lock, send) แยกตามทิศทาง เขียนเป็น <ไฟล์>.timings
+#
+# เมื่อไม่มี session: forwarder เช็คแค่ `timings is not None` ต่อ Frame (แบบเดียวกับ frame_capture) ไม่มีค่าใช้จ่ายอื่น
+# ตัวนับของ FrameTimings ไม่มี lock (หลาย Thread อาจเขียน stage เดียวกัน) ตัวเลขจึงเป็นค่าประมาณที่อาจหายไปบ้างตอนแย่งกัน
+import collections
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+from p2p_metrics import Histogram
+
+TIMING_BUCKETS = (0.000001, 0.000002, 0.000005, 0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005,
+                  0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0) # วินาที
+PROFILE_STAGES = ('read', 'lock', 'send')
+SAMPLE_INTERVAL = 0.005 # วินาทีระหว่างการสุ่ม stack แต่ละครั้ง
+SAMPLE_DUTY_MAX = 0.2 # สุ่มนานเกินสัดส่วนนี้ของเวลา (เช่นมีหลายพัน Thread) = เว้นช่วงให้ห่างขึ้นเอง
+STACK_DEPTH_MAX = 64
+
+_THREAD_NAME = re.compile(r'^Thread-\d+(?: \((.*)\))?$')
+
+
+class StageTiming(Histogram):
+    """Histogram ของเวลา 1 ขั้น (วินาที) ที่เก็บค่าสูงสุดไว้ด้วย"""
+    __slots__ = ('max',)
+
+    def __init__(self):
+        super().__init__(TIMING_BUCKETS)
+        self.max = 0
+
+    def observe(self, value):
+        super().observe(value)
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """ขอบบนของ bucket ที่ครอบ fraction ของค่าทั้งหมด (ค่าใน bucket สุดท้ายใช้ max แทน)"""
+        target = fraction * sum(self.counts)
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class FrameTimings:
+    """
+    เวลาต่อ Frame ของแต่ละ (ทิศทาง, ขั้น): read = อ่าน Frame จาก socket, lock = รอ lock/คิวที่ใช้ร่วมกัน,
+    send = ส่งต่อไปยังปลายทาง (socket หรือคิวขาออก) ความหมายละเอียดของแต่ละขั้นอยู่ที่ forwarder ที่วัด
+    """
+    def __init__(self):
+        self.stages = {}
+        self.started = time.monotonic()
+
+    def stage(self, direction, stage):
+        """StageTiming ของขั้นนี้ (สร้างเมื่อใช้ครั้งแรก) สำหรับส่งต่อให้โค้ดที่ไม่รู้จัก FrameTimings เช่น TunnelWriter"""
+        timing = self.stages.get((direction, stage))
+        if timing is None:
+            timing = self.stages.setdefault((direction, stage), StageTiming())
+        return timing
+
+    def record(self, direction, stage, seconds):
+        self.stage(direction, stage).observe(seconds)
+
+    def summary_lines(self):
+        """ตารางสรุป 1 บรรทัดต่อขั้น (µs) เรียงตามทิศทางแล้วตามลำดับ read, lock, send"""
+        order = {stage: index for index, stage in enumerate(PROFILE_STAGES)}
+        lines = [f"{'direction':<10} {'stage':<5} {'frames':>9} {'mean_us':>9} {'p50_us':>9} {'p90_us':>9} "
+                 f"{'p99_us':>9} {'max_us':>10} {'total_s':>9}"]
+        for (direction, stage), timing in sorted(self.stages.items(),
+                                                 key=lambda item: (item[0][0], order.get(item[0][1], len(order)))):
+            count = sum(timing.counts)
+            if not count:
+                continue
+            lines.append(f"{direction:<10} {stage:<5} {count:>9} {timing.sum / count * 1e6:>9.1f} "
+                         f"{timing.percentile(0.5) * 1e6:>9.1f} {timing.percentile(0.9) * 1e6:>9.1f} "
+                         f"{timing.percentile(0.99) * 1e6:>9.1f} {timing.max * 1e6:>10.1f} {timing.sum:>9.3f}")
+        if len(lines) == 1:
+            lines.append("(no frames were relayed during the session)")
+        return lines
+
+
+def thread_label(name):
+    """ชื่อ Thread ใน stack: 'Thread-12 (forward_from_peer_to_host)' -> 'forward_from_peer_to_host' (รวมผู้เล่นทุกคนเป็นกองเดียว)"""
+    match = _THREAD_NAME.match(name)
+    if match is None:
+        return name
+    return match.group(1) or 'Thread'
+
+
+class StackSampler:
+    """สุ่ม stack ของทุก Thread (ยกเว้นตัวเอง) ทุก interval วินาที แล้วนับ stack ที่ซ้ำกันรวมกัน"""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.threads_seen = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.names = {}
+        self.frame_labels = {} # {code object: 'ฟังก์ชัน (ไฟล์:บรรทัด)'}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='p2p-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _label(self, code):
+        label = self.frame_labels.get(code)
+        if label is None:
+            label = self.frame_labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.is_set():
+            started = time.perf_counter()
+            frames = sys._current_frames()
+            if any(ident not in self.names for ident in frames):
+                self.names = {thread.ident: thread_label(thread.name) for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < STACK_DEPTH_MAX:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(self.names.get(ident, 'unknown'))
+                self.stacks[';'.join(reversed(stack))] += 1
+            frames = frame = None # ไม่ถือ frame ของ Thread อื่นไว้ข้ามรอบ
+            self.samples += 1
+            self.threads_seen = max(self.threads_seen, len(self.names))
+            elapsed = time.perf_counter() - started
+            self.stopped.wait(max(self.interval, elapsed / SAMPLE_DUTY_MAX - elapsed))
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """
+    session ของการ profile ทีละ 1 session ต่อ process: start() เริ่มสุ่ม stack และเปิด FrameTimings
+    ครบเวลาแล้วเขียนไฟล์ <path_prefix>-<เวลา>.folded และ .folded.timings แล้วปิดทุกอย่างเอง
+    on_timings(FrameTimings หรือ None) ถูกเรียกตอนเริ่ม/จบ เพื่อให้ forwarder ของแต่ละโมดูลเริ่ม/หยุดวัด
+    """
+    def __init__(self, path_prefix, on_timings=None, log=print):
+        self.path_prefix = path_prefix
+        self.on_timings = on_timings or (lambda timings: None)
+        self.log = log
+        self.lock = threading.Lock()
+        self.session = None # (StackSampler, FrameTimings, path, Timer) ของ session ที่กำลังทำงาน
+
+    def start(self, seconds):
+        """เริ่ม session ยาว seconds วินาที คืนค่า path ของไฟล์ที่จะเขียน หรือ None ถ้ามี session ทำงานอยู่แล้ว"""
+        with self.lock:
+            if self.session is not None:
+                return None
+            path = f"{self.path_prefix}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+            sampler = StackSampler()
+            timings = FrameTimings()
+            timer = threading.Timer(seconds, self.finish)
+            timer.daemon = True
+            self.session = (sampler, timings, path, timer)
+        sampler.start()
+        self.on_timings(timings)
+        timer.start()
+        self.log(f"[Profile] Sampling all threads for {seconds:g}s -> {path}")
+        return path
+
+    def finish(self):
+        """จบ session ที่ทำงานอยู่ (ถ้ามี) แล้วเขียนไฟล์ทั้งสอง"""
+        with self.lock:
+            session, self.session = self.session, None
+        if session is None:
+            return
+        sampler, timings, path, timer = session
+        timer.cancel()
+        self.on_timings(None)
+        sampler.stop()
+        elapsed = time.monotonic() - timings.started
+        try:
+            sampler.write(path)
+            with open(f"{path}.timings", 'w') as f:
+                f.write(f"# per-frame stage timings over {elapsed:.1f}s (pid {os.getpid()})\n")
+                f.write("\n".join(timings.summary_lines()) + "\n")
+        except OSError as e:
+            self.log(f"[Profile] Could not write {path}: {e}")
+            return
+        self.log(f"[Profile] Wrote {sampler.samples} samples of up to {sampler.threads_seen} threads to {path} "
+                 f"(frame timings: {path}.timings)")
+
+    def install_signal(self, seconds, signum=getattr(signal, 'SIGUSR1', None)):
+        """
+        ให้ signal (ค่าเริ่มต้น SIGUSR1, ไม่มีบน Windows) เริ่ม session ยาว seconds วินาที คืนค่า False ถ้าใช้ไม่ได้
+        ต้องเรียกจาก Thread หลัก ตัว handler แค่เปิด Thread ใหม่ให้ start() (ไม่แตะ lock ใน handler)
+        """
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+        signal.signal(signum, lambda _signum, _frame: threading.Thread(target=self._signalled, args=(seconds,),
+                                                                        daemon=True).start())
+        return True
+
+    def _signalled(self, seconds):
+        if self.start(seconds) is None:
+            self.log("[Profile] A profiling session is already running.")
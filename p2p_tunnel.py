@@ -0,0 +1,992 @@
+# p2p_tunnel.py
+# โค้ดที่ใช้ร่วมกันระหว่าง serverp2p, p2p_client (clientp2p, p2p_gui) สำหรับรูปแบบ Frame บนอุโมงค์
+# รูปแบบ Frame: Header 8 bytes ('!II' = player_id, length) ตามด้วยข้อมูล length bytes
+# length = 0 หมายถึงผู้เล่นคนนั้นหลุดการเชื่อมต่อ
+#
+# Control Protocol (Port 9000): Client ส่ง 1 บรรทัด "<COMMAND> key=value ...\n"
+# Server ตอบ 1 บรรทัด "OK key=value ...\n" หรือ "ERROR:<Reason>\n"
+# Client รุ่นเก่าที่ไม่ส่งอะไรเลยจะได้เลข Port เปล่าๆ กลับไปเหมือนเดิม
+# คำสั่ง PORT/TUNNEL ได้ secret กลับมาด้วย ถ้าอุโมงค์หลุด Host ส่ง "RESUME secret=...\n"
+# ภายในช่วง grace ของ Server แล้วการเชื่อมต่อ Control นั้นจะกลายเป็นอุโมงค์เดิม (Port เดิม ผู้เล่นเดิม)
+# ขอหลายเส้นได้ด้วย "PORT stripes=N" แล้วเปิดเส้นเสริมด้วย "STRIPE secret=...\n" (ทำงานแบบเดียวกับ RESUME)
+# ผู้เล่นแต่ละคนอยู่บนเส้นเดียวเสมอ ฝั่ง Client จึงแยกจัดการแต่ละเส้นได้อิสระ
+#
+# การบีบอัด (ตกลงกันด้วย "PORT compress=zlib" ถ้า Server ยอมจะตอบ compress=zlib กลับมา):
+# 2 bit บนของ length เป็น flag: COMPRESSED_FLAG = payload เป็น deflate ของ stream ประจำผู้เล่นคนนั้น
+# STREAM_RESET_FLAG = ฝั่งรับต้องทิ้ง stream เดิมของผู้เล่นคนนั้นก่อน (ใช้คู่กับ Frame แรกของ stream ใหม่
+# หรือกับ Frame ดิบที่ลองบีบแล้วไม่เล็กลง) Frame ที่ไม่มี flag คือข้อมูลดิบที่ไม่ได้ผ่าน stream
+#
+# Public Port แบบ UDP ("PORT proto=udp" ถ้า Server ทำได้จะตอบ proto=udp กลับมา): Host ยังต่ออุโมงค์ด้วย TCP
+# เหมือนเดิม แต่ผู้เล่นคือต้นทาง (ip, port) ของ datagram และ 1 Frame = 1 datagram ทั้งสองทิศทาง
+# datagram ขนาด 0 ไม่ถูกส่งต่อ (length 0 ยังหมายถึงผู้เล่นหลุด ซึ่งสำหรับ UDP คือ session หมดอายุ)
+#
+# Heartbeat ("PORT heartbeat=1" ถ้า Server ทำได้จะตอบ heartbeat=<วินาที> กลับมา): player_id 0 สงวนไว้สำหรับ
+# Frame "PING"/"PONG" ฝั่งที่ได้ PING ต้องตอบ PONG บนเส้นเดียวกัน Host ส่ง PING ทุกเส้นตามช่วงที่ Server บอก
+# ถ้าเส้นไหนเงียบ (ไม่มี Frame ใดๆ เลย) เกิน HEARTBEAT_MISSES ช่วง อีกฝั่งจะถือว่าเส้นนั้นตายแล้วปิดทิ้ง
+#
+# Direct ("PORT direct=1" ถ้า Server ทำได้จะตอบ direct=1 กลับมา): เมื่อมีผู้เล่น TCP ใหม่ Server ส่ง Frame
+# "OPEN player=<id>\n" บน player_id 0 แล้ว Host เปิดการเชื่อมต่อข้อมูลของผู้เล่นคนนั้นด้วย "DATA secret=... player=<id>\n"
+# ทาง Control Port หลังได้ OK การเชื่อมต่อนั้นคือ byte stream ของผู้เล่นตรงๆ (ไม่มี Frame, ปิดฝั่งส่ง = EOF)
+# ถ้า Host ไม่เปิดมาภายในเวลาที่ Server กำหนด ผู้เล่นคนนั้นใช้อุโมงค์แบบ Frame ตามปกติ (DATA ที่มาช้าได้ ERROR)
+#
+# หลาย Local Service ในอุโมงค์เดียว ("PORT services=N" ถ้า Server ทำได้จะตอบ ports=<p0>,<p1>,... กลับมา):
+# Server จอง Public Port N ตัวในคำขอเดียว Host ต่ออุโมงค์ที่ Port แรกเหมือนเดิม ผู้เล่นที่เข้ามาทาง Port ลำดับ i
+# ได้ player_id ที่มี i อยู่ใน bit SERVICE_SHIFT ขึ้นไป (service_of) Host จึงรู้ว่าต้องต่อไปยัง Local Service ตัวไหน
+# จาก Frame แรกของผู้เล่นโดยไม่ต้องมีคำสั่งเพิ่ม service 0 คือ player_id แบบเดิมทุกอย่าง (รวม OPEN/DATA ของโหมด direct)
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+
+from p2p_metrics import Histogram, RELAY_DELAY_BUCKETS
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+FRAME_HEADER = struct.Struct('!II')
+HEADER_SIZE = FRAME_HEADER.size
+DECODER_BUFFER_SIZE = 256 * 1024
+WRITER_MAX_PENDING_BYTES = 4 * 1024 * 1024 # ผู้ส่งจะรอถ้ามีข้อมูลค้างในคิวของ TunnelWriter เกินค่านี้
+FAIR_QUANTUM = 16 * 1024 # [ใหม่] bytes ที่ผู้เล่นแต่ละคนได้ส่งต่อรอบของ deficit round robin (คูณด้วย weight)
+FAIR_BATCH_BYTES = 128 * 1024 # bytes สูงสุดที่ FairQueue ปล่อยลง socket ต่อครั้ง (ยิ่งเล็ก Frame เล็กยิ่งรอน้อย แต่ syscall มากขึ้น)
+FAIR_PLAYER_MAX_BYTES = 256 * 1024 # ผู้เล่นที่มีข้อมูลค้างในคิวขาออกของเส้นเกินนี้ต้องรอ (ผู้เล่นคนอื่นยังส่งต่อได้)
+CONTROL_LINE_LIMIT = 512 # ความยาวสูงสุดของ 1 บรรทัดใน Control Protocol และ preamble
+UDP_MAX_DATAGRAM = 65535 # ขนาดบัฟเฟอร์รับ datagram (ใหญ่สุดที่ UDP บน IPv4 ส่งได้)
+LOCAL_CONNECT_TIMEOUT = 10 # วินาทีที่รอ connect ไปยัง Local Service ก่อนถือว่าไม่สำเร็จ
+LOCAL_PENDING_MAX_BYTES = 1024 * 1024 # ข้อมูลของผู้เล่นที่รอส่งไปยัง Local Service ได้ (รวมช่วงที่ยัง connect ไม่เสร็จ)
+LOCAL_POOL_MAX_IDLE = 30 # วินาทีที่ socket ใน LocalConnectionPool รอได้ก่อนถูกปิดแล้วเปิดใหม่
+LOCAL_POOL_RETRY_SECONDS = 1 # ระยะรอก่อนเติม pool ใหม่เมื่อ connect ไม่สำเร็จ (Local Service อาจยังไม่เปิด)
+HEARTBEAT_PLAYER_ID = 0 # [ใหม่] player_id ของ Frame PING/PONG (ผู้เล่นจริงเริ่มที่ 1)
+HEARTBEAT_PING = b'PING'
+HEARTBEAT_PONG = b'PONG'
+HEARTBEAT_MISSES = 3 # จำนวนช่วง heartbeat ที่เส้นเงียบได้ก่อนถูกถือว่าตาย
+DIRECT_OPEN = 'OPEN' # [ใหม่] บรรทัดคำสั่งบน player_id 0 ที่ขอให้ Host เปิดการเชื่อมต่อข้อมูลของผู้เล่น (โหมด direct)
+SPLICE_PIPE_BYTES = 256 * 1024 # [ใหม่] ขนาด pipe ของ SplicePump (kernel อาจให้น้อยกว่านี้ ค่าเริ่มต้นของ Linux คือ 64KB)
+SPLICE_SUPPORTED = hasattr(os, 'splice') # os.splice มีเฉพาะ Linux และ Python 3.10 ขึ้นไป
+KEEPALIVE_IDLE = 60 # [ใหม่] ค่าเริ่มต้นของ TCP keepalive: วินาทีที่เงียบได้ก่อน kernel เริ่มส่ง probe
+KEEPALIVE_INTERVAL = 10 # วินาทีระหว่าง probe
+KEEPALIVE_COUNT = 3 # จำนวน probe ที่ไม่ได้คำตอบก่อน kernel ตัดการเชื่อมต่อ
+SERVICE_SHIFT = 24 # [ใหม่] bit 24-31 ของ player_id คือลำดับของ Local Service ในอุโมงค์ (bit 0-23 คือเลขผู้เล่น)
+PLAYER_ID_MASK = (1 << SERVICE_SHIFT) - 1
+MAX_SERVICES = 1 << (32 - SERVICE_SHIFT)
+READ_SIZE_MIN = 4096 # [ใหม่] ขนาด recv เริ่มต้นของ ReadSizer (การเชื่อมต่อที่ว่างหรือส่งทีละนิดอยู่ที่ขนาดนี้)
+READ_SIZE_MAX = 256 * 1024 # ขนาด recv สูงสุดที่การเชื่อมต่อที่ส่งต่อเนื่องขยายไปถึงได้
+SOCKET_BUFFER_ROLES = ('peer', 'tunnel', 'local') # [ใหม่] บทบาทของ socket ที่ตั้ง SO_SNDBUF/SO_RCVBUF แยกกันได้
+
+COMPRESSED_FLAG = 0x80000000
+STREAM_RESET_FLAG = 0x40000000
+LENGTH_MASK = 0x3FFFFFFF
+COMPRESS_MIN_SIZE = 256 # Frame ที่เล็กกว่านี้ส่งดิบเสมอ (header ของ deflate ไม่คุ้ม)
+COMPRESS_LEVEL = 1 # เน้นความเร็ว: คอขวดคือ uplink ของ Host ไม่ใช่อัตราส่วนสุดท้าย
+COMPRESS_WBITS = 13 # หน้าต่าง 8KB ต่อผู้เล่น (raw deflate) ใช้หน่วยความจำราว 48KB ต่อ stream
+COMPRESS_MEM_LEVEL = 5
+COMPRESS_MAX_BACKOFF = 64 # จำนวน Frame สูงสุดที่พักการบีบหลังเจอข้อมูลที่บีบไม่ลง
+DECOMPRESS_MAX_FRAME = 16 * 1024 * 1024 # ป้องกัน Frame ที่คลายออกมาใหญ่ผิดปกติ
+_SYNC_TAIL = b'\x00\x00\xff\xff' # ท้ายของ Z_SYNC_FLUSH ที่ตัดออกก่อนส่งและเติมกลับตอนคลาย
+
+try:
+    _IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+
+
+class FrameDecoder:
+    """
+    แกะ Frame จาก socket โดยอ่านด้วย recv_into ลงบัฟเฟอร์ที่จองไว้ล่วงหน้า
+    อ่านครั้งเดียวได้หลาย Frame และคืน payload เป็น memoryview ชี้เข้าไปในบัฟเฟอร์ (ไม่ copy)
+
+    ข้อควรระวัง: payload ใช้ได้จนกว่าจะขอ Frame ถัดไปเท่านั้น
+    ถ้าต้องเก็บไว้นานกว่านั้นให้แปลงเป็น bytes(payload) เอง
+    """
+    def __init__(self, sock, buffer_size=DECODER_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # ตำแหน่งแรกของข้อมูลที่ยังไม่ได้แกะ
+        self.end = 0   # ตำแหน่งถัดจากข้อมูลที่อ่านมาแล้ว
+        self.flags = 0 # flag การบีบอัดของ Frame ล่าสุดที่ yield ออกไป
+        self.needed = HEADER_SIZE # จำนวน byte ที่ต้องมีในบัฟเฟอร์ก่อนจะแกะ Frame ถัดไปได้
+        self.eof = False # [ใหม่] poll() เจออีกฝั่งปิดการเชื่อมต่อแล้ว
+
+    def frames(self):
+        """
+        Generator คืนค่า (player_id, payload) ทีละ Frame จนกว่าอีกฝั่งจะปิดการเชื่อมต่อ
+        ถ้าการเชื่อมต่อหลุดกลาง payload จะ raise ConnectionError
+        flag การบีบอัดของ Frame ที่เพิ่ง yield อ่านได้จาก self.flags
+        """
+        while True:
+            # แกะทุก Frame ที่อยู่ครบในบัฟเฟอร์ก่อน แล้วค่อยอ่านจาก socket เพิ่ม
+            yield from self._complete_frames()
+            if not self._fill(self.needed):
+                return
+
+    def poll(self):
+        """
+        [ใหม่] สำหรับ socket แบบ non-blocking (event loop): อ่านจาก socket 1 ครั้งแล้ว yield ทุก Frame ที่ครบ
+        ถ้ายังไม่มีข้อมูลจะ raise BlockingIOError ถ้าอีกฝั่งปิดที่ขอบ Frame จะตั้ง self.eof แล้วจบ
+        """
+        if not self._fill(self.needed):
+            self.eof = True
+            return
+        yield from self._complete_frames()
+
+    def _complete_frames(self):
+        unpack_from = FRAME_HEADER.unpack_from
+        self.needed = HEADER_SIZE
+        while self.end - self.start >= HEADER_SIZE:
+            player_id, length = unpack_from(self.buffer, self.start)
+            self.flags = length & ~LENGTH_MASK
+            length &= LENGTH_MASK
+            frame_end = self.start + HEADER_SIZE + length
+            if frame_end > self.end:
+                self.needed = HEADER_SIZE + length
+                break
+            payload = self.view[self.start + HEADER_SIZE:frame_end]
+            self.start = frame_end
+            yield player_id, payload
+
+    def _fill(self, needed):
+        """อ่านข้อมูลจาก socket เพิ่มอย่างน้อย 1 ครั้ง คืนค่า False เมื่ออีกฝั่งปิดการเชื่อมต่อที่ขอบ Frame"""
+        pending = self.end - self.start
+        if pending == 0:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.start < needed:
+            if needed > len(self.buffer):
+                # Frame ใหญ่กว่าบัฟเฟอร์: ขยายบัฟเฟอร์ (payload view เก่ายังชี้บัฟเฟอร์เดิมได้อย่างปลอดภัย)
+                new_buffer = bytearray(max(needed, len(self.buffer) * 2))
+                new_buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = new_buffer
+                self.view = memoryview(new_buffer)
+            else:
+                # ย้ายข้อมูลที่เหลือ (ไม่ถึง 1 Frame) ไปไว้ต้นบัฟเฟอร์
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            if pending >= HEADER_SIZE:
+                raise ConnectionError("Tunnel connection lost while reading data payload.")
+            return False
+        self.end += received
+        return True
+
+
+class FairQueue:
+    """
+    [ใหม่] คิวขาออกของเส้นที่แยกตามผู้เล่น แล้วเลือก Frame ด้วย deficit round robin (DRR)
+    - ผู้เล่นแต่ละคนได้ส่งรอบละ quantum * weight bytes Frame ไม่ถูกตัด: Frame ที่ใหญ่กว่าเครดิตรอสะสมเครดิตรอบถัดไป
+    - Frame ของผู้เล่นคนเดียวกันยังเรียงตามลำดับเดิม
+    - take() ปล่อยทีละไม่เกิน batch_bytes ดังนั้น Frame ของผู้เล่นที่ไม่มีอะไรค้างจะรอหลังผู้เล่นที่ส่งก้อนใหญ่
+      ไม่เกิน batch ที่ปล่อยไปแล้ว + 1 รอบของ DRR (quantum ของผู้เล่นที่มีคิวอยู่รวมกัน)
+    ไม่ thread-safe: ผู้ใช้ต้องถือ lock เอง หรือเรียกจาก event loop เดียว
+    """
+    def __init__(self, quantum=FAIR_QUANTUM):
+        self.quantum = quantum
+        self.queues = {} # {player_id: deque ของ (ขนาด, header, payload, เวลาเข้าคิว)} เฉพาะผู้เล่นที่มี Frame ค้าง
+        self.depths = {} # {player_id: bytes ที่ค้าง}
+        self.deficits = {}
+        self.weights = {} # {player_id: weight} ผู้เล่นที่ไม่มีในนี้ได้ weight 1
+        self.active = deque() # ลำดับการเวียนของผู้เล่นที่มี Frame ค้าง
+        self.turn = None # ผู้เล่นหัวคิวที่ได้เครดิตรอบนี้ไปแล้ว (take ครั้งก่อนเต็ม batch กลางรอบ)
+        self.pending_bytes = 0
+
+    def put(self, player_id, header, payload=b''):
+        size = len(header) + len(payload)
+        queue = self.queues.get(player_id)
+        if queue is None:
+            queue = self.queues[player_id] = deque()
+            self.depths[player_id] = size
+            self.deficits[player_id] = 0
+            self.active.append(player_id)
+        else:
+            self.depths[player_id] += size
+        queue.append((size, header, payload, time.monotonic()))
+        self.pending_bytes += size
+
+    def depth(self, player_id):
+        return self.depths.get(player_id, 0)
+
+    def set_weight(self, player_id, weight):
+        """weight > 1 = ได้ส่งมากกว่าผู้เล่นคนอื่นต่อรอบ (เช่น 2 = สองเท่า)"""
+        if weight == 1:
+            self.weights.pop(player_id, None)
+        else:
+            self.weights[player_id] = weight
+
+    def forget(self, player_id):
+        self.weights.pop(player_id, None)
+
+    def take(self, batch_bytes=FAIR_BATCH_BYTES):
+        """
+        เลือก Frame รวมราว batch_bytes (อย่างน้อย 1 Frame ถ้ามี) ตามลำดับ DRR
+        คืนค่า (buffers, bytes, เวลาเข้าคิวของ Frame ที่เก่าที่สุดในชุด หรือ None ถ้าคิวว่าง)
+        """
+        buffers = []
+        append = buffers.append
+        taken = 0
+        oldest = None
+        active, queues, depths, deficits = self.active, self.queues, self.depths, self.deficits
+        while active and taken < batch_bytes:
+            player_id = active[0]
+            queue = queues[player_id]
+            queued_at = queue[0][3] # Frame แรกของแต่ละคิวคือ Frame ที่เก่าที่สุดของผู้เล่นคนนั้น
+            if oldest is None or queued_at < oldest:
+                oldest = queued_at
+            started = taken
+            if len(active) == 1:
+                # ไม่มีใครรอ: ส่งได้เต็ม batch โดยไม่ต้องใช้เครดิต
+                while queue and taken < batch_bytes:
+                    size, header, payload, _ = queue.popleft()
+                    taken += size
+                    append(header)
+                    if payload:
+                        append(payload)
+                deficit = 0
+                exhausted = False
+                self.turn = None
+            else:
+                if self.turn != player_id:
+                    self.turn = player_id
+                    weights = self.weights
+                    deficits[player_id] += self.quantum * weights.get(player_id, 1) if weights else self.quantum
+                deficit = deficits[player_id]
+                exhausted = False
+                while queue and taken < batch_bytes:
+                    size, header, payload, _ = queue[0]
+                    if size > deficit:
+                        exhausted = True
+                        break
+                    queue.popleft()
+                    deficit -= size
+                    taken += size
+                    append(header)
+                    if payload:
+                        append(payload)
+            depths[player_id] -= taken - started
+            if not queue:
+                # หมดคิว: เครดิตที่เหลือไม่ถูกเก็บไว้ (ผู้เล่นที่เงียบไปไม่ได้สะสมสิทธิ์ส่งทีหลัง)
+                del queues[player_id], depths[player_id], deficits[player_id]
+                active.popleft()
+                self.turn = None
+            elif exhausted:
+                deficits[player_id] = deficit
+                active.rotate(-1)
+                self.turn = None
+            else:
+                deficits[player_id] = deficit # เต็ม batch กลางรอบ: ครั้งหน้าเริ่มที่ผู้เล่นคนเดิมต่อ
+        self.pending_bytes -= taken
+        return buffers, taken, oldest
+
+
+class TunnelWriter:
+    """
+    ตัวเขียน Frame ลงอุโมงค์ที่ทุก Thread ใช้ร่วมกัน
+    - Frame จากหลาย Thread เข้าคิวเดียวกัน จึงไม่มีทางซ้อนกันบนสาย
+    - header กับ payload ถูกส่งเป็นคนละ buffer ด้วย sendmsg (ไม่ต้องต่อ bytes)
+    - Frame ที่พร้อมในเวลาเดียวกันถูกรวมเป็น syscall เดียว
+      ตั้ง flush_window_us > 0 เพื่อรอรวม Frame เล็กๆ เพิ่มก่อนส่ง (แลกกับ latency)
+    - [ใหม่] คิวแยกตามผู้เล่น (FairQueue) ส่งทีละ batch ตามลำดับ DRR: ผู้เล่นที่ส่งก้อนใหญ่ไม่ถ่วง Frame เล็กของคนอื่น
+      และผู้ส่งที่มีข้อมูลค้างเกิน player_max_bytes จะรอเฉพาะตัวเอง
+    """
+    def __init__(self, sock, flush_window_us=0, max_pending_bytes=WRITER_MAX_PENDING_BYTES, quantum=FAIR_QUANTUM,
+                 batch_bytes=FAIR_BATCH_BYTES, player_max_bytes=FAIR_PLAYER_MAX_BYTES):
+        self.sock = sock
+        self.flush_window = flush_window_us / 1_000_000
+        self.max_pending_bytes = max_pending_bytes
+        self.batch_bytes = batch_bytes
+        self.player_max_bytes = player_max_bytes
+        self.queue = FairQueue(quantum)
+        self.raw = [] # bytes ดิบที่ต้องออกก่อน Frame ใดๆ (คำตอบ Control)
+        self.pending_bytes = 0 # raw + ทุกคิวของ FairQueue
+        self.frames_written = 0 # ตัวนับสะสม (นับตอนเข้าคิวภายใต้ cond เดียวกัน จึงไม่ต้องมี lock เพิ่ม)
+        self.bytes_written = 0
+        self.flush_delays = Histogram(RELAY_DELAY_BUCKETS) # เวลาที่ Frame เก่าสุดของแต่ละ batch รอตั้งแต่เข้าคิวจนส่งเสร็จ (เขียนโดย writer thread เท่านั้น)
+        self.closed = False
+        self.cond = threading.Condition()
+        try:
+            # การรวม Frame ทำเองที่นี่แล้ว จึงปิด Nagle เพื่อไม่ให้ kernel หน่วงซ้ำ
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        limit_unsent(sock, batch_bytes)
+        self.writer_thread = threading.Thread(target=self._run, daemon=True)
+        self.writer_thread.start()
+
+    def send_frame(self, player_id, data=b'', flags=0, wait=True, lock_timing=None):
+        """
+        ใส่ Frame เข้าคิวส่ง (data ว่าง = สัญญาณผู้เล่นหลุด) flags คือ flag การบีบอัดจาก FrameCompressor
+        จะ block เฉพาะตอนที่คิวรวมเกิน max_pending_bytes หรือคิวของผู้เล่นคนนี้เกิน player_max_bytes
+        (wait=False = ใส่คิวทันทีโดยไม่รอ ให้ผู้เรียกเช็ค has_room เองก่อน) raise BrokenPipeError ถ้าอุโมงค์ถูกปิดแล้ว
+        [ใหม่] lock_timing: Histogram (เช่น StageTiming ของ p2p_profile) ที่รับเวลารอ lock รวมกับเวลารอคิวว่าง (วินาที)
+        """
+        header = FRAME_HEADER.pack(player_id, len(data) | flags)
+        if lock_timing is not None:
+            waited = time.perf_counter()
+        with self.cond:
+            while wait and not self.closed and (self.pending_bytes >= self.max_pending_bytes or
+                                                self.queue.depth(player_id) >= self.player_max_bytes):
+                self.cond.wait()
+            if lock_timing is not None:
+                lock_timing.observe(time.perf_counter() - waited)
+            if self.closed:
+                raise BrokenPipeError("Tunnel writer is closed.")
+            self.queue.put(player_id, header, data)
+            self.pending_bytes += HEADER_SIZE + len(data)
+            self.frames_written += 1
+            self.bytes_written += HEADER_SIZE + len(data)
+            self.cond.notify_all()
+
+    def has_room(self, player_id):
+        """[ใหม่] send_frame ของผู้เล่นคนนี้จะไม่ต้องรอหรือไม่ (ใช้ตัดสินใจทิ้ง datagram ก่อนบีบอัด)"""
+        with self.cond:
+            return (self.pending_bytes < self.max_pending_bytes and
+                    self.queue.depth(player_id) < self.player_max_bytes)
+
+    def set_weight(self, player_id, weight):
+        """[ใหม่] ส่วนแบ่งต่อรอบ DRR ของผู้เล่นคนนี้ (ดู FairQueue.set_weight)"""
+        with self.cond:
+            self.queue.set_weight(player_id, weight)
+
+    def forget(self, player_id):
+        with self.cond:
+            self.queue.forget(player_id)
+
+    def queue_depths(self):
+        """[ใหม่] bytes ที่ค้างในคิวของผู้เล่นแต่ละคน {player_id: bytes} (เฉพาะคนที่มีค้าง)"""
+        with self.cond:
+            return dict(self.queue.depths)
+
+    def send_bytes(self, data):
+        """ใส่ bytes ดิบ (ไม่ใช่ Frame) เข้าคิว เช่นคำตอบ Control ที่ต้องถึงอีกฝั่งก่อน Frame แรก"""
+        with self.cond:
+            if self.closed:
+                raise BrokenPipeError("Tunnel writer is closed.")
+            self.raw.append(data)
+            self.pending_bytes += len(data)
+            self.cond.notify_all()
+
+    def close(self):
+        """หยุด writer (Frame ที่ยังค้างในคิวจะถูกทิ้ง) ไม่ได้ปิด socket"""
+        with self.cond:
+            self.closed = True
+            self.queue = FairQueue(self.queue.quantum)
+            self.raw = []
+            self.pending_bytes = 0
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending_bytes and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            if self.flush_window:
+                time.sleep(self.flush_window)
+            with self.cond:
+                buffers, self.raw = self.raw, []
+                raw_bytes = sum(len(data) for data in buffers)
+                frames, size, queued_since = self.queue.take(self.batch_bytes)
+                buffers += frames
+                self.pending_bytes -= raw_bytes + size
+                self.cond.notify_all()
+            try:
+                self._send_buffers(buffers)
+            except OSError:
+                self.close()
+                return
+            if queued_since is not None:
+                self.flush_delays.observe(time.monotonic() - queued_since)
+
+    def _send_buffers(self, buffers):
+        sendmsg = getattr(self.sock, 'sendmsg', None)
+        if sendmsg is None:
+            # Windows ไม่มี sendmsg: รวมเป็นก้อนเดียวแล้ว sendall (ยังคงเป็น syscall เดียวต่อรอบ)
+            self.sock.sendall(b''.join(buffers))
+            return
+        index = 0
+        while index < len(buffers):
+            sent = sendmsg(buffers[index:index + _IOV_MAX])
+            # ข้าม buffer ที่ส่งครบแล้ว และตัดส่วนที่ส่งไปแล้วของ buffer ที่ส่งไม่ครบ
+            while sent:
+                size = len(buffers[index])
+                if sent >= size:
+                    sent -= size
+                    index += 1
+                else:
+                    buffers[index] = memoryview(buffers[index])[sent:]
+                    sent = 0
+
+
+
+def send_buffers_nowait(sock, buffers):
+    """
+    [ใหม่] ส่ง buffers บน socket แบบ non-blocking เท่าที่ kernel รับได้ (sendmsg ทีละหลาย buffer เหมือน TunnelWriter)
+    คืนค่า (list ของส่วนที่ยังไม่ได้ส่ง, จำนวน byte ที่ส่งไป) ส่วนที่เหลือให้ส่งต่อเมื่อ socket พร้อมเขียนอีกครั้ง
+    """
+    sendmsg = getattr(sock, 'sendmsg', None)
+    index = 0
+    total = 0
+    try:
+        while index < len(buffers):
+            if sendmsg is None:
+                # Windows ไม่มี sendmsg: รวมส่วนที่เหลือเป็นก้อนเดียว
+                buffers, index = [b''.join(buffers[index:])], 0
+                sent = sock.send(buffers[0])
+            else:
+                sent = sendmsg(buffers[index:index + _IOV_MAX])
+            total += sent
+            while sent:
+                size = len(buffers[index])
+                if sent >= size:
+                    sent -= size
+                    index += 1
+                else:
+                    buffers[index] = memoryview(buffers[index])[sent:]
+                    sent = 0
+    except BlockingIOError:
+        pass
+    return buffers[index:], total
+
+class CompressionStats:
+    """ตัวนับของการบีบอัดฝั่งส่ง แต่ละผู้เล่นมีชุดของตัวเอง (แก้โดย Thread ของผู้เล่นคนนั้นเท่านั้น จึงไม่ต้องมี lock)"""
+    __slots__ = ('raw_bytes', 'wire_bytes', 'frames_compressed', 'frames_raw', 'frames_incompressible', 'cpu_seconds')
+
+    def __init__(self):
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.frames_compressed = 0
+        self.frames_raw = 0
+        self.frames_incompressible = 0
+        self.cpu_seconds = 0.0
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+class _CompressStream:
+    __slots__ = ('compressor', 'backoff', 'skip', 'stats')
+
+    def __init__(self):
+        self.compressor = None # สร้างเมื่อมี Frame ใหญ่พอจะบีบครั้งแรก
+        self.backoff = 0 # จำนวน Frame ที่จะพักครั้งถัดไปถ้ายังบีบไม่ลง
+        self.skip = 0 # จำนวน Frame ที่เหลือในช่วงพักการบีบ
+        self.stats = CompressionStats()
+
+
+class FrameCompressor:
+    """
+    บีบอัด payload ฝั่งส่งด้วย zlib โดยมี stream แยกต่อผู้เล่น (ข้อมูลของผู้เล่นคนเดียวกันมักคล้ายกัน)
+    - Frame เล็กกว่า min_size: ส่งดิบ ไม่แตะ stream
+    - บีบแล้วไม่เล็กลง: ส่งดิบพร้อม STREAM_RESET_FLAG, ทิ้ง stream และพักการบีบผู้เล่นคนนั้นเป็นจำนวน Frame ที่เพิ่มขึ้นเรื่อยๆ
+    compress() ของผู้เล่นคนหนึ่งต้องถูกเรียกจาก Thread เดียวกันเสมอ (Thread ที่อ่านข้อมูลของผู้เล่นคนนั้น)
+    """
+    def __init__(self, level=COMPRESS_LEVEL, min_size=COMPRESS_MIN_SIZE):
+        self.level = level
+        self.min_size = min_size
+        self.streams = {}
+        self.retired = CompressionStats() # ผลรวมของผู้เล่นที่หลุดไปแล้ว
+        self.lock = threading.Lock() # ใช้เฉพาะตอน forget/stats
+
+    def compress(self, player_id, data):
+        """คืนค่า (payload, flags) สำหรับส่งด้วย TunnelWriter.send_frame"""
+        stream = self.streams.get(player_id)
+        if stream is None:
+            stream = self.streams[player_id] = _CompressStream()
+        stats = stream.stats
+        size = len(data)
+        stats.raw_bytes += size
+        if size < self.min_size or stream.skip:
+            if stream.skip:
+                stream.skip -= 1
+            stats.frames_raw += 1
+            stats.wire_bytes += size
+            return data, 0
+
+        started = time.thread_time()
+        flags = COMPRESSED_FLAG
+        if stream.compressor is None:
+            stream.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -COMPRESS_WBITS, COMPRESS_MEM_LEVEL)
+            flags |= STREAM_RESET_FLAG
+        out = stream.compressor.compress(data) + stream.compressor.flush(zlib.Z_SYNC_FLUSH)
+        stats.cpu_seconds += time.thread_time() - started
+        out = out[:-len(_SYNC_TAIL)]
+        if len(out) >= size:
+            # บีบไม่ลง: ฝั่งรับไม่เคยเห็นข้อมูลนี้ใน stream จึงต้องเริ่ม stream ใหม่ทั้งสองฝั่ง
+            stream.compressor = None
+            stream.backoff = min(max(stream.backoff * 2, 1), COMPRESS_MAX_BACKOFF)
+            stream.skip = stream.backoff
+            stats.frames_incompressible += 1
+            stats.wire_bytes += size
+            return data, STREAM_RESET_FLAG
+        stream.backoff = 0
+        stats.frames_compressed += 1
+        stats.wire_bytes += len(out)
+        return out, flags
+
+    def forget(self, player_id):
+        """ทิ้ง stream ของผู้เล่น (หลุด หรือถูกย้ายไปเส้นอื่นที่ฝั่งรับไม่มี stream เดิม)"""
+        stream = self.streams.pop(player_id, None)
+        if stream is not None:
+            with self.lock:
+                self.retired.add(stream.stats)
+
+    def stats(self):
+        """ผลรวมตัวนับของทุกผู้เล่น (ค่าประมาณ ณ ขณะนั้น)"""
+        total = CompressionStats()
+        with self.lock:
+            total.add(self.retired)
+        for stream in list(self.streams.values()):
+            total.add(stream.stats)
+        return total
+
+
+class FrameDecompressor:
+    """คลาย payload ฝั่งรับ มี stream ต่อผู้เล่นคู่กับ FrameCompressor ของอีกฝั่ง (ใช้จาก Thread อ่านของเส้นนั้นเท่านั้น)"""
+    def __init__(self):
+        self.streams = {}
+        self.cpu_seconds = 0.0
+        self.wire_bytes = 0
+        self.raw_bytes = 0
+
+    def decompress(self, player_id, payload, flags):
+        """คืนค่าข้อมูลดิบ raise ValueError ถ้าข้อมูลเสียหรือคลายออกมาใหญ่เกิน DECOMPRESS_MAX_FRAME"""
+        if flags & STREAM_RESET_FLAG:
+            self.streams.pop(player_id, None)
+        if not flags & COMPRESSED_FLAG:
+            return payload
+        started = time.thread_time()
+        stream = self.streams.get(player_id)
+        if stream is None:
+            stream = self.streams[player_id] = zlib.decompressobj(-COMPRESS_WBITS)
+        try:
+            data = stream.decompress(bytes(payload) + _SYNC_TAIL, DECOMPRESS_MAX_FRAME)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed frame for player {player_id}: {e}")
+        if stream.unconsumed_tail:
+            raise ValueError(f"Compressed frame for player {player_id} expands beyond {DECOMPRESS_MAX_FRAME} bytes.")
+        self.cpu_seconds += time.thread_time() - started
+        self.wire_bytes += len(payload)
+        self.raw_bytes += len(data)
+        return data
+
+    def forget(self, player_id):
+        self.streams.pop(player_id, None)
+
+
+def format_compression_stats(sent, received=None):
+    """สรุปอัตราส่วนและเวลา CPU ของการบีบอัดเป็นข้อความ 1 บรรทัด (sent = CompressionStats, received = FrameDecompressor)"""
+    ratio = sent.wire_bytes / sent.raw_bytes if sent.raw_bytes else 1.0
+    line = (f"sent {sent.raw_bytes}B -> {sent.wire_bytes}B (ratio {ratio:.2f}, "
+            f"compressed={sent.frames_compressed} raw={sent.frames_raw} incompressible={sent.frames_incompressible}, "
+            f"cpu {sent.cpu_seconds * 1000:.1f}ms)")
+    if received is not None and received.wire_bytes:
+        line += (f"; received {received.wire_bytes}B -> {received.raw_bytes}B "
+                 f"(cpu {received.cpu_seconds * 1000:.1f}ms)")
+    return line
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """
+    [ใหม่] เปิด TCP keepalive ให้ kernel ตัดการเชื่อมต่อที่อีกฝั่งหายไปเฉยๆ (NAT หมดเวลา, เครื่องหลับ) เอง (idle=0 = ไม่เปิด)
+    TCP_USER_TIMEOUT (Linux) ตั้งเท่ากันเพื่อให้ข้อมูลที่ส่งค้างโดยไม่มี ACK ถูกตัดในเวลาเดียวกัน
+    ตัวเลือกที่ OS ไม่มีจะถูกข้าม
+    """
+    if not idle:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count),
+                            ('TCP_USER_TIMEOUT', (idle + interval * count) * 1000)):
+            option = getattr(socket, name, None)
+            if option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError:
+        pass # socket ปิดไปแล้ว
+
+
+class ReadSizer:
+    """
+    [ใหม่] ขนาด recv ของการเชื่อมต่อ 1 เส้นที่ปรับตามการใช้งาน (อ่าน 1 ครั้ง = 1 Frame = 1 รอบของ loop)
+    - อ่านได้เต็มขนาด: ยังมีข้อมูลรออยู่ใน kernel (โอนก้อนใหญ่) ขยายเท่าตัวจนถึง maximum ได้ Frame น้อยลงต่อ byte
+    - อ่านได้ไม่ถึง 1/4: การเชื่อมต่อว่างลงหรือส่งทีละนิด (game state) ลดครึ่งหนึ่งจนถึง minimum
+      recv ไม่ต้องจอง bytes ก้อนใหญ่แล้วหดทิ้งทุกครั้ง และ Frame เล็กไม่ต้องรอหลังก้อนใหญ่ในคิวของเส้น
+    ใช้ได้จาก Thread เดียว (เจ้าของการเชื่อมต่อ)
+    """
+    __slots__ = ('size', 'minimum', 'maximum')
+
+    def __init__(self, minimum=READ_SIZE_MIN, maximum=READ_SIZE_MAX):
+        self.minimum = min(minimum, maximum) # maximum ที่เล็กกว่า minimum = อ่านขนาดคงที่เท่า maximum
+        self.maximum = maximum
+        self.size = self.minimum
+
+    def update(self, received):
+        """บอกจำนวน byte ที่ recv ครั้งล่าสุดได้ แล้วเลือกขนาดของครั้งถัดไป (self.size)"""
+        size = self.size
+        if received >= size:
+            if size < self.maximum:
+                self.size = min(size * 2, self.maximum)
+        elif received * 4 <= size and size > self.minimum:
+            self.size = max(size // 2, self.minimum)
+
+
+def set_socket_buffers(sock, sizes):
+    """
+    [ใหม่] ตั้ง SO_SNDBUF/SO_RCVBUF จาก sizes = (sndbuf, rcvbuf) (None หรือ 0 = ปล่อยให้ kernel ปรับเอง)
+    ค่าที่ตั้งเองจะปิด autotuning ของ Linux สำหรับบัฟเฟอร์นั้น และ kernel จะคูณสองให้เป็นค่าจริง (เพดาน net.core.*mem_max)
+    """
+    if not sizes:
+        return
+    for option, size in zip((socket.SO_SNDBUF, socket.SO_RCVBUF), sizes):
+        if size:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, size)
+            except OSError:
+                pass # socket ปิดไปแล้ว
+
+
+def parse_socket_buffers(items, roles=SOCKET_BUFFER_ROLES):
+    """
+    [ใหม่] แปลงตัวเลือก "<role>_sndbuf=BYTES" / "<role>_rcvbuf=BYTES" เป็น {role: (sndbuf, rcvbuf)}
+    role ต้องอยู่ใน roles raise ValueError ถ้าชื่อหรือค่าไม่ถูกต้อง
+    """
+    buffers = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        role, _, kind = name.strip().rpartition('_')
+        if role not in roles or kind not in ('sndbuf', 'rcvbuf'):
+            raise ValueError(f"unknown socket buffer {name!r} (expected <{'|'.join(roles)}>_sndbuf or _rcvbuf)")
+        size = int(value)
+        if size < 0:
+            raise ValueError(f"{name} must not be negative")
+        sndbuf, rcvbuf = buffers.get(role, (0, 0))
+        buffers[role] = (size, rcvbuf) if kind == 'sndbuf' else (sndbuf, size)
+    return buffers
+
+
+def parse_fair_weights(items):
+    """
+    [ใหม่] แปลงตัวเลือก "SERVICE=WEIGHT" เป็น {service: weight} สำหรับ FairQueue.set_weight ของผู้เล่นแต่ละ service
+    raise ValueError ถ้าลำดับ service หรือ weight ไม่ถูกต้อง
+    """
+    weights = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        try:
+            service, weight = int(name), float(value)
+        except ValueError:
+            raise ValueError(f"expected SERVICE=WEIGHT, got {item!r}") from None
+        if not 0 <= service < MAX_SERVICES:
+            raise ValueError(f"service {service} is out of range (0-{MAX_SERVICES - 1})")
+        if weight <= 0:
+            raise ValueError(f"weight of service {service} must be positive")
+        weights[service] = weight
+    return weights
+
+
+def limit_unsent(sock, lowat=FAIR_BATCH_BYTES):
+    """
+    [ใหม่] ให้ kernel รับข้อมูลที่ยังไม่ได้ส่งออกไปบนสายไว้ใน socket ไม่เกินราว lowat (TCP_NOTSENT_LOWAT, Linux/macOS)
+    ส่วนที่เกินจึงรออยู่ใน FairQueue ที่จัดลำดับได้ แทนที่จะต่อคิวแบบ FIFO ในบัฟเฟอร์ส่งของ kernel หลายวินาที
+    """
+    option = getattr(socket, 'TCP_NOTSENT_LOWAT', None)
+    if option is None or not lowat:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, lowat)
+    except OSError:
+        pass
+
+
+# SO_MAX_PACING_RATE (Linux) ไม่มีใน module socket ของ Python
+_SO_MAX_PACING_RATE = getattr(socket, 'SO_MAX_PACING_RATE', 47 if sys.platform.startswith('linux') else None)
+_PACING_UNLIMITED = 0xFFFFFFFF
+
+
+def set_pacing_rate(sock, rate):
+    """
+    [ใหม่] ให้ kernel ปล่อยข้อมูลของ socket นี้ไม่เกิน rate bytes/วินาที (SO_MAX_PACING_RATE, Linux) rate=0 = ไม่จำกัด
+    ข้อมูลที่เกินจะค้างในบัฟเฟอร์ส่ง แล้วบัฟเฟอร์ของผู้เล่นใน relay ก็เต็มตามปกติ คืนค่า False ถ้า OS ไม่รองรับ
+    """
+    if _SO_MAX_PACING_RATE is None:
+        return False
+    try:
+        value = min(rate, _PACING_UNLIMITED - 1) if rate else _PACING_UNLIMITED
+        sock.setsockopt(socket.SOL_SOCKET, _SO_MAX_PACING_RATE, struct.pack('I', value))
+    except OSError:
+        return False
+    return True
+
+
+_SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if SPLICE_SUPPORTED else 0
+
+
+class SplicePump:
+    """
+    [ใหม่] ย้าย byte stream ทิศทางเดียวจาก socket src ไป dst ผ่าน pipe ใน kernel ด้วย os.splice (ข้อมูลไม่ผ่าน Python เลย)
+    - socket แบบ blocking: pump() รอเองจนย้ายได้ (ใช้กับ Thread ละทิศทาง)
+    - socket แบบ non-blocking: pump() ย้ายเท่าที่ทำได้ทันที แล้วผู้เรียกรอ src อ่านได้ (wants_read) หรือ dst เขียนได้
+      (wants_write) ก่อนเรียกอีกครั้ง ใช้ได้ทั้งกับ selectors และ add_reader/add_writer ของ asyncio
+    prefix คือข้อมูลที่ถูกอ่านเข้า user space ไปก่อนแล้ว (เช่นบัฟเฟอร์ของ StreamReader) ซึ่งต้องออกไปก่อน
+    เมื่อ src ปิดฝั่งส่งและข้อมูลใน pipe ออกหมดแล้ว done จะเป็น True (ผู้เรียก shutdown(SHUT_WR) ฝั่ง dst เอง)
+    """
+    __slots__ = ('src', 'dst', 'pipe_r', 'pipe_w', 'prefix', 'pending', 'eof', 'done', 'bytes', 'chunks')
+
+    def __init__(self, src, dst, prefix=b''):
+        self.src = src.fileno()
+        self.dst = dst.fileno()
+        self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_BYTES)
+            except OSError:
+                pass # เกิน /proc/sys/fs/pipe-max-size: ใช้ขนาดเดิม
+        self.prefix = bytes(prefix)
+        self.pending = 0 # bytes ที่อยู่ใน pipe รอออกไปที่ dst
+        self.eof = False
+        self.done = False
+        self.bytes = 0 # ตัวนับของผู้เรียก (อ่านจาก Thread อื่นได้)
+        self.chunks = 0
+
+    @property
+    def wants_read(self):
+        return not (self.prefix or self.pending or self.eof)
+
+    @property
+    def wants_write(self):
+        return bool(self.prefix or self.pending)
+
+    def pump(self, limit=1):
+        """
+        ย้ายข้อมูลจนกว่าจะต้องรอ, src ปิด หรือย้ายได้ครบ limit bytes (ทีละก้อนเท่าที่ pipe รับได้)
+        คืนค่าจำนวน byte ที่อ่านจาก src ในครั้งนี้ raise OSError ถ้า socket ฝั่งใดฝั่งหนึ่งเสีย
+        """
+        moved = 0
+        while True:
+            if self.prefix:
+                try:
+                    sent = os.write(self.dst, self.prefix)
+                except BlockingIOError:
+                    return moved
+                self.prefix = self.prefix[sent:]
+                continue
+            if self.pending:
+                try:
+                    self.pending -= os.splice(self.pipe_r, self.dst, self.pending, flags=_SPLICE_FLAGS)
+                except BlockingIOError:
+                    return moved
+                continue
+            if self.eof:
+                self.done = True
+                return moved
+            if moved >= limit:
+                return moved
+            try:
+                count = os.splice(self.src, self.pipe_w, SPLICE_PIPE_BYTES, flags=_SPLICE_FLAGS)
+            except BlockingIOError:
+                return moved
+            if not count:
+                self.eof = True
+                continue
+            self.pending = count
+            self.bytes += count
+            self.chunks += 1
+            moved += count
+
+    def close(self):
+        """ปิด pipe (socket ทั้งสองฝั่งเป็นของผู้เรียก)"""
+        if self.pipe_r is not None:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+            self.pipe_r = self.pipe_w = None
+
+
+def service_of(player_id):
+    """[ใหม่] ลำดับของ Local Service (ตาม ports= ของคำตอบ PORT) ที่ผู้เล่นคนนี้เข้ามา"""
+    return player_id >> SERVICE_SHIFT
+
+
+def service_player_id(service, number):
+    """[ใหม่] player_id ของผู้เล่นลำดับ number (เริ่มที่ 1) ของอุโมงค์ที่เข้ามาทาง service (วนกลับเมื่อเกิน PLAYER_ID_MASK)"""
+    return (service << SERVICE_SHIFT) | ((number - 1) % PLAYER_ID_MASK + 1)
+
+
+class ControlError(Exception):
+    """Server ตอบ ERROR กลับมา หรือคำตอบอ่านไม่ออก"""
+
+
+def format_control_line(word, **fields):
+    """สร้างบรรทัดของ Control Protocol เช่น format_control_line('OK', port=9001) -> b'OK port=9001\\n'"""
+    parts = [word] + [f"{key}={value}" for key, value in fields.items() if value is not None]
+    return (" ".join(parts) + "\n").encode()
+
+
+def parse_control_line(line):
+    """แยกบรรทัดเป็น (word, {key: value}) ค่าทุกตัวเป็น str"""
+    word, *pairs = line.split()
+    fields = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        fields[key] = value
+    return word, fields
+
+
+def recv_line(sock, limit=CONTROL_LINE_LIMIT):
+    """
+    อ่าน 1 บรรทัดจาก socket โดยอ่านทีละ byte เพื่อไม่ให้กินข้อมูลที่ตามหลังบรรทัดมา
+    คืนค่า None ถ้าอีกฝั่งปิดก่อนจบบรรทัด, raise ValueError ถ้ายาวเกิน limit
+    """
+    line = bytearray()
+    while len(line) < limit:
+        char = sock.recv(1)
+        if not char:
+            return None
+        if char == b'\n':
+            return line.decode('ascii', 'replace').strip()
+        line += char
+    raise ValueError("Control line too long.")
+
+
+def control_request(server_addr, command, timeout=10, **fields):
+    """
+    ส่งคำสั่ง 1 บรรทัดไปยัง Control Port แล้วคืนค่า fields ของคำตอบ OK เป็น dict
+    Server รุ่นเก่าที่ตอบเป็นเลข Port เปล่าๆ จะถูกแปลงเป็น {'port': '<เลข>'}
+    """
+    with socket.create_connection(server_addr, timeout=timeout) as sock:
+        sock.sendall(format_control_line(command, **fields))
+        # อ่านจนเจอ '\n' หรือจนกว่า Server จะปิด (Server รุ่นเก่าตอบโดยไม่มี '\n')
+        response = b''
+        while not response.endswith(b'\n') and len(response) < CONTROL_LINE_LIMIT:
+            chunk = sock.recv(CONTROL_LINE_LIMIT)
+            if not chunk:
+                break
+            response += chunk
+    response = response.decode('ascii', 'replace').strip()
+    if response.isdigit():
+        return {'port': response}
+    if not response:
+        raise ControlError("Server closed the control connection without a reply.")
+    if response.startswith("ERROR"):
+        raise ControlError(response)
+    word, reply = parse_control_line(response)
+    if word != 'OK':
+        raise ControlError(f"Unexpected reply: {response}")
+    return reply
+
+
+def resume_tunnel(server_addr, secret, timeout=10):
+    """
+    ขอต่ออุโมงค์เดิมกลับมาด้วย secret ที่ได้จากคำสั่ง PORT/TUNNEL
+    คืนค่า (socket, fields) โดย socket นี้คืออุโมงค์ของ Host พร้อมใช้งานทันที
+    raise ControlError ถ้า Server ไม่รู้จัก secret แล้ว (เลยช่วง grace) หรือ OSError ถ้าต่อ Server ไม่ได้
+    """
+    return _attach_host_connection(server_addr, 'RESUME', secret, timeout)
+
+
+def add_tunnel_stripe(server_addr, secret, timeout=10):
+    """เปิดการเชื่อมต่อเสริม (stripe) ของอุโมงค์ คืนค่าและ raise เหมือน resume_tunnel"""
+    return _attach_host_connection(server_addr, 'STRIPE', secret, timeout)
+
+
+def _attach_host_connection(server_addr, command, secret, timeout, **fields):
+    sock = socket.create_connection(server_addr, timeout=timeout)
+    try:
+        sock.sendall(format_control_line(command, secret=secret, **fields))
+        # ต้องอ่านทีละ byte: Frame จากผู้เล่นที่รออยู่อาจตามหลังบรรทัดคำตอบมาทันที
+        response = recv_line(sock)
+    except ValueError as e:
+        sock.close()
+        raise ControlError(str(e))
+    except OSError:
+        sock.close()
+        raise
+    if not response or not response.startswith('OK'):
+        sock.close()
+        raise ControlError(response or "Server closed the control connection without a reply.")
+    sock.settimeout(None)
+    return sock, parse_control_line(response)[1]
+
+
+class LocalConnectionPool:
+    """
+    socket ที่ connect ไปยัง Local Service ไว้ล่วงหน้า size อัน ผู้เล่นใหม่จึงได้การเชื่อมต่อทันทีแม้จะเข้ามาพร้อมกันหลายคน
+    มี Thread เติม pool เพียง Thread เดียว socket ที่รอนานเกิน max_idle หรือถูก Local Service ปิดไปแล้วจะไม่ถูกแจกออกไป
+    ใช้ได้กับ Local Service ที่ยอมให้เปิดการเชื่อมต่อค้างไว้ก่อนเท่านั้น (บาง Service ตัด idle connection เร็วมาก)
+    """
+    def __init__(self, addr, size, max_idle=LOCAL_POOL_MAX_IDLE):
+        self.addr = addr
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = deque() # (socket, เวลาที่ connect เสร็จ) เก่าสุดอยู่ซ้าย
+        self.hits = 0 # จำนวนผู้เล่นที่ได้ socket จาก pool
+        self.misses = 0 # จำนวนผู้เล่นที่ต้อง connect เอง (pool ว่าง)
+        self.closed = False
+        self.cond = threading.Condition()
+        threading.Thread(target=self._refill, daemon=True).start()
+
+    def take(self):
+        """คืน socket ที่พร้อมใช้ หรือ None ถ้า pool ว่าง (ไม่ block) ผู้เรียกต้อง connect เอง"""
+        with self.cond:
+            while self.idle:
+                sock, connected_at = self.idle.pop() # ใหม่สุดก่อน: มีโอกาสถูก Local Service ตัดน้อยที่สุด
+                if time.monotonic() - connected_at <= self.max_idle and _socket_is_open(sock):
+                    self.hits += 1
+                    self.cond.notify()
+                    return sock
+                sock.close()
+            self.misses += 1
+            self.cond.notify()
+        return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+            self.cond.notify()
+        for sock, _ in idle:
+            sock.close()
+
+    def _refill(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.idle) >= self.size:
+                    # ตื่นมาดู socket ที่เก่าเกินเป็นระยะด้วย แม้จะไม่มีใครมาขอ
+                    self.cond.wait(self.max_idle)
+                    self._expire(time.monotonic())
+                if self.closed:
+                    return
+            try:
+                sock = socket.create_connection(self.addr, timeout=LOCAL_CONNECT_TIMEOUT)
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(LOCAL_POOL_RETRY_SECONDS)
+                continue
+            with self.cond:
+                if self.closed:
+                    sock.close()
+                    return
+                self.idle.append((sock, time.monotonic()))
+
+    def _expire(self, now):
+        while self.idle and now - self.idle[0][1] > self.max_idle:
+            self.idle.popleft()[0].close()
+
+
+def _socket_is_open(sock):
+    """ดูว่าอีกฝั่งยังไม่ได้ปิด socket ที่ค้างไว้ (ข้อมูลที่ Service ส่งมาก่อนยังอยู่ครบ เพราะใช้ MSG_PEEK)"""
+    sock.setblocking(False)
+    try:
+        return bool(sock.recv(1, socket.MSG_PEEK))
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.setblocking(True)
@@ -1,9 +1,32 @@
 # server.py
+import os
+import sys
 import socket
 import threading
 import struct
 import time
+import signal
+import select
+import selectors
 import itertools
+import asyncio
+import argparse
+import collections
+import secrets
+import math
+import atexit
+import errno
+import subprocess
+
+from p2p_tunnel import (FrameDecoder, TunnelWriter, FairQueue, FrameCompressor, FrameDecompressor, FRAME_HEADER, LENGTH_MASK,
+                        CONTROL_LINE_LIMIT, UDP_MAX_DATAGRAM, WRITER_MAX_PENDING_BYTES,
+                        HEARTBEAT_PLAYER_ID, HEARTBEAT_PING, HEARTBEAT_PONG, DIRECT_OPEN, SPLICE_SUPPORTED, SplicePump,
+                        format_compression_stats, format_control_line, parse_control_line, recv_line, limit_unsent,
+                        set_keepalive, set_pacing_rate, ReadSizer, READ_SIZE_MIN, READ_SIZE_MAX, set_socket_buffers,
+                        parse_socket_buffers, parse_fair_weights, service_player_id, service_of, MAX_SERVICES)
+from p2p_metrics import DirectionMetrics, MetricsWriter, start_metrics_server
+from p2p_capture import FrameCapture, CAPTURE_TO_HOST, CAPTURE_TO_PEER
+from p2p_profile import Profiler
 
 # --- การตั้งค่า ---
 SERVER_HOST = '0.0.0.0'
@@ -11,178 +34,1593 @@ SERVER_CONTROL_PORT = 9000 # Port สำหรับ Client มาขอ Public
 PORT_POOL_START = 9001
 PORT_POOL_END = 9100
 HEALTH_CHECK_INTERVAL = 60 # วินาที: ความถี่ในการตรวจสอบ Port ที่ค้าง
+PEER_QUEUE_MAX_BYTES = 1024 * 1024 # [ใหม่] ขนาดบัฟเฟอร์ขาออกสูงสุดของผู้เล่นแต่ละคน
+PEER_OVERFLOW_POLICY = 'drop' # [ใหม่] เมื่อบัฟเฟอร์ผู้เล่นเต็ม: 'drop' = ตัดผู้เล่นคนนั้น, 'pause' = หยุดอ่านจาก Host ชั่วคราว
+TUNNEL_FLUSH_WINDOW_US = 0 # [ใหม่] ไมโครวินาทีที่ TunnelWriter รอรวม Frame เล็กๆ ก่อนส่งไปยัง Host (0 = ส่งทันที)
+FAIR_QUANTUM = 16 * 1024 # [ใหม่] bytes ต่อรอบของผู้เล่นแต่ละคนในตัวจัดคิว DRR ของแต่ละเส้นไปยัง Host
+FAIR_BATCH_BYTES = 128 * 1024 # bytes ที่ตัวจัดคิวปล่อยลง socket ของ Host ต่อครั้ง (ขอบเขตที่ Frame เล็กต้องรอหลังก้อนใหญ่)
+FAIR_PLAYER_MAX_BYTES = 256 * 1024 # ผู้เล่นที่มีข้อมูลค้างในคิวไป Host เกินนี้ต้องรอ (หรือทิ้ง datagram) เฉพาะตัวเอง
+FAIR_SERVICE_WEIGHTS = {} # [ใหม่] {ลำดับ service: weight} ส่วนแบ่ง DRR ต่อรอบของผู้เล่นแต่ละ service บนเส้นเดียวกัน (ไม่มี = 1)
+HOST_WAIT_TIMEOUT = 30 # [แก้ไข] วินาทีที่รอให้ Host ต่อเข้ามาหลังจากแจก Port/Tunnel ไปแล้ว (Client ต่อทันทีหลังได้คำตอบ)
+SHARED_PORT = None # [ใหม่] Port เดียวที่ทุกอุโมงค์ใช้ร่วมกัน (None = ปิดโหมดนี้)
+TUNNEL_TOKEN_BYTES = 6 # ความยาว token ของอุโมงค์บน Shared Port (hex 12 ตัวอักษร)
+CONTROL_REQUEST_TIMEOUT = 1.0 # วินาทีที่รอคำสั่งจาก Client ก่อนถือว่าเป็น Client รุ่นเก่า
+PREAMBLE_TIMEOUT = 10 # วินาทีที่รอ preamble บน Shared Port
+HOST_RESUME_GRACE = 30 # [ใหม่] วินาทีที่เก็บ Port และผู้เล่นไว้รอ Host ที่หลุดกลับมา RESUME (0 = ปิดทันทีแบบเดิม)
+LEASE_SECRET_BYTES = 16 # ความยาว secret ที่ใช้ RESUME อุโมงค์
+MAX_HOST_STRIPES = 8 # [ใหม่] จำนวนการเชื่อมต่อของ Host ต่ออุโมงค์สูงสุดที่ยอมให้ขอ
+COMPRESSION_ALLOWED = True # [ใหม่] ยอมให้ Client ขอบีบอัดข้อมูลบนอุโมงค์ด้วย "compress=zlib"
+STRIPE_PIN_POLICY = 'least-loaded' # [ใหม่] วิธีเลือกเส้นให้ผู้เล่นใหม่: 'least-loaded' หรือ 'hash' (player_id % จำนวนเส้น)
+UDP_SESSION_IDLE_TIMEOUT = 60 # [ใหม่] วินาทีที่ session UDP ของผู้เล่นอยู่ได้โดยไม่มี datagram ในทิศทางใดเลย
+UDP_WHEEL_TICK = 1.0 # ความละเอียดของ timer wheel ที่ใช้หมดอายุ session UDP (วินาที)
+METRICS_HOST = '127.0.0.1' # [ใหม่] endpoint /metrics (Prometheus text format) เปิดให้เครื่องตัวเองเท่านั้น
+METRICS_PORT = None # [ใหม่] Port ของ endpoint /metrics (None = ปิด)
+RELAY_ENGINE = 'thread' # ถูกตั้งโดย main(): 'thread' หรือ 'asyncio'
+HEARTBEAT_INTERVAL = 10 # [ใหม่] วินาทีระหว่าง PING ที่ขอให้ Host ส่งบนทุกเส้น (0 = ไม่เสนอ heartbeat)
+HEARTBEAT_MISSES = 3 # เส้นที่เงียบเกิน HEARTBEAT_INTERVAL * HEARTBEAT_MISSES วินาทีถือว่าตาย (เริ่มช่วงรอ RESUME ทันที)
+TCP_KEEPALIVE_IDLE = 60 # [ใหม่] TCP keepalive ของ socket Host และผู้เล่น: วินาทีที่เงียบได้ก่อนเริ่ม probe (0 = ปิด)
+TCP_KEEPALIVE_INTERVAL = 10 # วินาทีระหว่าง probe
+TCP_KEEPALIVE_COUNT = 3 # probe ที่ไม่ได้คำตอบก่อน kernel ตัดการเชื่อมต่อ
+WORKER_COUNT = 1 # [ใหม่] จำนวน worker process (มากกว่า 1 = โหมด pre-fork ที่ทุก worker รับ Control Port ร่วมกัน, Linux เท่านั้น)
+WORKER_RESTART_DELAY = 1.0 # วินาทีที่ Supervisor รอก่อนเริ่ม worker ที่ตายไปใหม่ (เพิ่มเท่าตัวถ้าตายซ้ำเร็วๆ สูงสุด 30)
+WORKER_STATS_TIMEOUT = 2.0 # วินาทีที่ Supervisor รอ /metrics จาก worker แต่ละตัว
+WORKER_INDEX = None # ถูกตั้งใน worker process: ลำดับของ worker นี้ (None = process เดียวแบบเดิม)
+TUNNEL_LIMITS = {} # [ใหม่] ขีดจำกัดเริ่มต้นของทุกอุโมงค์ {ชื่อ: ค่า} ชื่อตาม LIMIT_KEYS หรือ 'ip_' + ชื่อ (ไม่มี/0 = ไม่จำกัด)
+LIMIT_ADMIN_TOKEN = None # [ใหม่] token ของคำสั่ง LIMIT ที่ใช้แก้ขีดจำกัดของอุโมงค์ที่เปิดอยู่ และของ PROFILE (None = ปิดทั้งสองคำสั่ง)
+RATE_GRANT_BYTES = 16 * 1024 # bytes สูงสุดที่ forwarder เบิกจาก token bucket ของอุโมงค์/IP ต่อครั้ง (ไม่ต้องเข้า lock ทุก Frame)
+DIRECT_ALLOWED = True # [ใหม่] ยอมให้ Client ขอโหมด direct ด้วย "direct=1" (ต้องมี os.splice: Linux เท่านั้น)
+DIRECT_OPEN_TIMEOUT = 5 # วินาทีที่ผู้เล่นใหม่รอการเชื่อมต่อข้อมูลจาก Host ก่อนกลับไปใช้อุโมงค์แบบ Frame
+DIRECT_PUMP_BYTES = 256 * 1024 # bytes สูงสุดที่ asyncio engine ย้ายต่อทิศทางของผู้เล่น 1 คนต่อ 1 callback (ไม่ให้ผูกขาด loop)
+CAPTURE_PATH = None # [ใหม่] บันทึก Frame ของทุกอุโมงค์ลงไฟล์นี้ (None = ไม่บันทึก) worker แต่ละตัวเขียน <path>.w<ลำดับ>
+CAPTURE_PAYLOAD = False # เก็บข้อมูลของผู้เล่นลงไฟล์ด้วย (ค่าเริ่มต้นเก็บแค่เวลา, ทิศทาง, player_id และความยาว)
+PEER_READ_MAX_BYTES = READ_SIZE_MAX # [ใหม่] ขนาด recv สูงสุดของผู้เล่นที่ส่งต่อเนื่อง (เริ่มที่ READ_SIZE_MIN แล้วปรับด้วย ReadSizer)
+SOCKET_BUFFERS = {} # [ใหม่] {บทบาท: (SO_SNDBUF, SO_RCVBUF)} ของ socket 'peer' และ 'tunnel' (ของ Host) ไม่มี/0 = ให้ kernel ปรับเอง
+PEER_ACCEPT_BACKLOG = 1024 # [ใหม่] listen backlog ของ Public Port, Shared Port และ Control Port (kernel ตัดเหลือ net.core.somaxconn)
+PEER_PENDING_PER_IP = 0 # [ใหม่] การเชื่อมต่อที่รับแล้วแต่ยังไม่เป็นผู้เล่น (half-established) ต่อ IP สูงสุด (0 = ไม่จำกัด)
+PEER_LOG_PER_SECOND = 20 # [ใหม่] บรรทัด log ต่อผู้เล่น (เข้า/ออก/ถูกปฏิเสธ) สูงสุดต่อวินาที ส่วนที่เกินถูกสรุปเป็นบรรทัดเดียว
+ACCEPT_RETRY_DELAY = 0.1 # วินาทีที่หยุดรับการเชื่อมต่อเมื่อ accept() ล้มเหลวเพราะ fd หรือหน่วยความจำหมด
+MAX_TUNNEL_SERVICES = 8 # [ใหม่] จำนวน Public Port (Local Service) สูงสุดที่ 1 อุโมงค์ขอได้ด้วย "PORT services=N"
+DIRECTORY_ADDR = None # [ใหม่] (host, port) ของ p2p_directory ที่ node นี้รายงานภาระไปให้ (None = Server เดี่ยวแบบเดิม)
+NODE_NAME = None # ชื่อของ node นี้ใน Directory (None = hostname:Control Port)
+NODE_ADVERTISE_HOST = None # ที่อยู่ที่ Client ใช้ต่อมายัง node นี้ (None = SERVER_HOST หรือ IP ขาออกที่ใช้ต่อ Directory)
+DIRECTORY_TOKEN = None # token ที่ Directory ต้องการจาก node (ตรงกับ --node-token ของ p2p_directory)
+LOAD_REPORT_INTERVAL = 2 # วินาทีระหว่างรายงานภาระไปยัง Directory
+PEER_PARK_AFTER = 5.0 # [ใหม่] Thread engine: ผู้เล่นที่เงียบเกินนี้ (วินาที) คืน Thread อ่านแล้วรอใน PeerParker (0 = Thread ต่อผู้เล่นตลอด)
+PEER_WRITER_LINGER = 1.0 # [ใหม่] วินาทีที่ Thread writer ของผู้เล่นรอข้อมูลใหม่หลังส่งคิวหมดก่อนจบไป
+PROFILE_PATH = 'p2p-profile' # [ใหม่] prefix ของไฟล์ profile (<prefix>-<เวลา>.folded) worker แต่ละตัวใช้ <prefix>.w<ลำดับ>
+PROFILE_SECONDS = 10 # วินาทีของ session ที่เริ่มด้วย SIGUSR1 (คำสั่ง PROFILE กำหนดเองได้ไม่เกิน PROFILE_SECONDS_MAX)
+PROFILE_SECONDS_MAX = 300
 # -----------------
 
 # --- Global State ---
 used_ports = set()
+free_ports = collections.deque() # [ใหม่] Port ที่ว่างอยู่ เรียงตามลำดับที่จะแจก (สร้างโดย init_port_pool)
+tunnel_leases = {} # [ใหม่] {secret: Tunnel} สำหรับให้ Host ที่หลุดกลับมาต่ออุโมงค์เดิม
 active_managers = {} # [ใหม่] Dict สำหรับเก็บ Thread ที่จัดการแต่ละ Port: {port: thread_object}
+shared_tunnels = {} # [ใหม่] ตาราง route ของ Shared Port: {token: Tunnel}
 lock = threading.Lock()
+relay_stats = collections.Counter() # [ใหม่] ตัวนับเหตุการณ์ของ relay เช่น peer_overflow_drops, host_read_pauses
+stats_lock = threading.Lock()
+worker_link = None # [ใหม่] ลิงก์ไปยัง Supervisor สำหรับส่งต่อการเชื่อมต่อ (มีเฉพาะใน worker ของโหมด pre-fork)
+worker_link_lock = threading.Lock()
+worker_port_slices = [] # [ใหม่] Port slice ของทุก worker ตามลำดับ (ใช้ส่งคำสั่ง LIMIT port=... ไปยัง worker เจ้าของ Port)
+frame_capture = None # [ใหม่] FrameCapture เมื่อเปิด --capture
+frame_timings = None # [ใหม่] FrameTimings ระหว่าง session ของ profiler (forwarder อ่านค่านี้ครั้งเดียวต่อ Frame)
+profiler = None # [ใหม่] Profiler ของ process นี้ (สร้างโดย main())
+pending_peers = collections.Counter() # [ใหม่] {IP: จำนวนการเชื่อมต่อที่ยังไม่เป็นผู้เล่น} (เฉพาะเมื่อตั้ง PEER_PENDING_PER_IP)
+pending_lock = threading.Lock()
 # --------------------
 
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0) # ไม่มีบน Windows: จะ copy เข้าคิวทุกครั้ง
+
+def count_event(name, amount=1):
+    """เพิ่มค่าตัวนับใน relay_stats แบบ Thread-safe (ใช้กับเหตุการณ์ที่เกิดไม่บ่อย)"""
+    with stats_lock:
+        relay_stats[name] += amount
+
+class LogLimiter:
+    """
+    [ใหม่] พิมพ์ log ได้ไม่เกิน PEER_LOG_PER_SECOND บรรทัดต่อวินาที (Thread-safe ใช้ได้จาก event loop)
+    ช่วง connection storm บรรทัดต่อผู้เล่นหลายพันบรรทัดจะถ่วงทั้ง Thread ที่ accept และ event loop (stdout เป็น I/O แบบ block)
+    บรรทัดที่เกินถูกนับไว้ แล้วสรุปเป็นบรรทัดเดียวเมื่อมีบรรทัดถัดไปในวินาทีใหม่ (หรือใน Health Check)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.window = 0.0 # วินาทีของ monotonic ที่กำลังนับ
+        self.printed = 0
+        self.suppressed = 0
+
+    def __call__(self, line):
+        now = int(time.monotonic())
+        with self.lock:
+            if now != self.window:
+                self.window = now
+                self.printed = 0
+                suppressed, self.suppressed = self.suppressed, 0
+            else:
+                suppressed = 0
+            allowed = self.printed < PEER_LOG_PER_SECOND
+            if allowed:
+                self.printed += 1
+            else:
+                self.suppressed += 1
+        if suppressed:
+            print(f"[*] {suppressed} peer log line(s) suppressed.")
+        if allowed:
+            print(line)
+
+    def flush(self):
+        """พิมพ์จำนวนบรรทัดที่ถูกตัดทิ้งค้างอยู่ (เรียกจาก Health Checker)"""
+        with self.lock:
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            print(f"[*] {suppressed} peer log line(s) suppressed.")
+
+peer_log = LogLimiter()
+
+def claim_pending_peer(ip):
+    """
+    [ใหม่] นับการเชื่อมต่อที่เพิ่ง accept ของ IP นี้ว่ายังตั้งตัวไม่เสร็จ (รอ preamble หรือรอ Thread ของผู้เล่นเริ่ม)
+    คืนค่า False ถ้า IP นี้มีค้างครบ PEER_PENDING_PER_IP แล้ว (ผู้เรียกปิดการเชื่อมต่อทันที) ต้องเรียก release_pending_peer คู่กัน
+    """
+    if not PEER_PENDING_PER_IP:
+        return True
+    with pending_lock:
+        if pending_peers[ip] >= PEER_PENDING_PER_IP:
+            return False
+        pending_peers[ip] += 1
+    return True
+
+def release_pending_peer(ip):
+    if not PEER_PENDING_PER_IP:
+        return
+    with pending_lock:
+        pending_peers[ip] -= 1
+        if pending_peers[ip] <= 0:
+            del pending_peers[ip]
+
+def init_port_pool():
+    """[ใหม่] สร้าง free-list ของ Port ทั้งหมดใน Pool (เรียกจาก main() หลังตั้งค่า PORT_POOL_START/END)"""
+    with lock:
+        free_ports.clear()
+        free_ports.extend(port for port in range(PORT_POOL_START, PORT_POOL_END + 1) if port not in used_ports)
+
 def get_free_port():
-    """หา Port ที่ว่างใน Pool แบบ Thread-safe"""
+    """[แก้ไข] หยิบ Port ว่างจากหัว free-list แบบ Thread-safe (O(1) ไม่ต้องไล่ทั้ง Pool)"""
     with lock:
-        for port in range(PORT_POOL_START, PORT_POOL_END + 1):
-            if port not in used_ports:
-                used_ports.add(port)
-                return port
-        return None
+        if not free_ports:
+            return None
+        port = free_ports.popleft()
+        used_ports.add(port)
+        return port
 
 def release_port(port):
     """
     [แก้ไข] คืน Port กลับเข้า Pool และล้างข้อมูล Thread ที่เกี่ยวข้อง
-    ฟังก์ชันนี้จะถูกเรียกเมื่อ session จบลงปกติ หรือโดย Health Checker
+    ฟังก์ชันนี้จะถูกเรียกเมื่อ session จบลง
+    Port ที่คืนจะไปต่อท้าย free-list จึงถูกแจกซ้ำช้าที่สุด
     """
     with lock:
         # ตรวจสอบก่อนลบเพื่อป้องกัน Error หากมีการเรียกซ้ำ
         if port in used_ports:
             used_ports.remove(port)
+            free_ports.append(port)
             print(f"[*] Port {port} released and returned to the pool.")
         if port in active_managers:
             del active_managers[port]
 
-# [ใหม่] ฟังก์ชันสำหรับตรวจสอบและเก็บกวาด Port ที่ไม่ถูกใช้งาน
+def register_lease(tunnel):
+    """[ใหม่] ผูก secret ของอุโมงค์ไว้ให้ Host ใช้คำสั่ง RESUME ภายหลัง"""
+    with lock:
+        tunnel_leases[tunnel.secret] = tunnel
+
+def drop_lease(tunnel):
+    with lock:
+        if tunnel_leases.get(tunnel.secret) is tunnel:
+            del tunnel_leases[tunnel.secret]
+
+def new_lease_secret():
+    """[ใหม่] secret สำหรับ RESUME: โหมด pre-fork ขึ้นต้นด้วยเลข worker เจ้าของ ("w2.<hex>") เพื่อให้ worker อื่น route ถูก"""
+    secret = secrets.token_hex(LEASE_SECRET_BYTES)
+    return secret if WORKER_INDEX is None else f"w{WORKER_INDEX}.{secret}"
+
+# [ใหม่] ฟังก์ชันสำหรับรายงานสถานะของอุโมงค์เป็นระยะ
 def port_health_checker():
     """
-    ตรวจสอบสถานะของ Port Manager Threads เป็นระยะๆ
-    และเรียกคืน Port จาก Thread ที่หยุดทำงานไปแล้ว (เช่น เกิดข้อผิดพลาด)
+    พิมพ์สรุปสถานะของ Port, อุโมงค์และตัวนับเป็นระยะๆ
+    [แก้ไข] ไม่ต้องไล่หา Port ที่ค้างอีกแล้ว: Port ถูกคืนทันทีที่ Port Manager จบ (Host ไม่มาใน HOST_WAIT_TIMEOUT,
+    หมดช่วงรอ RESUME หรืออุโมงค์ปิด) และเส้นของ Host ที่ตายเงียบๆ ถูกตัดด้วย heartbeat/TCP keepalive
     """
     while True:
         time.sleep(HEALTH_CHECK_INTERVAL)
-        print(f"[Health Check] Running check for inactive ports... (Currently used: {len(used_ports)})")
+        peer_log.flush()
+        print(f"[Health Check] Ports in use: {len(used_ports)}, shared tunnels: {len(shared_tunnels)}")
 
-        reclaim_ports = []
         with lock:
-            # สร้าง list จาก .items() เพื่อให้สามารถแก้ไข dict ได้อย่างปลอดภัย
-            for port, thread in list(active_managers.items()):
-                if not thread.is_alive():
-                    reclaim_ports.append(port)
-
-        if reclaim_ports:
-            print(f"[Health Check] Found dead threads for ports: {reclaim_ports}. Reclaiming...")
-            for port in reclaim_ports:
-                # release_port จะจัดการ lock ของตัวเอง
-                release_port(port)
-        else:
-            print("[Health Check] All active ports seem healthy.")
+            tunnels = list(tunnel_leases.values())
+        for tunnel in tunnels:
+            tunnel.limits.prune()
+            if tunnel.max_stripes > 1:
+                print(f"[Health Check] Tunnel {tunnel.name} stripes: {tunnel.stripe_summary()}")
+            if tunnel.compressor is not None:
+                print(f"[Health Check] Tunnel {tunnel.name} compression: {tunnel.compression_summary()}")
+        if tunnels:
+            # [ใหม่] หน่วยความจำที่นับได้ของ session ทั้งหมด (ดู p2p_session_memory_bytes สำหรับรายอุโมงค์)
+            players = sum(len(tunnel.players) for tunnel in tunnels)
+            memory = sum(tunnel.memory_usage() for tunnel in tunnels)
+            print(f"[Health Check] Sessions: {players} players, {memory // 1024} KB accounted"
+                  f"{f', {peer_parker.parked()} parked' if RELAY_ENGINE == 'thread' else ''}")
+
+        with stats_lock:
+            stats_line = ", ".join(f"{name}={value}" for name, value in sorted(relay_stats.items()))
+        if stats_line:
+            print(f"[Health Check] Relay stats: {stats_line}")
+
+def collect_metrics():
+    """[ใหม่] สร้างข้อความของ /metrics จากตัวนับของทุกอุโมงค์ (ถูกเรียกจาก Thread ของ metrics endpoint)"""
+    writer = MetricsWriter()
+    with lock:
+        tunnels = list(tunnel_leases.values())
+        ports_in_use = len(used_ports)
+    writer.sample('p2p_ports_in_use', 'gauge', "Public ports currently allocated.", ports_in_use)
+    writer.sample('p2p_tunnels', 'gauge', "Tunnels currently open.", len(tunnels))
+    for tunnel in tunnels:
+        name = str(tunnel.name)
+        writer.sample('p2p_players', 'gauge', "Players currently connected to the tunnel.", len(tunnel.players), tunnel=name)
+        writer.sample('p2p_direct_players', 'gauge', "Players relayed over their own direct host connection.",
+                      len(tunnel.direct_links), tunnel=name)
+        writer.sample('p2p_peer_accepts_total', 'counter', "Players accepted by the tunnel.", tunnel.peer_accepts, tunnel=name)
+        writer.sample('p2p_host_connections', 'gauge', "Host connections (stripes) attached to the tunnel.",
+                      len(tunnel.stripes), tunnel=name)
+        writer.sample('p2p_peer_queued_bytes', 'gauge', "Bytes waiting in the outbound buffers of the tunnel's players.",
+                      tunnel.queued_bytes(), tunnel=name)
+        writer.sample('p2p_session_memory_bytes', 'gauge',
+                      "Estimated bytes held by the tunnel's session objects and queued data (thread stacks excluded).",
+                      tunnel.memory_usage(), tunnel=name)
+        if type(tunnel) is Tunnel:
+            readers, writers, parked = tunnel.thread_usage()
+            writer.sample('p2p_peer_threads', 'gauge', "Threads serving the tunnel's players (thread engine).",
+                          readers, tunnel=name, role='reader')
+            writer.sample('p2p_peer_threads', 'gauge', "Threads serving the tunnel's players (thread engine).",
+                          writers, tunnel=name, role='writer')
+            writer.sample('p2p_parked_players', 'gauge', "Idle players waiting in the shared selector without a thread.",
+                          parked, tunnel=name)
+        for limit, value in sorted(tunnel.limits.values.items()):
+            writer.sample('p2p_tunnel_limit', 'gauge', "Limits configured for the tunnel (rates in bytes or connections per second).",
+                          value, tunnel=name, limit=limit)
+        for player_id, depth in sorted(tunnel.host_queue_depths().items()):
+            writer.sample('p2p_host_queue_bytes', 'gauge', "Bytes each player has waiting in the fair queue towards the Host.",
+                          depth, tunnel=name, player=str(player_id))
+        for direction, metrics in tunnel.metrics_totals().items():
+            writer.sample('p2p_frames_total', 'counter', "Frames relayed.", metrics.frames, tunnel=name, direction=direction)
+            writer.sample('p2p_bytes_total', 'counter', "Payload bytes relayed.", metrics.bytes, tunnel=name, direction=direction)
+            writer.histogram('p2p_frame_size_bytes', "Payload size of relayed frames.", metrics.sizes,
+                             tunnel=name, direction=direction)
+            writer.histogram('p2p_relay_delay_seconds', "Time frames spend inside the relay before reaching the socket.",
+                             metrics.delays, tunnel=name, direction=direction)
+    with stats_lock:
+        events = sorted(relay_stats.items())
+    for event, value in events:
+        writer.sample('p2p_relay_events_total', 'counter', "Relay events such as overflow drops and UDP session churn.",
+                      value, event=event)
+    return writer.text()
+
+
+def report_load_to_directory(collect):
+    """
+    [ใหม่] โหมด cluster: ต่อค้างไว้กับ DIRECTORY_ADDR แล้วส่งบรรทัด NODE ทุก LOAD_REPORT_INTERVAL วินาที
+    collect คืนค่า MetricsWriter ของ node ทั้งตัว (process เดียวหรือทุก worker รวมกัน) หลุดเมื่อไรก็ต่อใหม่เอง
+    """
+    name = NODE_NAME or f"{socket.gethostname()}:{SERVER_CONTROL_PORT}"
+    pool_size = PORT_POOL_END - PORT_POOL_START + 1
+    while True:
+        try:
+            with socket.create_connection(DIRECTORY_ADDR, timeout=10) as sock:
+                host = NODE_ADVERTISE_HOST or (SERVER_HOST if SERVER_HOST != '0.0.0.0' else sock.getsockname()[0])
+                print(f"[+] Reporting load to directory {DIRECTORY_ADDR[0]}:{DIRECTORY_ADDR[1]} as {name} ({host})")
+                last_bytes, last_time, joined = None, time.monotonic(), False
+                while True:
+                    totals = collect()
+                    now, relayed = time.monotonic(), totals.total('p2p_bytes_total')
+                    # ตัวนับหายไปพร้อมอุโมงค์ที่ปิด: ช่วงที่ผลต่างติดลบนับเป็น 0
+                    bps = 0 if last_bytes is None else max(0, int((relayed - last_bytes) / max(now - last_time, 1e-3)))
+                    last_bytes, last_time = relayed, now
+                    sock.sendall(format_control_line(
+                        'NODE', name=name, host=host, control=SERVER_CONTROL_PORT, tunnels=int(totals.total('p2p_tunnels')),
+                        players=int(totals.total('p2p_players')), bps=bps,
+                        free=pool_size - int(totals.total('p2p_ports_in_use')), token=DIRECTORY_TOKEN))
+                    if not joined:
+                        reply = recv_line(sock)
+                        if reply != 'OK':
+                            print(f"[!] Directory refused this node: {reply or 'connection closed'}")
+                            break
+                        joined = True
+                    time.sleep(LOAD_REPORT_INTERVAL)
+        except (OSError, ValueError) as e:
+            print(f"[!] Lost the directory at {DIRECTORY_ADDR[0]}:{DIRECTORY_ADDR[1]}: {e}")
+        time.sleep(max(LOAD_REPORT_INTERVAL, 1))
+
+def node_totals():
+    """ตัวเลขรวมของ process นี้สำหรับ report_load_to_directory"""
+    writer = MetricsWriter()
+    writer.merge_text(collect_metrics())
+    return writer
+
+
+class PeerOutbound:
+    """
+    [ใหม่] บัฟเฟอร์ขาออกแบบจำกัดขนาดของผู้เล่น 1 คน มี Thread writer ของตัวเองคอยส่งข้อมูล
+    Host reader แค่นำข้อมูลมาใส่คิว จึงไม่ต้อง block เพราะ socket ของผู้เล่นที่ช้า
+    [แก้ไข] คิวและ Thread writer มีเฉพาะตอนที่มีข้อมูลค้างส่ง: ผู้เล่นที่ socket รับทันไม่ต้องมีทั้งสองอย่างเลย
+    และ writer ที่ส่งหมดแล้วเงียบเกิน PEER_WRITER_LINGER วินาทีจะจบไปพร้อมคืนคิว
+    """
+    __slots__ = ('peer_conn', 'player_id', 'max_bytes', 'policy', 'limits', 'ip', 'queue', 'queued_bytes', 'sending',
+                 'closed', 'cond', 'writer_thread')
+
+    def __init__(self, peer_conn, player_id, max_bytes=None, policy=None, limits=None, ip=None):
+        self.peer_conn = peer_conn
+        self.player_id = player_id
+        self.max_bytes = max_bytes if max_bytes is not None else PEER_QUEUE_MAX_BYTES
+        self.policy = policy if policy is not None else PEER_OVERFLOW_POLICY
+        self.limits = limits # [ใหม่] TunnelLimits ของอุโมงค์: max_buffered อาจทำให้เพดานต่ำกว่า max_bytes
+        self.ip = ip
+        self.queue = None # collections.deque ระหว่างที่มี writer อยู่
+        self.queued_bytes = 0
+        self.sending = False # writer thread กำลัง sendall ข้อมูลที่ออกจากคิวไปแล้วอยู่หรือไม่
+        self.closed = False
+        self.cond = threading.Condition()
+        self.writer_thread = None
+
+    def put(self, data):
+        """
+        นำข้อมูลเข้าคิว คืนค่า False ถ้าผู้เล่นถูกปิดไปแล้ว
+        data อาจเป็น memoryview ชั่วคราวจาก FrameDecoder: ถ้าคิวว่างจะลองส่งตรงแบบไม่ block ก่อน
+        แล้วค่อย copy เฉพาะส่วนที่ส่งไม่หมดเข้าคิว
+        ถ้าคิวเต็ม: policy 'drop' จะตัดผู้เล่นทิ้ง, 'pause' จะรอจนกว่าคิวจะว่าง (Host reader หยุดอ่าน)
+        [ใหม่] เพดานของคิวคือ max_bytes หรือส่วนแบ่ง max_buffered ของอุโมงค์/IP ถ้าน้อยกว่า (ดูเฉพาะตอนต้องเข้าคิว)
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if not self.queued_bytes and not self.sending and _MSG_DONTWAIT:
+                try:
+                    sent = self.peer_conn.send(data, _MSG_DONTWAIT)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    self._close_locked()
+                    return False
+                if sent == len(data):
+                    return True
+                data = data[sent:]
+            max_bytes = self.limits.buffer_cap(self.ip, self.max_bytes) if self.limits is not None else self.max_bytes
+            if self.queued_bytes and self.queued_bytes + len(data) > max_bytes:
+                if self.policy == 'drop':
+                    count_event('peer_overflow_drops')
+                    peer_log(f"[Player {self.player_id}] Outbound buffer full ({self.queued_bytes} bytes). Dropping player.")
+                    self._close_locked()
+                    return False
+                count_event('host_read_pauses')
+                paused_at = time.monotonic()
+                while not self.closed and self.queued_bytes and self.queued_bytes + len(data) > max_bytes:
+                    self.cond.wait()
+                count_event('host_read_paused_ms', int((time.monotonic() - paused_at) * 1000))
+                if self.closed:
+                    return False
+            if self.writer_thread is None:
+                self.queue = collections.deque()
+                self.writer_thread = threading.Thread(target=self._drain, daemon=True)
+                self.writer_thread.start()
+            self.queue.append(bytes(data))
+            self.queued_bytes += len(data)
+            self.cond.notify_all()
+            return True
+
+    def _drain(self):
+        """Thread writer: ส่งข้อมูลในคิวไปยังผู้เล่นทีละก้อน จบเองเมื่อคิวว่างเกิน PEER_WRITER_LINGER วินาที"""
+        while True:
+            with self.cond:
+                if not self.queue and not self.closed:
+                    self.cond.wait(PEER_WRITER_LINGER)
+                if self.closed or not self.queue:
+                    self.queue = None
+                    self.writer_thread = None # put() ครั้งถัดไปที่ต้องเข้าคิวจะเริ่ม writer ใหม่
+                    return
+                data = self.queue.popleft()
+                self.sending = True
+            try:
+                self.peer_conn.sendall(data)
+            except OSError:
+                self.close()
+                with self.cond:
+                    self.sending = False
+                continue
+            with self.cond:
+                self.sending = False
+                self.queued_bytes -= len(data)
+                self.cond.notify_all()
+
+    def _close_locked(self):
+        self.closed = True
+        if self.queue is not None:
+            self.queue.clear()
+        self.queued_bytes = 0
+        self.cond.notify_all()
+        try:
+            # shutdown ปลุกทั้ง Thread ที่ recv และ sendall ค้างอยู่บน socket นี้ (และ PeerParker ถ้าผู้เล่นจอดอยู่)
+            self.peer_conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        ปิดคิวและ socket ของผู้เล่น (ข้อมูลที่ค้างในคิวจะถูกทิ้ง)
+        [แก้ไข] แค่ shutdown: PeerSession ของผู้เล่นเป็นคนปิด fd ตอนจบ (fd ที่ยังอยู่ใน PeerParker ห้ามถูกปิดก่อน)
+        """
+        with self.cond:
+            if not self.closed:
+                self._close_locked()
+
+    def memory_usage(self):
+        """[ใหม่] bytes โดยประมาณของ object นี้รวมข้อมูลที่ค้างในคิว (ไม่รวม stack ของ Thread writer)"""
+        queue = self.queue
+        return sys.getsizeof(self) + (sys.getsizeof(queue) if queue is not None else 0) + self.queued_bytes
+
+
+class PeerSession:
+    """
+    [ใหม่] สถานะขาไป Host ของผู้เล่น 1 คน (Thread engine) แยกออกจาก Thread ที่อ่าน socket
+    ผู้เล่นที่เงียบเกิน PEER_PARK_AFTER วินาทีถูกจอดไว้ใน PeerParker (selector Thread เดียวของทั้ง process)
+    แล้ว Thread อ่านของผู้เล่นจบไป เมื่อมีข้อมูลหรือ socket ถูกปิด PeerParker เริ่ม Thread ใหม่ให้อ่านต่อจาก session เดิม
+    """
+    __slots__ = ('tunnel', 'conn', 'player_id', 'ip', 'grant', 'sizer')
+
+    def __init__(self, tunnel, conn, player_id, ip):
+        self.tunnel = tunnel
+        self.conn = conn
+        self.player_id = player_id
+        self.ip = ip
+        self.grant = RateGrant(tunnel.limits.bucket('to_host'), tunnel.limits.bucket('to_host', ip))
+        self.sizer = ReadSizer(READ_SIZE_MIN, PEER_READ_MAX_BYTES)
+
+    def resume(self):
+        """ถูกเรียกจาก PeerParker: อ่านต่อใน Thread ใหม่"""
+        with self.tunnel.players_lock:
+            self.tunnel.parked_players.discard(self.player_id)
+        threading.Thread(target=forward_from_peer_to_host, args=(self,), daemon=True).start()
+
+    def finish(self):
+        """ผู้เล่นหลุด: ลบออกจากอุโมงค์ แจ้ง Host แล้วปิด socket (ถูกเรียกครั้งเดียวจาก Thread อ่านตัวสุดท้าย)"""
+        tunnel = self.tunnel
+        peer_log(f"[Player {self.player_id}] Disconnected.")
+        with tunnel.players_lock:
+            outbound = tunnel.players.pop(self.player_id, None)
+            tunnel.parked_players.discard(self.player_id)
+        if outbound is not None:
+            outbound.close()
+        # แจ้งให้ Host รู้ว่าผู้เล่นคนนี้หลุดการเชื่อมต่อแล้ว (ส่งข้อมูลความยาว 0)
+        tunnel.remove_player(self.player_id)
+        tunnel.limits.release(self.ip, self.conn)
+        self.conn.close()
+
+
+class PeerParker:
+    """
+    [ใหม่] selector Thread เดียวที่เฝ้า socket ของผู้เล่นที่จอดไว้ (ไม่มี Thread อ่านของตัวเอง)
+    เริ่มเมื่อมีผู้เล่นคนแรกถูกจอด socket ที่อ่านได้ (ข้อมูลใหม่, EOF หรือถูก shutdown) ถูกถอดออกแล้วคืนให้ session
+    """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def park(self, session):
+        with self.lock:
+            self.selector.register(session.conn, selectors.EVENT_READ, session)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def parked(self):
+        return len(self.selector.get_map())
 
+    def _run(self):
+        while True:
+            events = self.selector.select(1.0) # epoll ที่ว่างก็รอได้ (ผู้เล่นใหม่ถูก register จาก Thread อื่นระหว่างรอ)
+            for key, _ in events:
+                with self.lock:
+                    self.selector.unregister(key.fileobj)
+                key.data.resume()
+
+peer_parker = PeerParker()
+
+
+class TimerWheel:
+    """
+    [ใหม่] Timer wheel สำหรับหมดอายุ item ที่เงียบเกิน timeout (ใช้กับ session UDP ทั้งสอง engine)
+    แต่ละช่องคือช่วงเวลา tick วินาที item อยู่ในช่องตามเวลาที่ควรหมดอายุ การ touch แค่แก้ item.last_seen
+    (ไม่ย้ายช่อง) เมื่อถึงช่องนั้น item ที่ยังมีความเคลื่อนไหวจะถูกใส่ช่องใหม่ตาม last_seen ล่าสุด
+    ไม่ thread-safe: ต้องใช้จาก Thread หรือ event loop เดียวกันเสมอ
+    """
+    def __init__(self, timeout, tick):
+        self.timeout = timeout
+        self.tick = tick
+        self.slots = [[] for _ in range(max(1, math.ceil(timeout / tick)) + 1)]
+        self.position = 0
+        self.next_tick = time.monotonic() + tick
+
+    def schedule(self, item, now):
+        """ใส่ item ในช่องที่จะถึงตอน item.last_seen + timeout"""
+        ticks = math.ceil((item.last_seen + self.timeout - now) / self.tick)
+        ticks = min(max(ticks, 1), len(self.slots) - 1)
+        self.slots[(self.position + ticks) % len(self.slots)].append(item)
+
+    def advance(self, now):
+        """เลื่อนเข็มจนถึงเวลา now คืนค่า list ของ item ที่เงียบเกิน timeout (ถูกเอาออกจาก wheel แล้ว)"""
+        expired = []
+        while now >= self.next_tick:
+            self.position = (self.position + 1) % len(self.slots)
+            self.next_tick += self.tick
+            due, self.slots[self.position] = self.slots[self.position], []
+            for item in due:
+                if now - item.last_seen >= self.timeout:
+                    expired.append(item)
+                else:
+                    self.schedule(item, now)
+        return expired
+
+class UdpSession:
+    """
+    [ใหม่] ผู้เล่น 1 คนบน Public Port แบบ UDP ระบุด้วย (ip, port) ต้นทาง
+    อยู่ในตาราง players ของอุโมงค์แทน PeerOutbound (Thread engine) หรือ StreamWriter (asyncio engine)
+    sender คือ socket UDP ของ Port (Thread engine) หรือ DatagramTransport (asyncio engine) ซึ่งมี sendto เหมือนกัน
+    """
+    __slots__ = ('sender', 'addr', 'player_id', 'last_seen', 'to_host', 'to_peer')
+
+    def __init__(self, sender, addr, player_id, limits=None):
+        self.sender = sender
+        self.addr = addr
+        self.player_id = player_id
+        self.last_seen = time.monotonic()
+        # [ใหม่] RateGrant ของ datagram แต่ละทิศทาง (ขาไปผู้เล่นทั้งอุโมงค์ถูกจำกัดที่ Host reader แล้ว เหลือแค่ของ IP)
+        self.to_host = RateGrant(limits.bucket('to_host'), limits.bucket('to_host', addr[0])) if limits else None
+        self.to_peer = RateGrant(limits.bucket('to_peer', addr[0])) if limits else None
+
+    def memory_usage(self):
+        """[ใหม่] bytes โดยประมาณของ session นี้ (datagram ไม่ถูกเก็บค้าง จึงมีแค่ตัว object)"""
+        return sys.getsizeof(self)
+
+    def put(self, data):
+        """ส่ง payload ของ 1 Frame เป็น 1 datagram (ส่งไม่ได้หรือเกิน ip_to_peer_rate = ทิ้งแบบ UDP ไม่ตัดผู้เล่น)"""
+        self.last_seen = time.monotonic()
+        if self.to_peer is not None and not self.to_peer.try_spend(len(data)):
+            count_event('limit_dropped_datagrams')
+            return True
+        try:
+            self.sender.sendto(data, self.addr)
+        except OSError:
+            count_event('udp_send_drops')
+        return True
+
+    write = put # asyncio engine เรียก write() เหมือน StreamWriter
+
+    def close(self):
+        pass # socket ใช้ร่วมกันทั้ง Port: session ถูกลบออกจากตารางโดย relay ของ Port เท่านั้น
+
+# --- [ใหม่] ขีดจำกัดของอุโมงค์: token bucket ต่อ Port และต่อ IP ต้นทางของผู้เล่น ---
+
+LIMIT_KEYS = ('to_host_rate', 'to_peer_rate', 'conn_rate', 'max_players', 'max_buffered')
+
+def parse_limit_fields(fields):
+    """
+    แปลงขีดจำกัดจาก {ชื่อ: str} เป็น {ชื่อ: int} ชื่อคือ LIMIT_KEYS (ทั้งอุโมงค์) หรือ 'ip_' + ชื่อ (ต่อ IP ต้นทาง)
+    raise ValueError ถ้าชื่อไม่รู้จักหรือค่าไม่ใช่จำนวนเต็มที่ไม่ติดลบ (0 = ยกเลิกขีดจำกัดนั้น)
+    """
+    limits = {}
+    for key, value in fields.items():
+        if key.removeprefix('ip_') not in LIMIT_KEYS:
+            raise ValueError(f"Unknown limit {key!r}.")
+        limits[key] = int(value)
+        if limits[key] < 0:
+            raise ValueError(f"Limit {key!r} must not be negative.")
+    return limits
+
+class TokenBucket:
+    """
+    token bucket ที่เติม rate token ต่อวินาที เก็บได้ไม่เกิน 1 วินาทีของ rate (rate=0 = ไม่จำกัด)
+    take() ยอมให้ติดลบแล้วคืนเวลาที่ต้องรอ (ไม่ต้องตัด Frame) ส่วน try_take() ไม่ติดหนี้ (ใช้กับการเชื่อมต่อและ datagram)
+    ใช้ร่วมกันหลาย Thread ได้ แต่ forwarder เบิกผ่าน RateGrant ทีละก้อนจึงแทบไม่ต้องแย่ง lock กัน
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate=0):
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.configure(rate)
+
+    def configure(self, rate):
+        """เปลี่ยน rate ระหว่างใช้งาน: token ที่สะสมไว้ไม่เกิน burst ใหม่ หนี้ที่ค้างอยู่ยังต้องจ่ายด้วย rate ใหม่"""
+        with self.lock:
+            self._refill(time.monotonic())
+            limited = self.rate
+            self.rate = rate
+            self.burst = max(rate, 1)
+            self.tokens = min(self.tokens, self.burst) if limited else self.burst
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, amount):
+        """หัก amount (ติดลบได้) คืนค่าวินาทีที่ผู้ใช้ต้องรอก่อนใช้ต่อ (0 = ไม่ต้องรอ)"""
+        with self.lock:
+            if not self.rate:
+                return 0
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def try_take(self, amount):
+        """หัก amount เฉพาะเมื่อมี token พอ คืนค่า False ถ้าไม่พอ (ไม่หักเลย)"""
+        with self.lock:
+            if not self.rate:
+                return True
+            self._refill(time.monotonic())
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def refund(self, amount):
+        with self.lock:
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + amount)
+
+    def full(self):
+        """bucket เต็ม (ลืมได้โดยไม่เสียประวัติการใช้)"""
+        with self.lock:
+            self._refill(time.monotonic())
+            return not self.rate or self.tokens >= self.burst
 
-def forward_from_peer_to_host(peer_conn, host_conn, player_id, players_lock, players):
-    """อ่านข้อมูลจากผู้เล่น (Peer), ใส่ Header, แล้วส่งไปให้ Host"""
+class RateGrant:
+    """
+    credit ส่วนตัวของ forwarder 1 ตัว (มีผู้ใช้คนเดียว จึงไม่มี lock) เบิกจาก bucket ของอุโมงค์และของ IP พร้อมกันทีละก้อน
+    ก้อนละไม่เกิน RATE_GRANT_BYTES หรือ 1/10 วินาทีของ rate ที่ต่ำที่สุด: เข้า lock ของ bucket ครั้งละก้อน ไม่ใช่ทุก Frame
+    เมื่อไม่มี bucket ไหนจำกัดก็ยังตรวจใหม่ทุก RATE_GRANT_BYTES ขีดจำกัดที่แก้ด้วยคำสั่ง LIMIT จึงมีผลแทบทันที
+    """
+    __slots__ = ('buckets', 'credit')
+
+    def __init__(self, *buckets):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self.credit = 0
+
+    def _grant_size(self):
+        rates = [bucket.rate for bucket in self.buckets if bucket.rate]
+        return min(RATE_GRANT_BYTES, max(1, min(rates) // 10)) if rates else 0
+
+    def spend(self, amount):
+        """ใช้ amount bytes ที่ส่งต่อไปแล้ว คืนค่าวินาทีที่ต้องหยุดอ่านต้นทางเพื่อให้อยู่ใน rate (0 = ไปต่อได้เลย)"""
+        self.credit -= amount
+        if self.credit >= 0:
+            return 0
+        size = self._grant_size()
+        if not size:
+            self.credit = RATE_GRANT_BYTES
+            return 0
+        need = size - self.credit
+        self.credit = size
+        return max(bucket.take(need) for bucket in self.buckets)
+
+    def try_spend(self, amount):
+        """แบบไม่ติดหนี้สำหรับ datagram: คืนค่า False (ให้ทิ้ง datagram) ถ้า bucket ใดไม่มี token พอ"""
+        if self.credit >= amount:
+            self.credit -= amount
+            return True
+        size = self._grant_size()
+        if not size:
+            self.credit = RATE_GRANT_BYTES
+            return True
+        need = amount - self.credit + size
+        taken = []
+        for bucket in self.buckets:
+            if not bucket.try_take(need):
+                for done in taken:
+                    done.refund(need)
+                return False
+            taken.append(bucket)
+        self.credit += need - amount
+        return True
+
+class IpUsage:
+    """ผู้เล่นจาก IP ต้นทางเดียวกันในอุโมงค์หนึ่ง: จำนวนผู้เล่น, bucket ของ IP และ socket ที่แบ่ง pacing rate กัน"""
+    __slots__ = ('players', 'connects', 'to_host', 'to_peer', 'sockets', 'paced')
+
+    def __init__(self):
+        self.players = 0
+        self.connects = TokenBucket()
+        self.to_host = TokenBucket()
+        self.to_peer = TokenBucket()
+        self.sockets = set()
+        self.paced = False
+
+class TunnelLimits:
+    """
+    ขีดจำกัดของอุโมงค์ 1 อัน ทั้งของทั้งอุโมงค์และต่อ IP ต้นทางของผู้เล่น ('ip_' + ชื่อ) ค่าที่ไม่มี = ไม่จำกัด
+    - to_host_rate / to_peer_rate: bytes/วินาทีแต่ละทิศทาง เกินแล้ว relay หยุดอ่านฝั่งต้นทางชั่วคราว (TCP ชะลอต้นทางเอง
+      ไม่ต้องทิ้งข้อมูล ยกเว้น datagram ของผู้เล่น UDP ที่ถูกทิ้ง)
+      ip_to_peer_rate แบ่งให้ socket ของผู้เล่นจาก IP นั้นเท่าๆ กันด้วย SO_MAX_PACING_RATE (Linux) เพื่อไม่ต้องหยุดอ่าน Host ทั้งเส้น
+    - conn_rate: ผู้เล่นใหม่ต่อวินาที, max_players: ผู้เล่นพร้อมกัน (เกิน = ปิดการเชื่อมต่อใหม่ทันที)
+    - max_buffered: bytes ที่ relay ถือไว้รอส่งให้ผู้เล่นรวมกัน แบ่งเท่าๆ กันเป็นเพดานบัฟเฟอร์ขาออกของแต่ละคน
+      (ขาไป Host มีเพดานต่อเส้นอยู่แล้วที่ WRITER_MAX_PENDING_BYTES ไม่ขึ้นกับจำนวนผู้เล่น)
+    update() เปลี่ยนค่าระหว่างทำงาน (คำสั่ง LIMIT): bucket ถูกปรับในที่ forwarder ที่ถือ RateGrant อยู่จึงเห็นค่าใหม่เอง
+    lock ใช้ตอนรับ/ปล่อยผู้เล่นและตอน update เท่านั้น ส่วน buffer_cap() อ่าน values ที่ถูกแทนทั้งก้อนโดยไม่ถือ lock
+    """
+    def __init__(self, values=None):
+        self.values = {}
+        self.lock = threading.Lock()
+        self.players = 0
+        self.ips = {} # {ip: IpUsage}
+        self.connects = TokenBucket()
+        self.to_host = TokenBucket()
+        self.to_peer = TokenBucket()
+        self.update(values or {})
+
+    def update(self, changes):
+        """รวม changes (ผ่าน parse_limit_fields แล้ว) เข้ากับค่าเดิม ค่า 0 คือยกเลิกขีดจำกัดนั้น"""
+        with self.lock:
+            values = dict(self.values)
+            for key, value in changes.items():
+                if value:
+                    values[key] = value
+                else:
+                    values.pop(key, None)
+            self.values = values
+            self.connects.configure(values.get('conn_rate', 0))
+            self.to_host.configure(values.get('to_host_rate', 0))
+            self.to_peer.configure(values.get('to_peer_rate', 0))
+            for usage in self.ips.values():
+                self._configure_ip(usage)
+                self._pace(usage)
+
+    def _configure_ip(self, usage):
+        usage.connects.configure(self.values.get('ip_conn_rate', 0))
+        usage.to_host.configure(self.values.get('ip_to_host_rate', 0))
+        usage.to_peer.configure(self.values.get('ip_to_peer_rate', 0))
+
+    def _pace(self, usage):
+        rate = self.values.get('ip_to_peer_rate', 0)
+        if not rate and not usage.paced:
+            return # ไม่เคยจำกัด: ไม่ต้องแตะ socket
+        share = rate // len(usage.sockets) if rate and usage.sockets else 0
+        for sock in usage.sockets:
+            set_pacing_rate(sock, max(share, 1) if rate else 0)
+        usage.paced = bool(rate)
+
+    def admit(self, ip, sock=None):
+        """
+        รับผู้เล่นใหม่จาก ip คืนค่า None ถ้ารับได้ (ต้องเรียก release เมื่อผู้เล่นหลุด) หรือเหตุผลที่ปฏิเสธ
+        sock: socket TCP ของผู้เล่นสำหรับ ip_to_peer_rate (ผู้เล่น UDP ใช้ socket ร่วมกันจึงไม่มี)
+        """
+        values = self.values
+        with self.lock:
+            usage = self.ips.get(ip)
+            if usage is None:
+                usage = self.ips[ip] = IpUsage()
+                self._configure_ip(usage)
+            if values.get('max_players') and self.players >= values['max_players']:
+                return 'TooManyPlayers'
+            if values.get('ip_max_players') and usage.players >= values['ip_max_players']:
+                return 'TooManyPlayersFromAddress'
+            if not usage.connects.try_take(1):
+                return 'AddressConnectRate'
+            if not self.connects.try_take(1):
+                usage.connects.refund(1)
+                return 'ConnectRate'
+            self.players += 1
+            usage.players += 1
+            if sock is not None:
+                usage.sockets.add(sock)
+                self._pace(usage)
+        return None
+
+    def release(self, ip, sock=None):
+        """ผู้เล่นที่ผ่าน admit หลุดไปแล้ว"""
+        with self.lock:
+            usage = self.ips.get(ip)
+            if usage is None:
+                return
+            self.players -= 1
+            usage.players -= 1
+            usage.sockets.discard(sock)
+            if not usage.players and usage.connects.full():
+                del self.ips[ip]
+            elif usage.sockets:
+                self._pace(usage)
+
+    def prune(self):
+        """ลืม IP ที่ไม่มีผู้เล่นแล้วและ bucket การเชื่อมต่อเต็มแล้ว (เรียกจาก Health Checker)"""
+        with self.lock:
+            for ip in [ip for ip, usage in self.ips.items() if not usage.players and usage.connects.full()]:
+                del self.ips[ip]
+
+    def bucket(self, direction, ip=None):
+        """bucket ของทิศทาง 'to_host'/'to_peer' ของทั้งอุโมงค์ (ip=None) หรือของ IP ที่ผ่าน admit แล้ว"""
+        if ip is None:
+            return getattr(self, direction)
+        usage = self.ips.get(ip)
+        return getattr(usage, direction) if usage is not None else None
+
+    def buffer_cap(self, ip, cap):
+        """เพดานบัฟเฟอร์ขาออกของผู้เล่น 1 คน: cap หรือส่วนแบ่งของ max_buffered / ip_max_buffered ถ้าน้อยกว่า"""
+        values = self.values
+        if values.get('max_buffered'):
+            cap = min(cap, values['max_buffered'] // max(1, self.players))
+        if values.get('ip_max_buffered'):
+            usage = self.ips.get(ip)
+            cap = min(cap, values['ip_max_buffered'] // max(1, usage.players if usage is not None else 1))
+        return cap
+
+def forward_from_peer_to_host(session):
+    """
+    อ่านข้อมูลจากผู้เล่น (Peer), ใส่ Header, แล้วส่งไปให้ Host ผ่านอุโมงค์
+    [แก้ไข] ส่งผ่าน tunnel.send_to_host แทน writer ตรงๆ เพื่อให้รอ Host ที่กำลัง RESUME ได้
+    [ใหม่] นับ Frame/bytes/ขนาดลงตัวนับของ Thread นี้เอง (ไม่มี lock ต่อ Frame)
+    [ใหม่] เกิน to_host_rate ของอุโมงค์หรือของ IP ผู้เล่น: หยุดอ่านผู้เล่นคนนี้ชั่วคราว (เบิก token เป็นก้อนผ่าน RateGrant)
+    [แก้ไข] ขนาด recv ปรับตาม ReadSizer แทน 4096 คงที่: ผู้เล่นที่โอนก้อนใหญ่ได้ Frame ละไม่เกิน PEER_READ_MAX_BYTES
+    [แก้ไข] รับ PeerSession แทนค่าแยกกัน: recv แบบไม่ block ก่อน ถ้ายังไม่มีข้อมูลจึงรอด้วย poll ได้ไม่เกิน PEER_PARK_AFTER
+    เงียบเกินนั้น = จอดผู้เล่นไว้ใน PeerParker แล้วจบ Thread นี้ (ผู้เล่นที่ส่งต่อเนื่องไม่เสีย syscall เพิ่ม)
+    [ใหม่] ระหว่าง profile (frame_timings): read = recv ที่ได้ข้อมูล (ไม่รวมเวลารอใน poll), lock = รอ lock/คิวของ TunnelWriter,
+    send = send_to_host ทั้งหมด (บีบอัด + lock + เข้าคิว)
+    """
+    tunnel, peer_conn, player_id, sizer, grant = session.tunnel, session.conn, session.player_id, session.sizer, session.grant
+    metrics = tunnel.track_metrics('to_host')
+    park_after = PEER_PARK_AFTER if _MSG_DONTWAIT else 0
+    flags = _MSG_DONTWAIT if park_after else 0
+    poller = None
     try:
         while True:
-            data = peer_conn.recv(4096)
+            timings = frame_timings
+            if timings is not None:
+                read_at = time.perf_counter()
+            try:
+                data = peer_conn.recv(sizer.size, flags)
+            except BlockingIOError:
+                if poller is None:
+                    poller = select.poll()
+                    poller.register(peer_conn, select.POLLIN)
+                if poller.poll(park_after * 1000):
+                    continue
+                with tunnel.players_lock:
+                    if player_id not in tunnel.players:
+                        break # ถูกตัดไปแล้วระหว่างรอ
+                    tunnel.parked_players.add(player_id)
+                peer_parker.park(session)
+                return
             if not data:
                 break
-            header = struct.pack('!II', player_id, len(data))
-            host_conn.sendall(header + data)
+            sizer.update(len(data))
+            metrics.frames += 1
+            metrics.bytes += len(data)
+            metrics.sizes.observe(len(data))
+            if frame_capture is not None:
+                frame_capture.record(tunnel.capture_id, CAPTURE_TO_HOST, player_id, data)
+            if timings is not None:
+                sent_at = time.perf_counter()
+                timings.record('to_host', 'read', sent_at - read_at)
+                tunnel.send_to_host(player_id, data, lock_timing=timings.stage('to_host', 'lock'))
+                timings.record('to_host', 'send', time.perf_counter() - sent_at)
+            else:
+                tunnel.send_to_host(player_id, data)
+            delay = grant.spend(len(data))
+            if delay:
+                count_event('limit_throttled_ms', int(delay * 1000))
+                time.sleep(delay)
     except (ConnectionResetError, BrokenPipeError, OSError):
         pass
     finally:
-        print(f"[Player {player_id}] Disconnected.")
-        with players_lock:
-            if player_id in players:
-                del players[player_id]
-        try:
-            # แจ้งให้ Host รู้ว่าผู้เล่นคนนี้หลุดการเชื่อมต่อแล้ว (ส่งข้อมูลความยาว 0)
-            header = struct.pack('!II', player_id, 0)
-            host_conn.sendall(header)
-        except (ConnectionResetError, BrokenPipeError, OSError):
-            pass
-        peer_conn.close()
+        tunnel.retire_metrics(metrics)
+    session.finish()
 
-def forward_from_host_to_peers(host_conn, players, players_lock):
-    """อ่านข้อมูลจาก Host, แกะ Header, แล้วส่งไปให้ผู้เล่น (Peer) ที่ถูกต้อง"""
+def forward_from_host_to_peers(stripe, tunnel):
+    """
+    อ่านข้อมูลจาก Host, แกะ Header, แล้วส่งไปให้ผู้เล่น (Peer) ที่ถูกต้อง
+    [แก้ไข] เมื่อ Host หลุดจะปิดแค่การเชื่อมต่อของ Host ผู้เล่นยังอยู่ในอุโมงค์ (Tunnel ตัดสินใจเองว่าจะปิดเมื่อไร)
+    [แก้ไข] อ่านทีละ stripe: Host อาจต่อเข้ามาหลายเส้น แต่ละเส้นมี Thread อ่านของตัวเอง
+    [ใหม่] relay delay ขาไปผู้เล่นคือเวลาตั้งแต่แกะ Frame ได้จนส่งเข้า socket/คิวของผู้เล่นเสร็จ
+    ส่วนขาไป Host ใช้เวลาในคิวของ TunnelWriter ของเส้นนี้
+    [ใหม่] เกิน to_peer_rate ของอุโมงค์: หยุดอ่านเส้นนี้ชั่วคราว (Host ถูกชะลอด้วย TCP แทนการสะสมข้อมูลใน relay)
+    [ใหม่] ระหว่าง profile (frame_timings): read = รอ + แกะ Frame ถัดไปจาก decoder (socket แบบ block จึงรวมเวลาที่ Host เงียบ),
+    lock = players_lock, send = outbound.put (ส่งตรงหรือเข้าคิวของผู้เล่น)
+    """
+    decoder = FrameDecoder(stripe.conn)
+    decompressor = stripe.decompressor
+    to_peer = tunnel.track_metrics('to_peer')
+    to_host = tunnel.track_metrics('to_host', delays=stripe.writer.flush_delays)
+    grant = RateGrant(tunnel.limits.bucket('to_peer'))
+    read_at = None
     try:
-        while True:
-            header_buffer = b''
-            while len(header_buffer) < 8:
-                packet = host_conn.recv(8 - len(header_buffer))
-                if not packet:
-                    header_buffer = None
-                    break
-                header_buffer += packet
-            
-            if not header_buffer:
-                break
-
-            player_id, length = struct.unpack('!II', header_buffer)
-            
-            data = b''
-            if length > 0:
-                while len(data) < length:
-                    chunk = host_conn.recv(length - len(data))
-                    if not chunk:
-                        raise ConnectionError("Host connection lost while reading data payload.")
-                    data += chunk
-
-            with players_lock:
-                if player_id in players:
-                    players[player_id].sendall(data)
+        # [แก้ไข] ใช้ FrameDecoder (recv_into + บัฟเฟอร์ที่จองไว้) แทนการต่อ bytes ทีละก้อน
+        for player_id, payload in decoder.frames():
+            timings = frame_timings
+            if timings is not None and read_at is not None:
+                timings.record('to_peer', 'read', time.perf_counter() - read_at)
+            stripe.frames_from_host += 1
+            stripe.bytes_from_host += len(payload)
+            if player_id == HEARTBEAT_PLAYER_ID:
+                if payload == HEARTBEAT_PING:
+                    stripe.writer.send_frame(HEARTBEAT_PLAYER_ID, HEARTBEAT_PONG)
+                continue
+            started = time.monotonic()
+            if decoder.flags:
+                # [ใหม่] Frame ที่ถูกบีบอัด (หรือสัญญาณเริ่ม stream ใหม่) จาก Host
+                if decompressor is None:
+                    raise ValueError("Host sent a compressed frame without negotiating compression.")
+                payload = decompressor.decompress(player_id, payload, decoder.flags)
+            if frame_capture is not None:
+                frame_capture.record(tunnel.capture_id, CAPTURE_TO_PEER, player_id, payload)
+            # [แก้ไข] ถือ lock แค่ตอนค้นหาผู้เล่น แล้วใส่ข้อมูลเข้าคิวขาออกของผู้เล่นนั้นแทนการ sendall ตรงๆ
+            if timings is not None:
+                locked_at = time.perf_counter()
+            with tunnel.players_lock:
+                outbound = tunnel.players.get(player_id)
+            if timings is not None:
+                sent_at = time.perf_counter()
+                timings.record('to_peer', 'lock', sent_at - locked_at)
+            if outbound is not None and payload:
+                outbound.put(payload)
+                if timings is not None:
+                    timings.record('to_peer', 'send', time.perf_counter() - sent_at)
+                to_peer.frames += 1
+                to_peer.bytes += len(payload)
+                to_peer.sizes.observe(len(payload))
+                to_peer.delays.observe(time.monotonic() - started)
+                delay = grant.spend(len(payload))
+                if delay:
+                    count_event('limit_throttled_ms', int(delay * 1000))
+                    time.sleep(delay)
+            read_at = time.perf_counter() if timings is not None else None
+    except socket.timeout:
+        count_event('host_heartbeat_timeouts')
+        print(f"[Host Tunnel] No heartbeat for {HEARTBEAT_INTERVAL * HEARTBEAT_MISSES}s. Dropping the connection.")
     except (ConnectionResetError, BrokenPipeError, OSError, ConnectionError) as e:
         print(f"[Host Tunnel] Connection lost: {e}")
+    except ValueError as e:
+        print(f"[Host Tunnel] Bad frame from Host: {e}")
     finally:
-        with players_lock:
-            for player_id, peer_conn in players.items():
-                peer_conn.close()
-            players.clear()
-        host_conn.close()
-
-def manage_public_port(public_port):
-    """จัดการ Public Port ที่จองไว้ รอรับ Host 1 คน และผู้เล่นหลายๆ คน"""
-    print(f"[*] Port Manager for {public_port} is running.")
+        stripe.writer.close()
+        stripe.conn.close()
+        tunnel.retire_metrics(to_peer)
+        tunnel.retire_metrics(to_host)
+
+class DirectLink:
+    """
+    [ใหม่] ผู้เล่น 1 คนในโหมด direct (Thread engine): socket ของผู้เล่นคู่กับการเชื่อมต่อข้อมูลที่ Host เปิดมาให้คนนี้โดยเฉพาะ
+    ข้อมูลไม่มี Frame และไม่ผ่าน Python: แต่ละทิศทางคือ SplicePump ใน Thread ของตัวเอง
+    (Thread ของผู้เล่นย้ายขาไป Host, Thread ที่รับคำสั่ง DATA ย้ายขาไปผู้เล่น) ทิศทางที่จบหลังสุดปิดทั้งสอง socket
+    """
+    __slots__ = ('peer_conn', 'player_id', 'peer_ip', 'data_conn', 'ready', 'running', 'lock')
+
+    def __init__(self, peer_conn, player_id, peer_ip):
+        self.peer_conn = peer_conn
+        self.player_id = player_id
+        self.peer_ip = peer_ip
+        self.data_conn = None # ถูกตั้งภายใต้ players_lock ของอุโมงค์เมื่อ Host เปิดมาทันเวลา
+        self.ready = threading.Event()
+        self.running = 2 # จำนวนทิศทางที่ยังไม่จบ
+        self.lock = threading.Lock()
+
+    def relay(self, tunnel, direction, grant):
+        """ย้ายข้อมูลทิศทาง 'to_host' หรือ 'to_peer' จน EOF (ส่ง EOF ต่อด้วย shutdown) หรือ socket เสีย (ตัดทั้งคู่)"""
+        src, dst = (self.peer_conn, self.data_conn) if direction == 'to_host' else (self.data_conn, self.peer_conn)
+        metrics = tunnel.track_metrics(direction)
+        pump = SplicePump(src, dst)
+        try:
+            while not pump.done:
+                moved = pump.pump()
+                if not moved:
+                    continue
+                metrics.frames += 1
+                metrics.bytes += moved
+                metrics.sizes.observe(moved)
+                delay = grant.spend(moved)
+                if delay:
+                    count_event('limit_throttled_ms', int(delay * 1000))
+                    time.sleep(delay)
+            dst.shutdown(socket.SHUT_WR) # อีกทิศทางยังส่งต่อได้จนกว่าจะ EOF เอง
+        except OSError:
+            _shutdown_quietly(self.peer_conn)
+            _shutdown_quietly(self.data_conn)
+        finally:
+            pump.close()
+            tunnel.retire_metrics(metrics)
+            with self.lock:
+                self.running -= 1
+                last = self.running == 0
+            if last:
+                self.peer_conn.close()
+                self.data_conn.close()
+                tunnel.drop_direct(self)
+
+    def close(self):
+        """ตัดทั้งสองฝั่ง (Thread ที่ splice ค้างอยู่จะตื่นและปิด socket เอง ผู้เล่นที่ยังรอ Host ก็ตื่นด้วย)"""
+        self.ready.set()
+        _shutdown_quietly(self.peer_conn)
+        if self.data_conn is not None:
+            _shutdown_quietly(self.data_conn)
+
+class HostStripe:
+    """
+    [ใหม่] การเชื่อมต่อ 1 เส้นจาก Host: อุโมงค์หนึ่งมีได้หลายเส้นเพื่อไม่ให้แพ็กเก็ตที่หายบนเส้นเดียว
+    (TCP head-of-line blocking) หรือผู้เล่นที่โหลดหนักคนเดียวถ่วงผู้เล่นทุกคน
+    ผู้เล่นแต่ละคนถูก pin ไว้กับเส้นเดียว ข้อมูลของผู้เล่นคนนั้นจึงยังเรียงลำดับเหมือนเดิม
+    """
+    __slots__ = ('conn', 'index', 'writer', 'decompressor', 'pinned_players', 'frames_from_host', 'bytes_from_host')
+
+    def __init__(self, conn, index, reply=b'', compressed=False, heartbeat=False):
+        self.conn = conn
+        self.index = index
+        # [ใหม่] Host ที่ตกลง heartbeat ส่ง PING ทุก HEARTBEAT_INTERVAL: recv ที่เงียบเกินกำหนดแปลว่าเส้นตาย
+        # (timeout นี้มีผลกับ sendmsg ของ TunnelWriter ด้วย: ส่งไม่ออกเลยนานขนาดนั้นก็ถือว่าตายเหมือนกัน)
+        if heartbeat:
+            conn.settimeout(HEARTBEAT_INTERVAL * HEARTBEAT_MISSES)
+        set_keepalive(conn, TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, TCP_KEEPALIVE_COUNT)
+        set_socket_buffers(conn, SOCKET_BUFFERS.get('tunnel'))
+        self.writer = TunnelWriter(conn, TUNNEL_FLUSH_WINDOW_US, quantum=FAIR_QUANTUM, batch_bytes=FAIR_BATCH_BYTES,
+                                   player_max_bytes=FAIR_PLAYER_MAX_BYTES)
+        # stream ของผู้เล่นฝั่งรับผูกกับเส้น: เส้นใหม่ของ Client เริ่ม stream ใหม่เสมอ
+        self.decompressor = FrameDecompressor() if compressed else None
+        if reply:
+            self.writer.send_bytes(reply) # คำตอบ Control ต้องมาก่อน Frame แรกของเส้นนี้
+        self.pinned_players = 0
+        self.frames_from_host = 0 # นับโดย Thread อ่านของเส้นนี้เพียง Thread เดียว
+        self.bytes_from_host = 0
+
+    def load_summary(self):
+        return (f"#{self.index}: players={self.pinned_players} "
+                f"to_host={self.writer.frames_written}f/{self.writer.bytes_written}B "
+                f"from_host={self.frames_from_host}f/{self.bytes_from_host}B "
+                f"queued={self.writer.pending_bytes}B")
+
+class Tunnel:
+    """
+    [ใหม่] สถานะของอุโมงค์ 1 อัน: Host 1 คน + ผู้เล่นหลายคน แยกออกมาจาก listener
+    ใช้ร่วมกันทั้งโหมด Port ละอุโมงค์ (manage_public_port) และโหมด Shared Port ที่ route ด้วย token
+
+    [ใหม่] เมื่อ Host หลุด อุโมงค์จะค้างไว้ HOST_RESUME_GRACE วินาที (ผู้เล่นยังเชื่อมต่ออยู่
+    และข้อมูลจากผู้เล่นจะรอ) ถ้า Host ส่ง "RESUME secret=..." มาทาง Control Port ทันเวลา
+    การเชื่อมต่อนั้นจะกลายเป็น Host คนใหม่ของอุโมงค์เดิม
+
+    [ใหม่] Host เปิดการเชื่อมต่อเพิ่มได้ด้วย "STRIPE secret=..." (สูงสุด max_stripes เส้น)
+    ผู้เล่นใหม่ถูก pin กับเส้นตาม STRIPE_PIN_POLICY ถ้าเส้นนั้นหลุด ผู้เล่นจะถูกย้ายไปเส้นอื่นเมื่อส่งข้อมูลครั้งถัดไป
+    """
+    __slots__ = ('name', 'capture_id', 'secret', 'resumable', 'max_stripes', 'compressor', 'heartbeat', 'direct',
+                 'players', 'parked_players', 'direct_links', 'players_lock', 'player_id_generator', 'ports', 'stripes',
+                 'player_stripes', 'stripe_index', 'host_generation', 'host_cond', 'closed', 'peer_accepts',
+                 'metrics_lock', 'live_metrics', 'retired_metrics', 'limits', 'close_waker')
+
+    def __init__(self, name, resumable=True):
+        self.name = name # ใช้แสดงใน log: เลข Public Port หรือ tunnel token
+        self.capture_id = frame_capture.add_tunnel(name) if frame_capture is not None else 0
+        self.secret = new_lease_secret()
+        self.resumable = resumable # Client รุ่นเก่าไม่รู้จัก secret จึง RESUME ไม่ได้
+        self.max_stripes = 1 # ถูกตั้งตามที่ Client ขอในคำสั่ง PORT/TUNNEL
+        self.compressor = None # [ใหม่] FrameCompressor เมื่อตกลงบีบอัดกับ Client แล้ว
+        self.heartbeat = False # [ใหม่] Host ตกลงส่ง PING แล้ว (ถูกตั้งตามคำสั่ง PORT/TUNNEL)
+        self.direct = False # [ใหม่] Host ตกลงเปิดการเชื่อมต่อข้อมูลแยกต่อผู้เล่น (ถูกตั้งตามคำสั่ง PORT/TUNNEL)
+        self.players = {}
+        self.parked_players = set() # [ใหม่] player_id ที่จอดอยู่ใน PeerParker (แก้ภายใต้ players_lock)
+        self.direct_links = {} # [ใหม่] {player_id: DirectLink} ผู้เล่นโหมด direct (แก้ภายใต้ players_lock)
+        self.players_lock = threading.Lock()
+        self.player_id_generator = itertools.count(1)
+        self.ports = [name] if isinstance(name, int) else [] # [ใหม่] Public Port ของแต่ละ service (ลำดับ = service)
+        self.stripes = [] # HostStripe ที่ยังเชื่อมต่ออยู่ (ว่าง = ไม่มี Host)
+        self.player_stripes = {} # {player_id: HostStripe} เส้นที่ผู้เล่นแต่ละคนถูก pin ไว้
+        self.stripe_index = itertools.count()
+        self.host_generation = 0 # เพิ่มทุกครั้งที่มี Host ต่อเข้ามา (ครั้งแรกหรือ RESUME)
+        self.host_cond = threading.Condition()
+        self.closed = threading.Event()
+        self.peer_accepts = 0 # [ใหม่] จำนวนผู้เล่นที่เคยเข้ามา (แก้ภายใต้ players_lock)
+        self.metrics_lock = threading.Lock() # ใช้ตอนเริ่ม/จบ Thread และตอน scrape เท่านั้น
+        self.live_metrics = [] # DirectionMetrics ที่ยังมี Thread เขียนอยู่
+        self.retired_metrics = {'to_host': DirectionMetrics('to_host'), 'to_peer': DirectionMetrics('to_peer')}
+        self.limits = TunnelLimits(TUNNEL_LIMITS) # [ใหม่] แก้ได้ระหว่างทำงานด้วยคำสั่ง LIMIT
+        self.close_waker = None # [ใหม่] socket ที่ close() shutdown เพื่อปลุก selector ของ manage_public_port
+
+    def attach_host(self, host_conn, reply=b''):
+        """
+        ผูกการเชื่อมต่อของ Host เข้ากับอุโมงค์ (ครั้งแรกหรือ RESUME) คืนค่า False ถ้าอุโมงค์ปิดไปแล้ว
+        ถ้ายังมี Host เดิมค้างอยู่ (Server ยังไม่รู้ว่าหลุด) จะตัด Host เดิมทิ้งทุกเส้น
+        reply คือคำตอบ Control ที่จะถูกส่งเป็นอย่างแรกของเส้นใหม่ หลังจากผูกเส้นเสร็จแล้ว
+        """
+        with self.host_cond:
+            if self.closed.is_set():
+                return False
+            old_stripes = self.stripes
+            for stripe in old_stripes:
+                # ปิด writer เดิมก่อนเพื่อให้ผู้เล่นย้ายไปเส้นใหม่ ไม่ส่งข้อมูลลงเส้นที่กำลังจะถูกตัด
+                stripe.writer.close()
+            self.stripes = [HostStripe(host_conn, next(self.stripe_index), reply, self.compressor is not None, self.heartbeat)]
+            self.host_generation += 1
+            self.host_cond.notify_all()
+        for stripe in old_stripes:
+            _shutdown_quietly(stripe.conn)
+        return True
+
+    def add_stripe(self, host_conn, reply=b''):
+        """[ใหม่] เพิ่มการเชื่อมต่อเสริมของ Host คืนค่า False ถ้ายังไม่มี Host, อุโมงค์ปิดแล้ว หรือครบจำนวนแล้ว"""
+        with self.host_cond:
+            if self.closed.is_set() or not self.stripes or len(self.stripes) >= self.max_stripes:
+                return False
+            self.stripes.append(HostStripe(host_conn, next(self.stripe_index), reply, self.compressor is not None,
+                                           self.heartbeat))
+            self.host_cond.notify_all()
+        return True
+
+    def serve_host(self, host_conn):
+        """อ่านข้อมูลจาก Host เส้นนี้จนกว่าจะหลุด (block จนจบ) ถ้าเป็นเส้นสุดท้ายจะเริ่มช่วงรอ RESUME หรือปิดอุโมงค์"""
+        with self.host_cond:
+            stripe = next((s for s in self.stripes if s.conn is host_conn), None)
+        if stripe is None:
+            return
+        forward_from_host_to_peers(stripe, self)
+
+        with self.host_cond:
+            if stripe not in self.stripes:
+                return # ถูกแทนที่ด้วย Host คนใหม่ที่ RESUME เข้ามาแล้ว
+            self.stripes.remove(stripe)
+            self.host_cond.notify_all()
+            if self.stripes:
+                return # ยังมีเส้นอื่นอยู่ ผู้เล่นของเส้นนี้จะถูกย้ายเมื่อส่งข้อมูลครั้งถัดไป
+            generation = self.host_generation
+
+        if self.resumable and HOST_RESUME_GRACE > 0 and not self.closed.is_set():
+            print(f"[{self.name}] Host disconnected. Keeping players for {HOST_RESUME_GRACE}s while waiting for RESUME...")
+            grace_timer = threading.Timer(HOST_RESUME_GRACE, self._expire_host, args=(generation,))
+            grace_timer.daemon = True
+            grace_timer.start()
+        else:
+            self.close()
+
+    def _expire_host(self, generation):
+        with self.host_cond:
+            if self.stripes or self.host_generation != generation:
+                return
+        print(f"[{self.name}] Host did not resume within {HOST_RESUME_GRACE}s.")
+        self.close()
+
+    def _pin_player(self, player_id):
+        """เลือกเส้นให้ผู้เล่น (ต้องถือ host_cond อยู่) คืนค่า None ถ้าไม่มีเส้นที่ใช้ได้"""
+        live = [stripe for stripe in self.stripes if not stripe.writer.closed]
+        if not live:
+            return None
+        if STRIPE_PIN_POLICY == 'hash':
+            stripe = live[player_id % len(live)]
+        else:
+            stripe = min(live, key=lambda s: (s.pinned_players, s.writer.pending_bytes))
+        old = self.player_stripes.get(player_id)
+        if old is not None:
+            old.pinned_players -= 1
+            old.writer.forget(player_id)
+            if self.compressor is not None:
+                self.compressor.forget(player_id) # ฝั่ง Client ของเส้นใหม่ไม่มี stream เดิม
+        stripe.pinned_players += 1
+        self.player_stripes[player_id] = stripe
+        if FAIR_SERVICE_WEIGHTS:
+            stripe.writer.set_weight(player_id, FAIR_SERVICE_WEIGHTS.get(service_of(player_id), 1))
+        return stripe
+
+    def send_to_host(self, player_id, data, wait=True, lock_timing=None):
+        """
+        ส่ง Frame ไปยัง Host ผ่านเส้นที่ผู้เล่นถูก pin ไว้
+        ถ้า Host หลุดหมดทุกเส้น (กำลัง RESUME) จะรอจนกว่า Host คนใหม่จะมาหรืออุโมงค์ปิด
+        raise BrokenPipeError เมื่ออุโมงค์ปิดแล้ว
+        [ใหม่] wait=False: raise BrokenPipeError ทันทีถ้าไม่มี Host (ใช้กับ datagram ที่ทิ้งได้)
+        [ใหม่] wait=False คืนค่า False (ทิ้ง datagram) ถ้าคิวของผู้เล่นคนนี้บนเส้นเต็ม (เช็คก่อนบีบอัด stream จึงไม่เสีย)
+        [ใหม่] lock_timing: ส่งต่อให้ TunnelWriter.send_frame (เวลารอ lock/คิวของเส้น ระหว่าง profile)
+        """
+        while True:
+            stripe = self.player_stripes.get(player_id)
+            if stripe is None or stripe.writer.closed:
+                with self.host_cond:
+                    stripe = self._pin_player(player_id)
+            if stripe is not None:
+                if not wait and not stripe.writer.has_room(player_id):
+                    return False
+                payload, flags = self.compressor.compress(player_id, data) if self.compressor else (data, 0)
+                try:
+                    stripe.writer.send_frame(player_id, payload, flags, wait=wait, lock_timing=lock_timing)
+                    return True
+                except BrokenPipeError:
+                    continue # เส้นนี้เพิ่งหลุด ลองเลือกเส้นใหม่ (stream จะถูกเริ่มใหม่ตอน pin)
+            if not wait:
+                raise BrokenPipeError("Host is not connected.")
+            with self.host_cond:
+                while not self.closed.is_set() and all(s.writer.closed for s in self.stripes):
+                    self.host_cond.wait()
+                if self.closed.is_set():
+                    raise BrokenPipeError("Tunnel is closed.")
+
+    def remove_player(self, player_id):
+        """ส่งสัญญาณผู้เล่นหลุดไปยังเส้นที่ผู้เล่นถูก pin ไว้ (ไม่รอ Host ที่กำลัง RESUME) แล้วยกเลิกการ pin"""
+        if frame_capture is not None:
+            frame_capture.record(self.capture_id, CAPTURE_TO_HOST, player_id)
+        with self.host_cond:
+            stripe = self.player_stripes.pop(player_id, None)
+            if stripe is not None:
+                stripe.pinned_players -= 1
+        if self.compressor is not None:
+            self.compressor.forget(player_id)
+        if stripe is not None:
+            stripe.writer.forget(player_id)
+            if stripe.decompressor is not None:
+                stripe.decompressor.forget(player_id)
+            try:
+                stripe.writer.send_frame(player_id, wait=False) # ต่อท้ายคิวของผู้เล่นเอง: ออกหลังข้อมูลที่ค้างเสมอ
+            except BrokenPipeError:
+                pass # Host คนใหม่ไม่รู้จักผู้เล่นคนนี้อยู่แล้ว
+
+    def admit_peer(self, peer_conn, peer_addr):
+        """[ใหม่] ตรวจขีดจำกัดก่อนรับผู้เล่น (ก่อนเริ่ม Thread ของผู้เล่น) ถ้าเกินจะปิดการเชื่อมต่อทันทีแล้วคืนค่า False"""
+        reason = self.limits.admit(peer_addr[0], peer_conn)
+        if reason is None:
+            return True
+        count_event('limit_rejected_peers')
+        peer_log(f"[{self.name}] Rejected peer {peer_addr}: {reason}")
+        peer_conn.close()
+        return False
+
+    def new_player_id(self, service=0):
+        """[ใหม่] player_id ถัดไปของผู้เล่นที่เข้ามาทาง Public Port ลำดับ service (เลขผู้เล่นนับต่อกันทุก service)"""
+        return service_player_id(service, next(self.player_id_generator))
+
+    def serve_peer(self, peer_conn, peer_addr, service=0):
+        """ลงทะเบียนผู้เล่นที่ผ่าน admit_peer แล้ว และส่งต่อข้อมูลของผู้เล่นไปยัง Host (block จนผู้เล่นหลุด)"""
+        player_id = self.new_player_id(service)
+        peer_log(f"[{self.name}] Peer connected: {peer_addr}, assigned ID: {player_id}")
+        set_keepalive(peer_conn, TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, TCP_KEEPALIVE_COUNT)
+        set_socket_buffers(peer_conn, SOCKET_BUFFERS.get('peer'))
+        with self.players_lock:
+            self.peer_accepts += 1
+        relayed = True # relay_direct ที่ raise ออกมาก็ต้องคืน limits เหมือนผู้เล่น direct ที่จบแล้ว
+        try:
+            relayed = self.direct and self.relay_direct(peer_conn, player_id, peer_addr[0])
+        finally:
+            if relayed:
+                self.limits.release(peer_addr[0], peer_conn)
+        if relayed:
+            return
+        # [แก้ไข] ตั้งแต่นี้ PeerSession เป็นเจ้าของ socket และคืน limits เองตอนผู้เล่นหลุด (อาจเป็นคนละ Thread กับตอนนี้)
+        with self.players_lock:
+            self.players[player_id] = PeerOutbound(peer_conn, player_id, limits=self.limits, ip=peer_addr[0])
+        forward_from_peer_to_host(PeerSession(self, peer_conn, player_id, peer_addr[0]))
+
+    def relay_direct(self, peer_conn, player_id, peer_ip):
+        """
+        [ใหม่] ขอให้ Host เปิดการเชื่อมต่อข้อมูลของผู้เล่นคนนี้ (OPEN บน player_id 0) แล้วย้ายขาไป Host ด้วย splice (block จนจบ)
+        คืนค่า False ถ้า Host ไม่เปิดมาภายใน DIRECT_OPEN_TIMEOUT: ยังไม่ได้อ่านอะไรจากผู้เล่น จึงใช้อุโมงค์แบบ Frame ต่อได้เลย
+        """
+        link = DirectLink(peer_conn, player_id, peer_ip)
+        with self.players_lock:
+            self.direct_links[player_id] = link
+        if self.send_control(format_control_line(DIRECT_OPEN, player=player_id)):
+            link.ready.wait(DIRECT_OPEN_TIMEOUT)
+        with self.players_lock:
+            if link.data_conn is None:
+                del self.direct_links[player_id]
+                if not self.closed.is_set():
+                    count_event('direct_fallbacks')
+                    peer_log(f"[Player {player_id}] Host did not open a direct connection. Using the tunnel.")
+                return False
+        count_event('direct_links')
+        peer_log(f"[Player {player_id}] Direct connection established.")
+        link.relay(self, 'to_host', RateGrant(self.limits.bucket('to_host'), self.limits.bucket('to_host', peer_ip)))
+        return True
+
+    def serve_direct(self, data_conn, player_id, reply):
+        """
+        [ใหม่] รับการเชื่อมต่อข้อมูลจากคำสั่ง DATA: ตอบ OK แล้ว Thread นี้ย้ายขาไปผู้เล่นจนจบ (ปิด data_conn เอง)
+        คืนค่า False ถ้าไม่มีผู้เล่นคนนี้รออยู่ (หมดเวลาแล้วหรือหลุดไปแล้ว)
+        """
+        data_conn.setblocking(True)
+        with self.players_lock:
+            link = self.direct_links.get(player_id)
+            if link is None or link.data_conn is not None or self.closed.is_set():
+                return False
+            link.data_conn = data_conn
+        set_keepalive(data_conn, TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, TCP_KEEPALIVE_COUNT)
+        set_socket_buffers(data_conn, SOCKET_BUFFERS.get('tunnel'))
+        try:
+            data_conn.sendall(reply)
+        except OSError:
+            link.close()
+        link.ready.set()
+        link.relay(self, 'to_peer', RateGrant(self.limits.bucket('to_peer'), self.limits.bucket('to_peer', link.peer_ip)))
+        return True
+
+    def drop_direct(self, link):
+        peer_log(f"[Player {link.player_id}] Disconnected.")
+        with self.players_lock:
+            if self.direct_links.get(link.player_id) is link:
+                del self.direct_links[link.player_id]
+
+    def send_control(self, payload):
+        """[ใหม่] ส่งบรรทัดคำสั่งบน player_id 0 ของเส้นใดก็ได้ที่ยังอยู่ คืนค่า False ถ้าไม่มี Host (กำลัง RESUME)"""
+        with self.host_cond:
+            stripes = [stripe for stripe in self.stripes if not stripe.writer.closed]
+        for stripe in stripes:
+            try:
+                stripe.writer.send_frame(HEARTBEAT_PLAYER_ID, payload, wait=False)
+                return True
+            except BrokenPipeError:
+                continue
+        return False
+
+    def track_metrics(self, direction, delays=None):
+        """
+        [ใหม่] สร้างตัวนับชุดใหม่ให้ Thread ที่เรียก (Thread นั้นเป็นผู้เขียนคนเดียว) ต้องเรียก retire_metrics เมื่อจบ
+        delays: ใช้ histogram ที่มีอยู่แล้วแทน เช่น flush_delays ของ TunnelWriter
+        """
+        metrics = DirectionMetrics(direction)
+        if delays is not None:
+            metrics.delays = delays
+        with self.metrics_lock:
+            self.live_metrics.append(metrics)
+        return metrics
+
+    def retire_metrics(self, metrics):
+        """รวมตัวนับของ Thread ที่จบแล้วเข้ากับยอดสะสมของอุโมงค์"""
+        with self.metrics_lock:
+            self.live_metrics.remove(metrics)
+            self.retired_metrics[metrics.direction].add(metrics)
+
+    def metrics_totals(self):
+        """[ใหม่] ยอดรวมตัวนับทุกชุดแยกตามทิศทาง {direction: DirectionMetrics} (ค่าประมาณ ณ ขณะนั้น)"""
+        totals = {direction: DirectionMetrics(direction) for direction in self.retired_metrics}
+        with self.metrics_lock:
+            for metrics in itertools.chain(self.retired_metrics.values(), self.live_metrics):
+                totals[metrics.direction].add(metrics)
+        return totals
+
+    def queued_bytes(self):
+        """ข้อมูลที่ค้างอยู่ในคิวขาออกของผู้เล่นทุกคนรวมกัน"""
+        with self.players_lock:
+            outbounds = list(self.players.values())
+        return sum(getattr(outbound, 'queued_bytes', 0) for outbound in outbounds)
+
+    def memory_usage(self):
+        """
+        [ใหม่] bytes โดยประมาณที่อุโมงค์นี้ถืออยู่: object ของอุโมงค์และของผู้เล่นทุกคน ตารางผู้เล่น
+        และข้อมูลที่ค้างในคิวทั้งสองทิศทาง (ไม่รวม stack ของ Thread ดู thread_usage)
+        """
+        with self.players_lock:
+            players = list(self.players.values())
+            tables = (sys.getsizeof(self.players) + sys.getsizeof(self.parked_players) + sys.getsizeof(self.direct_links)
+                      + sys.getsizeof(self.player_stripes))
+        return (sys.getsizeof(self) + tables + sum(player.memory_usage() for player in players)
+                + sum(stripe.writer.pending_bytes for stripe in list(self.stripes)))
+
+    def thread_usage(self):
+        """[ใหม่] (Thread อ่านของผู้เล่น, Thread writer ของผู้เล่น, ผู้เล่นที่จอดอยู่ใน PeerParker) ณ ตอนนี้"""
+        with self.players_lock:
+            outbounds = [player for player in self.players.values() if type(player) is PeerOutbound]
+            parked = len(self.parked_players)
+        return len(outbounds) - parked, sum(outbound.writer_thread is not None for outbound in outbounds), parked
+
+    def host_queue_depths(self):
+        """[ใหม่] bytes ที่ผู้เล่นแต่ละคนมีค้างในคิวไป Host {player_id: bytes} (รวมทุกเส้น, เฉพาะคนที่มีค้าง)"""
+        with self.host_cond:
+            stripes = list(self.stripes)
+        depths = {}
+        for stripe in stripes:
+            depths.update(stripe.writer.queue_depths())
+        return depths
+
+    def stripe_summary(self):
+        """[ใหม่] สรุปโหลดของแต่ละเส้นสำหรับ Health Checker"""
+        with self.host_cond:
+            stripes = list(self.stripes)
+        return "; ".join(stripe.load_summary() for stripe in stripes)
+
+    def compression_summary(self):
+        """[ใหม่] อัตราส่วนและเวลา CPU ของการบีบอัดทั้งสองทิศทางสำหรับ Health Checker"""
+        with self.host_cond:
+            stripes = list(self.stripes)
+        return format_compression_stats(self.compressor.stats(), merge_decompressor_stats(stripes))
+
+    def close(self):
+        """ปิดอุโมงค์: ตัดผู้เล่นทุกคนและ Host (ถ้ายังอยู่) แล้วลบ lease"""
+        with self.host_cond:
+            if self.closed.is_set():
+                return
+            self.closed.set()
+            stripes, self.stripes = self.stripes, []
+            self.host_cond.notify_all()
+        if self.close_waker is not None:
+            _shutdown_quietly(self.close_waker) # ให้ manage_public_port คืน Port ทันที ไม่ต้องรอรอบ select ถัดไป
+        drop_lease(self)
+        with self.players_lock:
+            outbounds = list(self.players.values())
+            self.players.clear()
+            links = list(self.direct_links.values())
+        for outbound in outbounds:
+            outbound.close()
+        for link in links:
+            link.close()
+        for stripe in stripes:
+            stripe.writer.close()
+            _shutdown_quietly(stripe.conn)
+
+def merge_decompressor_stats(stripes):
+    """รวมตัวนับของ FrameDecompressor ทุกเส้นให้อยู่ในรูปเดียวกับ FrameDecompressor 1 ตัว"""
+    total = FrameDecompressor()
+    for stripe in stripes:
+        if stripe.decompressor is not None:
+            total.cpu_seconds += stripe.decompressor.cpu_seconds
+            total.wire_bytes += stripe.decompressor.wire_bytes
+            total.raw_bytes += stripe.decompressor.raw_bytes
+    return total
+
+def _shutdown_quietly(conn):
+    """shutdown socket เพื่อปลุก Thread ที่ recv ค้างอยู่ (ไม่สนใจถ้าปิดไปแล้ว)"""
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def bind_public_listener(public_port):
+    """[ใหม่] bind listener ของ Public Port ก่อนตอบ Client เพื่อไม่ให้ Host ต่อเข้ามาก่อน listener พร้อม"""
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
     try:
         listener.bind((SERVER_HOST, public_port))
     except OSError as e:
         print(f"[!] Critical error: Could not bind to port {public_port}. {e}")
         print(f"[!] This port might be in use by another process. Releasing it.")
+        listener.close()
         release_port(public_port) # พยายาม release port ถ้า bind ไม่ได้
-        return
+        return None
+    listener.listen(PEER_ACCEPT_BACKLOG) # [แก้ไข] backlog ลึกพอรับผู้เล่นที่ต่อกลับมาพร้อมกันหลังรีสตาร์ท
+    return listener
+
+def bind_udp_socket(public_port):
+    """[ใหม่] bind socket UDP ของ Public Port (โหมด UDP) ถ้าไม่สำเร็จจะคืน Port เข้า Pool แล้วคืนค่า None"""
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        udp_sock.bind((SERVER_HOST, public_port))
+    except OSError as e:
+        print(f"[!] Critical error: Could not bind UDP port {public_port}. {e}")
+        udp_sock.close()
+        release_port(public_port)
+        return None
+    return udp_sock
+
+class UdpRelay:
+    """
+    [ใหม่] รับ datagram ของผู้เล่นบน Public Port แบบ UDP (ทำงานใน Thread ของ Port Manager)
+    ตาราง sessions {(ip, port): UdpSession} แจก player_id ให้ต้นทางใหม่ แล้วส่ง 1 datagram เป็น 1 Frame
+    session ที่เงียบเกิน UDP_SESSION_IDLE_TIMEOUT ถูกลบโดย TimerWheel ใน loop เดียวกัน (ไม่มี Thread ต่อ flow)
+    [ใหม่] service: ลำดับของ Public Port นี้ในอุโมงค์ (อุโมงค์ที่มีหลาย service มี UdpRelay ต่อ Port)
+    """
+    def __init__(self, udp_sock, tunnel, service=0):
+        self.sock = udp_sock
+        self.tunnel = tunnel
+        self.service = service
+        self.sessions = {}
+        self.wheel = TimerWheel(UDP_SESSION_IDLE_TIMEOUT, UDP_WHEEL_TICK)
+
+    def serve(self):
+        """อ่าน datagram จนกว่าอุโมงค์จะปิด (block จนจบ)"""
+        self.sock.settimeout(UDP_WHEEL_TICK)
+        self.metrics = self.tunnel.track_metrics('to_host')
+        try:
+            self._serve()
+        finally:
+            self.tunnel.retire_metrics(self.metrics)
+
+    def _serve(self):
+        while not self.tunnel.closed.is_set():
+            try:
+                data, addr = self.sock.recvfrom(UDP_MAX_DATAGRAM)
+            except socket.timeout:
+                data = None
+            except ConnectionResetError:
+                continue # Windows: ICMP port unreachable จาก datagram ที่ส่งไปก่อนหน้า
+            except OSError:
+                break # socket ถูกปิดแล้ว
+            now = time.monotonic()
+            if data:
+                self._receive(data, addr, now)
+            for session in self.wheel.advance(now):
+                self._expire(session)
+
+    def _receive(self, data, addr, now):
+        session = self.sessions.get(addr)
+        if session is None:
+            if self.tunnel.limits.admit(addr[0]) is not None:
+                count_event('limit_rejected_peers') # ไม่ print: ต้นทางที่ถูกปฏิเสธยังส่ง datagram มาเรื่อยๆ
+                return
+            session = UdpSession(self.sock, addr, self.tunnel.new_player_id(self.service), self.tunnel.limits)
+            peer_log(f"[{self.tunnel.name}] UDP peer: {addr}, assigned ID: {session.player_id}")
+            count_event('udp_sessions_opened')
+            self.sessions[addr] = session
+            with self.tunnel.players_lock:
+                self.tunnel.players[session.player_id] = session
+                self.tunnel.peer_accepts += 1
+            self.wheel.schedule(session, now)
+        session.last_seen = now
+        self.metrics.frames += 1
+        self.metrics.bytes += len(data)
+        self.metrics.sizes.observe(len(data))
+        if frame_capture is not None:
+            frame_capture.record(self.tunnel.capture_id, CAPTURE_TO_HOST, session.player_id, data)
+        if not session.to_host.try_spend(len(data)):
+            count_event('limit_dropped_datagrams')
+            return
+        try:
+            if not self.tunnel.send_to_host(session.player_id, data, wait=False):
+                count_event('udp_dropped_datagrams') # คิวของผู้เล่นคนนี้ไป Host เต็ม
+        except BrokenPipeError:
+            count_event('udp_dropped_datagrams') # ไม่มี Host (กำลัง RESUME): datagram ทิ้งได้ ไม่ต้องรอ
 
-    listener.listen(10)
+    def _expire(self, session):
+        del self.sessions[session.addr]
+        peer_log(f"[Player {session.player_id}] UDP session idle for {UDP_SESSION_IDLE_TIMEOUT}s. Disconnected.")
+        count_event('udp_sessions_expired')
+        with self.tunnel.players_lock:
+            self.tunnel.players.pop(session.player_id, None)
+        self.tunnel.limits.release(session.addr[0])
+        self.tunnel.remove_player(session.player_id)
 
+def manage_public_port(public_port, listeners, tunnel, udp_socks=()):
+    """
+    จัดการ Public Port ที่จองไว้ รอรับ Host 1 คน และผู้เล่นหลายๆ คน
+    [ใหม่] udp_socks: Port แบบ UDP ผู้เล่นส่ง datagram มาที่ udp_socks ส่วน listener TCP ใช้รับ Host เท่านั้น
+    [แก้ไข] listeners/udp_socks มี 1 ตัวต่อ service ตามลำดับของ tunnel.ports (Host ต่อเข้ามาที่ตัวแรกเสมอ)
+    """
+    listener = listeners[0]
+    print(f"[*] Port Manager for {public_port} is running.")
     try:
         print(f"[{public_port}] Waiting for Host to establish tunnel...")
         # [แก้ไข] เพิ่ม timeout เพื่อไม่ให้ listener.accept() ค้างตลอดไปหากมีปัญหา
-        listener.settimeout(300) # 5 นาทีสำหรับรอ Host
+        listener.settimeout(HOST_WAIT_TIMEOUT)
         host_conn, host_addr = listener.accept()
         print(f"[{public_port}] Host tunnel established: {host_addr}")
         listener.settimeout(None) # ปิด timeout เมื่อเชื่อมต่อสำเร็จ
 
-        players = {}
-        players_lock = threading.Lock()
-        player_id_generator = itertools.count(1)
+        tunnel.attach_host(host_conn)
 
-        host_reader_thread = threading.Thread(target=forward_from_host_to_peers, args=(host_conn, players, players_lock))
+        host_reader_thread = threading.Thread(target=tunnel.serve_host, args=(host_conn,))
         host_reader_thread.start()
 
-        while host_reader_thread.is_alive():
-            try:
-                # [แก้ไข] ตั้ง timeout สำหรับการรอผู้เล่นใหม่ เพื่อให้ loop ไม่ block ตลอดไป
-                # และทำให้ thread สามารถจบการทำงานได้ถ้า host หลุดไปแล้ว
-                listener.settimeout(1.0)
-                peer_conn, peer_addr = listener.accept()
-                listener.settimeout(None)
-                
-                player_id = next(player_id_generator)
-                print(f"[{public_port}] Peer connected: {peer_addr}, assigned ID: {player_id}")
-                
-                with players_lock:
-                    players[player_id] = peer_conn
-                
-                peer_thread = threading.Thread(target=forward_from_peer_to_host, args=(peer_conn, host_conn, player_id, players_lock, players))
-                peer_thread.start()
+        if udp_socks:
+            # [ใหม่] โหมด UDP: Host กลับมาทาง RESUME บน Control Port จึงไม่ต้องเปิด listener ไว้อีก
+            listener.close()
+            for service, udp_sock in enumerate(udp_socks[1:], 1):
+                threading.Thread(target=UdpRelay(udp_sock, tunnel, service).serve, daemon=True).start()
+            UdpRelay(udp_socks[0], tunnel).serve()
 
-            except socket.timeout:
-                # ไม่เป็นไร แค่ไม่มีใครเชื่อมต่อเข้ามาใน 1 วินาที
-                # loop จะวนกลับไปเช็คว่า host_reader_thread ยังทำงานอยู่หรือไม่
-                continue
-            except OSError:
-                # Listener ถูกปิดแล้ว
-                break
+        # [แก้ไข] รับผู้เล่นต่อไปจนกว่าอุโมงค์จะปิด (รวมช่วงที่ Host หลุดและรอ RESUME)
+        # [แก้ไข] listener แบบ non-blocking + selector: ตื่น 1 ครั้งแล้วรับทุกคนที่รออยู่ใน backlog
+        # (ไม่ต้องสลับ settimeout ทุก accept) และตื่นทันทีที่ tunnel.close() shutdown close_waker
+        # Port ของ service อื่นเริ่มรับผู้เล่นหลัง Host ต่อเข้ามาแล้ว (ผู้เล่นที่มาก่อนรออยู่ใน backlog)
+        else:
+            waker_r, tunnel.close_waker = socket.socketpair()
+            with waker_r, tunnel.close_waker, selectors.DefaultSelector() as selector:
+                selector.register(waker_r, selectors.EVENT_READ, None)
+                for service, sock in enumerate(listeners):
+                    sock.setblocking(False)
+                    selector.register(sock, selectors.EVENT_READ, service)
+                # ตั้ง close_waker ก่อนเช็ค closed: close() ที่เกิดก่อนหน้านี้ถูกเห็นที่นี่ ส่วนที่เกิดทีหลังจะปลุก select
+                while not tunnel.closed.is_set():
+                    ready = selector.select()
+                    if any(key.data is None for key, _ in ready):
+                        break # อุโมงค์ปิดแล้ว
+                    if not all([accept_pending_peers(key.fileobj, tunnel, key.data) for key, _ in ready]):
+                        break # Listener ถูกปิดแล้ว
 
         host_reader_thread.join()
 
@@ -191,47 +1629,1918 @@ def manage_public_port(public_port):
     except Exception as e:
         print(f"[!] Critical error in Port Manager {public_port}: {e}")
     finally:
-        listener.close()
-        release_port(public_port) # <--- จุดสำคัญ: คืน Port เมื่อจบการทำงาน
+        for sock in (*listeners, *udp_socks):
+            sock.close()
+        tunnel.close()
+        for port in tunnel.ports:
+            release_port(port) # <--- จุดสำคัญ: คืน Port เมื่อจบการทำงาน
         print(f"[*] Port Manager for {public_port} has shut down.")
 
+def accept_pending_peers(listener, tunnel, service=0):
+    """
+    [ใหม่] รับผู้เล่นทุกคนที่รออยู่ใน backlog ของ listener (non-blocking) จนกว่าจะว่าง คืนค่า False ถ้า listener ถูกปิดแล้ว
+    งานบน accept path มีแค่นับ half-established, ตรวจขีดจำกัด และเริ่ม Thread ของผู้เล่น
+    """
+    while True:
+        try:
+            peer_conn, peer_addr = listener.accept()
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            if listener.fileno() == -1:
+                return False
+            accept_failed(e)
+            return True
+        peer_conn.setblocking(True) # ไม่ให้ขึ้นกับ OS ว่าจะสืบทอด non-blocking จาก listener หรือไม่
+        if not claim_pending_peer(peer_addr[0]):
+            count_event('pending_rejected_peers')
+            peer_conn.close()
+            continue
+        # [ใหม่] ผู้เล่นที่เกินขีดจำกัดของอุโมงค์ถูกปิดที่นี่ ไม่เสีย Thread
+        if not tunnel.admit_peer(peer_conn, peer_addr):
+            release_pending_peer(peer_addr[0])
+            continue
+        threading.Thread(target=serve_admitted_peer, args=(tunnel, peer_conn, peer_addr, service)).start()
 
-def main():
-    """ฟังก์ชันหลักของ Server ทำหน้าที่เป็นผู้แจก Port และเริ่ม Health Checker"""
-    # [ใหม่] เริ่ม Thread สำหรับ Health Checker
-    health_thread = threading.Thread(target=port_health_checker, daemon=True)
-    health_thread.start()
-    print("[+] Port health checker service started.")
+def serve_admitted_peer(tunnel, peer_conn, peer_addr, service=0):
+    """[ใหม่] Thread ของผู้เล่นที่ผ่าน admit แล้ว: ผู้เล่นตั้งตัวเสร็จ (ไม่นับเป็น half-established อีก) เมื่อ Thread นี้เริ่ม"""
+    release_pending_peer(peer_addr[0])
+    tunnel.serve_peer(peer_conn, peer_addr, service)
 
-    control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    control_socket.bind((SERVER_HOST, SERVER_CONTROL_PORT))
-    control_socket.listen(5)
-    print(f"[*] Server Control listening on {SERVER_HOST}:{SERVER_CONTROL_PORT}")
+def accept_failed(error):
+    """
+    [ใหม่] accept() ล้มเหลวทั้งที่ listener ยังเปิดอยู่: fd หมด (EMFILE/ENFILE) หรือหน่วยความจำไม่พอ
+    หยุดสั้นๆ ให้การเชื่อมต่อเดิมได้ปิดลงก่อน แทนที่จะวนรับซ้ำจนกิน CPU เต็ม (การเชื่อมต่อยังรออยู่ใน backlog)
+    """
+    count_event('accept_errors')
+    if error.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+        peer_log(f"[!] accept() failed: {error}. Pausing accepts briefly.")
+        time.sleep(ACCEPT_RETRY_DELAY)
+
+def open_public_port(resumable=True, proto='tcp', services=1):
+    """
+    [ใหม่] จอง Port จาก Pool, bind listener แล้วเริ่ม Port Manager คืนค่าอุโมงค์ของ Port นั้น หรือ None
+    (เลข Port อยู่ที่ tunnel.name, secret สำหรับ RESUME อยู่ที่ tunnel.secret)
+    ใน asyncio engine ต้องเรียกจากใน event loop (Port Manager จะเป็น Task แทน Thread)
+    [ใหม่] proto='udp': bind socket UDP ที่เลข Port เดียวกันให้ผู้เล่น (listener TCP ยังใช้รับ Host)
+    [ใหม่] services=N: จอง Port N ตัวให้อุโมงค์เดียวกัน (tunnel.ports, ตัวแรกคือ tunnel.name ที่ Host ต่อเข้ามา)
+    Port ที่ 2 เป็นต้นไปมีแค่ socket ของผู้เล่น (listener TCP หรือ socket UDP) จองไม่ครบ = คืนทุก Port แล้วคืนค่า None
+    """
+    ports, listeners, udp_socks = [], [], []
+    for service in range(services):
+        port = get_free_port()
+        if not port:
+            break
+        if service == 0 or proto == 'tcp':
+            listener = bind_public_listener(port)
+            if listener is None:
+                break # bind_public_listener คืน Port นี้ให้แล้ว
+            listeners.append(listener)
+        if proto == 'udp':
+            udp_sock = bind_udp_socket(port)
+            if udp_sock is None:
+                break
+        ports.append(port)
+        if proto == 'udp':
+            udp_socks.append(udp_sock)
+    if len(ports) < services:
+        for sock in listeners + udp_socks:
+            sock.close()
+        for port in ports:
+            release_port(port)
+        return None
+    public_port = ports[0]
+    if RELAY_ENGINE == 'asyncio':
+        tunnel = AsyncTunnel(public_port, resumable)
+        manager = asyncio.get_running_loop().create_task(async_manage_public_port(public_port, listeners, tunnel, udp_socks))
+    else:
+        tunnel = Tunnel(public_port, resumable)
+        manager = threading.Thread(target=manage_public_port, args=(public_port, listeners, tunnel, udp_socks))
+    tunnel.ports = ports
+    register_lease(tunnel)
+    # [ใหม่] บันทึก Thread ที่สร้างขึ้นเพื่อการตรวจสอบ
+    with lock:
+        active_managers[public_port] = manager
+    if RELAY_ENGINE != 'asyncio':
+        manager.start()
+    return tunnel
+
+# --- [ใหม่] Shared Port: ทุกอุโมงค์ใช้ listener เดียว แล้ว route ด้วย token ใน preamble ---
+# Host และผู้เล่นส่ง preamble 1 บรรทัดก่อนข้อมูล: "HOST <token>\n" หรือ "PEER <token>\n"
 
+def new_tunnel_token():
+    """สร้าง token สั้นๆ ที่ไม่ซ้ำกับอุโมงค์ที่มีอยู่ (ต้องถือ lock อยู่)"""
+    while True:
+        token = secrets.token_hex(TUNNEL_TOKEN_BYTES)
+        if token not in shared_tunnels:
+            return token
+
+def open_shared_tunnel():
+    """[ใหม่] สร้างอุโมงค์ใหม่บน Shared Port คืนค่าอุโมงค์ (tunnel.name คือ token ที่ Host และผู้เล่นต้องใช้ใน preamble)"""
+    with lock:
+        token = new_tunnel_token()
+        tunnel = AsyncTunnel(token) if RELAY_ENGINE == 'asyncio' else Tunnel(token)
+        shared_tunnels[token] = tunnel
+    register_lease(tunnel)
+    if RELAY_ENGINE == 'asyncio':
+        asyncio.get_running_loop().call_later(HOST_WAIT_TIMEOUT, expire_shared_tunnel, token, tunnel)
+    else:
+        expire_timer = threading.Timer(HOST_WAIT_TIMEOUT, expire_shared_tunnel, args=(token, tunnel))
+        expire_timer.daemon = True
+        expire_timer.start()
+    print(f"[*] Shared tunnel {token} created.")
+    return tunnel
+
+def expire_shared_tunnel(token, tunnel):
+    """ลบอุโมงค์ที่ Host ไม่ต่อเข้ามาภายใน HOST_WAIT_TIMEOUT"""
+    with lock:
+        if tunnel.host_generation or shared_tunnels.get(token) is not tunnel:
+            return
+        del shared_tunnels[token]
+    tunnel.close()
+    print(f"[{token}] Timed out waiting for Host connection. Removing shared tunnel.")
+
+def close_shared_tunnel(token):
+    with lock:
+        shared_tunnels.pop(token, None)
+    print(f"[*] Shared tunnel {token} has shut down.")
+
+def handle_shared_connection(conn, addr):
+    """อ่าน preamble ของการเชื่อมต่อบน Shared Port แล้วส่งต่อให้อุโมงค์ที่ตรงกับ token"""
     try:
-        while True:
-            conn, addr = control_socket.accept()
-            public_port = get_free_port()
-            if public_port:
-                print(f"[+] Assigning port {public_port} to {addr}")
-                conn.sendall(str(public_port).encode())
-                
-                manager_thread = threading.Thread(target=manage_public_port, args=(public_port,))
-                
-                # [ใหม่] บันทึก Thread ที่สร้างขึ้นเพื่อการตรวจสอบ
-                with lock:
-                    active_managers[public_port] = manager_thread
-                
-                manager_thread.start()
-            else:
-                print(f"[-] No available ports for {addr}")
-                conn.sendall(b"ERROR:NoPorts")
-            conn.close()
-    except KeyboardInterrupt:
-        print("\n[!] Server is shutting down.")
+        conn.settimeout(PREAMBLE_TIMEOUT)
+        line = recv_line(conn)
+        conn.settimeout(None)
+        role, token = line.split() if line else (None, None)
+    except (OSError, ValueError):
+        conn.close()
+        return
     finally:
-        control_socket.close()
+        release_pending_peer(addr[0])
 
-if __name__ == "__main__":
-    main()
+    with lock:
+        tunnel = shared_tunnels.get(token)
+        # HOST ใช้ได้ครั้งเดียว: Host ที่หลุดต้องกลับมาด้วย RESUME ทาง Control Port
+        if tunnel is not None and role == 'HOST' and tunnel.host_generation == 0:
+            tunnel.attach_host(conn)
+        elif tunnel is None or role != 'PEER' or tunnel.host_generation == 0 or tunnel.closed.is_set():
+            tunnel = None
+
+    if tunnel is None:
+        peer_log(f"[Shared] Rejected connection from {addr}: {line!r}")
+        conn.close()
+        return
+
+    if role == 'HOST':
+        print(f"[{token}] Host tunnel established: {addr}")
+        try:
+            tunnel.serve_host(conn)
+            tunnel.closed.wait() # อุโมงค์ยังอยู่ระหว่างรอ RESUME
+        finally:
+            close_shared_tunnel(token)
+    elif tunnel.admit_peer(conn, addr):
+        tunnel.serve_peer(conn, addr)
+
+def shared_port_listener():
+    """รับการเชื่อมต่อทั้งหมดบน Shared Port แล้วแยก Thread ไปอ่าน preamble"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((SERVER_HOST, SHARED_PORT))
+    listener.listen(PEER_ACCEPT_BACKLOG)
+    print(f"[*] Shared tunnel port listening on {SERVER_HOST}:{SHARED_PORT}")
+    while True:
+        try:
+            conn, addr = listener.accept()
+        except OSError as e:
+            accept_failed(e)
+            continue
+        # [ใหม่] การเชื่อมต่อที่ยังไม่ส่ง preamble นับเป็น half-established ของ IP นั้น
+        if not claim_pending_peer(addr[0]):
+            count_event('pending_rejected_peers')
+            conn.close()
+            continue
+        threading.Thread(target=handle_shared_connection, args=(conn, addr), daemon=True).start()
+
+# --- [ใหม่] Control Protocol ---
+
+def legacy_port_reply(addr):
+    """คำตอบสำหรับ Client รุ่นเก่า: เลข Port เปล่าๆ (ไม่มี '\\n') และไม่มี secret จึง RESUME ไม่ได้"""
+    tunnel = open_public_port(resumable=False)
+    if tunnel is None:
+        print(f"[-] No available ports for {addr}")
+        return b"ERROR:NoPorts"
+    print(f"[+] Assigning port {tunnel.name} to {addr}")
+    return str(tunnel.name).encode()
+
+def handle_control_command(line, addr):
+    """
+    ประมวลผลคำสั่ง 1 บรรทัดจาก Client คืนค่า (คำตอบเป็น bytes, handoff)
+    handoff คือ (อุโมงค์, คำสั่ง, player_id) ที่จะรับการเชื่อมต่อนี้ไปเป็นของ Host หรือ None
+    [ใหม่] RESUME/STRIPE: หลังตอบ OK การเชื่อมต่อ Control นี้จะกลายเป็นอุโมงค์ของ Host ทันที
+    (RESUME แทนที่ทุกเส้นเดิม, STRIPE เพิ่มเป็นเส้นเสริม)
+    [ใหม่] DATA: การเชื่อมต่อนี้กลายเป็น byte stream ของผู้เล่น player_id (โหมด direct)
+    """
+    try:
+        command, fields = parse_control_line(line)
+    except ValueError:
+        return b"ERROR:BadRequest\n", None
+
+    # [ใหม่] stripes=N: จำนวนการเชื่อมต่อที่ Host ต้องการ (ตอบกลับจำนวนที่อนุญาตจริง)
+    stripes = None
+    if 'stripes' in fields:
+        try:
+            stripes = max(1, min(int(fields['stripes']), MAX_HOST_STRIPES))
+        except ValueError:
+            return b"ERROR:BadRequest\n", None
+
+    # [ใหม่] compress=zlib: ตอบ compress=zlib กลับถ้ายอม (ไม่มีในคำตอบ = ไม่บีบอัด)
+    compress = 'zlib' if fields.get('compress') == 'zlib' and COMPRESSION_ALLOWED else None
+
+    # [ใหม่] proto=udp: ผู้เล่นส่ง datagram มาที่ Public Port (ตอบ proto=udp กลับ, Server รุ่นเก่าจะไม่ตอบ)
+    proto = fields.get('proto', 'tcp')
+    if proto not in ('tcp', 'udp'):
+        return b"ERROR:BadRequest\n", None
+
+    # [ใหม่] heartbeat=1: Host จะส่ง PING ทุกกี่วินาทีที่ตอบกลับไป (ไม่มีในคำตอบ = Server ไม่ตรวจ heartbeat)
+    heartbeat = HEARTBEAT_INTERVAL if fields.get('heartbeat') == '1' and HEARTBEAT_INTERVAL > 0 else None
+
+    # [ใหม่] direct=1: Host จะเปิดการเชื่อมต่อข้อมูลแยกให้ผู้เล่น TCP แต่ละคน (ตอบ direct=1 ถ้ายอม)
+    direct = 1 if fields.get('direct') == '1' and DIRECT_ALLOWED and SPLICE_SUPPORTED and proto == 'tcp' else None
+
+    # [ใหม่] services=N: Local Service N ตัวบนอุโมงค์เดียว ได้ Public Port N ตัว (ตอบ ports=<p0>,<p1>,... กลับไป)
+    # ขอเกินที่ยอมไม่ได้ถูกลดลงเหมือน stripes: Port ที่หายไปคือ service ที่ผู้เล่นเข้าไม่ถึง
+    try:
+        services = int(fields.get('services', 1))
+    except ValueError:
+        return b"ERROR:BadRequest\n", None
+    if not 1 <= services <= min(MAX_TUNNEL_SERVICES, MAX_SERVICES):
+        return b"ERROR:TooManyServices\n", None
+
+    if command == 'PORT':
+        tunnel = open_public_port(proto=proto, services=services)
+        if tunnel is None:
+            print(f"[-] No available ports for {addr}")
+            return b"ERROR:NoPorts\n", None
+        tunnel.max_stripes = stripes or 1
+        tunnel.heartbeat = heartbeat is not None
+        tunnel.direct = direct is not None
+        if compress:
+            tunnel.compressor = FrameCompressor()
+        ports = ",".join(str(port) for port in tunnel.ports) if services > 1 else None
+        print(f"[+] Assigning port {ports or tunnel.name} to {addr}")
+        return format_control_line('OK', port=tunnel.name, secret=tunnel.secret, stripes=stripes, compress=compress,
+                                   proto='udp' if proto == 'udp' else None, heartbeat=heartbeat, direct=direct,
+                                   ports=ports), None
+
+    if command == 'TUNNEL':
+        if not SHARED_PORT:
+            return b"ERROR:SharedPortDisabled\n", None
+        if proto == 'udp':
+            return b"ERROR:SharedPortIsTcpOnly\n", None
+        if services > 1:
+            return b"ERROR:SharedPortIsSingleService\n", None # ผู้เล่นบน Shared Port แยกกันด้วย token เท่านั้น
+        tunnel = open_shared_tunnel()
+        tunnel.max_stripes = stripes or 1
+        tunnel.heartbeat = heartbeat is not None
+        tunnel.direct = direct is not None
+        if compress:
+            tunnel.compressor = FrameCompressor()
+        print(f"[+] Assigning shared tunnel {tunnel.name} to {addr}")
+        return format_control_line('OK', tunnel=tunnel.name, port=SHARED_PORT, secret=tunnel.secret,
+                                   stripes=stripes, compress=compress, heartbeat=heartbeat, direct=direct), None
+
+    if command in ('RESUME', 'STRIPE'):
+        with lock:
+            tunnel = tunnel_leases.get(fields.get('secret'))
+        if tunnel is None or tunnel.host_generation == 0 or tunnel.closed.is_set():
+            return b"ERROR:UnknownLease\n", None
+        if command == 'STRIPE':
+            if not tunnel.stripes or len(tunnel.stripes) >= tunnel.max_stripes:
+                return b"ERROR:TooManyStripes\n", None
+            print(f"[{tunnel.name}] Host adding tunnel connection from {addr}")
+        else:
+            print(f"[{tunnel.name}] Host resuming tunnel from {addr}")
+        if isinstance(tunnel.name, int):
+            return format_control_line('OK', port=tunnel.name), (tunnel, command, None)
+        return format_control_line('OK', tunnel=tunnel.name, port=SHARED_PORT), (tunnel, command, None)
+
+    if command == 'DATA':
+        with lock:
+            tunnel = tunnel_leases.get(fields.get('secret'))
+        if tunnel is None or not tunnel.direct or tunnel.closed.is_set():
+            return b"ERROR:UnknownLease\n", None
+        if not fields.get('player', '').isdigit():
+            return b"ERROR:BadRequest\n", None
+        player_id = int(fields['player'])
+        return format_control_line('OK', player=player_id), (tunnel, command, player_id)
+
+    if command == 'LIMIT':
+        return handle_limit_command(fields), None
+
+    if command == 'PROFILE':
+        return handle_profile_command(fields), None
+
+    return b"ERROR:UnknownCommand\n", None
+
+def find_tunnel(port=None, token=None):
+    """[ใหม่] หาอุโมงค์ที่เปิดอยู่จากเลข Public Port (ของ service ใดก็ได้) หรือ token ของ Shared Port คืนค่า None ถ้าไม่มี"""
+    with lock:
+        if token is not None:
+            return shared_tunnels.get(token)
+        return next((tunnel for tunnel in tunnel_leases.values()
+                     if any(str(public_port) == port for public_port in tunnel.ports)), None)
+
+def handle_limit_command(fields):
+    """
+    [ใหม่] LIMIT admin=<token> port=<n>|tunnel=<token> [ชื่อ=ค่า ...]: แก้ขีดจำกัดของอุโมงค์ที่เปิดอยู่ (ผู้ดูแล Server เท่านั้น)
+    ชื่อตาม parse_limit_fields (0 = ยกเลิก) ไม่ระบุค่าเลย = ถามค่าปัจจุบัน ตอบ OK พร้อมขีดจำกัดทั้งหมดหลังแก้
+    """
+    if not LIMIT_ADMIN_TOKEN:
+        return b"ERROR:LimitsDisabled\n"
+    if not secrets.compare_digest(fields.pop('admin', '').encode(), LIMIT_ADMIN_TOKEN.encode()):
+        return b"ERROR:Forbidden\n"
+    tunnel = find_tunnel(fields.pop('port', None), fields.pop('tunnel', None))
+    if tunnel is None or tunnel.closed.is_set():
+        return b"ERROR:UnknownTunnel\n"
+    try:
+        changes = parse_limit_fields(fields)
+    except ValueError:
+        return b"ERROR:BadRequest\n"
+    if changes:
+        tunnel.limits.update(changes)
+        print(f"[{tunnel.name}] Limits changed: {tunnel.limits.values or 'none'}")
+    return format_control_line('OK', **tunnel.limits.values)
+
+def handle_profile_command(fields):
+    """
+    [ใหม่] PROFILE admin=<token> [seconds=N]: สุ่ม stack ของทุก Thread และจับเวลาต่อ Frame ของ process นี้ N วินาที
+    ใช้ token เดียวกับ LIMIT ตอบ OK พร้อม path ของไฟล์ที่จะเขียน (โหมด pre-fork: เฉพาะ worker ที่รับคำสั่งนี้
+    ใช้ SIGUSR1 ที่ Supervisor เพื่อ profile ทุก worker)
+    """
+    if not LIMIT_ADMIN_TOKEN:
+        return b"ERROR:ProfilingDisabled\n"
+    if not secrets.compare_digest(fields.get('admin', '').encode(), LIMIT_ADMIN_TOKEN.encode()):
+        return b"ERROR:Forbidden\n"
+    seconds = fields.get('seconds', str(PROFILE_SECONDS))
+    if not seconds.isdigit() or not 0 < int(seconds) <= PROFILE_SECONDS_MAX or profiler is None:
+        return b"ERROR:BadRequest\n"
+    path = profiler.start(int(seconds))
+    if path is None:
+        return b"ERROR:ProfileRunning\n"
+    return format_control_line('OK', seconds=seconds, path=path)
+
+def set_frame_timings(timings):
+    """[ใหม่] callback ของ Profiler: เริ่ม (FrameTimings) หรือหยุด (None) การจับเวลาใน forwarder ทุกตัว"""
+    global frame_timings
+    frame_timings = timings
+
+def start_profiler():
+    """[ใหม่] เตรียม Profiler ของ process นี้ และให้ SIGUSR1 เริ่ม session ยาว PROFILE_SECONDS วินาที"""
+    global profiler
+    prefix = PROFILE_PATH if WORKER_INDEX is None else f"{PROFILE_PATH}.w{WORKER_INDEX}"
+    profiler = Profiler(prefix, on_timings=set_frame_timings)
+    profiler.install_signal(PROFILE_SECONDS)
+
+def accept_control_connections(listener):
+    """
+    [ใหม่] รับทุกการเชื่อมต่อที่รออยู่ใน backlog ของ Control Port (non-blocking) จนกว่าจะว่าง
+    แล้วแยก Thread ต่อคำขอ เพราะต้องรออ่านคำสั่งจาก Client ก่อนตอบ
+    """
+    while True:
+        try:
+            conn, addr = listener.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            accept_failed(e)
+            return
+        conn.setblocking(True) # ไม่ให้ขึ้นกับ OS ว่าจะสืบทอด non-blocking จาก listener หรือไม่
+        threading.Thread(target=handle_control_connection, args=(conn, addr), daemon=True).start()
+
+def handle_control_connection(conn, addr):
+    """
+    [ใหม่] รับคำสั่งจาก Control Port (1 Thread ต่อ 1 คำขอ ซึ่งจบเร็ว)
+    Client รุ่นเก่าไม่ส่งคำสั่งมา: ถ้าไม่มีข้อมูลภายใน CONTROL_REQUEST_TIMEOUT จะแจก Port แบบเดิม
+    """
+    try:
+        conn.settimeout(CONTROL_REQUEST_TIMEOUT)
+        try:
+            line = recv_line(conn)
+        except socket.timeout:
+            line = None
+        except ValueError:
+            line = ''
+        conn.settimeout(None)
+
+        # [ใหม่] โหมด pre-fork: คำสั่งของอุโมงค์ที่อยู่ใน worker อื่นถูกส่งต่อทั้ง socket
+        target = route_control_line(line)
+        if target is not None:
+            forward_to_worker(conn, line, target)
+            conn.close()
+            return
+    except OSError:
+        conn.close()
+        return
+    answer_control(conn, addr, line)
+
+def answer_control(conn, addr, line):
+    """ตอบคำสั่งที่อ่านมาแล้ว (line=None คือ Client รุ่นเก่า) ใช้ทั้งกับการเชื่อมต่อปกติและที่ worker อื่นส่งต่อมา"""
+    try:
+        if line is None:
+            conn.sendall(legacy_port_reply(addr))
+        else:
+            reply, handoff = handle_control_command(line, addr)
+            if handoff is None:
+                conn.sendall(reply)
+            elif handoff[1] == 'DATA':
+                # [ใหม่] Thread นี้ย้ายข้อมูลขาไปผู้เล่นของการเชื่อมต่อ direct จนจบ (serve_direct ตอบ OK และปิด conn เอง)
+                tunnel, _, player_id = handoff
+                if tunnel.serve_direct(conn, player_id, reply):
+                    return
+                conn.sendall(b"ERROR:UnknownPlayer\n")
+            else:
+                # OK ถูกส่งโดย writer ของเส้นใหม่หลังผูกเส้นแล้ว: ข้อมูลที่ Host ส่งมาหลังได้ OK จะไม่ตกไปที่เส้นเดิม
+                tunnel, command, _ = handoff
+                attach = tunnel.add_stripe if command == 'STRIPE' else tunnel.attach_host
+                if attach(conn, reply):
+                    # Thread นี้กลายเป็น Thread อ่านข้อมูลของ Host เส้นนี้ (serve_host ปิด conn เอง)
+                    tunnel.serve_host(conn)
+                    return
+                conn.sendall(b"ERROR:UnknownLease\n")
+    except OSError:
+        pass
+    conn.close()
+
+
+# --- [ใหม่] Asyncio Engine ---
+# ทุก listener, host tunnel และ peer socket ทำงานบน event loop เดียว
+# จำนวน Thread จึงคงที่ไม่ว่าจะมีผู้เล่นกี่คน (wire format เหมือนเดิมทุกอย่าง)
+
+async def async_forward_from_peer_to_host(peer_reader, peer_writer, tunnel, player_id, peer_ip=None):
+    """
+    เวอร์ชัน asyncio ของ forward_from_peer_to_host
+    [แก้ไข] relay delay ขาไป Host วัดที่ pump ของเส้น (เวลาในคิว) เหมือน TunnelWriter ของ engine แบบ thread
+    [ใหม่] ระหว่าง profile: read = await read (รวมเวลารอผู้เล่น), send = await send_to_host (รวมเวลารอคิวของเส้นว่าง)
+    engine นี้ไม่มี lock จึงไม่มีขั้น lock
+    """
+    metrics = tunnel.track_metrics('to_host')
+    grant = RateGrant(tunnel.limits.bucket('to_host'), tunnel.limits.bucket('to_host', peer_ip))
+    sizer = ReadSizer(READ_SIZE_MIN, PEER_READ_MAX_BYTES)
+    try:
+        while True:
+            timings = frame_timings
+            if timings is not None:
+                read_at = time.perf_counter()
+            data = await peer_reader.read(sizer.size)
+            if not data:
+                break
+            sizer.update(len(data))
+            metrics.frames += 1
+            metrics.bytes += len(data)
+            metrics.sizes.observe(len(data))
+            if frame_capture is not None:
+                frame_capture.record(tunnel.capture_id, CAPTURE_TO_HOST, player_id, data)
+            if timings is not None:
+                sent_at = time.perf_counter()
+                timings.record('to_host', 'read', sent_at - read_at)
+                await tunnel.send_to_host(player_id, data)
+                timings.record('to_host', 'send', time.perf_counter() - sent_at)
+            else:
+                await tunnel.send_to_host(player_id, data)
+            delay = grant.spend(len(data))
+            if delay:
+                count_event('limit_throttled_ms', int(delay * 1000))
+                await asyncio.sleep(delay)
+    except (ConnectionResetError, BrokenPipeError, OSError):
+        pass
+    finally:
+        peer_log(f"[Player {player_id}] Disconnected.")
+        # แจ้งให้ Host รู้ว่าผู้เล่นคนนี้หลุดการเชื่อมต่อแล้ว (ส่งข้อมูลความยาว 0)
+        tunnel.remove_player(player_id)
+        peer_writer.close()
+
+async def async_forward_from_host_to_peers(host_reader, stripe, tunnel, metrics):
+    """
+    เวอร์ชัน asyncio ของ forward_from_host_to_peers (อ่านทีละ stripe) metrics คือตัวนับขาไปผู้เล่น
+    [ใหม่] ระหว่าง profile: read = รออ่าน header + payload, send = peer_writer.write (ไม่รวมเวลารอ drain ของนโยบาย pause)
+    """
+    players = tunnel.players
+    grant = RateGrant(tunnel.limits.bucket('to_peer'))
+    try:
+        while True:
+            timings = frame_timings
+            if timings is not None:
+                read_at = time.perf_counter()
+            try:
+                header = await host_reader.readexactly(8)
+            except asyncio.IncompleteReadError:
+                break
+
+            player_id, length = struct.unpack('!II', header)
+            flags = length & ~LENGTH_MASK
+            length &= LENGTH_MASK
+
+            data = b''
+            if length > 0:
+                try:
+                    data = await host_reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    raise ConnectionError("Host connection lost while reading data payload.")
+            stripe.frames_from_host += 1
+            stripe.bytes_from_host += length
+            if player_id == HEARTBEAT_PLAYER_ID:
+                if data == HEARTBEAT_PING and not stripe.writer.is_closing():
+                    stripe.writer.write(FRAME_HEADER.pack(HEARTBEAT_PLAYER_ID, len(HEARTBEAT_PONG)) + HEARTBEAT_PONG)
+                continue
+            started = time.monotonic()
+            if flags:
+                if stripe.decompressor is None:
+                    raise ValueError("Host sent a compressed frame without negotiating compression.")
+                data = stripe.decompressor.decompress(player_id, data, flags)
+            if frame_capture is not None:
+                frame_capture.record(tunnel.capture_id, CAPTURE_TO_PEER, player_id, data)
+
+            peer_writer = players.get(player_id)
+            if peer_writer is not None and data:
+                # [แก้ไข] transport ของผู้เล่นคือบัฟเฟอร์ขาออกของผู้เล่นคนนั้น จะรอ drain เฉพาะเมื่อเกิน PEER_QUEUE_MAX_BYTES
+                if timings is not None:
+                    sent_at = time.perf_counter()
+                    timings.record('to_peer', 'read', sent_at - read_at)
+                    peer_writer.write(data)
+                    timings.record('to_peer', 'send', time.perf_counter() - sent_at)
+                else:
+                    peer_writer.write(data)
+                metrics.frames += 1
+                metrics.bytes += len(data)
+                metrics.sizes.observe(len(data))
+                if isinstance(peer_writer, UdpSession):
+                    metrics.delays.observe(time.monotonic() - started)
+                    delay = grant.spend(len(data))
+                    if delay:
+                        await _throttle(delay, stripe)
+                    continue # datagram ไม่มีบัฟเฟอร์ต่อผู้เล่น
+                buffered = peer_writer.transport.get_write_buffer_size()
+                cap = tunnel.limits.buffer_cap(tunnel.player_ips.get(player_id), PEER_QUEUE_MAX_BYTES) if buffered else 0
+                if buffered > cap:
+                    if PEER_OVERFLOW_POLICY == 'drop':
+                        count_event('peer_overflow_drops')
+                        peer_log(f"[Player {player_id}] Outbound buffer full. Dropping player.")
+                        players.pop(player_id, None)
+                        peer_writer.transport.abort()
+                    else:
+                        count_event('host_read_pauses')
+                        paused_at = time.monotonic()
+                        stripe.paused = True # ไม่ได้อ่านเส้นนี้เพราะรอผู้เล่น: ความเงียบช่วงนี้ไม่ใช่ความผิดของ Host
+                        try:
+                            peer_writer.transport.set_write_buffer_limits(high=cap) # drain() รอจนต่ำกว่าเพดานของผู้เล่นคนนี้
+                            await peer_writer.drain()
+                        except (ConnectionResetError, BrokenPipeError, OSError):
+                            pass # [แก้ไข] ผู้เล่นหลุดระหว่างรอ: เป็นเรื่องของผู้เล่นคนนั้น ไม่ใช่ Host เส้นนี้
+                        finally:
+                            stripe.paused = False
+                        count_event('host_read_paused_ms', int((time.monotonic() - paused_at) * 1000))
+                metrics.delays.observe(time.monotonic() - started)
+                delay = grant.spend(len(data))
+                if delay:
+                    await _throttle(delay, stripe)
+    except (ConnectionResetError, BrokenPipeError, OSError, ConnectionError) as e:
+        print(f"[Host Tunnel] Connection lost: {e}")
+    except ValueError as e:
+        print(f"[Host Tunnel] Bad frame from Host: {e}")
+    finally:
+        # [แก้ไข] ปิดแค่ Host เส้นนี้ ผู้เล่นยังอยู่ใน AsyncTunnel ระหว่างรอ RESUME
+        stripe.writer.close()
+
+async def _throttle(delay, stripe):
+    """[ใหม่] เกิน to_peer_rate ของอุโมงค์: หยุดอ่านเส้นนี้ชั่วคราว (ความเงียบช่วงนี้ไม่นับเป็น heartbeat ที่หายไป)"""
+    count_event('limit_throttled_ms', int(delay * 1000))
+    stripe.paused = True
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        stripe.paused = False
+
+def _detach_stream(reader, writer):
+    """
+    [ใหม่] หยุด transport ของ stream แล้วคืนค่า (socket ที่ dup ออกมาแบบ non-blocking, ข้อมูลที่ reader อ่านค้างไว้แล้ว)
+    transport เดิมยังถือ socket ไว้ (ไม่ได้อ่านแล้ว) จนกว่าผู้เรียกจะ abort: fd ที่ dup มาจึงใช้กับ add_reader ได้
+    """
+    transport = writer.transport
+    transport.pause_reading()
+    # read() ที่มีข้อมูลในบัฟเฟอร์จบได้ในก้าวเดียว จึงเรียก coroutine ตรงๆ แทนการ await: ไม่มีรอบของ loop คั่น
+    # transport จึงไม่มีโอกาสอ่านข้อมูลเพิ่มเข้าบัฟเฟอร์ (ถ้าบัฟเฟอร์ว่าง read จะรอ และถูกปิดทิ้งทันที)
+    read = reader.read(2 ** 30)
+    try:
+        read.send(None)
+        prefix = b''
+    except StopIteration as done:
+        prefix = done.value
+    finally:
+        read.close()
+    # StreamReader ที่เคยหยุด transport เองเพราะบัฟเฟอร์เต็มจะสั่ง resume ตอนถูกอ่าน: หยุดซ้ำอีกครั้ง
+    transport.pause_reading()
+    sock = writer.get_extra_info('socket')
+    detached = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    detached.setblocking(False)
+    return detached, prefix
+
+class AsyncSpliceDirection:
+    """[ใหม่] 1 ทิศทางของ AsyncDirectLink: เรียก pump() เมื่อ src อ่านได้/dst เขียนได้ แล้วเลือกเหตุการณ์ที่ต้องรอต่อ"""
+    __slots__ = ('link', 'pump', 'src', 'dst', 'metrics', 'grant', 'watching', 'timer')
+
+    def __init__(self, link, src, dst, prefix, metrics, grant):
+        self.link = link
+        self.pump = SplicePump(src, dst, prefix)
+        self.src = src
+        self.dst = dst
+        self.metrics = metrics
+        self.grant = grant
+        self.watching = None # 'read' (รอ src), 'write' (รอ dst) หรือ None
+        self.timer = None # call_later ระหว่างพักตาม RateGrant
+
+    def drive(self):
+        self.timer = None
+        if self.link.finished.done():
+            return # อีกทิศทางเพิ่งปิด link ไปในรอบเดียวกัน
+        try:
+            moved = self.pump.pump(DIRECT_PUMP_BYTES)
+        except OSError:
+            self.link.close()
+            return
+        delay = 0
+        if moved:
+            self.metrics.frames += 1
+            self.metrics.bytes += moved
+            self.metrics.sizes.observe(moved)
+            delay = self.grant.spend(moved)
+        if self.pump.done:
+            self._watch(None)
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            self.link.direction_done()
+        elif delay:
+            count_event('limit_throttled_ms', int(delay * 1000))
+            self._watch(None)
+            self.timer = self.link.loop.call_later(delay, self.drive)
+        else:
+            self._watch('write' if self.pump.wants_write else 'read')
+
+    def _watch(self, kind):
+        """เปลี่ยนเหตุการณ์ที่รอเฉพาะเมื่อต่างจากเดิม (ไม่ต้องแก้ selector ทุก callback)"""
+        if kind == self.watching:
+            return
+        loop = self.link.loop
+        if self.watching == 'read':
+            loop.remove_reader(self.src)
+        elif self.watching == 'write':
+            loop.remove_writer(self.dst)
+        if kind == 'read':
+            loop.add_reader(self.src, self.drive)
+        elif kind == 'write':
+            loop.add_writer(self.dst, self.drive)
+        self.watching = kind
+
+    def stop(self):
+        self._watch(None)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pump.close()
+
+class AsyncDirectLink:
+    """
+    [ใหม่] เวอร์ชัน asyncio ของ DirectLink: ทั้งสองทิศทางเป็น SplicePump ที่ขับด้วย add_reader/add_writer บน event loop
+    (ไม่มี Thread เพิ่ม) serve_peer ของผู้เล่นรอ finished แล้วเป็นผู้ปิด transport ทั้งสองฝั่ง
+    """
+    __slots__ = ('player_id', 'loop', 'opened', 'finished', 'tunnel', 'directions', 'socks')
+
+    def __init__(self, player_id):
+        self.player_id = player_id
+        self.loop = asyncio.get_running_loop()
+        self.opened = self.loop.create_future() # (reader, writer, คำตอบ OK) ของการเชื่อมต่อข้อมูลจาก Host หรือ None
+        self.finished = self.loop.create_future()
+        self.tunnel = None
+        self.directions = []
+        self.socks = []
+
+    def start(self, tunnel, peer, data, reply, peer_ip):
+        """peer/data คือผลของ _detach_stream คำตอบ OK ออกไปก่อนข้อมูลที่ผู้เล่นส่งมาระหว่างรอ Host"""
+        (peer_sock, peer_prefix), (data_sock, data_prefix) = peer, data
+        self.socks = [peer_sock, data_sock]
+        self.directions = [
+            AsyncSpliceDirection(self, peer_sock, data_sock, reply + peer_prefix, tunnel.track_metrics('to_host'),
+                                 RateGrant(tunnel.limits.bucket('to_host'), tunnel.limits.bucket('to_host', peer_ip))),
+            AsyncSpliceDirection(self, data_sock, peer_sock, data_prefix, tunnel.track_metrics('to_peer'),
+                                 RateGrant(tunnel.limits.bucket('to_peer'), tunnel.limits.bucket('to_peer', peer_ip))),
+        ]
+        self.tunnel = tunnel
+        for direction, prefix in zip(self.directions, (peer_prefix, data_prefix)):
+            if prefix: # ข้อมูลที่ StreamReader อ่านไว้ก่อนย้ายขาก็นับเป็นข้อมูลที่ส่งต่อด้วย
+                direction.metrics.frames += 1
+                direction.metrics.bytes += len(prefix)
+                direction.metrics.sizes.observe(len(prefix))
+        for direction in self.directions:
+            direction.drive()
+            if self.finished.done():
+                break
+
+    def direction_done(self):
+        if all(direction.pump.done for direction in self.directions):
+            self.close()
+
+    def close(self):
+        """หยุดทั้งสองทิศทางและปิด socket ที่ dup มา (เรียกซ้ำได้ ผู้เล่นที่ยังรอ Host จะกลับไปใช้อุโมงค์แบบ Frame)"""
+        if not self.opened.done():
+            self.opened.set_result(None)
+        if self.finished.done():
+            return
+        for direction in self.directions:
+            direction.stop()
+            self.tunnel.retire_metrics(direction.metrics)
+        for sock in self.socks:
+            sock.close()
+        self.finished.set_result(None)
+
+class AsyncHostStripe:
+    """[ใหม่] เวอร์ชัน asyncio ของ HostStripe (ตัวนับทุกตัวแก้บน event loop เดียว)"""
+    __slots__ = ('writer', 'index', 'decompressor', 'watchdog', 'paused', 'fair', 'ready', 'progress', 'delays', 'pump',
+                 'pinned_players', 'frames_to_host', 'bytes_to_host', 'frames_from_host', 'bytes_from_host')
+
+    def __init__(self, writer, index, compressed=False, delays=None):
+        self.writer = writer
+        self.index = index
+        host_sock = writer.get_extra_info('socket')
+        set_keepalive(host_sock, TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, TCP_KEEPALIVE_COUNT)
+        set_socket_buffers(host_sock, SOCKET_BUFFERS.get('tunnel'))
+        self.decompressor = FrameDecompressor() if compressed else None
+        self.watchdog = None # [ใหม่] timer ตรวจ heartbeat (เฉพาะ Host ที่ตกลง heartbeat)
+        self.paused = False
+        # [ใหม่] Frame ไป Host เข้า FairQueue ก่อน แล้ว pump ปล่อยลง transport ทีละ batch ตามลำดับ DRR
+        # transport จึงมีข้อมูลค้างไม่เกินราว FAIR_BATCH_BYTES ส่วนที่เหลือรอในคิวของผู้เล่นแต่ละคน
+        self.fair = FairQueue(FAIR_QUANTUM)
+        self.ready = asyncio.Event()
+        self.progress = asyncio.get_running_loop().create_future() # resolve ทุกครั้งที่ pump ปล่อย batch
+        self.delays = delays # histogram เวลาที่ Frame เก่าสุดของแต่ละ batch รออยู่ในคิว
+        self.pump = None
+        writer.transport.set_write_buffer_limits(high=FAIR_BATCH_BYTES)
+        limit_unsent(host_sock, FAIR_BATCH_BYTES)
+        try:
+            # [แก้ไข] asyncio ปิด Nagle ให้เฉพาะ socket ที่ proto เป็น IPPROTO_TCP แต่ listener ของเราสร้างด้วย proto 0
+            # Frame ที่ตามหลัง Frame เล็กที่ยังไม่ได้ ACK (เช่นผู้เล่นหลุดแล้วมีผู้เล่นใหม่) จึงรอ delayed ACK ของ Client ราว 40ms
+            host_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        self.pinned_players = 0
+        self.frames_to_host = 0
+        self.bytes_to_host = 0
+        self.frames_from_host = 0
+        self.bytes_from_host = 0
+
+    def put(self, player_id, header, payload=b''):
+        self.fair.put(player_id, header, payload)
+        self.ready.set()
+
+    def is_full(self, player_id):
+        return (self.fair.depth(player_id) >= FAIR_PLAYER_MAX_BYTES or
+                self.fair.pending_bytes >= WRITER_MAX_PENDING_BYTES)
+
+    async def run_pump(self):
+        writer = self.writer
+        try:
+            while not writer.is_closing():
+                if not self.fair.pending_bytes:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                buffers, _, queued_since = self.fair.take(FAIR_BATCH_BYTES)
+                writer.writelines(buffers)
+                if self.delays is not None:
+                    self.delays.observe(time.monotonic() - queued_since)
+                self._signal_progress()
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._signal_progress()
+
+    def _signal_progress(self):
+        self.progress.set_result(None)
+        self.progress = asyncio.get_running_loop().create_future()
+
+    def queued_bytes(self):
+        return self.fair.pending_bytes + self.writer.transport.get_write_buffer_size()
+
+    def load_summary(self):
+        return (f"#{self.index}: players={self.pinned_players} "
+                f"to_host={self.frames_to_host}f/{self.bytes_to_host}B "
+                f"from_host={self.frames_from_host}f/{self.bytes_from_host}B "
+                f"queued={self.queued_bytes()}B")
+
+class AsyncTunnel:
+    """[ใหม่] เวอร์ชัน asyncio ของ Tunnel (ทุกอย่างอยู่บน event loop เดียว จึงไม่ต้องมี players_lock)"""
+    __slots__ = ('name', 'capture_id', 'secret', 'resumable', 'max_stripes', 'compressor', 'heartbeat', 'direct',
+                 'players', 'direct_links', 'player_id_generator', 'ports', 'stripes', 'player_stripes', 'stripe_index',
+                 'host_generation', 'host_connected', 'host_changed', 'closed', 'peer_accepts', 'metrics', 'limits',
+                 'player_ips')
+
+    def __init__(self, name, resumable=True):
+        self.name = name
+        self.capture_id = frame_capture.add_tunnel(name) if frame_capture is not None else 0
+        self.secret = new_lease_secret()
+        self.resumable = resumable
+        self.max_stripes = 1
+        self.compressor = None
+        self.heartbeat = False
+        self.direct = False
+        self.players = {}
+        self.direct_links = {} # [ใหม่] {player_id: AsyncDirectLink}
+        self.player_id_generator = itertools.count(1)
+        self.ports = [name] if isinstance(name, int) else []
+        self.stripes = []
+        self.player_stripes = {}
+        self.stripe_index = itertools.count()
+        self.host_generation = 0
+        self.host_connected = asyncio.Event()
+        self.host_changed = asyncio.get_running_loop().create_future() # ถูก resolve และสร้างใหม่ทุกครั้งที่เส้นของ Host เปลี่ยน
+        self.closed = asyncio.Event()
+        self.peer_accepts = 0
+        self.metrics = {'to_host': DirectionMetrics('to_host'), 'to_peer': DirectionMetrics('to_peer')}
+        self.limits = TunnelLimits(TUNNEL_LIMITS)
+        self.player_ips = {} # [ใหม่] {player_id: IP ต้นทาง} สำหรับเพดานบัฟเฟอร์ต่อ IP
+
+    def _signal_host_change(self):
+        self.host_changed.set_result(None)
+        self.host_changed = asyncio.get_running_loop().create_future()
+
+    async def serve_host(self, reader, writer, extra_stripe=False):
+        """
+        รับการเชื่อมต่อเป็น Host ของอุโมงค์ (ครั้งแรก, RESUME หรือเส้นเสริมเมื่อ extra_stripe=True)
+        แล้วอ่านข้อมูลจนหลุด ถ้าเป็นเส้นสุดท้ายจะเริ่มช่วงรอ RESUME หรือปิดอุโมงค์
+        """
+        if self.closed.is_set() or (extra_stripe and not (self.stripes and len(self.stripes) < self.max_stripes)):
+            writer.close()
+            return
+        stripe = AsyncHostStripe(writer, next(self.stripe_index), self.compressor is not None,
+                                 delays=self.metrics['to_host'].delays)
+        stripe.pump = asyncio.ensure_future(stripe.run_pump())
+        if extra_stripe:
+            self.stripes.append(stripe)
+        else:
+            old_stripes, self.stripes = self.stripes, [stripe]
+            self.host_generation += 1
+            self.host_connected.set()
+            for old in old_stripes:
+                old.writer.transport.abort()
+            print(f"[{self.name}] Host tunnel established: {writer.get_extra_info('peername')}")
+        self._signal_host_change()
+        if self.heartbeat:
+            self._watch_heartbeat(stripe, -1, 0)
+        try:
+            await async_forward_from_host_to_peers(reader, stripe, self, self.track_metrics('to_peer'))
+        finally:
+            stripe.pump.cancel()
+            if stripe.watchdog is not None:
+                stripe.watchdog.cancel()
+            if stripe in self.stripes:
+                self.stripes.remove(stripe)
+                if not self.closed.is_set():
+                    self._signal_host_change()
+                if not self.stripes:
+                    self._host_lost()
+
+    def _watch_heartbeat(self, stripe, frames_seen, missed):
+        """
+        [ใหม่] ตรวจทุก HEARTBEAT_INTERVAL ว่าเส้นนี้มี Frame ใหม่หรือไม่ (ไม่แตะ hot path: ดูจากตัวนับ Frame ที่มีอยู่แล้ว)
+        เงียบครบ HEARTBEAT_MISSES รอบติดกันจะตัดเส้นทิ้ง แล้ว serve_host จะเริ่มช่วงรอ RESUME ตามปกติ
+        """
+        if stripe.frames_from_host != frames_seen or stripe.paused:
+            missed = 0
+        else:
+            missed += 1
+            if missed >= HEARTBEAT_MISSES:
+                count_event('host_heartbeat_timeouts')
+                print(f"[{self.name}] No heartbeat from Host for {HEARTBEAT_INTERVAL * HEARTBEAT_MISSES}s. Dropping the connection.")
+                stripe.writer.transport.abort()
+                return
+        stripe.watchdog = asyncio.get_running_loop().call_later(HEARTBEAT_INTERVAL, self._watch_heartbeat,
+                                                                stripe, stripe.frames_from_host, missed)
+
+    def _host_lost(self):
+        if self.resumable and HOST_RESUME_GRACE > 0 and not self.closed.is_set():
+            print(f"[{self.name}] Host disconnected. Keeping players for {HOST_RESUME_GRACE}s while waiting for RESUME...")
+            asyncio.get_running_loop().call_later(HOST_RESUME_GRACE, self._expire_host, self.host_generation)
+        else:
+            self.close()
+
+    def _expire_host(self, generation):
+        if not self.stripes and self.host_generation == generation and not self.closed.is_set():
+            print(f"[{self.name}] Host did not resume within {HOST_RESUME_GRACE}s.")
+            self.close()
+
+    def _pin_player(self, player_id):
+        live = [stripe for stripe in self.stripes if not stripe.writer.is_closing()]
+        if not live:
+            return None
+        if STRIPE_PIN_POLICY == 'hash':
+            stripe = live[player_id % len(live)]
+        else:
+            stripe = min(live, key=lambda s: (s.pinned_players, s.queued_bytes()))
+        old = self.player_stripes.get(player_id)
+        if old is not None:
+            old.pinned_players -= 1
+            old.fair.forget(player_id)
+            if self.compressor is not None:
+                self.compressor.forget(player_id)
+        stripe.pinned_players += 1
+        self.player_stripes[player_id] = stripe
+        if FAIR_SERVICE_WEIGHTS:
+            stripe.fair.set_weight(player_id, FAIR_SERVICE_WEIGHTS.get(service_of(player_id), 1))
+        return stripe
+
+    async def send_to_host(self, player_id, data):
+        """
+        ส่ง Frame ไปยังเส้นที่ผู้เล่นถูก pin ไว้ ถ้า Host หลุดทุกเส้นจะรอ raise BrokenPipeError เมื่ออุโมงค์ปิด
+        [แก้ไข] รอเฉพาะตอนที่คิวของผู้เล่นคนนี้ (หรือคิวรวมของเส้น) เต็ม แทนการรอ drain ของทั้งเส้น
+        """
+        while True:
+            stripe = self.player_stripes.get(player_id)
+            if stripe is None or stripe.writer.is_closing():
+                stripe = self._pin_player(player_id)
+            if stripe is not None:
+                self._write_frame(stripe, player_id, data)
+                while stripe.is_full(player_id) and not stripe.writer.is_closing():
+                    await stripe.progress
+                return
+            if self.closed.is_set():
+                raise BrokenPipeError("Tunnel is closed.")
+            await self.host_changed
+
+    def send_datagram(self, player_id, data):
+        """
+        [ใหม่] ส่ง datagram ของผู้เล่น UDP เป็น 1 Frame โดยไม่รอ (เรียกจาก callback ของ DatagramProtocol)
+        คืนค่า False (ทิ้ง datagram) ถ้าไม่มี Host หรือคิวของผู้เล่นคนนี้บนเส้นเต็ม
+        """
+        stripe = self.player_stripes.get(player_id)
+        if stripe is None or stripe.writer.is_closing():
+            stripe = self._pin_player(player_id)
+        if stripe is None or stripe.is_full(player_id):
+            return False
+        self._write_frame(stripe, player_id, data)
+        return True
+
+    def _write_frame(self, stripe, player_id, data):
+        payload, flags = self.compressor.compress(player_id, data) if self.compressor else (data, 0)
+        stripe.put(player_id, struct.pack('!II', player_id, len(payload) | flags), payload)
+        stripe.frames_to_host += 1
+        stripe.bytes_to_host += 8 + len(payload)
+
+    def remove_player(self, player_id):
+        """ส่งสัญญาณผู้เล่นหลุดไปยังเส้นที่ถูก pin ไว้ (ไม่รอ Host ที่กำลัง RESUME) แล้วยกเลิกการ pin"""
+        if frame_capture is not None:
+            frame_capture.record(self.capture_id, CAPTURE_TO_HOST, player_id)
+        self.players.pop(player_id, None)
+        self.player_ips.pop(player_id, None)
+        if self.compressor is not None:
+            self.compressor.forget(player_id)
+        stripe = self.player_stripes.pop(player_id, None)
+        if stripe is not None:
+            stripe.pinned_players -= 1
+            stripe.fair.forget(player_id)
+            if stripe.decompressor is not None:
+                stripe.decompressor.forget(player_id)
+            if not stripe.writer.is_closing():
+                stripe.put(player_id, struct.pack('!II', player_id, 0)) # ต่อท้ายคิวของผู้เล่นเอง: ออกหลังข้อมูลที่ค้างเสมอ
+
+    def new_player_id(self, service=0):
+        return service_player_id(service, next(self.player_id_generator))
+
+    async def serve_peer(self, reader, writer, service=0):
+        if self.closed.is_set():
+            writer.close()
+            return
+        peer_addr = writer.get_extra_info('peername')
+        peer_sock = writer.get_extra_info('socket')
+        reason = self.limits.admit(peer_addr[0], peer_sock)
+        if reason is not None:
+            count_event('limit_rejected_peers')
+            peer_log(f"[{self.name}] Rejected peer {peer_addr}: {reason}")
+            writer.close()
+            return
+        player_id = self.new_player_id(service)
+        peer_log(f"[{self.name}] Peer connected: {peer_addr}, assigned ID: {player_id}")
+        set_keepalive(peer_sock, TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, TCP_KEEPALIVE_COUNT)
+        set_socket_buffers(peer_sock, SOCKET_BUFFERS.get('peer'))
+        self.peer_accepts += 1
+        try:
+            if self.direct and await self.relay_direct(reader, writer, player_id, peer_addr[0]):
+                return
+            writer.transport.set_write_buffer_limits(high=PEER_QUEUE_MAX_BYTES)
+            self.players[player_id] = writer
+            self.player_ips[player_id] = peer_addr[0]
+            await async_forward_from_peer_to_host(reader, writer, self, player_id, peer_addr[0])
+        finally:
+            self.limits.release(peer_addr[0], peer_sock)
+
+    async def relay_direct(self, reader, writer, player_id, peer_ip):
+        """เวอร์ชัน asyncio ของ Tunnel.relay_direct (ข้อมูลที่ผู้เล่นส่งมาระหว่างรอยังอยู่ใน reader จึงกลับไปใช้อุโมงค์ได้เสมอ)"""
+        link = AsyncDirectLink(player_id)
+        self.direct_links[player_id] = link
+        try:
+            if self.send_control(format_control_line(DIRECT_OPEN, player=player_id)):
+                try:
+                    await asyncio.wait_for(asyncio.shield(link.opened), DIRECT_OPEN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+            opened = link.opened.result() if link.opened.done() else None
+            if opened is None:
+                if not self.closed.is_set():
+                    count_event('direct_fallbacks')
+                    peer_log(f"[Player {player_id}] Host did not open a direct connection. Using the tunnel.")
+                return False
+            data_reader, data_writer, reply = opened
+            count_event('direct_links')
+            peer_log(f"[Player {player_id}] Direct connection established.")
+            try:
+                link.start(self, _detach_stream(reader, writer), _detach_stream(data_reader, data_writer),
+                           reply, peer_ip)
+                await link.finished
+            finally:
+                link.close()
+                data_writer.transport.abort()
+                writer.transport.abort()
+                peer_log(f"[Player {player_id}] Disconnected.")
+            return True
+        finally:
+            if self.direct_links.get(player_id) is link:
+                del self.direct_links[player_id]
+
+    def attach_direct(self, reader, writer, player_id, reply):
+        """[ใหม่] ส่งการเชื่อมต่อข้อมูลจากคำสั่ง DATA ให้ผู้เล่นที่รออยู่ (OK ออกไปพร้อมข้อมูลแรก) คืนค่า False ถ้าไม่มีใครรอ"""
+        link = self.direct_links.get(player_id)
+        if link is None or link.opened.done() or self.closed.is_set():
+            return False
+        data_sock = writer.get_extra_info('socket')
+        set_keepalive(data_sock, TCP_KEEPALIVE_IDLE, TCP_KEEPALIVE_INTERVAL, TCP_KEEPALIVE_COUNT)
+        set_socket_buffers(data_sock, SOCKET_BUFFERS.get('tunnel'))
+        link.opened.set_result((reader, writer, reply))
+        return True
+
+    def send_control(self, payload):
+        """[ใหม่] ส่งบรรทัดคำสั่งบน player_id 0 ของเส้นแรกที่ยังอยู่ คืนค่า False ถ้าไม่มี Host"""
+        for stripe in self.stripes:
+            if not stripe.writer.is_closing():
+                stripe.put(HEARTBEAT_PLAYER_ID, FRAME_HEADER.pack(HEARTBEAT_PLAYER_ID, len(payload)), payload)
+                return True
+        return False
+
+    def track_metrics(self, direction):
+        """ทุกอย่างอยู่บน event loop เดียว จึงใช้ตัวนับชุดเดียวต่อทิศทางร่วมกันได้เลย"""
+        return self.metrics[direction]
+
+    def retire_metrics(self, metrics):
+        pass
+
+    def metrics_totals(self):
+        """สำเนาของตัวนับ (ถูกเรียกจาก Thread ของ metrics endpoint)"""
+        totals = {}
+        for direction, metrics in self.metrics.items():
+            totals[direction] = DirectionMetrics(direction)
+            totals[direction].add(metrics)
+        return totals
+
+    def queued_bytes(self):
+        return sum(writer.transport.get_write_buffer_size()
+                   for writer in list(self.players.values()) if not isinstance(writer, UdpSession))
+
+    def memory_usage(self):
+        """[ใหม่] เวอร์ชัน asyncio ของ Tunnel.memory_usage (ผู้เล่น TCP คือ StreamWriter และบัฟเฟอร์ของ transport)"""
+        total = (sys.getsizeof(self) + sys.getsizeof(self.players) + sys.getsizeof(self.player_ips)
+                 + sys.getsizeof(self.direct_links) + sys.getsizeof(self.player_stripes))
+        for player in list(self.players.values()):
+            if isinstance(player, UdpSession):
+                total += player.memory_usage()
+            else:
+                total += sys.getsizeof(player) + player.transport.get_write_buffer_size()
+        return total + sum(stripe.queued_bytes() for stripe in list(self.stripes))
+
+    async def handle_connection(self, reader, writer):
+        """ใช้กับ listener ของ Port ละอุโมงค์: การเชื่อมต่อแรกคือ Host เสมอ ที่เหลือเป็นผู้เล่น"""
+        if self.host_generation == 0:
+            await self.serve_host(reader, writer)
+        else:
+            await self.serve_peer(reader, writer)
+
+    def host_queue_depths(self):
+        """เรียกจาก Thread ของ metrics endpoint: dict(...) คัดลอกทั้ง dict โดยไม่ปล่อย GIL จึงไม่เห็น dict ที่ loop แก้ค้างครึ่งทาง"""
+        depths = {}
+        for stripe in list(self.stripes):
+            depths.update(dict(stripe.fair.depths))
+        return depths
+
+    def stripe_summary(self):
+        return "; ".join(stripe.load_summary() for stripe in list(self.stripes))
+
+    def compression_summary(self):
+        return format_compression_stats(self.compressor.stats(), merge_decompressor_stats(list(self.stripes)))
+
+    def close(self):
+        """ปิดอุโมงค์: ตัดผู้เล่นทุกคนและ Host (ถ้ายังอยู่) แล้วลบ lease"""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self._signal_host_change()
+        drop_lease(self)
+        for peer_writer in self.players.values():
+            peer_writer.close()
+        self.players.clear()
+        for link in list(self.direct_links.values()):
+            link.close()
+        stripes, self.stripes = self.stripes, []
+        for stripe in stripes:
+            stripe.writer.close()
+
+class AsyncUdpRelay(asyncio.DatagramProtocol):
+    """[ใหม่] เวอร์ชัน asyncio ของ UdpRelay: datagram มาทาง callback และ timer wheel เดินด้วย call_later"""
+    def __init__(self, tunnel, service=0):
+        self.tunnel = tunnel
+        self.service = service
+        self.sessions = {}
+        self.wheel = TimerWheel(UDP_SESSION_IDLE_TIMEOUT, UDP_WHEEL_TICK)
+        self.transport = None
+        self.ticker = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._tick()
+
+    def connection_lost(self, exc):
+        if self.ticker is not None:
+            self.ticker.cancel()
+
+    def error_received(self, exc):
+        pass # ICMP port unreachable จาก datagram ที่ส่งไปก่อนหน้า: ผู้เล่นคนนั้นจะหมดอายุเอง
+
+    def _tick(self):
+        for session in self.wheel.advance(time.monotonic()):
+            del self.sessions[session.addr]
+            peer_log(f"[Player {session.player_id}] UDP session idle for {UDP_SESSION_IDLE_TIMEOUT}s. Disconnected.")
+            count_event('udp_sessions_expired')
+            self.tunnel.limits.release(session.addr[0])
+            self.tunnel.remove_player(session.player_id)
+        self.ticker = asyncio.get_running_loop().call_later(UDP_WHEEL_TICK, self._tick)
+
+    def datagram_received(self, data, addr):
+        if not data:
+            return # length 0 คือสัญญาณผู้เล่นหลุด จึงส่ง datagram ว่างต่อไม่ได้
+        now = time.monotonic()
+        session = self.sessions.get(addr)
+        if session is None:
+            if self.tunnel.limits.admit(addr[0]) is not None:
+                count_event('limit_rejected_peers')
+                return
+            session = UdpSession(self.transport, addr, self.tunnel.new_player_id(self.service), self.tunnel.limits)
+            peer_log(f"[{self.tunnel.name}] UDP peer: {addr}, assigned ID: {session.player_id}")
+            count_event('udp_sessions_opened')
+            self.sessions[addr] = session
+            self.tunnel.players[session.player_id] = session
+            self.tunnel.peer_accepts += 1
+            self.wheel.schedule(session, now)
+        session.last_seen = now
+        metrics = self.tunnel.metrics['to_host']
+        metrics.frames += 1
+        metrics.bytes += len(data)
+        metrics.sizes.observe(len(data))
+        if frame_capture is not None:
+            frame_capture.record(self.tunnel.capture_id, CAPTURE_TO_HOST, session.player_id, data)
+        if not session.to_host.try_spend(len(data)):
+            count_event('limit_dropped_datagrams')
+        elif not self.tunnel.send_datagram(session.player_id, data):
+            count_event('udp_dropped_datagrams')
+
+async def async_manage_public_port(public_port, listeners, tunnel, udp_socks=()):
+    """เวอร์ชัน asyncio ของ manage_public_port: ใช้ listener บน event loop แทน Thread"""
+    print(f"[*] Port Manager for {public_port} is running.")
+    servers = []
+    udp_transports = []
+    try:
+        # backlog ของ asyncio คือจำนวน accept สูงสุดต่อการตื่น 1 ครั้งด้วย: รับทุกคนที่รออยู่ใน backlog ในรอบเดียว
+        servers.append(await asyncio.start_server(tunnel.handle_connection, sock=listeners[0], backlog=PEER_ACCEPT_BACKLOG))
+        print(f"[{public_port}] Waiting for Host to establish tunnel...")
+        await asyncio.wait_for(tunnel.host_connected.wait(), HOST_WAIT_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        if udp_socks:
+            # [ใหม่] โหมด UDP: listener TCP ใช้รับ Host เท่านั้น ผู้เล่นมาทาง datagram
+            servers[0].close()
+            for service, udp_sock in enumerate(udp_socks):
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda service=service: AsyncUdpRelay(tunnel, service), sock=udp_sock)
+                udp_transports.append(transport)
+        else:
+            # [ใหม่] Port ของ service อื่นเริ่มรับผู้เล่นหลัง Host ต่อเข้ามาแล้ว (ผู้เล่นที่มาก่อนรออยู่ใน backlog)
+            for service, listener in enumerate(listeners[1:], 1):
+                servers.append(await asyncio.start_server(
+                    lambda reader, writer, service=service: tunnel.serve_peer(reader, writer, service),
+                    sock=listener, backlog=PEER_ACCEPT_BACKLOG))
+        await tunnel.closed.wait()
+    except asyncio.TimeoutError:
+        print(f"[{public_port}] Timed out waiting for Host connection. Shutting down this port manager.")
+    except Exception as e:
+        print(f"[!] Critical error in Port Manager {public_port}: {e}")
+    finally:
+        for server in servers:
+            server.close()
+        for listener in listeners[len(servers):]:
+            listener.close()
+        for transport in udp_transports:
+            transport.close()
+        for udp_sock in udp_socks[len(udp_transports):]:
+            udp_sock.close()
+        tunnel.close()
+        for port in tunnel.ports:
+            release_port(port)
+        print(f"[*] Port Manager for {public_port} has shut down.")
+
+async def async_handle_shared_connection(reader, writer):
+    """เวอร์ชัน asyncio ของ handle_shared_connection"""
+    addr = writer.get_extra_info('peername')
+    if not claim_pending_peer(addr[0]):
+        count_event('pending_rejected_peers')
+        writer.close()
+        return
+    try:
+        line = (await asyncio.wait_for(reader.readline(), PREAMBLE_TIMEOUT)).decode('ascii', 'replace').strip()
+        role, token = line.split()
+    except (asyncio.TimeoutError, ValueError, OSError):
+        writer.close()
+        return
+    finally:
+        release_pending_peer(addr[0])
+
+    with lock:
+        tunnel = shared_tunnels.get(token)
+    if tunnel is not None and role == 'HOST' and tunnel.host_generation == 0:
+        try:
+            await tunnel.serve_host(reader, writer)
+            await tunnel.closed.wait() # อุโมงค์ยังอยู่ระหว่างรอ RESUME
+        finally:
+            close_shared_tunnel(token)
+    elif tunnel is not None and role == 'PEER' and tunnel.host_generation and not tunnel.closed.is_set():
+        await tunnel.serve_peer(reader, writer)
+    else:
+        peer_log(f"[Shared] Rejected connection from {addr}: {line!r}")
+        writer.close()
+
+async def async_handle_control(reader, writer):
+    """เวอร์ชัน asyncio ของ handle_control_connection"""
+    addr = writer.get_extra_info('peername')
+    try:
+        line = (await asyncio.wait_for(reader.readline(), CONTROL_REQUEST_TIMEOUT)).decode('ascii', 'replace').strip()
+    except asyncio.TimeoutError:
+        line = None
+    except (ValueError, OSError):
+        line = ''
+
+    target = route_control_line(line)
+    if target is not None:
+        try:
+            forward_to_worker(writer.get_extra_info('socket'), line, target)
+        except OSError:
+            pass
+        writer.close()
+        return
+    await async_answer_control(reader, writer, addr, line)
+
+async def async_answer_control(reader, writer, addr, line):
+    """เวอร์ชัน asyncio ของ answer_control"""
+    handoff = None
+    if line is None:
+        writer.write(legacy_port_reply(addr))
+    else:
+        reply, handoff = handle_control_command(line, addr)
+        if handoff is not None and handoff[1] == 'DATA':
+            # [ใหม่] serve_peer ของผู้เล่นคนนั้นรับการเชื่อมต่อนี้ไป (ตอบ OK และปิดเอง)
+            tunnel, _, player_id = handoff
+            if tunnel.attach_direct(reader, writer, player_id, reply):
+                return
+            reply, handoff = b"ERROR:UnknownPlayer\n", None
+        writer.write(reply)
+    if handoff is not None:
+        # การเชื่อมต่อนี้กลายเป็นของ Host: RESUME แทนที่ทุกเส้นเดิม, STRIPE เพิ่มเป็นเส้นเสริม
+        # (ไม่รอ drain ก่อน เพื่อให้ผูกเส้นเสร็จก่อนที่ Host จะได้ OK และเริ่มส่งข้อมูล)
+        tunnel, command, _ = handoff
+        await tunnel.serve_host(reader, writer, extra_stripe=(command == 'STRIPE'))
+        return
+    try:
+        await writer.drain()
+    except (ConnectionResetError, BrokenPipeError, OSError):
+        pass
+    writer.close()
+
+async def async_main():
+    """จุดเริ่มต้นของ Asyncio Engine: เปิด Control Port (และ Shared Port ถ้าเปิดใช้) บน event loop"""
+    if SHARED_PORT and not WORKER_INDEX:
+        await asyncio.start_server(async_handle_shared_connection, SERVER_HOST, SHARED_PORT, reuse_address=True,
+                                   backlog=PEER_ACCEPT_BACKLOG)
+        print(f"[*] Shared tunnel port listening on {SERVER_HOST}:{SHARED_PORT}")
+    if worker_link is not None:
+        asyncio.get_running_loop().add_reader(worker_link.fileno(), async_accept_handoff)
+    control_server = await asyncio.start_server(async_handle_control, SERVER_HOST, SERVER_CONTROL_PORT, reuse_address=True,
+                                                reuse_port=WORKER_INDEX is not None, backlog=PEER_ACCEPT_BACKLOG)
+    print(f"[*] Server Control listening on {SERVER_HOST}:{SERVER_CONTROL_PORT} (asyncio engine)")
+    async with control_server:
+        await control_server.serve_forever()
+
+
+# --- [ใหม่] Pre-fork Workers ---
+# Supervisor เริ่ม worker ตาม WORKER_COUNT แต่ละ worker รัน main() ตามปกติใน process ของตัวเอง (GIL ของตัวเอง)
+# [แก้ไข] worker ถูกเริ่มเป็น process ใหม่ (subprocess + pass_fds) ด้วยอาร์กิวเมนต์ชุดเดิมบวก --worker-link
+# แทน os.fork(): Supervisor มี Thread อื่น (/metrics, รายงาน directory) ที่อาจถือ lock อยู่ตอน fork
+# ทำให้ worker ที่เริ่มใหม่ค้างได้ตั้งแต่ print แรก
+# และ bind Control Port ร่วมกันด้วย SO_REUSEPORT ให้ kernel กระจายการเชื่อมต่อ
+# Port Pool ถูกแบ่งเป็น slice ที่ไม่ทับกัน อุโมงค์แต่ละอันจึงมีเจ้าของเพียง worker เดียว
+# คำสั่งที่ต้องไปหาอุโมงค์ของ worker อื่น (RESUME/STRIPE ตาม secret, TUNNEL ไป worker 0 ที่ถือ Shared Port)
+# ถูกส่งต่อทั้ง socket ผ่าน Supervisor ด้วย SCM_RIGHTS พร้อมบรรทัดคำสั่งที่อ่านไปแล้ว
+
+def route_control_line(line):
+    """
+    คืนเลข worker ที่ต้องตอบคำสั่งนี้ หรือ None ถ้า worker นี้ (หรือ Server แบบ process เดียว) ตอบเองได้
+    PORT และ Client รุ่นเก่าใช้ slice ของ worker ที่รับการเชื่อมต่อไว้เสมอ
+    """
+    if WORKER_INDEX is None or not line:
+        return None
+    try:
+        command, fields = parse_control_line(line)
+    except ValueError:
+        return None
+    if command == 'TUNNEL' or (command == 'LIMIT' and 'tunnel' in fields):
+        target = 0
+    elif command == 'LIMIT':
+        # [ใหม่] อุโมงค์แบบ Port ละอุโมงค์อยู่ใน worker ที่ Port slice ครอบเลข Port นั้น
+        port = int(fields['port']) if fields.get('port', '').isdigit() else None
+        target = next((index for index, (start, end) in enumerate(worker_port_slices) if start <= port <= end), None) \
+            if port is not None else None
+        if target is None:
+            return None
+    elif command in ('RESUME', 'STRIPE', 'DATA'):
+        owner, dot, _ = fields.get('secret', '').partition('.')
+        if not dot or not owner.startswith('w') or not owner[1:].isdigit():
+            return None
+        target = int(owner[1:])
+    else:
+        return None
+    return target if target != WORKER_INDEX and target < WORKER_COUNT else None
+
+def forward_to_worker(conn, line, target):
+    """ส่ง socket ของ Client (พร้อมบรรทัดคำสั่ง) ให้ Supervisor ส่งต่อไปยัง worker target แล้ว process นี้ปิดของตัวเองได้เลย"""
+    with worker_link_lock:
+        socket.send_fds(worker_link, [f"{target} {line}".encode()], [conn.fileno()])
+    count_event('worker_handoffs_out')
+
+def accept_handoff():
+    """รับการเชื่อมต่อ 1 รายการที่ worker อื่นส่งต่อมา คืนค่า (socket, บรรทัดคำสั่ง) หรือ None ถ้า Supervisor ปิดลิงก์"""
+    message, fds, _flags, _addr = socket.recv_fds(worker_link, CONTROL_LINE_LIMIT + 16, 1)
+    if not fds:
+        return None
+    count_event('worker_handoffs_in')
+    return socket.socket(fileno=fds[0]), message.decode('ascii', 'replace')
+
+def _peer_address(conn):
+    try:
+        return conn.getpeername()
+    except OSError:
+        return None
+
+def _supervisor_gone():
+    """worker ผูกชีวิตกับ Supervisor: ลิงก์ขาดแปลว่า Supervisor ตายแล้ว ไม่ควรมี worker กำพร้าค้างถือ Port ไว้"""
+    print(f"[Worker {WORKER_INDEX}] Supervisor has gone away. Exiting.")
+    sys.stdout.flush()
+    os._exit(1)
+
+def serve_handoffs():
+    """Thread ของ worker (engine ปกติ): ตอบการเชื่อมต่อที่ถูกส่งต่อมาด้วย Thread ละคำขอ เหมือน Control Port"""
+    while True:
+        try:
+            handoff = accept_handoff()
+        except OSError:
+            handoff = None
+        if handoff is None:
+            _supervisor_gone()
+        conn, line = handoff
+        threading.Thread(target=answer_control, args=(conn, _peer_address(conn), line), daemon=True).start()
+
+def async_accept_handoff():
+    """callback ของ event loop (asyncio engine) เมื่อมีการเชื่อมต่อถูกส่งต่อมา"""
+    try:
+        handoff = accept_handoff()
+    except BlockingIOError:
+        return
+    except OSError:
+        handoff = None
+    if handoff is None:
+        _supervisor_gone()
+    conn, line = handoff
+    asyncio.get_running_loop().create_task(async_answer_handoff(conn, line))
+
+async def async_answer_handoff(conn, line):
+    conn.setblocking(False)
+    addr = _peer_address(conn)
+    try:
+        reader, writer = await asyncio.open_connection(sock=conn)
+    except OSError:
+        conn.close()
+        return
+    await async_answer_control(reader, writer, addr, line)
+
+def serve_stats_link(sock):
+    """Thread ของ worker: ทุกบรรทัดที่ Supervisor ส่งมาได้คำตอบเป็นข้อความ /metrics ของ worker นี้ (ขึ้นต้นด้วยความยาว)"""
+    while True:
+        try:
+            if recv_line(sock) is None:
+                return
+            body = collect_metrics().encode()
+            sock.sendall(struct.pack('!I', len(body)) + body)
+        except (OSError, ValueError):
+            return
+
+def run_worker(index, port_range, link, stats_link, engine, slices=()):
+    """จุดเริ่มต้นของ worker (process ที่ Supervisor เริ่ม): ใช้ Port slice ของตัวเอง ส่วน /metrics ให้ Supervisor รวมให้"""
+    global WORKER_INDEX, PORT_POOL_START, PORT_POOL_END, METRICS_PORT, worker_link
+    WORKER_INDEX = index
+    PORT_POOL_START, PORT_POOL_END = port_range
+    worker_port_slices[:] = slices
+    METRICS_PORT = None
+    worker_link = link
+    threading.Thread(target=serve_stats_link, args=(stats_link,), daemon=True).start()
+    print(f"[Worker {index}] pid {os.getpid()} serving ports {PORT_POOL_START}-{PORT_POOL_END}")
+    main(engine)
+
+def split_port_pool(count):
+    """แบ่ง PORT_POOL_START..END เป็น count ช่วงต่อเนื่องที่ไม่ทับกัน (ช่วงแรกๆ ได้เพิ่ม 1 Port ถ้าหารไม่ลงตัว)"""
+    total = PORT_POOL_END - PORT_POOL_START + 1
+    if total < count:
+        raise SystemExit(f"[!] Port pool has {total} ports, fewer than {count} workers.")
+    slices = []
+    start = PORT_POOL_START
+    for index in range(count):
+        size = total // count + (1 if index < total % count else 0)
+        slices.append((start, start + size - 1))
+        start += size
+    return slices
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("worker closed the stats link")
+        data += chunk
+    return bytes(data)
+
+
+class WorkerProcess:
+    """worker 1 ตัวตามมุมมองของ Supervisor (pid เป็น None ระหว่างรอเริ่มใหม่)"""
+    def __init__(self, index, port_range):
+        self.index = index
+        self.port_range = port_range
+        self.process = None # subprocess.Popen ของ worker ที่ทำงานอยู่
+        self.pid = None
+        self.link = None # SOCK_SEQPACKET: บรรทัดคำสั่ง + fd ของการเชื่อมต่อที่ส่งต่อ
+        self.stats_link = None # SOCK_STREAM: คำขอ/คำตอบ /metrics
+        self.stats_lock = threading.Lock()
+        self.started_at = 0
+        self.restart_at = 0
+        self.restart_delay = WORKER_RESTART_DELAY
+        self.restarts = 0
+
+
+class Supervisor:
+    """
+    process แม่ของโหมด pre-fork: เริ่ม worker, เริ่ม worker ที่ตายใหม่ด้วย slice เดิม,
+    ส่งต่อการเชื่อมต่อระหว่าง worker และรวมสถิติ/metrics ของทุก worker (ไม่รับการเชื่อมต่อของ Client เอง)
+    """
+    def __init__(self, engine, count):
+        self.engine = engine
+        self.workers = [WorkerProcess(index, port_range) for index, port_range in enumerate(split_port_pool(count))]
+        self.selector = selectors.DefaultSelector()
+        self.handoffs = 0
+        self.handoffs_dropped = 0
+
+    def run(self):
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, self.forward_signal) # [ใหม่] profile ทุก worker พร้อมกัน
+        for worker in self.workers:
+            self.spawn(worker)
+        if METRICS_PORT:
+            start_metrics_server(METRICS_HOST, METRICS_PORT, lambda: self.collect_metrics().text())
+            print(f"[+] Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics (all workers)")
+        if DIRECTORY_ADDR:
+            threading.Thread(target=report_load_to_directory, args=(self.collect_metrics,), daemon=True).start()
+        next_report = time.monotonic() + HEALTH_CHECK_INTERVAL
+        try:
+            while True:
+                for key, _ in self.selector.select(timeout=0.5):
+                    self.relay_handoff(key.data)
+                self.reap()
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.pid is None and now >= worker.restart_at:
+                        worker.restarts += 1
+                        self.spawn(worker)
+                if now >= next_report:
+                    self.report()
+                    next_report = now + HEALTH_CHECK_INTERVAL
+        except KeyboardInterrupt:
+            print("\n[!] Server is shutting down.")
+        finally:
+            self.stop()
+
+    def forward_signal(self, signum, _frame):
+        """[ใหม่] ส่ง signal ที่ Supervisor ได้รับ (SIGUSR1 = เริ่ม profile) ต่อให้ทุก worker ที่ทำงานอยู่"""
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def spawn(self, worker):
+        """
+        [แก้ไข] เริ่ม worker เป็น process ใหม่ที่รันสคริปต์นี้ด้วยอาร์กิวเมนต์ชุดเดิม (ค่าตั้งทุกตัวจึงเหมือนกัน)
+        ปลายลิงก์ทั้งสองส่งให้ worker ด้วย pass_fds (fd อื่นของ Supervisor ไม่ติดไป)
+        """
+        link, worker_link_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        stats_link, stats_end = socket.socketpair()
+        fds = (worker_link_end.fileno(), stats_end.fileno())
+        sys.stdout.flush()
+        try:
+            worker.process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                 '--worker-link', f"{worker.index}:{fds[0]}:{fds[1]}"],
+                # python -u ของ Supervisor ไม่ติดไปกับ process ใหม่เอง: ส่งต่อทาง environment
+                pass_fds=fds, env=dict(os.environ, PYTHONUNBUFFERED='1') if getattr(sys.stdout, 'write_through', False) else None)
+        except OSError as e:
+            link.close()
+            stats_link.close()
+            worker.restart_at = time.monotonic() + worker.restart_delay
+            print(f"[Supervisor] Could not start worker {worker.index}: {e}")
+            return
+        finally:
+            worker_link_end.close()
+            stats_end.close()
+        pid = worker.process.pid
+        worker.pid = pid
+        worker.link = link
+        with worker.stats_lock:
+            worker.stats_link = stats_link
+        worker.started_at = time.monotonic()
+        self.selector.register(link, selectors.EVENT_READ, worker)
+        print(f"[Supervisor] Started worker {worker.index} (pid {pid}) for ports {worker.port_range[0]}-{worker.port_range[1]}")
+
+    def detach(self, worker):
+        try:
+            self.selector.unregister(worker.link)
+        except (KeyError, ValueError):
+            pass
+        worker.link.close()
+        with worker.stats_lock:
+            if worker.stats_link is not None:  # request_metrics ปิดไปแล้วถ้า worker ตายระหว่างถูกขอ metrics
+                worker.stats_link.close()
+            worker.stats_link = None
+        worker.link = None
+        worker.process = None
+        worker.pid = None
+
+    def reap(self):
+        """เก็บ worker ที่ตายแล้วและตั้งเวลาเริ่มใหม่ (ตายภายใน 10 วินาทีหลังเริ่ม = รอนานขึ้นเท่าตัว)"""
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            status = worker.process.poll()
+            if status is None:
+                continue
+            pid = worker.pid
+            now = time.monotonic()
+            if now - worker.started_at < 10:
+                worker.restart_delay = min(worker.restart_delay * 2, 30)
+            else:
+                worker.restart_delay = WORKER_RESTART_DELAY
+            worker.restart_at = now + worker.restart_delay
+            self.detach(worker)
+            print(f"[Supervisor] Worker {worker.index} (pid {pid}) exited with status {status}. "
+                  f"Restarting in {worker.restart_delay:g}s.")
+
+    def relay_handoff(self, worker):
+        """ส่งต่อการเชื่อมต่อ 1 รายการจาก worker หนึ่งไปยัง worker เจ้าของ (worker ปลายทางที่ตายอยู่ = Client ถูกตัดแล้วลองใหม่เอง)"""
+        try:
+            message, fds, _flags, _addr = socket.recv_fds(worker.link, CONTROL_LINE_LIMIT + 16, 1)
+        except OSError:
+            return
+        if not message and not fds:
+            self.selector.unregister(worker.link) # worker ปิดลิงก์ระหว่างกำลังจะตาย reap() จะเก็บต่อ
+            return
+        target_text, _, line = message.partition(b' ')
+        index = int(target_text) if target_text.isdigit() else len(self.workers)
+        target = self.workers[index] if index < len(self.workers) else None
+        try:
+            if target is None or target.link is None:
+                raise ConnectionError(f"worker {target_text.decode('ascii', 'replace')} is not running")
+            socket.send_fds(target.link, [line], fds, socket.MSG_DONTWAIT)
+            self.handoffs += 1
+        except OSError as e:
+            self.handoffs_dropped += 1
+            print(f"[Supervisor] Dropped a handed-off connection: {e}")
+            try:
+                os.write(fds[0], b"ERROR:WorkerUnavailable\n") # อุโมงค์ของ worker ที่ตายหายไปพร้อมกับ process แล้ว
+            except (OSError, IndexError):
+                pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def request_metrics(self, worker):
+        """ขอข้อความ /metrics จาก worker (worker ที่ไม่ตอบภายใน WORKER_STATS_TIMEOUT ถูกข้ามจนกว่าจะเริ่มใหม่)"""
+        with worker.stats_lock:
+            sock = worker.stats_link
+            if sock is None:
+                return ''
+            try:
+                sock.settimeout(WORKER_STATS_TIMEOUT)
+                sock.sendall(b"METRICS\n")
+                size, = struct.unpack('!I', _recv_exact(sock, 4))
+                return _recv_exact(sock, size).decode()
+            except OSError as e:
+                print(f"[Supervisor] Worker {worker.index} did not answer the stats request: {e}")
+                sock.close()
+                worker.stats_link = None
+                return ''
+
+    def collect_metrics(self):
+        """metrics ของทุก worker รวมกัน (sample ชื่อ/label เดียวกันถูกบวกกัน) พร้อมสถานะของ worker แต่ละตัว"""
+        writer = MetricsWriter()
+        for worker in self.workers:
+            writer.sample('p2p_worker_up', 'gauge', "Whether the pre-fork worker process is running.",
+                          int(worker.pid is not None), worker=worker.index)
+            writer.sample('p2p_worker_restarts_total', 'counter', "Times the supervisor restarted the worker.",
+                          worker.restarts, worker=worker.index)
+        writer.sample('p2p_worker_handoffs_total', 'counter', "Control connections passed to the worker that owns the tunnel.",
+                      self.handoffs)
+        writer.sample('p2p_worker_handoffs_dropped_total', 'counter', "Handed-off connections closed because the owner was down.",
+                      self.handoffs_dropped)
+        for worker in self.workers:
+            writer.merge_text(self.request_metrics(worker))
+        return writer
+
+    def report(self):
+        totals = self.collect_metrics()
+        alive = sum(worker.pid is not None for worker in self.workers)
+        restarts = sum(worker.restarts for worker in self.workers)
+        print(f"[Supervisor] Workers alive: {alive}/{len(self.workers)}, restarts: {restarts}, handoffs: {self.handoffs}, "
+              f"ports in use: {totals.total('p2p_ports_in_use')}, tunnels: {totals.total('p2p_tunnels')}, "
+              f"players: {totals.total('p2p_players')}")
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.wait()
+
+
+def open_frame_capture():
+    """[ใหม่] เปิดไฟล์บันทึก Frame ของ process นี้ (worker แยกไฟล์กันเพื่อไม่ต้องแย่งกันเขียน) และปิดให้เมื่อ process จบ"""
+    global frame_capture
+    path = CAPTURE_PATH if WORKER_INDEX is None else f"{CAPTURE_PATH}.w{WORKER_INDEX}"
+    frame_capture = FrameCapture(path, payload=CAPTURE_PAYLOAD)
+    atexit.register(frame_capture.close)
+    print(f"[+] Capturing tunnel frames to {path} ({'with' if CAPTURE_PAYLOAD else 'without'} payloads)")
+
+def main(engine='thread'):
+    """
+    ฟังก์ชันหลักของ Server ทำหน้าที่เป็นผู้แจก Port และเริ่ม Health Checker
+    engine: 'thread' (ค่าเริ่มต้น, Thread ต่อผู้เล่น) หรือ 'asyncio' (event loop เดียว)
+    """
+    global RELAY_ENGINE
+    if WORKER_COUNT > 1 and WORKER_INDEX is None:
+        # [ใหม่] โหมด pre-fork: process นี้เป็น Supervisor ส่วน worker แต่ละตัวจะกลับมาเรียก main() อีกครั้ง
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'send_fds'):
+            raise SystemExit("[!] --workers needs SO_REUSEPORT and descriptor passing (Linux).")
+        Supervisor(engine, WORKER_COUNT).run()
+        return
+    RELAY_ENGINE = engine
+    init_port_pool()
+    start_profiler()
+    if CAPTURE_PATH:
+        open_frame_capture()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_HOST, METRICS_PORT, collect_metrics)
+        print(f"[+] Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    # [ใหม่] เริ่ม Thread สำหรับ Health Checker
+    health_thread = threading.Thread(target=port_health_checker, daemon=True)
+    health_thread.start()
+    print("[+] Port health checker service started.")
+    if DIRECTORY_ADDR and WORKER_INDEX is None: # ในโหมด pre-fork Supervisor รายงานตัวเลขรวมของทุก worker แทน
+        threading.Thread(target=report_load_to_directory, args=(node_totals,), daemon=True).start()
+
+    if engine == 'asyncio':
+        try:
+            asyncio.run(async_main())
+        except KeyboardInterrupt:
+            print("\n[!] Server is shutting down.")
+        return
+
+    if SHARED_PORT and not WORKER_INDEX:
+        threading.Thread(target=shared_port_listener, daemon=True).start()
+    if worker_link is not None:
+        threading.Thread(target=serve_handoffs, daemon=True).start()
+
+    control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if WORKER_INDEX is not None:
+        control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # [ใหม่] ทุก worker bind Port เดียวกัน
+    control_socket.bind((SERVER_HOST, SERVER_CONTROL_PORT))
+    # [แก้ไข] backlog ลึกพอรับ RESUME/STRIPE/DATA ของ Host ทุกคนที่ต่อกลับมาพร้อมกันหลังรีสตาร์ท
+    control_socket.listen(PEER_ACCEPT_BACKLOG)
+    control_socket.setblocking(False)
+    print(f"[*] Server Control listening on {SERVER_HOST}:{SERVER_CONTROL_PORT}")
+
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(control_socket, selectors.EVENT_READ)
+            while True:
+                selector.select()
+                accept_control_connections(control_socket)
+    except KeyboardInterrupt:
+        print("\n[!] Server is shutting down.")
+    finally:
+        control_socket.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="P2P relay server")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+                        help="relay engine: one thread per peer (default) or a single asyncio event loop")
+    parser.add_argument('--control-port', type=int, default=SERVER_CONTROL_PORT,
+                        help="port clients use to request public ports")
+    parser.add_argument('--port-range', default=f"{PORT_POOL_START}-{PORT_POOL_END}",
+                        help="public port pool as START-END (inclusive)")
+    parser.add_argument('--peer-queue-bytes', type=int, default=PEER_QUEUE_MAX_BYTES,
+                        help="outbound buffer limit per peer in bytes")
+    parser.add_argument('--overflow-policy', choices=('drop', 'pause'), default=PEER_OVERFLOW_POLICY,
+                        help="when a peer's buffer overflows: drop that peer, or pause reading from the host")
+    parser.add_argument('--shared-port', type=int, default=SHARED_PORT,
+                        help="also serve token-routed tunnels on this single port")
+    parser.add_argument('--flush-us', type=int, default=TUNNEL_FLUSH_WINDOW_US,
+                        help="microseconds to wait for more frames before flushing a host tunnel write (0 = no wait)")
+    parser.add_argument('--fair-quantum', type=int, default=FAIR_QUANTUM,
+                        help="bytes each player may send towards the host per deficit-round-robin turn")
+    parser.add_argument('--fair-batch-bytes', type=int, default=FAIR_BATCH_BYTES,
+                        help="bytes the fair queue hands to a host socket at a time")
+    parser.add_argument('--fair-weight', action='append', default=[], metavar='SERVICE=WEIGHT',
+                        help="repeatable: share of each deficit-round-robin turn for players of a local service "
+                             "(e.g. 1=4 gives service 1 four times the default share of 1) on a shared host connection")
+    parser.add_argument('--fair-player-bytes', type=int, default=FAIR_PLAYER_MAX_BYTES,
+                        help="bytes one player may have queued towards the host before it has to wait")
+    parser.add_argument('--max-stripes', type=int, default=MAX_HOST_STRIPES,
+                        help="most parallel host connections a tunnel may open")
+    parser.add_argument('--stripe-policy', choices=('least-loaded', 'hash'), default=STRIPE_PIN_POLICY,
+                        help="how new players are pinned to a host connection")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="refuse tunnel compression even when a client asks for it")
+    parser.add_argument('--udp-idle-timeout', type=int, default=UDP_SESSION_IDLE_TIMEOUT,
+                        help="seconds before a silent UDP peer's session is expired")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on this local port (127.0.0.1 only)")
+    parser.add_argument('--host-wait-timeout', type=int, default=HOST_WAIT_TIMEOUT,
+                        help="seconds a newly assigned port waits for its host before it is released")
+    parser.add_argument('--heartbeat-interval', type=int, default=HEARTBEAT_INTERVAL,
+                        help="seconds between host PINGs offered to clients (0 = no heartbeat)")
+    parser.add_argument('--heartbeat-misses', type=int, default=HEARTBEAT_MISSES,
+                        help="silent heartbeat intervals before a host connection is declared dead")
+    parser.add_argument('--keepalive-idle', type=int, default=TCP_KEEPALIVE_IDLE,
+                        help="TCP keepalive idle seconds on host and peer sockets (0 = off)")
+    parser.add_argument('--keepalive-interval', type=int, default=TCP_KEEPALIVE_INTERVAL,
+                        help="seconds between TCP keepalive probes")
+    parser.add_argument('--keepalive-count', type=int, default=TCP_KEEPALIVE_COUNT,
+                        help="unanswered TCP keepalive probes before the connection is dropped")
+    parser.add_argument('--workers', type=int, default=WORKER_COUNT,
+                        help="pre-fork this many worker processes sharing the control port with SO_REUSEPORT (Linux)")
+    parser.add_argument('--worker-link', help=argparse.SUPPRESS) # INDEX:LINK_FD:STATS_FD ที่ Supervisor ส่งให้ worker
+    parser.add_argument('--limit', action='append', default=[], metavar='NAME=VALUE',
+                        help="default limit for every tunnel, repeatable: " + ", ".join(LIMIT_KEYS) +
+                             " (rates per second) or the same names prefixed with ip_ to apply per peer address")
+    parser.add_argument('--admin-token', default=LIMIT_ADMIN_TOKEN,
+                        help="enable the LIMIT and PROFILE control commands for clients presenting this token")
+    parser.add_argument('--resume-grace', type=int, default=HOST_RESUME_GRACE,
+                        help="seconds to keep a port and its peers after the host drops, waiting for RESUME (0 = close at once)")
+    parser.add_argument('--capture', metavar='FILE', default=CAPTURE_PATH,
+                        help="record every tunnel frame (time, direction, player, length) to FILE for replay_capture.py")
+    parser.add_argument('--capture-payload', action='store_true',
+                        help="also store frame payloads in the capture (large; contains player data)")
+    parser.add_argument('--no-direct', action='store_true',
+                        help="refuse per-player direct data connections even when a client asks for them")
+    parser.add_argument('--direct-timeout', type=float, default=DIRECT_OPEN_TIMEOUT,
+                        help="seconds a player waits for the host's direct connection before using the tunnel")
+    parser.add_argument('--peer-read-max', type=int, default=PEER_READ_MAX_BYTES,
+                        help=f"largest read from a busy peer socket; reads start at {READ_SIZE_MIN} bytes and adapt "
+                             f"(= {READ_SIZE_MIN} keeps fixed small reads)")
+    parser.add_argument('--socket-buffer', action='append', default=[], metavar='NAME=BYTES',
+                        help="SO_SNDBUF/SO_RCVBUF per socket role, repeatable: peer_sndbuf, peer_rcvbuf, tunnel_sndbuf, "
+                             "tunnel_rcvbuf (default: kernel autotuning)")
+    parser.add_argument('--max-services', type=int, default=MAX_TUNNEL_SERVICES,
+                        help="public ports (local services) one client may request for a single tunnel")
+    parser.add_argument('--accept-backlog', type=int, default=PEER_ACCEPT_BACKLOG,
+                        help="listen() backlog of public, shared and control ports (the kernel caps it at net.core.somaxconn)")
+    parser.add_argument('--max-pending-per-ip', type=int, default=PEER_PENDING_PER_IP,
+                        help="connections per source IP accepted but not yet serving as players (0 = no limit)")
+    parser.add_argument('--peer-log-rate', type=int, default=PEER_LOG_PER_SECOND,
+                        help="per-peer log lines (connect/disconnect/reject) printed per second; the rest are counted")
+    parser.add_argument('--directory', metavar='HOST:PORT', default=None,
+                        help="join a relay cluster: report this node's load to the p2p_directory at HOST:PORT")
+    parser.add_argument('--node-name', default=NODE_NAME,
+                        help="name of this node in the directory (default: hostname:control port)")
+    parser.add_argument('--advertise-host', default=NODE_ADVERTISE_HOST,
+                        help="address clients are sent to for this node (default: the address used to reach the directory)")
+    parser.add_argument('--directory-token', default=DIRECTORY_TOKEN,
+                        help="token the directory expects from its nodes (its --node-token)")
+    parser.add_argument('--load-report-interval', type=float, default=LOAD_REPORT_INTERVAL,
+                        help="seconds between load reports to the directory")
+    parser.add_argument('--park-idle-after', type=float, default=PEER_PARK_AFTER,
+                        help="thread engine: seconds a silent peer keeps its own reader thread before it is parked "
+                             "in a shared selector thread (0 = one reader thread per peer always)")
+    parser.add_argument('--profile-path', default=PROFILE_PATH, metavar='PREFIX',
+                        help="file prefix for runtime profiles started by SIGUSR1 or the PROFILE control command "
+                             "(writes PREFIX-<time>.folded stacks and .folded.timings per-frame stage timings)")
+    parser.add_argument('--profile-seconds', type=int, default=PROFILE_SECONDS,
+                        help="length of a profile started by SIGUSR1")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    SERVER_CONTROL_PORT = args.control_port
+    PORT_POOL_START, PORT_POOL_END = (int(port) for port in args.port_range.split('-'))
+    PEER_QUEUE_MAX_BYTES = args.peer_queue_bytes
+    PEER_OVERFLOW_POLICY = args.overflow_policy
+    TUNNEL_FLUSH_WINDOW_US = args.flush_us
+    FAIR_QUANTUM = args.fair_quantum
+    FAIR_BATCH_BYTES = args.fair_batch_bytes
+    FAIR_PLAYER_MAX_BYTES = args.fair_player_bytes
+    try:
+        FAIR_SERVICE_WEIGHTS = parse_fair_weights(args.fair_weight)
+    except ValueError as e:
+        raise SystemExit(f"[!] --fair-weight: {e}")
+    SHARED_PORT = args.shared_port
+    HOST_RESUME_GRACE = args.resume_grace
+    MAX_HOST_STRIPES = args.max_stripes
+    STRIPE_PIN_POLICY = args.stripe_policy
+    COMPRESSION_ALLOWED = not args.no_compression
+    UDP_SESSION_IDLE_TIMEOUT = args.udp_idle_timeout
+    METRICS_PORT = args.metrics_port
+    HOST_WAIT_TIMEOUT = args.host_wait_timeout
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    HEARTBEAT_MISSES = max(1, args.heartbeat_misses)
+    TCP_KEEPALIVE_IDLE = args.keepalive_idle
+    TCP_KEEPALIVE_INTERVAL = args.keepalive_interval
+    TCP_KEEPALIVE_COUNT = args.keepalive_count
+    WORKER_COUNT = max(1, args.workers)
+    try:
+        TUNNEL_LIMITS = parse_limit_fields(dict(item.partition('=')[::2] for item in args.limit))
+    except ValueError as e:
+        raise SystemExit(f"[!] --limit: {e}")
+    LIMIT_ADMIN_TOKEN = args.admin_token
+    CAPTURE_PATH = args.capture
+    CAPTURE_PAYLOAD = args.capture_payload
+    DIRECT_ALLOWED = not args.no_direct
+    DIRECT_OPEN_TIMEOUT = args.direct_timeout
+    PEER_READ_MAX_BYTES = max(1, args.peer_read_max)
+    try:
+        SOCKET_BUFFERS = parse_socket_buffers(args.socket_buffer, ('peer', 'tunnel'))
+    except ValueError as e:
+        raise SystemExit(f"[!] --socket-buffer: {e}")
+    MAX_TUNNEL_SERVICES = max(1, args.max_services)
+    PEER_ACCEPT_BACKLOG = max(1, args.accept_backlog)
+    PEER_PENDING_PER_IP = max(0, args.max_pending_per_ip)
+    PEER_LOG_PER_SECOND = max(0, args.peer_log_rate)
+    if args.directory:
+        directory_host, _, directory_port = args.directory.rpartition(':')
+        if not directory_host or not directory_port.isdigit():
+            raise SystemExit("[!] --directory must be HOST:PORT")
+        DIRECTORY_ADDR = (directory_host, int(directory_port))
+    NODE_NAME = args.node_name
+    NODE_ADVERTISE_HOST = args.advertise_host
+    DIRECTORY_TOKEN = args.directory_token
+    LOAD_REPORT_INTERVAL = max(0.1, args.load_report_interval)
+    PEER_PARK_AFTER = max(0, args.park_idle_after)
+    PROFILE_PATH = args.profile_path
+    PROFILE_SECONDS = max(1, args.profile_seconds)
+    if args.worker_link:
+        # [ใหม่] process นี้คือ worker ที่ Supervisor เริ่ม: slice คำนวณจาก --port-range/--workers ชุดเดียวกับ Supervisor
+        index, link_fd, stats_fd = (int(value) for value in args.worker_link.split(':'))
+        slices = split_port_pool(WORKER_COUNT)
+        run_worker(index, slices[index], socket.socket(fileno=link_fd), socket.socket(fileno=stats_fd), args.engine, slices)
+    else:
+        main(engine=args.engine)